@@ -8,17 +8,28 @@ custom Synspec routines, repackaged into HDF5 by G. Narayan.
 
 from __future__ import absolute_import
 from __future__ import unicode_literals
+import os
+import atexit
+import hashlib
+import tempfile
 import warnings
 import numpy as np
 from . import io
+from .cache import LRUCache
 import extinction
 import scipy.interpolate as spinterp
-from scipy.ndimage.filters import gaussian_filter1d
+from scipy.ndimage.filters import gaussian_filter1d, correlate1d
+from scipy.fftpack import next_fast_len
+from scipy.signal import lfilter
 from astropy.constants import c, h, k_B
 from astropy import units as u
 from six.moves import zip
 
-__all__=['WDmodel']
+__all__=['WDmodel', 'WDmodel_BoundModel', 'WDmodel_Convolver', 'WDmodel_ConvolvedGrid', 'WDmodel_Emulator', 'WDmodel_Planck', 'WDmodel_Reddening']
+
+# written after the data of a shared grid, so a grid that was not completely
+# written is never attached
+_SHARED_GRID_MARKER = b'WDmodel shared grid complete'
 
 class WDmodel(object):
     """
@@ -51,6 +62,27 @@ class WDmodel(object):
         ``'custom'`` Custom law from Jay Holberg (email, 20180424)
         ============ ==================================================
 
+    convolver : ``{'auto','direct','fft','iir'}``, optional
+        Specify the backend used for the Gaussian instrumental broadening.
+        See :py:class:`WDmodel.WDmodel.WDmodel_Convolver`. Default is
+        ``'auto'``.
+    teffbounds : None or 2-tuple, optional
+        Lower and upper bound on temperature in Kelvin. If supplied, only the
+        part of the grid needed for these bounds is read. See
+        :py:func:`WDmodel.io.read_model_grid`.
+    loggbounds : None or 2-tuple, optional
+        Lower and upper bound on surface gravity in dex
+    wavebounds : None or 2-tuple, optional
+        Lower and upper bound on wavelength in Angstrom. This must include
+        the spectrum, allowing for ``shift`` and ``rvel``, and any passbands
+        used for synthetic photometry.
+    dtype : ``{'float64', 'float32'}``, optional
+        Precision of the stored grid and of the interpolation in the grid.
+        ``float32`` halves the memory used by the grid. The rest of the model
+        and the likelihood are always computed in float64. See
+        :py:meth:`WDmodel.WDmodel.WDmodel.validate_precision`. Default is
+        ``'float64'``.
+
     Attributes
     ----------
     _lines : dict
@@ -81,6 +113,24 @@ class WDmodel(object):
     _lflux : array-like
         Array of model grid ``log10`` fluxes for interpolation, shape ``(_ntemp, _ngrav, _nwave)``
     _law : extinction function corresponding to ``rvmodel``
+    _reddening : :py:class:`WDmodel.WDmodel.WDmodel_Reddening` instance
+        Cached extinction curves for ``_law`` at the model grid wavelengths
+        ``_wave``
+    _convolver : :py:class:`WDmodel.WDmodel.WDmodel_Convolver` instance
+        Gaussian instrumental broadening with the ``convolver`` backend
+    _planck : :py:class:`WDmodel.WDmodel.WDmodel_Planck` instance
+        Unit-free Planck function used by the plasma models
+    _grid_bounds : tuple
+        The input ``teffbounds``, ``loggbounds``, ``wavebounds``
+    _dtype : :py:class:`numpy.dtype`
+        The input ``dtype``
+    _shared_grid : None or str
+        Filename of the read-only memory-mapped copy of ``_lflux`` if the
+        grid is shared between processes. See
+        :py:meth:`WDmodel.WDmodel.WDmodel.share_grid`
+    _emulator : None or :py:class:`WDmodel.WDmodel.WDmodel_Emulator` instance
+        The emulator used instead of interpolating the grid. See
+        :py:meth:`WDmodel.WDmodel.WDmodel.set_emulator`
 
     Returns
     -------
@@ -89,7 +139,8 @@ class WDmodel(object):
     Raises
     ------
     ValueError
-        If the supplied rvmodel is unknown
+        If the supplied rvmodel, convolver or dtype is unknown, or the bounds
+        do not overlap the grid
 
     Notes
     -----
@@ -109,7 +160,8 @@ class WDmodel(object):
         overhead of the public methods.
     """
 
-    def __init__(self, grid_file=None, grid_name=None, sptype=None, rvmodel='f99'):
+    def __init__(self, grid_file=None, grid_name=None, sptype=None, rvmodel='f99', convolver='auto',\
+            teffbounds=None, loggbounds=None, wavebounds=None, dtype='float64'):
         lno     = [   1    ,   2     ,    3     ,    4    ,   5      ,  6      ]
         lines   = ['alpha' , 'beta'  , 'gamma'  , 'delta' , 'epsilon', 'zeta'  ]
         H       = [6562.857, 4861.346, 4340.478 ,4101.745 , 3970.081 , 3889.056]
@@ -121,18 +173,35 @@ class WDmodel(object):
         # we're passing grid_file so we know which model to init
         self._fwhm_to_sigma = np.sqrt(8.*np.log(2.))
         self._sptype = sptype
+        self._grid_bounds = (teffbounds, loggbounds, wavebounds)
+        if dtype not in ('float64', 'float32'):
+            message = 'Grid dtype must be float64 or float32 ({})'.format(dtype)
+            raise ValueError(message)
+        self._dtype = np.dtype(dtype)
         self.__init__tlusty(grid_file=grid_file, grid_name=grid_name)
         self.__init__rvmodel(rvmodel=rvmodel)
+        self._convolver = WDmodel_Convolver(backend=convolver)
+        self._planck = WDmodel_Planck()
+
+
+    def _read_grid(self, grid_file, grid_name, dtype=None):
+        """
+        Reads the ``log10`` grid with the bounds, spectral type and ``dtype``
+        of the model. See :py:func:`WDmodel.io.read_model_grid`
+        """
+        if dtype is None:
+            dtype = self._dtype
+        teffbounds, loggbounds, wavebounds = self._grid_bounds
+        return io.read_model_grid(grid_file, grid_name, teffbounds=teffbounds, loggbounds=loggbounds,\
+                wavebounds=wavebounds, log=True, sptype=self._sptype, dtype=dtype)
 
 
     def __init__tlusty(self, grid_file=None, grid_name=None):
-        ingrid = io.read_model_grid(grid_file, grid_name)
-        self._grid_file, self._grid_name, self._wave, self._ggrid, self._tgrid, _flux, self._negrid = ingrid
+        ingrid = self._read_grid(grid_file, grid_name)
+        self._grid_file, self._grid_name, self._wave, self._ggrid, self._tgrid, self._lflux, self._negrid = ingrid
         self._lwave = np.log10(self._wave, dtype=np.float64)
-        if self._sptype in ('emission', 'transmission'):
-            self._lflux = _flux.T*np.log10(np.e)  # file opacities are ln opacity
-        else:
-            self._lflux = np.log10(_flux.T)
+        self._shared_grid = None
+        self._emulator = None
         self._ntemp = len(self._tgrid)
         self._ngrav = len(self._ggrid)
         self._nwave = len(self._wave)
@@ -145,7 +214,7 @@ class WDmodel(object):
                 self._lflux)
 
         # interpolation to get ne from rho (ggrid) and T (tgrid)
-        if grid_file == 'TlustyPlasmaGrids.hdf5':
+        if self._negrid is not None:
             self._splrhoT_ne = spinterp.RectBivariateSpline(self._ggrid, self._tgrid, self._negrid)
 
 
@@ -164,6 +233,7 @@ class WDmodel(object):
         else:
             message = 'Unknown reddening law {}'.format(rvmodel)
             raise ValueError(message)
+        self._reddening = WDmodel_Reddening(self._law, self._wave)
 
 
     def _custom_extinction(self, wave, av, rv=3.1, unit='aa'):
@@ -265,11 +335,18 @@ class WDmodel(object):
         Notes
         -----
             ``av`` and ``flux`` should be >= 0.
+
+            ``flux`` is reddened in place. If ``wave`` is the model grid
+            wavelength array :py:attr:`WDmodel.WDmodel.WDmodel._wave`, the
+            cached extinction curves of
+            :py:attr:`WDmodel.WDmodel.WDmodel._reddening` are used.
         """
+        if wave is self._wave:
+            return self._reddening.apply(flux, av, rv)
         return extinction.apply(self.extinction(wave, av, rv), flux, inplace=True)
 
 
-    def plancklam(self, wave, T):
+    def plancklam(self, wave, T, cache=False):
         """
         Returns the Planck function, B_lambda(T)
 
@@ -278,18 +355,36 @@ class WDmodel(object):
         wave : array-like
             Array of wavelengths in Angstrom at which to compute extinction,
             sorted in ascending order
-        T : float
-            Temperature in Kelvin
+        T : float or array-like
+            Temperature in Kelvin. Arrays are broadcast against ``wave``.
+        cache : bool, optional
+            Cache the result for ``wave``. Only set for wavelength arrays that
+            are reused and never modified, such as the model grid wavelengths.
+            Default is ``False``
 
 
         Returns
         -------
         out : array-like
-            The Planck function in erg/s/cm^2/Ang
+            The Planck function in erg/s/cm^2/Ang. Must not be modified if
+            ``cache`` is set.
 
         Notes
         -----
-            .
+            Uses the unit-free, cached
+            :py:class:`WDmodel.WDmodel.WDmodel_Planck`.
+        """
+        return self._planck(wave, T, cache=cache)
+
+
+    def _plancklam_units(self, wave, T):
+        """
+        Returns the Planck function, B_lambda(T), computed with
+        :py:mod:`astropy.units`
+
+        Not used by the model, but serves as the reference the output of
+        :py:func:`WDmodel.WDmodel.WDmodel.plancklam` is tested against. See
+        that method for a description of the parameters.
         """
 
         wave = (wave*u.Angstrom).to(u.m)
@@ -328,7 +423,7 @@ class WDmodel(object):
         return rho*opac*length
 
 
-    def plasma(self, wave, opac, rho, T, length=12.):
+    def plasma(self, wave, opac, rho, T, length=12., cache=False):
         """
         Uses opacity grid to calculate transmission or, along with the
         blackbody function defined in
@@ -348,6 +443,9 @@ class WDmodel(object):
             plasma temperature (K)
         length : float, optional
             The plasma length in cm. Default is 12 cm.
+        cache : bool, optional
+            Cache the Planck function for ``wave``. See
+            :py:func:`WDmodel.WDmodel.WDmodel.plancklam`. Default is ``False``
 
         Returns
         -------
@@ -366,7 +464,7 @@ class WDmodel(object):
         if self._sptype == 'transmission':
             return trans
 
-        B_lam = self.plancklam(wave, T)
+        B_lam = self.plancklam(wave, T, cache=cache)
         emiss = B_lam*(1. - trans)
 
         return emiss
@@ -483,6 +581,8 @@ class WDmodel(object):
             :py:attr:`WDmodel.WDmodel.WDmodel._tgrid`, for grid locations and
             limits.
         """
+        if self._emulator is not None:
+            return self._emulator._get_model(teff, logg, wave=wave, log=log)
         xi = (teff, logg)
         out = self._model(xi)
         if wave is not None:
@@ -494,6 +594,183 @@ class WDmodel(object):
         return (10.**out)
 
 
+    def _get_grid_weights(self, teff, logg):
+        """
+        Returns the lower grid indices and fractional distances of ``teff``
+        and ``logg`` within the model grid
+
+        Replicates the bracketing used by
+        :py:class:`scipy.interpolate.RegularGridInterpolator` so that a
+        bilinear interpolation constructed from the output is identical to
+        :py:func:`WDmodel.WDmodel.WDmodel._get_model`.
+
+        Parameters
+        ----------
+        teff : float
+            Desired model white dwarf atmosphere temperature (in Kelvin)
+        logg : float
+            Desired model white dwarf atmosphere surface gravity (in dex)
+
+        Returns
+        -------
+        it : int
+            Index of the grid temperature at or below ``teff``
+        ig : int
+            Index of the grid surface gravity at or below ``logg``
+        tfac : float
+            Fractional distance of ``teff`` between ``_tgrid[it]`` and ``_tgrid[it+1]``
+        gfac : float
+            Fractional distance of ``logg`` between ``_ggrid[ig]`` and ``_ggrid[ig+1]``
+
+        Raises
+        ------
+        ValueError
+            If ``teff`` or ``logg`` are out of range of the model grid
+        """
+        if not ((self._tgrid[0] <= teff <= self._tgrid[-1]) and (self._ggrid[0] <= logg <= self._ggrid[-1])):
+            message = 'One of the requested teff, logg = ({}, {}) is out of bounds of the model grid'.format(teff, logg)
+            raise ValueError(message)
+        it = min(max(int(np.searchsorted(self._tgrid, teff)) - 1, 0), self._ntemp - 2)
+        ig = min(max(int(np.searchsorted(self._ggrid, logg)) - 1, 0), self._ngrav - 2)
+        tfac = (teff - self._tgrid[it])/(self._tgrid[it+1] - self._tgrid[it])
+        gfac = (logg - self._ggrid[ig])/(self._ggrid[ig+1] - self._ggrid[ig])
+        return it, ig, tfac, gfac
+
+
+    def _get_grid_model(self, teff, logg, lo=0, hi=None):
+        """
+        Returns the bilinearly interpolated ``log10`` model flux at ``teff``,
+        ``logg`` on the model grid wavelengths ``_wave[lo:hi]``
+
+        The interpolation is done in the precision of the grid,
+        :py:attr:`_dtype`, or by the emulator if one is set.
+        """
+        if self._emulator is not None:
+            return self._emulator._get_grid_model(teff, logg, lo, hi)
+        it, ig, tfac, gfac = self._get_grid_weights(teff, logg)
+        lflux = self._lflux
+        dt = lflux.dtype.type
+        otfac = 1. - tfac
+        ogfac = 1. - gfac
+        out  = lflux[it,   ig,   lo:hi]*dt(otfac*ogfac)
+        out += lflux[it+1, ig,   lo:hi]*dt(tfac*ogfac)
+        out += lflux[it,   ig+1, lo:hi]*dt(otfac*gfac)
+        out += lflux[it+1, ig+1, lo:hi]*dt(tfac*gfac)
+        return out
+
+
+    def _get_grid_model_grad(self, teff, logg, lo=0, hi=None):
+        """
+        Returns the bilinearly interpolated ``log10`` model flux at ``teff``,
+        ``logg`` on the model grid wavelengths ``_wave[lo:hi]`` and its
+        partial derivatives with respect to ``teff`` and ``logg``
+
+        The derivatives are those of the bilinear interpolant within the grid
+        cell containing ``teff``, ``logg``, so they are discontinuous across
+        the grid nodes. Computed in double precision, or by the emulator if
+        one is set.
+
+        Returns
+        -------
+        lflux : array-like
+            Interpolated ``log10`` model flux, as
+            :py:func:`WDmodel.WDmodel.WDmodel._get_grid_model`
+        dteff : array-like
+            Partial derivative of ``lflux`` with respect to ``teff``
+        dlogg : array-like
+            Partial derivative of ``lflux`` with respect to ``logg``
+        """
+        if self._emulator is not None:
+            return self._emulator._get_grid_model_grad(teff, logg, lo, hi)
+        it, ig, tfac, gfac = self._get_grid_weights(teff, logg)
+        lflux = self._lflux
+        f00 = lflux[it,   ig,   lo:hi].astype('float64')
+        f10 = lflux[it+1, ig,   lo:hi].astype('float64')
+        f01 = lflux[it,   ig+1, lo:hi].astype('float64')
+        f11 = lflux[it+1, ig+1, lo:hi].astype('float64')
+        otfac = 1. - tfac
+        ogfac = 1. - gfac
+        out   = f00*(otfac*ogfac) + f10*(tfac*ogfac) + f01*(otfac*gfac) + f11*(tfac*gfac)
+        dteff = ((f10 - f00)*ogfac + (f11 - f01)*gfac)/(self._tgrid[it+1] - self._tgrid[it])
+        dlogg = ((f01 - f00)*otfac + (f11 - f10)*tfac)/(self._ggrid[ig+1] - self._ggrid[ig])
+        return out, dteff, dlogg
+
+
+    def _get_grid_weights_batch(self, teff, logg):
+        """
+        Returns the lower grid indices and fractional distances of arrays of
+        ``teff`` and ``logg`` within the model grid
+
+        Vectorized version of
+        :py:func:`WDmodel.WDmodel.WDmodel._get_grid_weights`.
+
+        Parameters
+        ----------
+        teff : array-like
+            Desired model white dwarf atmosphere temperatures (in Kelvin)
+        logg : array-like
+            Desired model white dwarf atmosphere surface gravities (in dex)
+
+        Returns
+        -------
+        it : array-like
+            Indices of the grid temperatures at or below ``teff``
+        ig : array-like
+            Indices of the grid surface gravities at or below ``logg``
+        tfac : array-like
+            Fractional distances of ``teff`` between ``_tgrid[it]`` and ``_tgrid[it+1]``
+        gfac : array-like
+            Fractional distances of ``logg`` between ``_ggrid[ig]`` and ``_ggrid[ig+1]``
+
+        Raises
+        ------
+        ValueError
+            If any ``teff`` or ``logg`` are out of range of the model grid
+        """
+        teff = np.atleast_1d(np.asarray(teff, dtype=np.float64))
+        logg = np.atleast_1d(np.asarray(logg, dtype=np.float64))
+        if not (np.all((teff >= self._tgrid[0]) & (teff <= self._tgrid[-1])) and\
+                np.all((logg >= self._ggrid[0]) & (logg <= self._ggrid[-1]))):
+            message = 'One of the requested teff, logg is out of bounds of the model grid'
+            raise ValueError(message)
+        it = np.clip(np.searchsorted(self._tgrid, teff) - 1, 0, self._ntemp - 2)
+        ig = np.clip(np.searchsorted(self._ggrid, logg) - 1, 0, self._ngrav - 2)
+        tfac = (teff - self._tgrid[it])/(self._tgrid[it+1] - self._tgrid[it])
+        gfac = (logg - self._ggrid[ig])/(self._ggrid[ig+1] - self._ggrid[ig])
+        return it, ig, tfac, gfac
+
+
+    def _get_resample_table(self, wave):
+        """
+        Returns the indices and weights to linearly interpolate a model on the
+        grid wavelengths onto ``wave`` in ``log10`` wavelength
+
+        Replicates the bracketing and edge behavior of :py:func:`numpy.interp`
+        on :py:attr:`WDmodel.WDmodel.WDmodel._lwave`.
+
+        Parameters
+        ----------
+        wave : array-like
+            Wavelengths in Angstrom. May be multi-dimensional.
+
+        Returns
+        -------
+        ind : array-like
+            Index of the grid wavelength at or below each element of ``wave``
+        frac : array-like
+            Fractional distance of ``log10(wave)`` between ``_lwave[ind]`` and
+            ``_lwave[ind+1]``
+        """
+        lwave = np.log10(wave)
+        gwave = self._lwave
+        ind   = np.searchsorted(gwave, lwave, side='right') - 1
+        np.clip(ind, 0, self._nwave - 2, out=ind)
+        dw    = gwave[ind+1] - gwave[ind]
+        frac  = np.divide(lwave - gwave[ind], dw, out=np.zeros_like(lwave), where=dw > 0)
+        np.clip(frac, 0., 1., out=frac)
+        return ind, frac
+
+
     def _get_ne(self, rho, Te):
         """
         Returns the electron density, ne, given ``Te`` and ``rho``
@@ -620,7 +897,7 @@ class WDmodel(object):
         unreddened model, and reddens it with
         :py:func:`WDmodel.WDmodel.WDmodel.reddening` and convolves it with a
         Gaussian kernel using
-        :py:func:`scipy.ndimage.filters.gaussian_filter1d`
+        :py:meth:`WDmodel.WDmodel.WDmodel_Convolver.convolve`
 
         Parameters
         ----------
@@ -678,7 +955,7 @@ class WDmodel(object):
         if self._sptype in ('emission', 'transmission'):
             mod = self.plasma(wave, mod, logg, teff, length)
         gsig = fwhm/self._fwhm_to_sigma * pixel_scale
-        mod = gaussian_filter1d(mod, gsig, order=0, mode='nearest')
+        mod = self._convolver.convolve(mod, gsig)
         if log:
             mod = np.log10(mod)
         return mod
@@ -699,7 +976,7 @@ class WDmodel(object):
         unreddened model, and reddens it with
         :py:func:`WDmodel.WDmodel.WDmodel.reddening` and convolves it with a
         Gaussian kernel using
-        :py:func:`scipy.ndimage.filters.gaussian_filter1d`
+        :py:meth:`WDmodel.WDmodel.WDmodel_Convolver.convolve`
 
         Parameters
         ----------
@@ -764,11 +1041,11 @@ class WDmodel(object):
         mod  = self._get_model(teff, logg)
         mod  = self.reddening(self._wave, mod, av, rv=rv)
         if self._sptype in ('emission', 'transmission'):
-            mod = self.plasma(self._wave, mod, logg, teff, length)
+            mod = self.plasma(self._wave, mod, logg, teff, length, cache=True)
         omod = np.interp(np.log10(wave), self._lwave, np.log10(mod))
         omod = 10.**omod
         gsig = fwhm/self._fwhm_to_sigma * pixel_scale
-        omod = gaussian_filter1d(omod, gsig, order=0, mode='nearest')
+        omod = self._convolver.convolve(omod, gsig)
         if log:
             omod = np.log10(omod)
             mod  = np.log10(mod)
@@ -778,6 +1055,276 @@ class WDmodel(object):
         return omod, mod
 
 
+    def _get_obs_model_grad(self, teff, logg, av, fwhm, wave, shift, rvel, rv=3.1, pixel_scale=1.):
+        """
+        Returns the observed model flux at wavelengths ``wave`` and its
+        partial derivatives with respect to ``teff``, ``logg``, ``av``,
+        ``rv``, ``fwhm``, ``shift`` and ``rvel``
+
+        Binds the model to ``wave`` and uses
+        :py:func:`WDmodel.WDmodel.WDmodel_BoundModel._get_obs_model_grad`.
+        When evaluating the gradient repeatedly at the same wavelengths, bind
+        the model with :py:meth:`bind` once instead.
+
+        Returns
+        -------
+        flux : array-like
+            The observed model flux at ``wave``
+        dflux : array-like
+            Array of shape ``(7, len(wave))`` with the partial derivatives of
+            ``flux`` with respect to the parameters in
+            :py:attr:`WDmodel.WDmodel.WDmodel_BoundModel._grad_names`
+        """
+        bmodel = self.bind(wave, pixel_scale=pixel_scale)
+        return bmodel._get_obs_model_grad(teff, logg, av, fwhm, shift, rvel, rv=rv)
+
+
+    def _get_extinction_batch(self, wave, av, rv):
+        """
+        Returns the extinction for arrays of ``av``, ``rv`` at each row of
+        wavelengths ``wave``
+
+        The extinction laws are linear in ``av``, so the law is evaluated once
+        for ``av = 1`` for each unique combination of wavelength row and
+        ``rv``, and scaled.
+
+        Parameters
+        ----------
+        wave : array-like
+            Wavelengths in Angstrom, shape ``(N, nwave)`` or ``(nwave,)``
+        av : array-like
+            Extinction in the V band, :math:`A_V`, shape ``(N,)``
+        rv : array-like
+            The reddening law parameter, :math:`R_V`, shape ``(N,)``
+
+        Returns
+        -------
+        out : array-like
+            Extinction, shape ``(N, nwave)``
+
+        Notes
+        -----
+            If ``wave`` is the model grid wavelength array
+            :py:attr:`WDmodel.WDmodel.WDmodel._wave`, the cached extinction
+            curves of :py:attr:`WDmodel.WDmodel.WDmodel._reddening` are used.
+        """
+        av = np.atleast_1d(av)
+        rv = np.broadcast_to(rv, av.shape)
+        if wave is self._wave:
+            out = np.empty((len(av), self._nwave))
+            for i in range(len(av)):
+                out[i] = self._reddening.get_curve(rv[i])
+            out *= av[:, np.newaxis]
+            return out
+
+        wave = np.atleast_2d(wave)
+        shared = (wave.shape[0] == 1)
+        out = np.empty((len(av), wave.shape[1]))
+        curves = {}
+        for i in range(len(av)):
+            row = 0 if shared else i
+            # rows are the same wavelengths with different shifts, so the end
+            # points identify the row
+            key = (wave[row, 0], wave[row, -1], rv[i])
+            curve = curves.get(key)
+            if curve is None:
+                curve = self._law(np.ascontiguousarray(wave[row]), 1., rv[i], unit='aa')
+                curves[key] = curve
+            out[i] = curve
+        out *= av[:, np.newaxis]
+        return out
+
+
+    def _convolve_batch(self, mod, gsig):
+        """
+        Convolves each row of ``mod`` with a Gaussian kernel of width ``gsig``
+
+        Rows with the same kernel width are convolved together.
+
+        Parameters
+        ----------
+        mod : array-like
+            Array of fluxes, shape ``(N, nwave)``
+        gsig : array-like
+            Gaussian kernel standard deviation in pixels, shape ``(N,)``
+
+        Returns
+        -------
+        out : array-like
+            The convolved fluxes
+        """
+        gsig = np.broadcast_to(gsig, (mod.shape[0],))
+        out  = np.empty_like(mod)
+        for sig in np.unique(gsig):
+            rows = (gsig == sig)
+            out[rows] = self._convolver.convolve(mod[rows], sig)
+        return out
+
+
+    def _get_obs_model_batch(self, teff, logg, av, fwhm, wave, shift, rvel, rv=3.1, log=False, pixel_scale=1., length=12.):
+        """
+        Returns the observed model flux for arrays of ``teff``, ``logg``,
+        ``av``, ``rv``, ``fwhm``, ``shift``, ``rvel`` at wavelengths ``wave``
+
+        Vectorized version of :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model`
+        that evaluates ``N`` parameter vectors at once. Interpolation in the
+        grid and resampling onto the shifted wavelengths is done as a single
+        gather from the grid, the cached extinction curve of
+        :py:attr:`WDmodel.WDmodel.WDmodel._reddening` for each unique ``rv`` is
+        resampled with the same tables, and rows with the same ``fwhm`` are
+        convolved together.
+
+        Parameters
+        ----------
+        teff : array-like
+            Desired model white dwarf atmosphere temperatures (in Kelvin)
+        logg : array-like
+            Desired model white dwarf atmosphere surface gravities (in dex)
+        av : array-like
+            Extinction in the V band, :math:`A_V`
+        fwhm : array-like
+            Instrumental FWHM in Angstrom
+        wave : array-like
+            Desired wavelengths at which to compute the model atmosphere flux.
+        shift : array-like
+            Linear wavelength shift in Angstroms
+        rvel : array-like
+            Radial velocity shift in km/s
+        rv : array-like, optional
+            The reddening law parameter, :math:`R_V`. Default is ``3.1``
+        log : bool, optional
+            Return the log10 flux, rather than the flux
+        pixel_scale : float, optional
+            Jacobian of the transformation between wavelength in Angstrom and
+            pixels. Default is ``1.``
+        length : array-like, optional
+            Length of plasma used to compute plasma spectrum. Default is ``12.``
+
+        Returns
+        -------
+        flux : array-like
+            Observed model flux with shape ``(N, len(wave))``. Row ``i`` is the
+            same as the output of
+            :py:func:`WDmodel.WDmodel.WDmodel_BoundModel._get_obs_model` for
+            the ``i``-th element of the parameter arrays.
+
+        Notes
+        -----
+            All parameter arrays are broadcast to the length of ``teff``.
+            Inputs must be within the bounds of the grid. See
+            :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model`.
+        """
+        teff = np.atleast_1d(np.asarray(teff, dtype=np.float64))
+        nrow = len(teff)
+        logg, av, fwhm, shift, rvel, rv, length = [np.broadcast_to(np.asarray(x, dtype=np.float64), (nrow,))\
+                for x in (logg, av, fwhm, shift, rvel, rv, length)]
+        wave = np.asarray(wave, dtype=np.float64)
+
+        owave = wave[np.newaxis, :]*(1. - rvel[:, np.newaxis]*1000./c.value) - shift[:, np.newaxis]
+        ind, frac = self._get_resample_table(owave)
+        if self._emulator is not None:
+            lmod  = self._emulator._get_grid_model_batch(teff, logg)
+            rows  = np.arange(nrow)[:, np.newaxis]
+            lower = lmod[rows, ind]
+            ind  += 1
+            upper = lmod[rows, ind]
+        else:
+            it, ig, tfac, gfac = self._get_grid_weights_batch(teff, logg)
+            it = it[:, np.newaxis]
+            ig = ig[:, np.newaxis]
+            w00 = ((1. - tfac)*(1. - gfac))[:, np.newaxis]
+            w10 = (tfac*(1. - gfac))[:, np.newaxis]
+            w01 = ((1. - tfac)*gfac)[:, np.newaxis]
+            w11 = (tfac*gfac)[:, np.newaxis]
+            lflux = self._lflux
+            lower = lflux[it, ig, ind]*w00 + lflux[it+1, ig, ind]*w10 + lflux[it, ig+1, ind]*w01 + lflux[it+1, ig+1, ind]*w11
+            ind  += 1
+            upper = lflux[it, ig, ind]*w00 + lflux[it+1, ig, ind]*w10 + lflux[it, ig+1, ind]*w01 + lflux[it+1, ig+1, ind]*w11
+        mod = 10.**(lower + (upper - lower)*frac)
+
+        # resample the cached extinction curve on the grid with the same
+        # tables, as WDmodel_BoundModel._redden does
+        ext = np.empty_like(mod)
+        for thisrv in np.unique(rv):
+            rows  = (rv == thisrv)
+            curve = self._reddening.get_curve(thisrv)
+            elo   = curve[ind[rows]-1]
+            ext[rows] = elo + (curve[ind[rows]] - elo)*frac[rows]
+        mod *= np.exp(ext*(WDmodel_Reddening._lnscale*av[:, np.newaxis]))
+        if self._sptype in ('emission', 'transmission'):
+            mod = self.plasma(owave, mod, logg[:, np.newaxis], teff[:, np.newaxis], length[:, np.newaxis])
+        gsig = fwhm/self._fwhm_to_sigma * pixel_scale
+        mod = self._convolve_batch(mod, gsig)
+        if log:
+            mod = np.log10(mod)
+        return mod
+
+
+    def _get_sed_batch(self, teff, logg, av, rv, length):
+        """
+        Returns the full reddened model SEDs on the model grid wavelengths for
+        arrays of ``teff``, ``logg``, ``av``, ``rv`` and ``length``, with
+        shape ``(len(teff), _nwave)``. All the arrays must have the same
+        length.
+        """
+        if self._emulator is not None:
+            mod  = self._emulator._get_grid_model_batch(teff, logg)
+        else:
+            self._get_grid_weights_batch(teff, logg)
+            mod  = self._model(np.column_stack((teff, logg)))
+        mod  = 10.**mod
+        mod *= 10.**(-0.4*self._get_extinction_batch(self._wave, av, rv))
+        if self._sptype in ('emission', 'transmission'):
+            mod = self.plasma(self._wave, mod, logg[:, np.newaxis], teff[:, np.newaxis], length[:, np.newaxis], cache=True)
+        return mod
+
+
+    def _get_full_obs_model_batch(self, teff, logg, av, fwhm, wave, shift, rvel, rv=3.1, log=False, pixel_scale=1., length=12.):
+        """
+        Returns the observed model flux for arrays of ``teff``, ``logg``,
+        ``av``, ``rv``, ``fwhm``, ``shift``, ``rvel`` at wavelengths ``wave``
+        as well as the full SEDs
+
+        Vectorized version of
+        :py:func:`WDmodel.WDmodel.WDmodel._get_full_obs_model`. See
+        :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model_batch` for a
+        description of the parameters.
+
+        Returns
+        -------
+        flux : array-like
+            Observed model flux with shape ``(N, len(wave))``
+        mod : :py:class:`numpy.recarray` with ``dtype=[('wave', '<f8'), ('flux', '<f8')]``
+            Full model SEDs with shape ``(N, _nwave)``. Row ``i`` is the same
+            as the full SED returned by
+            :py:func:`WDmodel.WDmodel.WDmodel._get_full_obs_model` for the
+            ``i``-th element of the parameter arrays.
+        """
+        teff = np.atleast_1d(np.asarray(teff, dtype=np.float64))
+        nrow = len(teff)
+        logg, av, fwhm, shift, rvel, rv, length = [np.broadcast_to(np.asarray(x, dtype=np.float64), (nrow,))\
+                for x in (logg, av, fwhm, shift, rvel, rv, length)]
+        wave = np.asarray(wave, dtype=np.float64)
+
+        owave = wave[np.newaxis, :]*(1. - rvel[:, np.newaxis]*1000./c.value) - shift[:, np.newaxis]
+        mod = self._get_sed_batch(teff, logg, av, rv, length)
+        ind, frac = self._get_resample_table(owave)
+        lmod  = np.log10(mod)
+        rows  = np.arange(nrow)[:, np.newaxis]
+        lower = lmod[rows, ind]
+        upper = lmod[rows, ind+1]
+        omod  = 10.**(lower + (upper - lower)*frac)
+        gsig  = fwhm/self._fwhm_to_sigma * pixel_scale
+        omod  = self._convolve_batch(omod, gsig)
+        if log:
+            omod = np.log10(omod)
+            mod  = lmod
+        names=str('wave,flux')
+        wout = self._wave[np.newaxis, :]*(1. + rvel[:, np.newaxis]*1000./c.value) + shift[:, np.newaxis]
+        mod = np.rec.fromarrays((wout, mod), names=names)
+        return omod, mod
+
+
     @classmethod
     def _wave_test(cls, wave):
         """
@@ -963,7 +1510,7 @@ class WDmodel(object):
 
         Uses :py:func:`WDmodel.WDmodel.WDmodel.get_red_model` to get the
         reddened model and convolves it with a Gaussian kernel using
-        :py:func:`scipy.ndimage.filters.gaussian_filter1d`
+        :py:meth:`WDmodel.WDmodel.WDmodel_Convolver.convolve`
 
         Parameters
         ----------
@@ -1025,12 +1572,78 @@ class WDmodel(object):
             raise ValueError(message)
 
         gsig = fwhm/self._fwhm_to_sigma * pixel_scale
-        modflux = gaussian_filter1d(modflux, gsig, order=0, mode='nearest')
+        modflux = self._convolver.convolve(modflux, gsig)
         if log:
             modflux = np.log10(modflux)
         return modwave, modflux
 
 
+    def get_obs_model_batch(self, theta_matrix, wave, log=False, pixel_scale=1.):
+        """
+        Returns the observed model flux for a matrix of parameter vectors at
+        wavelengths ``wave``
+
+        Wraps :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model_batch` adding
+        checking of inputs.
+
+        Parameters
+        ----------
+        theta_matrix : array-like
+            Array of shape ``(N, 8)`` with columns ``teff``, ``logg``, ``av``,
+            ``rv``, ``fwhm``, ``shift``, ``rvel``, ``length`` i.e. the model
+            parameters in the order of
+            :py:data:`WDmodel.io._PARAMETER_NAMES`
+        wave : array-like
+            Desired wavelengths at which to compute the model atmosphere flux.
+        log : bool, optional
+            Return the log10 flux, rather than the flux
+        pixel_scale : float, optional
+            Jacobian of the transformation between wavelength in Angstrom and
+            pixels. Default is ``1.``
+
+        Returns
+        -------
+        flux : array-like
+            Observed model flux with shape ``(N, len(wave))``
+
+        Raises
+        ------
+        ValueError
+            If ``theta_matrix`` does not have 8 columns, any ``teff`` or
+            ``logg`` are out of range of the model grid, any ``av < 0``, any
+            ``rv`` not in ``[1.7, 5.1]``, any ``fwhm <= 0``, ``pixel_scale <=
+            0`` or if there are any invalid wavelengths
+        """
+        theta_matrix = np.atleast_2d(np.asarray(theta_matrix, dtype=np.float64))
+        if theta_matrix.ndim != 2 or theta_matrix.shape[1] != 8:
+            message = 'theta_matrix must have shape (N, 8) with columns teff, logg, av, rv, fwhm, shift, rvel, length'
+            raise ValueError(message)
+        teff, logg, av, rv, fwhm, shift, rvel, length = theta_matrix.T
+
+        wave = np.atleast_1d(wave)
+        self._wave_test(wave)
+
+        if np.any(av < 0):
+            message = 'Av must be positive'
+            raise ValueError(message)
+
+        if np.any((rv < 1.7) | (rv > 5.1)):
+            message = 'Rv must be in [1.7, 5.1]'
+            raise ValueError(message)
+
+        if np.any(fwhm <= 0):
+            message = 'FWHM must be strictly positive'
+            raise ValueError(message)
+
+        pixel_scale = float(pixel_scale)
+        if pixel_scale <= 0:
+            message = 'Pixel scale must be strictly positive'
+            raise ValueError(message)
+
+        return self._get_obs_model_batch(teff, logg, av, fwhm, wave, shift, rvel,\
+                rv=rv, log=log, pixel_scale=pixel_scale, length=length)
+
+
     @classmethod
     def _get_indices_in_range(cls, wave, WA, WB, W0=None):
         """
@@ -1242,14 +1855,2427 @@ class WDmodel(object):
         return self._extract_from_indices(w, f, ZE, df=df)
 
 
-    # these are implemented for compatibility with python's pickle
-    # which in turn is required to make the code work with MPI
-    def __getstate__(self):
-        return self.__dict__
+    def bind(self, wave, pixel_scale=1., cache=None):
+        """
+        Returns a forward model bound to the wavelength array ``wave``
+
+        Parameters
+        ----------
+        wave : array-like
+            Wavelengths at which the observed model will be repeatedly
+            evaluated - typically the spectrum wavelengths ``spec.wave``
+        pixel_scale : float, optional
+            Jacobian of the transformation between wavelength in Angstrom and
+            pixels. Default is ``1.``
+        cache : None or :py:class:`WDmodel.cache.WDmodel_StageCache` instance, optional
+            If supplied, the intermediate stages of the model are cached.
 
+        Returns
+        -------
+        out : :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` instance
 
-    def __setstate__(self, d):
-        self.__dict__.update(d)
+        See Also
+        --------
+        :py:class:`WDmodel.WDmodel.WDmodel_BoundModel`
+        """
+        return WDmodel_BoundModel(self, wave, pixel_scale=pixel_scale, cache=cache)
 
 
-    __call__ = get_model
+    def _get_shared_grid_name(self, shared_dir):
+        """
+        Returns the filename of the shared grid in ``shared_dir``
+
+        The name is a hash of the grid file, its size and modification time,
+        the grid name, the spectral type, the grid bounds and type, so processes
+        using the same grid find the same file, and a modified grid file is
+        never matched to a stale shared grid.
+        """
+        grid_file = os.path.abspath(self._grid_file)
+        stat = os.stat(grid_file)
+        key = '{}:{}:{}:{}:{}:{}:{}'.format(grid_file, stat.st_size, stat.st_mtime, self._grid_name, self._sptype,\
+                self._grid_bounds, self._dtype)
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return os.path.join(shared_dir, 'WDmodel_grid_{}.npy'.format(digest))
+
+
+    def _attach_grid(self):
+        """
+        Memory maps the shared grid :py:attr:`_shared_grid`, creating it from
+        :py:attr:`_lflux` or the grid file if it does not exist on this node,
+        and reinitializes the interpolator to use it
+        """
+        shape = (self._ntemp, self._ngrav, self._nwave)
+        lflux = None
+        if os.path.exists(self._shared_grid):
+            lflux = _load_shared_grid(self._shared_grid, shape)
+
+        if lflux is None:
+            lflux = self._lflux
+            if lflux is None:
+                # unpickled on a node without the shared grid
+                lflux = self._read_grid(self._grid_file, self._grid_name)[5]
+            # another process may be writing the same grid, so write to a
+            # private file and atomically rename it into place, replacing
+            # any incomplete grid left by a process that crashed
+            tmpfile = '{}.{}.tmp'.format(self._shared_grid, os.getpid())
+            try:
+                with open(tmpfile, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(lflux))
+                    f.write(_SHARED_GRID_MARKER)
+                os.rename(tmpfile, self._shared_grid)
+            except (IOError, OSError):
+                _remove_shared_grid(tmpfile)
+                raise
+            atexit.register(_remove_shared_grid, self._shared_grid)
+            message = 'Wrote shared model grid {}'.format(self._shared_grid)
+            print(message)
+            lflux = np.load(self._shared_grid, mmap_mode='r')
+
+        self._lflux = np.asarray(lflux)
+        self._model = spinterp.RegularGridInterpolator((self._tgrid, self._ggrid),\
+                self._lflux)
+
+
+    def share_grid(self, shared_dir=None):
+        """
+        Moves the model grid into a read-only memory-mapped file that is
+        shared by all the processes on a node
+
+        After this, pickling the model - e.g. to send it to the workers of an
+        :py:class:`emcee.utils.MPIPool` - does not include the grid. Instead,
+        the workers attach to the shared grid by name when the model is
+        unpickled. The first process on each node to unpickle the model
+        creates the shared grid from the grid file if it does not already
+        exist.
+
+        Parameters
+        ----------
+        shared_dir : None or str, optional
+            Directory for the shared grid. It must be local to the node, and
+            must be the same path on every node. If ``None``, uses
+            ``/dev/shm`` if it exists, and the system temporary directory
+            otherwise.
+
+        Returns
+        -------
+        shared_grid : str
+            Filename of the shared grid
+
+        Raises
+        ------
+        IOError
+            If ``shared_dir`` does not exist
+        ValueError
+            If the model grid has been released by
+            :py:meth:`WDmodel.WDmodel.WDmodel.set_emulator`
+
+        Notes
+        -----
+            The process that creates the shared grid removes it when it
+            exits. Processes that have the grid mapped at that point keep
+            their mapping, and processes that attach later recreate it.
+            The shared grid ends with a completion marker after the data,
+            and a file without it, e.g. left by a process that crashed, is
+            recreated rather than attached.
+        """
+        if shared_dir is None:
+            shared_dir = '/dev/shm'
+            if not os.path.isdir(shared_dir):
+                shared_dir = tempfile.gettempdir()
+        if not os.path.isdir(shared_dir):
+            message = 'Shared grid directory {} does not exist'.format(shared_dir)
+            raise IOError(message)
+        if self._lflux is None:
+            message = 'Cannot share model grid. Model grid has been released.'
+            raise ValueError(message)
+        self._shared_grid = self._get_shared_grid_name(shared_dir)
+        self._attach_grid()
+        return self._shared_grid
+
+
+    def validate_precision(self, ntest=1000, seed=None, lflux=None, stored=True):
+        """
+        Compares a reduced precision model grid against the float64 grid
+
+        The interpolation is linear in the ``log10`` flux, so the error
+        anywhere in the grid from rounding the grid is bounded by the largest
+        rounding error at the grid nodes. The rounding error of the
+        interpolation itself is measured at ``ntest`` random ``teff``,
+        ``logg``.
+
+        Parameters
+        ----------
+        ntest : int, optional
+            Number of random parameter vectors to test the interpolation.
+            Default is ``1000``
+        seed : None or int, optional
+            Seed for the random parameter vectors
+        lflux : None or array-like, optional
+            The float64 ``log10`` flux of the model grid. If supplied, the
+            rounding error is computed at every node. If ``None``, only the
+            nodes of the grid cells of the random parameter vectors are read
+            in float64 and checked.
+        stored : bool, optional
+            Return the report stored with the grid by
+            :py:func:`WDmodel.io.write_grid_precision` for the precision of
+            the model, if there is one, instead of checking the grid.
+            Ignored if ``lflux`` is supplied. Default is ``True``
+
+        Returns
+        -------
+        report : dict
+            With keys
+
+                * ``node_dex`` - max absolute error in ``log10`` flux at the grid nodes
+                * ``interp_dex`` - max absolute error in interpolated ``log10`` flux
+                * ``flux`` - max relative error in flux
+                * ``mag`` - max error in magnitudes
+
+            ``flux`` and ``mag`` are the larger of the two errors, and bound the
+            error of the model flux at any wavelength, and so of any synthetic
+            magnitude, if every node was checked.
+
+        Notes
+        -----
+            ``convert_WDmodel_grid`` checks reduced precision grids at every
+            node when they are written, and stores the report, so loading
+            such a grid does not need the float64 grid. A stored report
+            covers the whole grid, so it also bounds the error of any part
+            of it read with bounds. Otherwise, only the nodes of at most
+            ``ntest`` cells are read. A grid
+            stored in reduced precision can only be compared against itself,
+            so without a stored report only the interpolation error is
+            measured. All errors are ``0`` for a float64 model.
+        """
+        if self._lflux is None:
+            message = 'Cannot validate precision. Model grid has been released.'
+            raise ValueError(message)
+        if lflux is None and stored:
+            report = io.read_grid_precision(self._grid_file, self._grid_name, self._dtype)
+            if report is not None:
+                return report
+
+        rng = np.random.RandomState(seed)
+        teff = rng.uniform(self._tgrid[0], self._tgrid[-1], size=ntest)
+        logg = rng.uniform(self._ggrid[0], self._ggrid[-1], size=ntest)
+        it, ig, tfac, gfac = self._get_grid_weights_batch(teff, logg)
+        if lflux is None:
+            # read each cell once, however many of the parameter vectors fall in it
+            cellid, icell = np.unique(it*self._ngrav + ig, return_inverse=True)
+            cit, cig = np.divmod(cellid, self._ngrav)
+            cells = io.read_model_grid_cells(self._grid_file, self._grid_name, self._tgrid[cit], self._ggrid[cig],\
+                    wavebounds=self._grid_bounds[2], sptype=self._sptype)
+            node_dex = 0.
+            for i, j, cell in zip(cit, cig, cells):
+                node_dex = max(node_dex, np.max(np.abs(self._lflux[i:i+2, j:j+2] - cell)))
+        else:
+            node_dex = np.max(np.abs(self._lflux - lflux))
+
+        interp_dex = 0.
+        for i in range(ntest):
+            if lflux is None:
+                cell = cells[icell[i]]
+            else:
+                cell = lflux[it[i]:it[i]+2, ig[i]:ig[i]+2]
+            ref  = cell[0, 0]*((1. - tfac[i])*(1. - gfac[i])) + cell[1, 0]*(tfac[i]*(1. - gfac[i]))\
+                    + cell[0, 1]*((1. - tfac[i])*gfac[i]) + cell[1, 1]*(tfac[i]*gfac[i])
+            out  = self._get_grid_model(teff[i], logg[i])
+            interp_dex = max(interp_dex, np.max(np.abs(out - ref)))
+
+        maxdex = max(node_dex, interp_dex)
+        report = {'node_dex':float(node_dex), 'interp_dex':float(interp_dex),\
+                'flux':float(10.**maxdex - 1.), 'mag':float(2.5*maxdex)}
+        return report
+
+
+    def _get_emulator_file(self):
+        """
+        Returns the default filename of the emulator of the model grid, next
+        to the grid file
+        """
+        root, _ = os.path.splitext(os.path.abspath(self._grid_file))
+        return '{}_emulator.hdf5'.format(root)
+
+
+    def _get_emulator_grid_key(self):
+        """
+        Returns a key identifying the grid an emulator is built from
+
+        The key is the grid file, its size and modification time, the grid
+        name and the spectral type, so an emulator stored outside the grid file
+        is never matched to a modified grid.
+        """
+        grid_file = os.path.abspath(self._grid_file)
+        stat = os.stat(grid_file)
+        return '{}:{}:{}:{}:{}'.format(grid_file, stat.st_size, stat.st_mtime, self._grid_name, self._sptype)
+
+
+    def _read_emulator(self, infile, tol):
+        """
+        Returns the emulator of the model grid stored in ``infile`` if it was
+        made for this grid and meets ``tol``, else ``None``
+        """
+        try:
+            ingrid = io.read_grid_emulator(infile, self._grid_name)
+        except KeyError:
+            return None
+        tgrid, ggrid, wave, mean, comps, weights, attrs = ingrid
+        try:
+            if io._is_plasma(attrs.get('sptype', '')) != io._is_plasma(self._sptype):
+                message = 'Emulator was made for sptype {}'.format(attrs.get('sptype'))
+                raise ValueError(message)
+            # emulators stored in the grid file belong to it, others must name it
+            if os.path.abspath(infile) != os.path.abspath(self._grid_file) and\
+                    attrs.get('grid_key') != self._get_emulator_grid_key():
+                message = 'Emulator in {} was made for a different grid'.format(infile)
+                raise ValueError(message)
+            emulator = WDmodel_Emulator(tgrid, ggrid, wave, mean, comps, weights,\
+                    tol=attrs.get('tol'), maxerr=attrs.get('maxerr'))
+            emulator = emulator.subset(self._tgrid, self._ggrid, self._wave)
+        except ValueError as e:
+            message = '{}\nRebuilding emulator of grid {}'.format(e, self._grid_name)
+            warnings.warn(message, RuntimeWarning)
+            return None
+        if emulator.maxerr is None or emulator.maxerr > tol:
+            message = 'Emulator in {} does not meet tolerance {:g}. Rebuilding.'.format(infile, tol)
+            warnings.warn(message, RuntimeWarning)
+            return None
+        return emulator
+
+
+    def set_emulator(self, tol=1e-3, emulator_file=None, maxcomp=None, keep_grid=True):
+        """
+        Replaces the interpolation in the model grid with a principal
+        component emulator of the grid
+
+        The emulator is read from ``emulator_file`` if it is set. Otherwise it
+        is read from the grid file, or from the file ``<grid>_emulator.hdf5``
+        next to the grid file. An emulator is only used if it was made for
+        this grid and reproduces it to within ``tol``. Otherwise it is built
+        from the grid, and written to ``emulator_file``, or the file next to
+        the grid file, so the next model reuses it. See
+        :py:class:`WDmodel.WDmodel.WDmodel_Emulator`.
+
+        Parameters
+        ----------
+        tol : float, optional
+            Maximum absolute error of the emulator in ``log10`` flux at any
+            grid node. Default is ``1e-3``
+        emulator_file : None or str, optional
+            HDF5 file to read the emulator from, and to write it to if it is
+            built. Default is ``None``
+        maxcomp : None or int, optional
+            Maximum number of components of a new emulator. Default is ``None``
+        keep_grid : bool, optional
+            Keep the model grid in memory. If not set, the grid is released
+            and only the emulator is kept. Default is ``True``
+
+        Returns
+        -------
+        emulator : :py:class:`WDmodel.WDmodel.WDmodel_Emulator` instance
+            The emulator used by the model
+
+        Raises
+        ------
+        ValueError
+            If the emulator needs to be built but the grid was released
+
+        Notes
+        -----
+            An emulator in a file other than the grid file is matched to the
+            grid by the grid filename, size and modification time, the grid
+            name and the spectral type. If the emulator cannot be written
+            next to the grid file, e.g. because the grid is installed with
+            the package, a warning is issued and it is rebuilt by every
+            model.
+        """
+        if emulator_file is None:
+            infiles = [self._grid_file, self._get_emulator_file()]
+            outfile = infiles[-1]
+        else:
+            infiles = [emulator_file]
+            outfile = emulator_file
+
+        emulator = None
+        for infile in infiles:
+            if os.path.exists(infile):
+                emulator = self._read_emulator(infile, tol)
+            if emulator is not None:
+                break
+
+        if emulator is None:
+            if self._lflux is None:
+                message = 'Cannot build emulator. Model grid has been released.'
+                raise ValueError(message)
+            emulator = WDmodel_Emulator.from_grid(self._tgrid, self._ggrid, self._wave, self._lflux,\
+                    tol=tol, maxcomp=maxcomp)
+            if emulator.maxerr > tol:
+                message = 'Emulator with {} components has max error {:.2e} dex, greater than tolerance {:g}'.format(\
+                        emulator.ncomp, emulator.maxerr, tol)
+                warnings.warn(message, RuntimeWarning)
+            attrs = {'tol':tol, 'maxerr':emulator.maxerr, 'sptype':str(self._sptype),\
+                    'grid_file':str(os.path.abspath(self._grid_file)), 'grid_key':self._get_emulator_grid_key()}
+            try:
+                io.write_grid_emulator(outfile, self._grid_name, emulator._tgrid, emulator._ggrid,\
+                        emulator._wave, emulator._mean, emulator._comps, emulator._weights, attrs=attrs)
+            except (IOError, OSError) as e:
+                message = '{}\nCould not write emulator of grid {} to {}'.format(e, self._grid_name, outfile)
+                warnings.warn(message, RuntimeWarning)
+
+        message = 'Using grid emulator with {} components, max error {:.2e} dex'.format(emulator.ncomp, emulator.maxerr)
+        print(message)
+        self._emulator = emulator
+        if not keep_grid:
+            self._lflux = None
+            self._model = None
+            self._shared_grid = None
+        return emulator
+
+
+    # these are implemented for compatibility with python's pickle
+    # which in turn is required to make the code work with MPI
+    def __getstate__(self):
+        mapped = _is_memmap(self._lflux)
+        if getattr(self, '_shared_grid', None) is None and not mapped:
+            return self.__dict__
+        # the grid is attached by name when unpickled rather than copied
+        d = self.__dict__.copy()
+        d['_lflux'] = None
+        d['_model'] = None
+        return d
+
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        if d.get('_shared_grid') is not None:
+            self._attach_grid()
+        elif self._lflux is None and d.get('_emulator') is None:
+            # memory mapped compiled grid
+            self._lflux = self._read_grid(self._grid_file, self._grid_name)[5]
+            self._model = spinterp.RegularGridInterpolator((self._tgrid, self._ggrid),\
+                    self._lflux)
+
+
+    __call__ = get_model
+
+
+def _is_memmap(arr):
+    """
+    Returns ``True`` if the array ``arr`` is a view of a memory mapped file
+    """
+    while arr is not None:
+        if isinstance(arr, np.memmap):
+            return True
+        arr = getattr(arr, 'base', None)
+    return False
+
+
+def _load_shared_grid(shared_grid, shape):
+    """
+    Returns the shared grid file ``shared_grid`` memory mapped, or ``None``
+    if it has the wrong shape or does not end with the completion marker
+    written after the data by
+    :py:meth:`WDmodel.WDmodel.WDmodel._attach_grid`
+    """
+    try:
+        lflux = np.load(shared_grid, mmap_mode='r')
+        if lflux.shape != shape:
+            return None
+        with open(shared_grid, 'rb') as f:
+            f.seek(lflux.offset + lflux.nbytes)
+            marker = f.read()
+    except (IOError, OSError, ValueError):
+        return None
+    if marker != _SHARED_GRID_MARKER:
+        return None
+    return lflux
+
+
+def _remove_shared_grid(shared_grid):
+    """
+    Removes the shared grid file ``shared_grid`` if it exists
+    """
+    try:
+        os.remove(shared_grid)
+    except OSError:
+        pass
+
+
+class WDmodel_Reddening(object):
+    """
+    Extinction curves of a reddening law bound to a fixed wavelength array
+
+    The shape of the extinction curve only depends on ``rv``, and the
+    extinction :math:`A_{\lambda}` is linear in ``av``. This class caches
+    :math:`A_{\lambda}/A_V` on the bound wavelengths on a lattice of ``rv``
+    with spacing ``rvstep``, so reddening a spectrum is a single multiply and
+    exponential. The curve is exact if ``rv`` is on the lattice, which
+    includes the default ``rv = 3.1``, so a fixed ``rv`` costs a single
+    evaluation of the law. Otherwise, the curve is linearly interpolated
+    between the two bracketing lattice nodes.
+
+    Parameters
+    ----------
+    law : callable
+        The extinction function, with the interface of
+        :py:attr:`WDmodel.WDmodel.WDmodel._law`
+    wave : array-like
+        Wavelengths in Angstrom the curves are computed at, sorted in
+        ascending order
+    rvstep : None or float, optional
+        Spacing of the ``rv`` lattice. If ``None``, the curve is computed
+        exactly for every ``rv`` and cached. Default is ``0.01``
+    maxsize : int, optional
+        Maximum number of curves to cache. Default is ``128``
+
+    Attributes
+    ----------
+    wave : array-like
+        Contiguous copy of the input ``wave``
+    rvstep : None or float
+        The input ``rvstep``
+    _law : callable
+        The input ``law``
+    _curves : :py:class:`WDmodel.cache.LRUCache` instance
+        The cached curves, keyed on the lattice node index, or on ``rv`` if
+        ``rvstep`` is ``None``
+
+    Notes
+    -----
+        The linear interpolation error for ``rvstep=0.01`` is ``~2E-5``
+        relative to :math:`A_{\lambda}` for the supported laws.
+    """
+    _lnscale = -0.4*np.log(10.)
+
+    def __init__(self, law, wave, rvstep=0.01, maxsize=128):
+        self._law = law
+        self.wave = np.ascontiguousarray(wave, dtype=np.float64)
+        self.rvstep = rvstep
+        self._curves = LRUCache(maxsize=maxsize)
+
+
+    def _get_node(self, key, rv):
+        """
+        Returns the cached curve for ``key``, computing it at ``rv`` if needed
+        """
+        curve = self._curves.get(key)
+        if curve is None:
+            curve = self._law(self.wave, 1., rv, unit='aa')
+            self._curves.put(key, curve)
+        return curve
+
+
+    def get_curve(self, rv):
+        """
+        Returns the extinction curve :math:`A_{\lambda}/A_V` for ``rv``
+
+        Parameters
+        ----------
+        rv : float
+            The reddening law parameter, :math:`R_V`
+
+        Returns
+        -------
+        curve : array-like
+            The extinction per unit ``av`` at the bound wavelengths. Must not
+            be modified.
+        """
+        rv = float(rv)
+        if self.rvstep is None:
+            return self._get_node(rv, rv)
+        x = rv/self.rvstep
+        i = int(np.floor(x))
+        frac = x - i
+        if frac < 1e-8:
+            return self._get_node(i, i*self.rvstep)
+        if frac > 1. - 1e-8:
+            return self._get_node(i+1, (i+1)*self.rvstep)
+        lower = self._get_node(i, i*self.rvstep)
+        upper = self._get_node(i+1, (i+1)*self.rvstep)
+        return lower + (upper - lower)*frac
+
+
+    def get_curve_grad(self, rv):
+        """
+        Returns the extinction curve :math:`A_{\lambda}/A_V` for ``rv`` and
+        its derivative with respect to ``rv``
+
+        The derivative is the slope of the linear interpolation between the
+        lattice nodes bracketing ``rv`` (the nodes above, if ``rv`` is on the
+        lattice). If ``rvstep`` is ``None``, it is a central difference of the
+        reddening law with a step of ``1E-4``.
+
+        Parameters
+        ----------
+        rv : float
+            The reddening law parameter, :math:`R_V`
+
+        Returns
+        -------
+        curve : array-like
+            The extinction per unit ``av`` at the bound wavelengths. Must not
+            be modified.
+        dcurve : array-like
+            The derivative of ``curve`` with respect to ``rv``
+        """
+        rv = float(rv)
+        curve = self.get_curve(rv)
+        if self.rvstep is None:
+            h = 1e-4
+            dcurve = (self._law(self.wave, 1., rv+h, unit='aa') - self._law(self.wave, 1., rv-h, unit='aa'))/(2.*h)
+            return curve, dcurve
+        x = rv/self.rvstep
+        i = int(np.floor(x))
+        if x - i > 1. - 1e-8:
+            i += 1
+        lower = self._get_node(i, i*self.rvstep)
+        upper = self._get_node(i+1, (i+1)*self.rvstep)
+        return curve, (upper - lower)/self.rvstep
+
+
+    def extinction(self, av, rv=3.1):
+        """
+        Returns the extinction :math:`A_{\lambda}` at the bound wavelengths
+        for ``av`` and ``rv``
+        """
+        return self.get_curve(rv)*av
+
+
+    def apply(self, flux, av, rv=3.1):
+        """
+        Reddens ``flux`` at the bound wavelengths in place
+
+        Parameters
+        ----------
+        flux : array-like
+            Array of fluxes at the bound wavelengths
+        av : float
+            Extinction in the V band, :math:`A_V`
+        rv : float, optional
+            The reddening law parameter, :math:`R_V`. Default is ``3.1``
+
+        Returns
+        -------
+        out : array-like
+            The reddened ``flux``
+        """
+        flux *= np.exp(self.get_curve(rv)*(self._lnscale*av))
+        return flux
+
+
+class WDmodel_Planck(object):
+    """
+    Unit-free Planck function, :math:`B_{\lambda}(T)`, with a cache of recent
+    evaluations
+
+    :py:func:`WDmodel.WDmodel.WDmodel.plancklam` was originally computed with
+    :py:class:`astropy.units.Quantity` objects, converting units on every
+    call, which dominates the cost of the plasma models. This class folds the
+    physical constants and unit conversions into two dimensionless constants
+    once, so that
+
+    .. math::
+
+        B_{\lambda}(T) = \\frac{c_1}{\lambda^5} \\frac{1}{\exp(c_2/\lambda T) - 1}
+
+    with :math:`\lambda` in Angstrom, :math:`T` in Kelvin and :math:`B_{\lambda}`
+    in erg/s/cm^2/Ang. If requested, the wavelength factors are cached for
+    each wavelength array, and :math:`B_{\lambda}` for each scalar
+    temperature, so repeated temperatures cost a cache lookup.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of temperatures to cache. Default is ``16``
+
+    Attributes
+    ----------
+    _waves : :py:class:`WDmodel.cache.LRUCache` instance
+        The cached wavelength array and its factors :math:`c_1/\lambda^5` and
+        :math:`c_2/\lambda`
+    _curves : :py:class:`WDmodel.cache.LRUCache` instance
+        The cached :math:`B_{\lambda}(T)`, keyed on the temperature and the
+        wavelength array
+
+    Notes
+    -----
+        Wavelength arrays are not hashable, so they are identified by the
+        identity of the array object, as in
+        :py:func:`WDmodel.WDmodel.WDmodel.reddening`. The cached entry keeps a
+        reference to the array, so its identity cannot be reused by another
+        array while it is cached. Only arrays that are reused and never
+        modified, such as the model grid wavelengths, should be cached -
+        freshly shifted wavelengths bypass the cache. Agrees with the
+        :py:mod:`astropy.units` version,
+        :py:func:`WDmodel.WDmodel.WDmodel._plancklam_units`, to rounding.
+    """
+    _c1 = (2.*h*(c**2)/u.Angstrom**5).to(u.erg / u.s / u.cm**2 / u.Angstrom).value
+    _c2 = (h*c/(u.Angstrom*k_B*u.K)).decompose().value
+
+    def __init__(self, maxsize=16):
+        self._waves  = LRUCache(maxsize=4)
+        self._curves = LRUCache(maxsize=maxsize)
+
+
+    def _get_wave_factors(self, wave):
+        """
+        Returns the cached :math:`c_1/\lambda^5` and :math:`c_2/\lambda` for
+        the array ``wave``, identified by its identity
+        """
+        key = id(wave)
+        entry = self._waves.get(key)
+        if entry is None or entry[0] is not wave:
+            entry = (wave, self._c1/wave**5, self._c2/wave)
+            self._waves.put(key, entry)
+        return entry[1:]
+
+
+    def __call__(self, wave, T, cache=False):
+        """
+        Returns the Planck function, :math:`B_{\lambda}(T)`
+
+        Parameters
+        ----------
+        wave : array-like
+            Array of wavelengths in Angstrom
+        T : float or array-like
+            Temperature in Kelvin. Arrays are broadcast against ``wave``,
+            e.g. shape ``(N, 1)`` for ``N`` temperatures
+        cache : bool, optional
+            Cache the wavelength factors for ``wave``, and the result if ``T``
+            is a scalar. ``wave`` must then be a :py:class:`numpy.ndarray`
+            that is not modified afterwards. Default is ``False``
+
+        Returns
+        -------
+        out : array-like
+            The Planck function in erg/s/cm^2/Ang. Must not be modified if
+            ``cache`` is set and ``T`` is a scalar, since it may be cached.
+        """
+        if not cache:
+            wave = np.asarray(wave, dtype=np.float64)
+            return self._c1/wave**5/(np.exp(self._c2/(wave*T)) - 1.)
+
+        fac1, fac2 = self._get_wave_factors(wave)
+        if np.ndim(T) != 0:
+            return fac1/(np.exp(fac2/T) - 1.)
+
+        # the entry keeps a reference to wave as well, since it may outlive
+        # the entry of the wavelength factors
+        key = (float(T), id(wave))
+        entry = self._curves.get(key)
+        if entry is None or entry[0] is not wave:
+            entry = (wave, fac1/(np.exp(fac2/T) - 1.))
+            self._curves.put(key, entry)
+        return entry[1]
+
+
+class WDmodel_Convolver(object):
+    """
+    Gaussian instrumental broadening with selectable backends
+
+    Convolves model fluxes with a Gaussian kernel of standard deviation
+    ``gsig`` pixels, with the same edge handling (``mode='nearest'``) as
+    :py:func:`scipy.ndimage.filters.gaussian_filter1d`. Three backends are
+    available:
+
+        * ``direct`` - direct convolution with the truncated kernel. Exactly
+          reproduces :py:func:`scipy.ndimage.filters.gaussian_filter1d`, but
+          costs :math:`O(N\sigma)`.
+        * ``fft`` - convolution of the edge-padded flux with the same
+          truncated kernel by FFT. Agrees with ``direct`` to roundoff, and
+          costs :math:`O(N \log N)` independent of ``gsig``.
+        * ``iir`` - recursive Gaussian filter of Young & van Vliet (1995),
+          run forward and backward. Costs :math:`O(N)` independent of
+          ``gsig``, but only approximates the Gaussian, with errors of up to
+          ~1% of the depth of features comparable in width to the kernel.
+
+    With ``backend='auto'``, ``direct`` is used for narrow kernels and
+    ``fft`` for wide kernels, where the crossover is set by the kernel size
+    relative to the FFT length. The approximate ``iir`` backend is never
+    selected automatically.
+
+    Parameters
+    ----------
+    backend : {'auto', 'direct', 'fft', 'iir'}, optional
+        The convolution backend. Default is ``'auto'``
+    truncate : float, optional
+        Truncate the kernel at this many standard deviations. Default is
+        ``4.``, the same as :py:func:`scipy.ndimage.filters.gaussian_filter1d`
+    fft_factor : float, optional
+        With ``backend='auto'``, use ``fft`` if the kernel size exceeds
+        ``fft_factor`` times :math:`\log_2` of the FFT length. Default is
+        ``6.``
+    maxsize : int, optional
+        Maximum number of kernels to cache. Default is ``32``
+
+    Attributes
+    ----------
+    backend : str
+        The input ``backend``
+    truncate : float
+        The input ``truncate``
+    fft_factor : float
+        The input ``fft_factor``
+    _kernels : :py:class:`WDmodel.cache.LRUCache` instance
+        The cached kernels, keyed on ``gsig`` and the backend
+
+    Notes
+    -----
+        Use :py:meth:`WDmodel.WDmodel.WDmodel_Convolver.benchmark` to compare
+        the accuracy and speed of the backends for a particular spectrum
+        size. The default ``fft_factor`` puts the crossover at ``gsig ~ 10``
+        pixels for a few thousand pixels, typical of low-resolution spectra.
+
+    References
+    ----------
+        Young, I. T. & van Vliet, L. J., 1995, Signal Processing, 44, 139
+    """
+    backends = ('auto', 'direct', 'fft', 'iir')
+
+    def __init__(self, backend='auto', truncate=4., fft_factor=6., maxsize=32):
+        if backend not in self.backends:
+            message = 'Unknown convolution backend {}. Must be one of {}'.format(backend, ', '.join(self.backends))
+            raise ValueError(message)
+        self.backend    = backend
+        self.truncate   = truncate
+        self.fft_factor = fft_factor
+        self._kernels   = LRUCache(maxsize=maxsize)
+
+
+    def _get_radius(self, gsig):
+        """
+        Returns the half-width of the truncated kernel in pixels
+        """
+        return int(self.truncate*gsig + 0.5)
+
+
+    def _get_kernel(self, gsig):
+        """
+        Returns the truncated, normalized Gaussian kernel for ``gsig``
+        """
+        key = ('direct', gsig)
+        kernel = self._kernels.get(key)
+        if kernel is None:
+            radius = self._get_radius(gsig)
+            x = np.arange(-radius, radius+1)
+            kernel = np.exp(-0.5/(gsig*gsig)*x**2)
+            kernel /= kernel.sum()
+            self._kernels.put(key, kernel)
+        return kernel
+
+
+    def _get_kernel_fft(self, gsig, nfft):
+        """
+        Returns the FFT of the truncated kernel for ``gsig``, zero-padded to
+        length ``nfft``
+        """
+        key = ('fft', gsig, nfft)
+        kernel = self._kernels.get(key)
+        if kernel is None:
+            kernel = np.fft.rfft(self._get_kernel(gsig), nfft)
+            self._kernels.put(key, kernel)
+        return kernel
+
+
+    def _get_iir_coeffs(self, gsig):
+        """
+        Returns the numerator and denominator of the Young & van Vliet (1995)
+        recursive filter for ``gsig``
+        """
+        key = ('iir', gsig)
+        coeffs = self._kernels.get(key)
+        if coeffs is None:
+            if gsig >= 2.5:
+                q = 0.98711*gsig - 0.96330
+            else:
+                q = 3.97156 - 4.14554*np.sqrt(1. - 0.26891*gsig)
+            q2 = q*q
+            q3 = q2*q
+            b0 = 1.57825 + 2.44413*q + 1.4281*q2 + 0.422205*q3
+            b1 = 2.44413*q + 2.85619*q2 + 1.26661*q3
+            b2 = -(1.4281*q2 + 1.26661*q3)
+            b3 = 0.422205*q3
+            B  = 1. - (b1 + b2 + b3)/b0
+            coeffs = (np.array([B]), np.array([1., -b1/b0, -b2/b0, -b3/b0]))
+            self._kernels.put(key, coeffs)
+        return coeffs
+
+
+    def _get_iir_coeffs_grad(self, gsig):
+        """
+        Returns the derivatives of the numerator and denominator of the
+        recursive filter for ``gsig`` with respect to ``gsig``
+        """
+        key = ('iirgrad', gsig)
+        dcoeffs = self._kernels.get(key)
+        if dcoeffs is None:
+            if gsig >= 2.5:
+                q  = 0.98711*gsig - 0.96330
+                dq = 0.98711
+            else:
+                r  = np.sqrt(1. - 0.26891*gsig)
+                q  = 3.97156 - 4.14554*r
+                dq = 4.14554*0.26891/(2.*r)
+            q2 = q*q
+            q3 = q2*q
+            b  = np.array([1.57825 + 2.44413*q + 1.4281*q2 + 0.422205*q3,\
+                    2.44413*q + 2.85619*q2 + 1.26661*q3,\
+                    -(1.4281*q2 + 1.26661*q3),\
+                    0.422205*q3])
+            db = np.array([2.44413 + 2.*1.4281*q + 3.*0.422205*q2,\
+                    2.44413 + 2.*2.85619*q + 3.*1.26661*q2,\
+                    -(2.*1.4281*q + 3.*1.26661*q2),\
+                    3.*0.422205*q2])*dq
+            # a_k = -b_k/b0 and B = 1 + a_1 + a_2 + a_3
+            da = np.zeros(4)
+            da[1:] = -(db[1:]*b[0] - b[1:]*db[0])/b[0]**2.
+            dcoeffs = (np.array([da.sum()]), da)
+            self._kernels.put(key, dcoeffs)
+        return dcoeffs
+
+
+    @staticmethod
+    def _pad(flux, npad):
+        """
+        Pads the last axis of ``flux`` with ``npad`` copies of the edge values
+        """
+        if npad == 0:
+            return flux
+        left  = np.repeat(flux[..., :1], npad, axis=-1)
+        right = np.repeat(flux[..., -1:], npad, axis=-1)
+        return np.concatenate((left, flux, right), axis=-1)
+
+
+    def _direct(self, flux, gsig):
+        """
+        Direct convolution with the cached truncated kernel
+        """
+        return correlate1d(flux, self._get_kernel(gsig), axis=-1, mode='nearest')
+
+
+    def _fft(self, flux, gsig):
+        """
+        FFT convolution of the edge-padded flux with the truncated kernel
+        """
+        npix   = flux.shape[-1]
+        radius = self._get_radius(gsig)
+        padded = self._pad(flux, radius)
+        # the padding is as wide as the kernel, so the wraparound of the
+        # circular convolution never reaches the output pixels
+        nfft   = next_fast_len(padded.shape[-1])
+        out = np.fft.irfft(np.fft.rfft(padded, nfft)*self._get_kernel_fft(gsig, nfft), nfft)
+        return out[..., 2*radius:2*radius+npix]
+
+
+    def _iir(self, flux, gsig):
+        """
+        Forward-backward recursive Gaussian filter of the edge-padded flux
+        """
+        if gsig < 0.5:
+            # the recursive filter coefficients are not defined here
+            return self._direct(flux, gsig)
+        npix = flux.shape[-1]
+        npad = int(6.*gsig + 0.5) + 3
+        b, a = self._get_iir_coeffs(gsig)
+        out = lfilter(b, a, self._pad(flux, npad), axis=-1)
+        out = lfilter(b, a, out[..., ::-1], axis=-1)[..., ::-1]
+        return out[..., npad:npad+npix]
+
+
+    def _iir_grad(self, flux, gsig):
+        """
+        Forward-backward recursive Gaussian filter of the edge-padded flux,
+        and its derivative with respect to ``gsig``
+
+        The derivative of each pass of the filter, ``a*y = B*x``, is the same
+        filter applied to ``dB*x + B*dx - da*y``, where ``da*y`` is the
+        derivative of the denominator applied to the output of the pass.
+        """
+        if gsig < 0.5:
+            return self._direct(flux, gsig), correlate1d(flux, self._get_kernel_grad(gsig), axis=-1, mode='nearest')
+        npix = flux.shape[-1]
+        npad = int(6.*gsig + 0.5) + 3
+        b, a = self._get_iir_coeffs(gsig)
+        db, da = self._get_iir_coeffs_grad(gsig)
+        x = self._pad(flux, npad)
+        y = lfilter(b, a, x, axis=-1)
+        dy = lfilter([1.], a, db[0]*x - lfilter(da, [1.], y, axis=-1), axis=-1)
+        y  = y[..., ::-1]
+        dy = dy[..., ::-1]
+        out  = lfilter(b, a, y, axis=-1)
+        dout = lfilter([1.], a, db[0]*y + b[0]*dy - lfilter(da, [1.], out, axis=-1), axis=-1)
+        return out[..., ::-1][..., npad:npad+npix], dout[..., ::-1][..., npad:npad+npix]
+
+
+    def select(self, gsig, npix):
+        """
+        Returns the backend used to convolve ``npix`` pixels with a kernel of
+        width ``gsig``
+
+        Parameters
+        ----------
+        gsig : float
+            Gaussian kernel standard deviation in pixels
+        npix : int
+            Number of pixels
+
+        Returns
+        -------
+        backend : str
+            One of ``'direct'``, ``'fft'`` or ``'iir'``
+        """
+        if self.backend != 'auto':
+            return self.backend
+        ksize = 2*self._get_radius(gsig) + 1
+        nfft  = next_fast_len(npix + ksize - 1)
+        if ksize > self.fft_factor*np.log2(nfft):
+            return 'fft'
+        return 'direct'
+
+
+    def convolve(self, flux, gsig):
+        """
+        Convolves ``flux`` along the last axis with a Gaussian kernel
+
+        Parameters
+        ----------
+        flux : array-like
+            Array of fluxes, shape ``(nwave,)`` or ``(N, nwave)``
+        gsig : float
+            Gaussian kernel standard deviation in pixels
+
+        Returns
+        -------
+        out : array-like
+            The convolved fluxes, the same shape as ``flux``
+        """
+        flux = np.asarray(flux, dtype=np.float64)
+        gsig = float(gsig)
+        backend = self.select(gsig, flux.shape[-1])
+        if backend == 'fft':
+            return self._fft(flux, gsig)
+        elif backend == 'iir':
+            return self._iir(flux, gsig)
+        return self._direct(flux, gsig)
+
+
+    def _get_kernel_grad(self, gsig):
+        """
+        Returns the derivative of the truncated, normalized Gaussian kernel
+        with respect to ``gsig``, at fixed truncation radius
+        """
+        key = ('grad', gsig)
+        dkernel = self._kernels.get(key)
+        if dkernel is None:
+            kernel = self._get_kernel(gsig)
+            radius = self._get_radius(gsig)
+            x2 = np.arange(-radius, radius+1)**2.
+            dkernel = kernel*(x2 - np.dot(kernel, x2))/gsig**3.
+            self._kernels.put(key, dkernel)
+        return dkernel
+
+
+    def convolve_grad(self, flux, gsig):
+        """
+        Convolves ``flux`` along the last axis with a Gaussian kernel, and
+        returns the derivative of the result with respect to ``gsig``
+
+        The derivative is the convolution of ``flux`` with the derivative of
+        the truncated kernel, with the same edge handling. The truncation
+        radius only changes at isolated values of ``gsig``, and is held
+        fixed. With the ``iir`` backend, it is the derivative of the
+        recursive filter through its coefficients, so the derivative is that
+        of the approximate convolution that :py:meth:`convolve` returns.
+
+        Parameters
+        ----------
+        flux : array-like
+            Array of fluxes, shape ``(nwave,)`` or ``(N, nwave)``
+        gsig : float
+            Gaussian kernel standard deviation in pixels
+
+        Returns
+        -------
+        out : array-like
+            The convolved fluxes, as :py:meth:`convolve`
+        dout : array-like
+            The derivative of ``out`` with respect to ``gsig``
+        """
+        flux = np.asarray(flux, dtype=np.float64)
+        gsig = float(gsig)
+        backend = self.select(gsig, flux.shape[-1])
+        if backend == 'iir':
+            return self._iir_grad(flux, gsig)
+        out  = self.convolve(flux, gsig)
+        dkernel = self._get_kernel_grad(gsig)
+        if backend == 'fft':
+            npix   = flux.shape[-1]
+            radius = self._get_radius(gsig)
+            padded = self._pad(flux, radius)
+            nfft   = next_fast_len(padded.shape[-1])
+            dout = np.fft.irfft(np.fft.rfft(padded, nfft)*np.fft.rfft(dkernel, nfft), nfft)
+            dout = dout[..., 2*radius:2*radius+npix]
+        else:
+            dout = correlate1d(flux, dkernel, axis=-1, mode='nearest')
+        return out, dout
+
+
+    @classmethod
+    def benchmark(cls, flux, sigmas, number=100, truncate=4.):
+        """
+        Compares the accuracy and speed of the convolution backends against
+        :py:func:`scipy.ndimage.filters.gaussian_filter1d`
+
+        Parameters
+        ----------
+        flux : array-like
+            Array of fluxes to convolve, shape ``(nwave,)`` or ``(N, nwave)``
+            - typically a model spectrum on the spectrum wavelengths
+        sigmas : array-like
+            Gaussian kernel standard deviations in pixels to test
+        number : int, optional
+            Number of convolutions to time for each backend and ``sigma``.
+            Default is ``100``
+        truncate : float, optional
+            Truncate the kernel at this many standard deviations. Default is
+            ``4.``
+
+        Returns
+        -------
+        out : :py:class:`numpy.recarray`
+            One row per ``sigma`` and backend, with columns ``sigma``,
+            ``backend``, ``time`` (mean time per convolution in seconds) and
+            ``maxerr`` (maximum relative difference from
+            :py:func:`scipy.ndimage.filters.gaussian_filter1d`). The
+            reference itself is included as backend ``'scipy'``, and the
+            ``auto`` row reports the backend it selected as
+            ``'auto:<backend>'``.
+
+        Notes
+        -----
+            Timings use :py:func:`timeit.timeit`, and include the kernel
+            cache, so the first call for each ``sigma`` is not counted.
+        """
+        import timeit
+        flux = np.asarray(flux, dtype=np.float64)
+        rows = []
+        for sigma in np.atleast_1d(sigmas):
+            sigma = float(sigma)
+            ref = gaussian_filter1d(flux, sigma, axis=-1, order=0, mode='nearest', truncate=truncate)
+            thistime = timeit.timeit(lambda: gaussian_filter1d(flux, sigma, axis=-1, order=0,\
+                    mode='nearest', truncate=truncate), number=number)
+            rows.append((sigma, 'scipy', thistime/number, 0.))
+            for backend in cls.backends:
+                conv = cls(backend=backend, truncate=truncate)
+                out  = conv.convolve(flux, sigma)
+                thistime = timeit.timeit(lambda: conv.convolve(flux, sigma), number=number)
+                maxerr = np.max(np.abs(out/ref - 1.))
+                if backend == 'auto':
+                    backend = 'auto:{}'.format(conv.select(sigma, flux.shape[-1]))
+                rows.append((sigma, backend, thistime/number, maxerr))
+        names = str('sigma,backend,time,maxerr')
+        sigma, backend, thistime, maxerr = zip(*rows)
+        out = np.rec.fromarrays((sigma, np.array(backend, dtype='U16'), thistime, maxerr), names=names)
+        return out
+
+
+class WDmodel_Emulator(object):
+    """
+    Principal component emulator of the model grid
+
+    Decomposes the ``log10`` model grid,
+    :py:attr:`WDmodel.WDmodel.WDmodel._lflux`, into a mean spectrum and the
+    smallest number of principal components that reproduce every grid node
+    to within a tolerance. Only the ``ncomp`` component weights are
+    interpolated in ``teff`` and ``logg``, and the spectrum is reconstructed
+    from them with a single matrix product, rather than interpolating the
+    full ``_nwave`` long spectrum at the four grid corners.
+
+    Provides the same ``_get_model`` interface as
+    :py:class:`WDmodel.WDmodel.WDmodel`. Once attached to a model with
+    :py:meth:`WDmodel.WDmodel.WDmodel.set_emulator`, the model and anything
+    using it e.g. :py:class:`WDmodel.likelihood.WDmodel_Likelihood`, use the
+    emulator transparently.
+
+    Parameters
+    ----------
+    tgrid : array-like
+        Array of grid temperature values in Kelvin
+    ggrid : array-like
+        Array of grid surface gravity values in dex
+    wave : array-like
+        Array of grid wavelengths in Angstrom
+    mean : array-like
+        Mean ``log10`` flux of the grid, shape ``(nwave,)``
+    comps : array-like
+        Principal components of the ``log10`` flux, shape ``(ncomp, nwave)``
+    weights : array-like
+        Component weights at the grid nodes, shape ``(ntemp, ngrav, ncomp)``
+    tol : float, optional
+        The tolerance the emulator was built with in dex. Default is ``None``
+    maxerr : float, optional
+        The maximum absolute error of the emulator in ``log10`` flux at the
+        grid nodes. Default is ``None``
+
+    Attributes
+    ----------
+    ncomp : int
+        The number of principal components
+    tol : float
+        The input ``tol``
+    maxerr : float
+        The input ``maxerr``
+
+    Notes
+    -----
+        The interpolation is linear in the component weights, so the
+        emulated spectrum is exactly the bilinear interpolation of the
+        reconstructed grid. The maximum error at the grid nodes, ``maxerr``,
+        therefore bounds the error of the emulator with respect to the grid
+        everywhere, not just at the nodes.
+
+        Use :py:meth:`WDmodel.WDmodel.WDmodel_Emulator.from_grid` to build
+        an emulator, and :py:func:`WDmodel.io.write_grid_emulator` to store
+        it alongside the grid.
+    """
+    def __init__(self, tgrid, ggrid, wave, mean, comps, weights, tol=None, maxerr=None):
+        self._tgrid   = np.asarray(tgrid, dtype=np.float64)
+        self._ggrid   = np.asarray(ggrid, dtype=np.float64)
+        self._wave    = np.asarray(wave, dtype=np.float64)
+        self._lwave   = np.log10(self._wave)
+        self._mean    = np.asarray(mean, dtype=np.float64)
+        self._comps   = np.ascontiguousarray(comps, dtype=np.float64)
+        self._weights = np.ascontiguousarray(weights, dtype=np.float64)
+        self._ntemp   = len(self._tgrid)
+        self._ngrav   = len(self._ggrid)
+        self.ncomp    = len(self._comps)
+        self.tol      = tol
+        self.maxerr   = maxerr
+        shape = (self._ntemp, self._ngrav, self.ncomp)
+        if self._weights.shape != shape or self._comps.shape != (self.ncomp, len(self._wave))\
+                or self._mean.shape != self._wave.shape:
+            message = 'Emulator weights {} and components {} do not match grids {}'.format(self._weights.shape,\
+                    self._comps.shape, shape[:2] + self._wave.shape)
+            raise ValueError(message)
+
+
+    @classmethod
+    def from_grid(cls, tgrid, ggrid, wave, lflux, tol=1e-3, maxcomp=None):
+        """
+        Builds an emulator of a model grid
+
+        Parameters
+        ----------
+        tgrid, ggrid, wave : array-like
+            The temperature, surface gravity and wavelength arrays of the grid
+        lflux : array-like
+            The ``log10`` flux of the grid, shape ``(ntemp, ngrav, nwave)``
+            i.e. :py:attr:`WDmodel.WDmodel.WDmodel._lflux`
+        tol : float, optional
+            Maximum absolute error in ``log10`` flux at any grid node.
+            Default is ``1e-3``
+        maxcomp : None or int, optional
+            Maximum number of components. If set, ``tol`` may not be
+            reached. Default is ``None``
+
+        Returns
+        -------
+        out : :py:class:`WDmodel.WDmodel.WDmodel_Emulator` instance
+
+        Raises
+        ------
+        ValueError
+            If ``tol`` is not greater than zero
+        """
+        if tol <= 0.:
+            message = 'Emulator tolerance must be greater than 0. ({:g})'.format(tol)
+            raise ValueError(message)
+        ntemp, ngrav, nwave = lflux.shape
+        data = np.asarray(lflux, dtype=np.float64).reshape(ntemp*ngrav, nwave)
+        mean = data.mean(axis=0)
+        resid = data - mean
+        u, s, vt = np.linalg.svd(resid, full_matrices=False)
+        if maxcomp is None:
+            maxcomp = len(s)
+        maxcomp = max(min(maxcomp, len(s)), 1)
+
+        # add components until every node is reproduced to within tol
+        for ncomp in range(1, maxcomp+1):
+            resid -= np.outer(u[:, ncomp-1]*s[ncomp-1], vt[ncomp-1])
+            maxerr = np.max(np.abs(resid))
+            if maxerr <= tol:
+                break
+
+        weights = (u[:, :ncomp]*s[:ncomp]).reshape(ntemp, ngrav, ncomp)
+        return cls(tgrid, ggrid, wave, mean, vt[:ncomp], weights, tol=tol, maxerr=float(maxerr))
+
+
+    def subset(self, tgrid, ggrid, wave):
+        """
+        Returns the emulator restricted to a contiguous part of its grid
+
+        Used to apply an emulator of the full grid to a model that only read
+        part of the grid. See :py:func:`WDmodel.io.read_model_grid`.
+
+        Parameters
+        ----------
+        tgrid, ggrid, wave : array-like
+            The temperature, surface gravity and wavelength arrays of the
+            part of the grid
+
+        Returns
+        -------
+        out : :py:class:`WDmodel.WDmodel.WDmodel_Emulator` instance
+
+        Raises
+        ------
+        ValueError
+            If the arrays are not a contiguous part of the emulator grid
+        """
+        slices = []
+        for name, node, sub in (('teff', self._tgrid, tgrid), ('logg', self._ggrid, ggrid),\
+                ('wave', self._wave, wave)):
+            start = int(np.searchsorted(node, sub[0]))
+            stop  = start + len(sub)
+            if stop > len(node) or not np.allclose(node[start:stop], sub, rtol=1e-10, atol=0.):
+                message = 'Emulator {} grid does not match the model grid'.format(name)
+                raise ValueError(message)
+            slices.append(slice(start, stop))
+        tslice, gslice, wslice = slices
+        return WDmodel_Emulator(self._tgrid[tslice], self._ggrid[gslice], self._wave[wslice],\
+                self._mean[wslice], self._comps[:, wslice], self._weights[tslice, gslice],\
+                tol=self.tol, maxerr=self.maxerr)
+
+
+    def _get_weights(self, teff, logg):
+        """
+        Returns the bilinearly interpolated component weights at ``teff``,
+        ``logg``, with the same bracketing as
+        :py:func:`WDmodel.WDmodel.WDmodel._get_grid_weights`
+        """
+        if not ((self._tgrid[0] <= teff <= self._tgrid[-1]) and (self._ggrid[0] <= logg <= self._ggrid[-1])):
+            message = 'One of the requested teff, logg = ({}, {}) is out of bounds of the model grid'.format(teff, logg)
+            raise ValueError(message)
+        it = min(max(int(np.searchsorted(self._tgrid, teff)) - 1, 0), self._ntemp - 2)
+        ig = min(max(int(np.searchsorted(self._ggrid, logg)) - 1, 0), self._ngrav - 2)
+        tfac = (teff - self._tgrid[it])/(self._tgrid[it+1] - self._tgrid[it])
+        gfac = (logg - self._ggrid[ig])/(self._ggrid[ig+1] - self._ggrid[ig])
+        weights = self._weights
+        out  = weights[it,   ig  ]*((1. - tfac)*(1. - gfac))
+        out += weights[it+1, ig  ]*(tfac*(1. - gfac))
+        out += weights[it,   ig+1]*((1. - tfac)*gfac)
+        out += weights[it+1, ig+1]*(tfac*gfac)
+        return out
+
+
+    def _get_weights_batch(self, teff, logg):
+        """
+        Vectorized version of
+        :py:func:`WDmodel.WDmodel.WDmodel_Emulator._get_weights`. Returns an
+        array with shape ``(len(teff), ncomp)``
+        """
+        if not (np.all((teff >= self._tgrid[0]) & (teff <= self._tgrid[-1])) and\
+                np.all((logg >= self._ggrid[0]) & (logg <= self._ggrid[-1]))):
+            message = 'One of the requested teff, logg is out of bounds of the model grid'
+            raise ValueError(message)
+        it = np.clip(np.searchsorted(self._tgrid, teff) - 1, 0, self._ntemp - 2)
+        ig = np.clip(np.searchsorted(self._ggrid, logg) - 1, 0, self._ngrav - 2)
+        tfac = ((teff - self._tgrid[it])/(self._tgrid[it+1] - self._tgrid[it]))[:, np.newaxis]
+        gfac = ((logg - self._ggrid[ig])/(self._ggrid[ig+1] - self._ggrid[ig]))[:, np.newaxis]
+        weights = self._weights
+        out  = weights[it,   ig  ]*((1. - tfac)*(1. - gfac))
+        out += weights[it+1, ig  ]*(tfac*(1. - gfac))
+        out += weights[it,   ig+1]*((1. - tfac)*gfac)
+        out += weights[it+1, ig+1]*(tfac*gfac)
+        return out
+
+
+    def _get_grid_model(self, teff, logg, lo=0, hi=None):
+        """
+        Returns the emulated ``log10`` model flux at ``teff``, ``logg`` on
+        the grid wavelengths ``_wave[lo:hi]``. See
+        :py:func:`WDmodel.WDmodel.WDmodel._get_grid_model`
+        """
+        return self._mean[lo:hi] + np.dot(self._get_weights(teff, logg), self._comps[:, lo:hi])
+
+
+    def _get_grid_model_grad(self, teff, logg, lo=0, hi=None):
+        """
+        Returns the emulated ``log10`` model flux at ``teff``, ``logg`` on
+        the grid wavelengths ``_wave[lo:hi]`` and its partial derivatives
+        with respect to ``teff`` and ``logg``. See
+        :py:func:`WDmodel.WDmodel.WDmodel._get_grid_model_grad`
+        """
+        if not ((self._tgrid[0] <= teff <= self._tgrid[-1]) and (self._ggrid[0] <= logg <= self._ggrid[-1])):
+            message = 'One of the requested teff, logg = ({}, {}) is out of bounds of the model grid'.format(teff, logg)
+            raise ValueError(message)
+        it = min(max(int(np.searchsorted(self._tgrid, teff)) - 1, 0), self._ntemp - 2)
+        ig = min(max(int(np.searchsorted(self._ggrid, logg)) - 1, 0), self._ngrav - 2)
+        tfac = (teff - self._tgrid[it])/(self._tgrid[it+1] - self._tgrid[it])
+        gfac = (logg - self._ggrid[ig])/(self._ggrid[ig+1] - self._ggrid[ig])
+        weights = self._weights
+        w00 = weights[it,   ig  ]
+        w10 = weights[it+1, ig  ]
+        w01 = weights[it,   ig+1]
+        w11 = weights[it+1, ig+1]
+        w  = w00*((1. - tfac)*(1. - gfac)) + w10*(tfac*(1. - gfac)) + w01*((1. - tfac)*gfac) + w11*(tfac*gfac)
+        dt = ((w10 - w00)*(1. - gfac) + (w11 - w01)*gfac)/(self._tgrid[it+1] - self._tgrid[it])
+        dg = ((w01 - w00)*(1. - tfac) + (w11 - w10)*tfac)/(self._ggrid[ig+1] - self._ggrid[ig])
+        comps = self._comps[:, lo:hi]
+        out = self._mean[lo:hi] + np.dot(w, comps)
+        return out, np.dot(dt, comps), np.dot(dg, comps)
+
+
+    def _get_grid_model_batch(self, teff, logg):
+        """
+        Returns the emulated ``log10`` model flux for arrays of ``teff``,
+        ``logg`` on the grid wavelengths with shape ``(len(teff), nwave)``
+        """
+        return self._mean + np.dot(self._get_weights_batch(teff, logg), self._comps)
+
+
+    def _get_model(self, teff, logg, wave=None, log=False):
+        """
+        Returns the emulated model flux given ``teff`` and ``logg`` at
+        wavelengths ``wave``
+
+        Same interface as :py:func:`WDmodel.WDmodel.WDmodel._get_model`.
+
+        Parameters
+        ----------
+        teff : float
+            Desired model white dwarf atmosphere temperature (in Kelvin)
+        logg : float
+            Desired model white dwarf atmosphere surface gravity (in dex)
+        wave : array-like, optional
+            Desired wavelengths at which to compute the model atmosphere flux.
+            If not supplied, the full model wavelength grid is returned.
+        log : bool, optional
+            Return the log10 flux rather than the flux.
+
+        Returns
+        -------
+        flux : array-like
+            Emulated model flux at ``teff``, ``logg`` and wavelengths ``wave``.
+
+        Notes
+        -----
+            Inputs ``teff``, ``logg`` and ``wave`` must be within the bounds
+            of the grid.
+        """
+        out = self._get_grid_model(teff, logg)
+        if wave is not None:
+            out = np.interp(np.log10(wave), self._lwave, out)
+
+        if log:
+            return out
+
+        return (10.**out)
+
+
+class WDmodel_ConvolvedGrid(object):
+    """
+    Model grid convolved with the instrumental broadening and resampled onto
+    a fixed spectrum wavelength array
+
+    When ``fwhm`` is well constrained, it only varies over a narrow range
+    during a fit, but :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model`
+    convolves the model on every call. This class tabulates the ``log10``
+    of the unreddened model, resampled onto the shifted spectrum wavelengths
+    and convolved, on the model grid ``teff`` and ``logg`` nodes and a
+    uniform grid of ``fwhm``. The observed model is then interpolated
+    trilinearly in ``teff``, ``logg`` and ``fwhm`` instead of being
+    convolved, and reddened after the convolution rather than before.
+
+    Parameters
+    ----------
+    wave : array-like
+        The spectrum wavelengths the grid is tabulated for
+    tgrid : array-like
+        Array of grid temperature values in Kelvin
+    ggrid : array-like
+        Array of grid surface gravity values in dex
+    fgrid : array-like
+        Array of grid ``fwhm`` values in Angstrom
+    lflux : array-like
+        The ``log10`` of the convolved model flux with shape ``(len(tgrid),
+        len(ggrid), len(fgrid), len(wave))``
+    shift : float, optional
+        Linear wavelength shift in Angstroms the grid is tabulated for.
+        Default is ``0.``
+    rvel : float, optional
+        Radial velocity shift in km/s the grid is tabulated for. Default is
+        ``0.``
+    pixel_scale : float, optional
+        Jacobian of the transformation between wavelength in Angstrom and
+        pixels the grid is tabulated for. Default is ``1.``
+
+    Attributes
+    ----------
+    wave : array-like
+        The input ``wave``
+    shift : float
+        The input ``shift``
+    rvel : float
+        The input ``rvel``
+    pixel_scale : float
+        The input ``pixel_scale``
+    maxerr : None or float
+        The maximum relative error in flux with respect to the exact
+        convolution, set by :py:meth:`validate`
+
+    Notes
+    -----
+        The grid is only valid for the ``shift``, ``rvel`` and
+        ``pixel_scale`` it was tabulated for, and within the bounds of
+        ``tgrid``, ``ggrid`` and ``fgrid``. Use :py:meth:`in_bounds` to check
+        this, and compute the exact model otherwise.
+        :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` does this
+        automatically. It cannot be used with the plasma models, since those
+        are not linear in the model flux.
+
+        The extinction curve varies slowly over the width of the kernel, so
+        reddening after the convolution is a small approximation. It is
+        included in the error measured by :py:meth:`validate`.
+    """
+    def __init__(self, wave, tgrid, ggrid, fgrid, lflux, shift=0., rvel=0., pixel_scale=1.):
+        self.wave   = np.asarray(wave, dtype=np.float64)
+        self._tgrid = np.asarray(tgrid, dtype=np.float64)
+        self._ggrid = np.asarray(ggrid, dtype=np.float64)
+        self._fgrid = np.asarray(fgrid, dtype=np.float64)
+        self._lflux = np.ascontiguousarray(lflux, dtype=np.float64)
+        self.shift  = shift
+        self.rvel   = rvel
+        self.pixel_scale = pixel_scale
+        self.maxerr = None
+        shape = (len(self._tgrid), len(self._ggrid), len(self._fgrid), len(self.wave))
+        if self._lflux.shape != shape:
+            message = 'Convolved grid shape {} does not match grids {}'.format(self._lflux.shape, shape)
+            raise ValueError(message)
+        if min(shape[:3]) < 2:
+            message = 'Convolved grid must have at least two nodes in teff, logg and fwhm {}'.format(shape[:3])
+            raise ValueError(message)
+
+
+    @classmethod
+    def from_model(cls, bmodel, fwhmbounds, shift=0., rvel=0., nfwhm=11, teffbounds=None, loggbounds=None):
+        """
+        Tabulates the convolved model for a bound model
+
+        Parameters
+        ----------
+        bmodel : :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` instance
+            The model bound to the spectrum wavelengths
+        fwhmbounds : 2-tuple
+            Lower and upper bound of the ``fwhm`` grid in Angstrom
+        shift : float, optional
+            Linear wavelength shift in Angstroms. Default is ``0.``
+        rvel : float, optional
+            Radial velocity shift in km/s. Default is ``0.``
+        nfwhm : int, optional
+            Number of ``fwhm`` nodes. Default is ``11``
+        teffbounds : None or 2-tuple, optional
+            Only tabulate the model grid nodes needed for these temperature
+            bounds. See :py:func:`WDmodel.io.read_model_grid`
+        loggbounds : None or 2-tuple, optional
+            Only tabulate the model grid nodes needed for these surface
+            gravity bounds
+
+        Returns
+        -------
+        out : :py:class:`WDmodel.WDmodel.WDmodel_ConvolvedGrid` instance
+
+        Raises
+        ------
+        ValueError
+            If the model is a plasma model, or ``fwhmbounds`` or ``nfwhm``
+            are invalid
+        """
+        model = bmodel.model
+        if model._sptype in ('emission', 'transmission'):
+            message = 'Convolved grid cannot be used with sptype {}'.format(model._sptype)
+            raise ValueError(message)
+        fwhmlo, fwhmhi = fwhmbounds
+        if not (0. < fwhmlo < fwhmhi):
+            message = 'Convolved grid fwhm bounds must be positive and increasing ({}, {})'.format(fwhmlo, fwhmhi)
+            raise ValueError(message)
+        if nfwhm < 2:
+            message = 'Number of convolved grid fwhm nodes must be GE 2 ({})'.format(nfwhm)
+            raise ValueError(message)
+
+        tgrid = model._tgrid[io._get_grid_slice(model._tgrid, teffbounds)]
+        ggrid = model._ggrid[io._get_grid_slice(model._ggrid, loggbounds)]
+        fgrid = np.linspace(fwhmlo, fwhmhi, nfwhm)
+        gsig  = fgrid/model._fwhm_to_sigma * bmodel.pixel_scale
+
+        bmodel._set_tables(shift, rvel)
+        lflux = np.empty((len(tgrid), len(ggrid), nfwhm, len(bmodel.wave)))
+        for i, teff in enumerate(tgrid):
+            for j, logg in enumerate(ggrid):
+                mod = 10.**bmodel._resample(bmodel._get_sub_model(teff, logg))
+                for k in range(nfwhm):
+                    lflux[i, j, k] = np.log10(model._convolver.convolve(mod, gsig[k]))
+        return cls(bmodel.wave, tgrid, ggrid, fgrid, lflux, shift=shift, rvel=rvel, pixel_scale=bmodel.pixel_scale)
+
+
+    def in_bounds(self, teff, logg, fwhm, shift, rvel, pixel_scale):
+        """
+        Returns ``True`` if the grid can be used for all of the parameters,
+        which may be scalars or arrays
+        """
+        tgrid, ggrid, fgrid = self._tgrid, self._ggrid, self._fgrid
+        return bool(np.all(np.isclose(shift, self.shift)) and np.all(np.isclose(rvel, self.rvel))\
+                and np.isclose(pixel_scale, self.pixel_scale)\
+                and np.all((teff >= tgrid[0]) & (teff <= tgrid[-1]))\
+                and np.all((logg >= ggrid[0]) & (logg <= ggrid[-1]))\
+                and np.all((fwhm >= fgrid[0]) & (fwhm <= fgrid[-1])))
+
+
+    def _get_lflux(self, teff, logg, fwhm):
+        """
+        Returns the trilinearly interpolated ``log10`` convolved model flux
+        at ``teff``, ``logg`` and ``fwhm``. The parameters must be in bounds.
+        """
+        block = []
+        weights = 1.
+        for grid, x in ((self._tgrid, teff), (self._ggrid, logg), (self._fgrid, fwhm)):
+            ind = min(max(int(np.searchsorted(grid, x)) - 1, 0), len(grid) - 2)
+            frac = (x - grid[ind])/(grid[ind+1] - grid[ind])
+            block.append(slice(ind, ind+2))
+            weights = np.multiply.outer(weights, (1. - frac, frac))
+        # contract the 2x2x2 block of nodes around the parameters
+        return np.einsum('ijk,ijkl->l', weights, self._lflux[tuple(block)])
+
+
+    def _get_lflux_batch(self, teff, logg, fwhm):
+        """
+        Vectorized version of
+        :py:func:`WDmodel.WDmodel.WDmodel_ConvolvedGrid._get_lflux` with shape
+        ``(len(teff), len(wave))``
+        """
+        teff = np.atleast_1d(teff)
+        logg = np.atleast_1d(logg)
+        fwhm = np.atleast_1d(fwhm)
+        out = 0.
+        nodes = []
+        for grid, x in ((self._tgrid, teff), (self._ggrid, logg), (self._fgrid, fwhm)):
+            ind = np.clip(np.searchsorted(grid, x) - 1, 0, len(grid) - 2)
+            frac = ((x - grid[ind])/(grid[ind+1] - grid[ind]))[:, np.newaxis]
+            nodes.append(((ind, 1. - frac), (ind+1, frac)))
+        for it, wt in nodes[0]:
+            for ig, wg in nodes[1]:
+                for ik, wk in nodes[2]:
+                    out = out + self._lflux[it, ig, ik]*(wt*wg*wk)
+        return out
+
+
+    def validate(self, bmodel, ntest=100, seed=None, avbounds=(0., 1.), rv=3.1):
+        """
+        Returns the maximum relative error in flux of the reddened model from
+        the grid with respect to the exact convolution
+
+        Parameters
+        ----------
+        bmodel : :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` instance
+            The model bound to the spectrum wavelengths the grid was made with
+        ntest : int, optional
+            Number of random parameter vectors within the grid. Default is
+            ``100``
+        seed : None or int, optional
+            Seed for the random parameter vectors
+        avbounds : 2-tuple, optional
+            Range of ``av`` of the random parameter vectors. Default is ``(0.,
+            1.)``
+        rv : float, optional
+            The reddening law parameter, :math:`R_V`. Default is ``3.1``
+
+        Returns
+        -------
+        maxerr : float
+            The maximum relative error in flux. Also saved as :py:attr:`maxerr`
+        """
+        model = bmodel.model
+        bmodel._set_tables(self.shift, self.rvel)
+        rng = np.random.RandomState(seed)
+        maxerr = 0.
+        for _ in range(ntest):
+            teff = rng.uniform(self._tgrid[0], self._tgrid[-1])
+            logg = rng.uniform(self._ggrid[0], self._ggrid[-1])
+            fwhm = rng.uniform(self._fgrid[0], self._fgrid[-1])
+            av   = rng.uniform(*avbounds)
+            mod  = 10.**bmodel._resample(bmodel._get_sub_model(teff, logg))
+            ref  = bmodel._redden(mod, av, rv)
+            ref  = model._convolver.convolve(ref, fwhm/model._fwhm_to_sigma * self.pixel_scale)
+            out  = bmodel._get_convolved_model(teff, logg, av, fwhm, rv, convgrid=self)
+            maxerr = max(maxerr, np.max(np.abs(out/ref - 1.)))
+        self.maxerr = float(maxerr)
+        return self.maxerr
+
+
+class WDmodel_BoundModel(object):
+    """
+    DA White Dwarf forward model bound to a fixed wavelength array
+
+    The spectrum wavelengths do not change over the course of a fit, but
+    :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model` recomputes their
+    ``log10`` and searches the model grid for them on every call. This class
+    precomputes the resampling index and weight tables for the (shifted)
+    wavelengths once, restricts the grid interpolation to the subrange of the
+    model wavelengths that actually brackets them, and stores the pixel scale.
+    The tables are only rebuilt when ``shift`` or ``rvel`` change.
+
+    The output of :py:func:`_get_obs_model` and :py:func:`_get_full_obs_model`
+    is the same as the corresponding :py:class:`WDmodel.WDmodel.WDmodel`
+    methods, except that the extinction curve at the observed wavelengths is
+    resampled from the model grid wavelengths (see :py:func:`_redden`). The
+    output is identical if ``rv`` is on the lattice of
+    :py:class:`WDmodel.WDmodel.WDmodel_Reddening`, which includes the default
+    ``rv = 3.1``. Otherwise, the linear interpolation of the curve in ``rv``
+    limits the relative difference to ``~2E-6`` for the bound and batch
+    outputs, and ``~5E-5`` for the full SED. They have the same call
+    signature, so an instance can be passed anywhere the private model
+    methods are used, such as
+    :py:meth:`WDmodel.likelihood.WDmodel_Likelihood.get_value`. Calls with a
+    different wavelength array are passed through to the unbound model.
+
+    If a ``cache`` is supplied, the output of each stage of the model is
+    cached, keyed on only the parameters that stage depends on:
+
+    ================= ==========================================================
+         stage          depends on
+    ================= ==========================================================
+    ``'tables'``      ``shift``, ``rvel``
+    ``'interp'``      ``teff``, ``logg`` (and the grid subrange)
+    ``'resample'``    ``teff``, ``logg``, ``shift``, ``rvel``
+    ``'redden'``      ``'resample'`` + ``av``, ``rv``
+    ``'plasma'``      ``'redden'`` + ``length`` (only if ``sptype`` is set)
+    ``'convolve'``    ``'plasma'`` or ``'redden'`` + ``fwhm``
+    ``'sed'``         ``teff``, ``logg``, ``av``, ``rv`` (+ ``length``)
+    ``'sedconvolve'`` ``'sed'`` + ``shift``, ``rvel``, ``fwhm``
+    ================= ==========================================================
+
+    The last two stages are the full SED and the observed model computed
+    from it by :py:func:`_get_full_obs_model`. When a sampler changes only
+    some of the parameters, the stages that do not depend on them are reused.
+
+    If a convolved grid is set with :py:meth:`set_convolved_grid`, the
+    observed model is interpolated in ``fwhm`` from the grid instead of
+    being convolved, whenever the grid covers the parameters.
+
+    Parameters
+    ----------
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The DA White Dwarf SED model generator
+    wave : array-like
+        Wavelengths the model is bound to, sorted in ascending order
+    pixel_scale : float, optional
+        Jacobian of the transformation between wavelength in Angstrom and
+        pixels. Default is ``1.``
+    cache : None or :py:class:`WDmodel.cache.WDmodel_StageCache` instance, optional
+        Cache for the stages of the model. Default is ``None`` i.e. no caching.
+
+    Attributes
+    ----------
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The input ``model``
+    wave : array-like
+        Contiguous copy of the input ``wave``
+    pixel_scale : float
+        The input ``pixel_scale``
+    cache : None or :py:class:`WDmodel.cache.WDmodel_StageCache` instance
+        The input ``cache``
+    _table_key : tuple
+        ``(shift, rvel)`` for which the resampling tables were computed
+    _owave : array-like
+        ``wave`` shifted by ``shift`` and ``rvel``
+    _owave_new : bool
+        ``True`` if ``_owave`` was just computed for a new ``shift`` and
+        ``rvel``, and has not been used yet. See :py:meth:`_plasma`
+    _lo : int
+        Index of the first model grid wavelength used for resampling
+    _hi : int
+        Index after the last model grid wavelength used for resampling
+    _ind : array-like
+        Index of the model grid wavelength in the subrange ``[_lo:_hi]`` at or
+        below each element of ``_owave``
+    _frac : array-like
+        Fractional distance of ``log10(_owave)`` between the bracketing model
+        grid wavelengths
+    _ext_key : tuple
+        ``(shift, rvel, rv)`` for which ``_ext_curve`` was computed
+    _ext_curve : array-like
+        The extinction curve :math:`A_{\lambda}/A_V` at ``_owave``
+    convgrid : None or :py:class:`WDmodel.WDmodel.WDmodel_ConvolvedGrid` instance
+        The convolved grid set by :py:meth:`set_convolved_grid`
+    _grad_names : tuple
+        The parameters, in order, of the partial derivatives returned by
+        :py:func:`_get_obs_model_grad`
+
+    Notes
+    -----
+        Any attribute not defined on this class is looked up on ``model``, so
+        the instance can stand in for the model it wraps.
+    """
+    # the parameters, in order, that the model gradients are computed for
+    _grad_names = ('teff', 'logg', 'av', 'rv', 'fwhm', 'shift', 'rvel')
+
+    def __init__(self, model, wave, pixel_scale=1., cache=None):
+        self.model = model
+        self.wave  = np.ascontiguousarray(wave, dtype=np.float64)
+        self.pixel_scale = pixel_scale
+        self.cache = cache
+        self._table_key = None
+        self._owave_new = False
+        self._ext_key = None
+        self._ext_curve = None
+        self._ext_slope = None
+        self.convgrid = None
+        self._set_tables(0., 0.)
+
+
+    def __getattr__(self, name):
+        # only called if the attribute isn't found normally
+        model = self.__dict__.get('model')
+        if model is None or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(model, name)
+
+
+    def _is_bound(self, wave):
+        """
+        Returns ``True`` if ``wave`` is the wavelength array the model is bound to
+        """
+        if wave is self.wave:
+            return True
+        return (np.shape(wave) == self.wave.shape) and np.array_equal(wave, self.wave)
+
+
+    def _set_tables(self, shift, rvel):
+        """
+        Computes the resampling tables for the bound wavelengths shifted by
+        ``shift`` and ``rvel``
+
+        Uses :py:func:`WDmodel.WDmodel.WDmodel._get_resample_table`. Does
+        nothing if the tables for ``(shift, rvel)`` are already computed.
+
+        Parameters
+        ----------
+        shift : float
+            Linear wavelength shift in Angstroms
+        rvel : float
+            Radial velocity shift in km/s
+        """
+        key = (shift, rvel)
+        if key == self._table_key:
+            return
+        tables = None
+        if self.cache is not None:
+            tables = self.cache.get('tables', key)
+        if tables is None:
+            owave = self.wave*(1. - rvel*1000./c.value) - shift
+            ind, frac = self.model._get_resample_table(owave)
+            lo = ind.min()
+            hi = ind.max() + 2
+            tables = (lo, hi, ind - lo, frac, owave)
+            if self.cache is not None:
+                self.cache.put('tables', key, tables)
+            self._owave_new = True
+        else:
+            self._owave_new = False
+        self._lo, self._hi, self._ind, self._frac, self._owave = tables
+        self._table_key = key
+
+
+    def _get_sub_model(self, teff, logg):
+        """
+        Returns the interpolated ``log10`` model flux on the bound subrange of
+        the model grid wavelengths, ``_wave[_lo:_hi]``
+
+        Parameters
+        ----------
+        teff : float
+            Desired model white dwarf atmosphere temperature (in Kelvin)
+        logg : float
+            Desired model white dwarf atmosphere surface gravity (in dex)
+
+        Returns
+        -------
+        lflux : array-like
+            Interpolated ``log10`` model flux at ``teff``, ``logg``
+        """
+        return self.model._get_grid_model(teff, logg, self._lo, self._hi)
+
+
+    def _resample(self, sub):
+        """
+        Linearly interpolates ``sub``, defined on ``_wave[_lo:_hi]``, onto
+        the shifted bound wavelengths using the precomputed tables
+        """
+        lower = sub[self._ind]
+        return lower + (sub[self._ind+1] - lower)*self._frac
+
+
+    def _redden(self, mod, av, rv):
+        """
+        Reddens the model flux ``mod`` at the shifted bound wavelengths in
+        place
+
+        The extinction curve cached by
+        :py:attr:`WDmodel.WDmodel.WDmodel._reddening` on the model grid
+        wavelengths is resampled onto the shifted bound wavelengths with the
+        same tables as the model flux, so the reddening law is never evaluated
+        at the bound wavelengths. The resampled curve is reused until
+        ``shift``, ``rvel`` or ``rv`` change.
+        """
+        curve, _ = self._get_ext_curve(rv)
+        mod *= np.exp(curve*(WDmodel_Reddening._lnscale*av))
+        return mod
+
+
+    def _get_ext_curve(self, rv):
+        """
+        Returns the extinction curve :math:`A_{\lambda}/A_V` at the shifted
+        bound wavelengths and its gradient per pixel, resampled from the
+        cached curve on the model grid wavelengths. The curve is reused until
+        ``shift``, ``rvel`` or ``rv`` change.
+        """
+        key = self._table_key + (rv,)
+        if key != self._ext_key:
+            curve = self.model._reddening.get_curve(rv)[self._lo:self._hi]
+            self._ext_curve = self._resample(curve)
+            self._ext_slope = np.gradient(self._ext_curve)
+            self._ext_key = key
+        return self._ext_curve, self._ext_slope
+
+
+    def _observe(self, mod, teff, logg, av, fwhm, rv, pixel_scale, length):
+        """
+        Reddens, applies the plasma model if needed, and convolves the model
+        flux ``mod`` at the shifted bound wavelengths
+        """
+        mod = self._redden(mod, av, rv)
+        if self.model._sptype in ('emission', 'transmission'):
+            mod = self._plasma(mod, teff, logg, length)
+        gsig = fwhm/self.model._fwhm_to_sigma * pixel_scale
+        return self.model._convolver.convolve(mod, gsig)
+
+
+    def _plasma(self, mod, teff, logg, length):
+        """
+        Applies the plasma model to ``mod`` at the shifted bound wavelengths
+
+        The Planck function is only cached for ``_owave`` once it is reused,
+        so wavelengths shifted for a single evaluation, e.g. when ``shift`` or
+        ``rvel`` change on every step of a fit, bypass the cache as
+        :py:class:`WDmodel.WDmodel.WDmodel_Planck` requires.
+        """
+        cache = not self._owave_new
+        self._owave_new = False
+        return self.model.plasma(self._owave, mod, logg, teff, length, cache=cache)
+
+
+    def set_convolved_grid(self, fwhmbounds, shift=0., rvel=0., nfwhm=11, teffbounds=None, loggbounds=None,\
+            tol=1e-3, ntest=100, seed=None, avbounds=(0., 1.), rv=3.1):
+        """
+        Tabulates the model convolved with a range of ``fwhm`` on the bound
+        wavelengths, and uses it instead of convolving the model if it agrees
+        with the exact convolution
+
+        See :py:class:`WDmodel.WDmodel.WDmodel_ConvolvedGrid`. The grid is
+        used whenever ``shift``, ``rvel``, the pixel scale, ``teff``,
+        ``logg`` and ``fwhm`` are covered by it, and the exact model is
+        computed otherwise.
+
+        Parameters
+        ----------
+        fwhmbounds : 2-tuple
+            Lower and upper bound of the ``fwhm`` grid in Angstrom
+        shift : float, optional
+            Linear wavelength shift in Angstroms. Default is ``0.``
+        rvel : float, optional
+            Radial velocity shift in km/s. Default is ``0.``
+        nfwhm : int, optional
+            Number of ``fwhm`` nodes. Default is ``11``
+        teffbounds : None or 2-tuple, optional
+            Only tabulate the model grid nodes needed for these temperature
+            bounds
+        loggbounds : None or 2-tuple, optional
+            Only tabulate the model grid nodes needed for these surface
+            gravity bounds
+        tol : float, optional
+            Maximum relative error in flux with respect to the exact
+            convolution to use the grid. Default is ``1e-3``
+        ntest : int, optional
+            Number of random parameter vectors to validate the grid. Default
+            is ``100``
+        seed : None or int, optional
+            Seed for the random parameter vectors
+        avbounds : 2-tuple, optional
+            Range of ``av`` to validate the grid with. Default is ``(0., 1.)``
+        rv : float, optional
+            The reddening law parameter to validate the grid with. Default is
+            ``3.1``
+
+        Returns
+        -------
+        maxerr : float
+            The maximum relative error in flux of the grid
+
+        Notes
+        -----
+            If the error exceeds ``tol``, a ``RuntimeWarning`` is issued and
+            the grid is not used.
+        """
+        convgrid = WDmodel_ConvolvedGrid.from_model(self, fwhmbounds, shift=shift, rvel=rvel, nfwhm=nfwhm,\
+                teffbounds=teffbounds, loggbounds=loggbounds)
+        maxerr = convgrid.validate(self, ntest=ntest, seed=seed, avbounds=avbounds, rv=rv)
+        if maxerr > tol:
+            message = 'Convolved grid error {:.2e} exceeds tolerance {:g}. Convolving the model.'.format(maxerr, tol)
+            warnings.warn(message, RuntimeWarning)
+            self.convgrid = None
+        else:
+            self.convgrid = convgrid
+        return maxerr
+
+
+    def _use_convolved_grid(self, teff, logg, fwhm, shift, rvel, pixel_scale):
+        """
+        Returns ``True`` if the convolved grid covers the parameters
+        """
+        convgrid = self.convgrid
+        return convgrid is not None and convgrid.in_bounds(teff, logg, fwhm, shift, rvel, pixel_scale)
+
+
+    def _get_convolved_model(self, teff, logg, av, fwhm, rv, convgrid=None):
+        """
+        Returns the reddened observed model flux at the shifted bound
+        wavelengths interpolated from ``convgrid``, or :py:attr:`convgrid` if
+        it is ``None``
+        """
+        if convgrid is None:
+            convgrid = self.convgrid
+        curve, slope = self._get_ext_curve(rv)
+        lnmod = np.log(10.)*convgrid._get_lflux(teff, logg, fwhm)
+        gsig  = fwhm/self.model._fwhm_to_sigma * convgrid.pixel_scale
+        return self._redden_convolved(lnmod, curve, slope, WDmodel_Reddening._lnscale*av, gsig)
+
+
+    @staticmethod
+    def _redden_convolved(lnmod, curve, slope, scale, gsig):
+        """
+        Returns the convolved model flux with natural log ``lnmod`` reddened
+        by the extinction curve ``curve`` times ``scale``, corrected for the
+        variation of the extinction across the kernel
+
+        If the log of the extinction is locally linear with ``slope*scale``
+        per pixel, the product of the extinction and a Gaussian kernel of
+        ``gsig`` pixels is the kernel shifted by ``slope*scale*gsig**2``
+        pixels and scaled by ``exp((slope*scale*gsig)**2/2)``. The shift is
+        applied to ``lnmod`` to first order. Works on the last axis of the
+        arrays, with ``scale`` and ``gsig`` broadcast against the other axes.
+        """
+        gsig  = np.asarray(gsig)
+        if gsig.ndim:
+            gsig = gsig[..., np.newaxis]
+        slope = slope*scale
+        # same as np.gradient along the last axis, without the overhead
+        grad = np.empty_like(lnmod)
+        grad[..., 1:-1] = 0.5*(lnmod[..., 2:] - lnmod[..., :-2])
+        grad[..., 0]  = lnmod[..., 1] - lnmod[..., 0]
+        grad[..., -1] = lnmod[..., -1] - lnmod[..., -2]
+        grad += 0.5*slope
+        grad *= slope*gsig**2.
+        grad += curve*scale
+        grad += lnmod
+        return np.exp(grad)
+
+
+    def _get_convolved_model_batch(self, teff, logg, av, fwhm, shift, rvel, rv):
+        """
+        Returns the reddened observed model flux at the shifted bound
+        wavelengths interpolated from the convolved grid for arrays of
+        parameters, with shape ``(len(teff), len(wave))``
+        """
+        self._set_tables(shift[0], rvel[0])
+        lnmod = np.log(10.)*self.convgrid._get_lflux_batch(teff, logg, fwhm)
+        gsig  = fwhm/self.model._fwhm_to_sigma * self.convgrid.pixel_scale
+        scale = WDmodel_Reddening._lnscale*av[:, np.newaxis]
+        mod   = np.empty_like(lnmod)
+        for thisrv in np.unique(rv):
+            rows  = (rv == thisrv)
+            curve, slope = self._get_ext_curve(thisrv)
+            mod[rows] = self._redden_convolved(lnmod[rows], curve, slope, scale[rows], gsig[rows])
+        return mod
+
+
+    def _get_cached_obs_model(self, teff, logg, av, fwhm, shift, rvel, rv, pixel_scale, length):
+        """
+        Returns the observed model flux at the shifted bound wavelengths,
+        reusing cached stages
+
+        Looks up the stages from the last to the first, and only computes the
+        stages after the last one that was found in the cache. The returned
+        array is owned by the cache and must not be modified.
+        """
+        cache  = self.cache
+        plasma = self.model._sptype in ('emission', 'transmission')
+        rkey = (teff, logg, shift, rvel)
+        akey = rkey + (av, rv)
+        pkey = akey + (length,)
+        ckey = (pkey if plasma else akey) + (fwhm, pixel_scale)
+
+        mod = cache.get('convolve', ckey)
+        if mod is not None:
+            return mod
+
+        mod = cache.get('plasma', pkey) if plasma else None
+        if mod is None:
+            mod = cache.get('redden', akey)
+            if mod is None:
+                mod = cache.get('resample', rkey)
+                if mod is None:
+                    ikey = (teff, logg, self._lo, self._hi)
+                    sub  = cache.get('interp', ikey)
+                    if sub is None:
+                        sub = self._get_sub_model(teff, logg)
+                        cache.put('interp', ikey, sub)
+                    mod = 10.**self._resample(sub)
+                    cache.put('resample', rkey, mod)
+                # reddening is in place
+                mod = self._redden(mod.copy(), av, rv)
+                cache.put('redden', akey, mod)
+            if plasma:
+                mod = self._plasma(mod, teff, logg, length)
+                cache.put('plasma', pkey, mod)
+
+        gsig = fwhm/self.model._fwhm_to_sigma * pixel_scale
+        mod  = self.model._convolver.convolve(mod, gsig)
+        cache.put('convolve', ckey, mod)
+        return mod
+
+
+    def _get_sed(self, teff, logg, av, rv, length):
+        """
+        Returns the full reddened model SED on the model grid wavelengths,
+        reusing the cached SED if possible. The returned array must not be
+        modified.
+        """
+        model = self.model
+        plasma = model._sptype in ('emission', 'transmission')
+        skey = (teff, logg, av, rv, length) if plasma else (teff, logg, av, rv)
+        mod = None
+        if self.cache is not None:
+            mod = self.cache.get('sed', skey)
+        if mod is None:
+            mod  = model._get_model(teff, logg)
+            mod  = model.reddening(model._wave, mod, av, rv=rv)
+            if plasma:
+                mod = model.plasma(model._wave, mod, logg, teff, length, cache=True)
+            if self.cache is not None:
+                self.cache.put('sed', skey, mod)
+        return skey, mod
+
+
+    def _get_obs_model(self, teff, logg, av, fwhm, wave, shift, rvel, rv=3.1, log=False, pixel_scale=None, length=12.):
+        """
+        Returns the observed model flux given ``teff``, ``logg``, ``av``, ``rv``,
+        ``fwhm`` (for Gaussian instrumental broadening) and wavelengths ``wave``
+
+        Same as :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model` but uses the
+        precomputed resampling tables if ``wave`` is the bound wavelength
+        array. If ``pixel_scale`` is ``None``, the bound pixel scale is used.
+        See :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model` for a
+        description of the parameters and output.
+        """
+        if pixel_scale is None:
+            pixel_scale = self.pixel_scale
+        if not self._is_bound(wave):
+            return self.model._get_obs_model(teff, logg, av, fwhm, wave, shift, rvel,\
+                    rv=rv, log=log, pixel_scale=pixel_scale, length=length)
+        self._set_tables(shift, rvel)
+        if self._use_convolved_grid(teff, logg, fwhm, shift, rvel, pixel_scale):
+            mod = self._get_convolved_model(teff, logg, av, fwhm, rv)
+            if log:
+                mod = np.log10(mod)
+            return mod
+        if self.cache is not None:
+            mod = self._get_cached_obs_model(teff, logg, av, fwhm, shift, rvel, rv, pixel_scale, length)
+            if log:
+                return np.log10(mod)
+            return mod.copy()
+        mod = 10.**self._resample(self._get_sub_model(teff, logg))
+        mod = self._observe(mod, teff, logg, av, fwhm, rv, pixel_scale, length)
+        if log:
+            mod = np.log10(mod)
+        return mod
+
+
+    def _get_full_obs_model(self, teff, logg, av, fwhm, wave, shift, rvel, rv=3.1, log=False, pixel_scale=None, length=12.):
+        """
+        Returns the observed model flux given ``teff``, ``logg``, ``av``, ``rv``,
+        ``fwhm`` (for Gaussian instrumental broadening) at wavelengths, ``wave`` as
+        well as the full SED.
+
+        Same as :py:func:`WDmodel.WDmodel.WDmodel._get_full_obs_model` but
+        uses the precomputed resampling tables if ``wave`` is the bound
+        wavelength array. If ``pixel_scale`` is ``None``, the bound pixel
+        scale is used. See
+        :py:func:`WDmodel.WDmodel.WDmodel._get_full_obs_model` for a
+        description of the parameters and output.
+        """
+        if pixel_scale is None:
+            pixel_scale = self.pixel_scale
+        model = self.model
+        if not self._is_bound(wave):
+            return model._get_full_obs_model(teff, logg, av, fwhm, wave, shift, rvel,\
+                    rv=rv, log=log, pixel_scale=pixel_scale, length=length)
+        self._set_tables(shift, rvel)
+        skey, mod = self._get_sed(teff, logg, av, rv, length)
+        okey = skey + (shift, rvel, fwhm, pixel_scale)
+        omod = None
+        if self.cache is not None:
+            omod = self.cache.get('sedconvolve', okey)
+        if omod is None:
+            if self._use_convolved_grid(teff, logg, fwhm, shift, rvel, pixel_scale):
+                omod = self._get_convolved_model(teff, logg, av, fwhm, rv)
+            else:
+                omod = 10.**self._resample(np.log10(mod[self._lo:self._hi]))
+                gsig = fwhm/model._fwhm_to_sigma * pixel_scale
+                omod = model._convolver.convolve(omod, gsig)
+            if self.cache is not None:
+                self.cache.put('sedconvolve', okey, omod)
+        if log:
+            omod = np.log10(omod)
+            mod  = np.log10(mod)
+        else:
+            omod = omod.copy()
+        names=str('wave,flux')
+        wout = model._wave*(1. + rvel*1000./c.value) + shift
+        mod = np.rec.fromarrays((wout, mod), names=names)
+        return omod, mod
+
+
+    def _get_obs_model_batch(self, teff, logg, av, fwhm, wave, shift, rvel, rv=3.1, log=False, pixel_scale=None, length=12.):
+        """
+        Returns the observed model flux for arrays of ``teff``, ``logg``,
+        ``av``, ``rv``, ``fwhm``, ``shift``, ``rvel`` at wavelengths ``wave``
+
+        Same as :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model_batch`, but
+        interpolates the convolved grid if it is set and covers all the
+        parameters. If ``pixel_scale`` is ``None``, the bound pixel scale is
+        used.
+        """
+        if pixel_scale is None:
+            pixel_scale = self.pixel_scale
+        model = self.model
+        teff = np.atleast_1d(np.asarray(teff, dtype=np.float64))
+        nrow = len(teff)
+        logg, av, fwhm, shift, rvel, rv = [np.broadcast_to(np.asarray(x, dtype=np.float64), (nrow,))\
+                for x in (logg, av, fwhm, shift, rvel, rv)]
+        if not (self._is_bound(wave) and self._use_convolved_grid(teff, logg, fwhm, shift, rvel, pixel_scale)):
+            return model._get_obs_model_batch(teff, logg, av, fwhm, wave, shift, rvel,\
+                    rv=rv, log=log, pixel_scale=pixel_scale, length=length)
+        mod = self._get_convolved_model_batch(teff, logg, av, fwhm, shift, rvel, rv)
+        if log:
+            mod = np.log10(mod)
+        return mod
+
+
+    def _get_full_obs_model_batch(self, teff, logg, av, fwhm, wave, shift, rvel, rv=3.1, log=False, pixel_scale=None, length=12.):
+        """
+        Returns the observed model flux for arrays of ``teff``, ``logg``,
+        ``av``, ``rv``, ``fwhm``, ``shift``, ``rvel`` at wavelengths ``wave``
+        as well as the full SEDs
+
+        Same as :py:func:`WDmodel.WDmodel.WDmodel._get_full_obs_model_batch`,
+        but interpolates the observed model flux from the convolved grid if it
+        is set and covers all the parameters. If ``pixel_scale`` is ``None``,
+        the bound pixel scale is used.
+        """
+        if pixel_scale is None:
+            pixel_scale = self.pixel_scale
+        model = self.model
+        teff = np.atleast_1d(np.asarray(teff, dtype=np.float64))
+        nrow = len(teff)
+        logg, av, fwhm, shift, rvel, rv, length = [np.broadcast_to(np.asarray(x, dtype=np.float64), (nrow,))\
+                for x in (logg, av, fwhm, shift, rvel, rv, length)]
+        if not (self._is_bound(wave) and self._use_convolved_grid(teff, logg, fwhm, shift, rvel, pixel_scale)):
+            return model._get_full_obs_model_batch(teff, logg, av, fwhm, wave, shift, rvel,\
+                    rv=rv, log=log, pixel_scale=pixel_scale, length=length)
+        omod = self._get_convolved_model_batch(teff, logg, av, fwhm, shift, rvel, rv)
+        mod  = model._get_sed_batch(teff, logg, av, rv, length)
+        if log:
+            omod = np.log10(omod)
+            mod  = np.log10(mod)
+        names=str('wave,flux')
+        wout = model._wave[np.newaxis, :]*(1. + rvel[:, np.newaxis]*1000./c.value) + shift[:, np.newaxis]
+        mod = np.rec.fromarrays((wout, mod), names=names)
+        return omod, mod
+
+
+    def _check_grad(self):
+        """
+        Raises a :py:exc:`ValueError` if the gradient of the model is not
+        implemented for the model's ``sptype``
+        """
+        if self.model._sptype in ('emission', 'transmission'):
+            message = 'Gradients are only implemented for the DA white dwarf model, not sptype {}'.format(self.model._sptype)
+            raise ValueError(message)
+
+
+    def _get_obs_model_grad(self, teff, logg, av, fwhm, shift, rvel, rv=3.1, pixel_scale=None):
+        """
+        Returns the observed model flux at the bound wavelengths and its
+        partial derivatives with respect to the model parameters
+
+        Computes the same model as the exact path of :py:func:`_get_obs_model`
+        and propagates the derivatives analytically through the bilinear grid
+        interpolation (see
+        :py:func:`WDmodel.WDmodel.WDmodel._get_grid_model_grad`), the
+        resampling onto the shifted wavelengths, the reddening (see
+        :py:meth:`WDmodel.WDmodel.WDmodel_Reddening.get_curve_grad`) and the
+        Gaussian convolution (see
+        :py:meth:`WDmodel.WDmodel.WDmodel_Convolver.convolve_grad`). The
+        convolved grid and the stage cache are not used.
+
+        Parameters
+        ----------
+        teff : float
+            Desired model white dwarf atmosphere temperature (in Kelvin)
+        logg : float
+            Desired model white dwarf atmosphere surface gravity (in dex)
+        av : float
+            Extinction in the V band, :math:`A_V`
+        fwhm : float
+            Instrumental FWHM in Angstrom
+        shift : float
+            Linear wavelength shift in Angstroms
+        rvel : float
+            Radial velocity shift in km/s
+        rv : float, optional
+            The reddening law parameter, :math:`R_V`. Default is ``3.1``
+        pixel_scale : float or None, optional
+            Jacobian of the transformation between wavelength in Angstrom and
+            pixels. If ``None``, the bound pixel scale is used.
+
+        Returns
+        -------
+        flux : array-like
+            The observed model flux at the bound wavelengths
+        dflux : array-like
+            Array of shape ``(len(_grad_names), len(wave))`` with the partial
+            derivatives of ``flux`` with respect to the parameters in
+            :py:attr:`_grad_names`
+
+        Raises
+        ------
+        ValueError
+            If the model ``sptype`` is ``emission`` or ``transmission``
+
+        Notes
+        -----
+            The grid interpolation and resampling are piecewise linear, so the
+            derivatives with respect to ``teff``, ``logg``, ``shift`` and
+            ``rvel`` are those within the current grid cell and wavelength
+            interval, and are discontinuous at the nodes.
+        """
+        self._check_grad()
+        if pixel_scale is None:
+            pixel_scale = self.pixel_scale
+        model = self.model
+        self._set_tables(shift, rvel)
+        lo, hi = self._lo, self._hi
+        ind, frac = self._ind, self._frac
+
+        sub, dsub_teff, dsub_logg = model._get_grid_model_grad(teff, logg, lo, hi)
+        curve_sub, dcurve_sub = model._reddening.get_curve_grad(rv)
+        curve_sub  = curve_sub[lo:hi]
+        dcurve_sub = dcurve_sub[lo:hi]
+        curve = self._resample(curve_sub)
+
+        # slopes with respect to log10 of the shifted wavelengths, which are
+        # zero where the wavelengths are off the end of the model grid
+        lwave = model._lwave[lo:hi]
+        dlw   = lwave[ind+1] - lwave[ind]
+        lowave = np.log10(self._owave)
+        inside = (lowave >= model._lwave[0]) & (lowave <= model._lwave[-1]) & (dlw > 0)
+        dlw = np.where(inside, dlw, 1.)
+        lslope = np.where(inside, (sub[ind+1] - sub[ind])/dlw, 0.)
+        cslope = np.where(inside, (curve_sub[ind+1] - curve_sub[ind])/dlw, 0.)
+
+        ln10  = np.log(10.)
+        scale = WDmodel_Reddening._lnscale
+        mod = 10.**(sub[ind] + (sub[ind+1] - sub[ind])*frac)
+        mod *= np.exp(curve*(scale*av))
+
+        # d ln(mod)/d log10(owave) and d log10(owave)/d shift, d rvel
+        dlnmod_dlw = ln10*lslope + (scale*av)*cslope
+        dlw_dowave = 1./(self._owave*ln10)
+        dowave_drvel = -self.wave*1000./c.value
+
+        dmod = np.empty((6, len(mod)))
+        dmod[0] = mod*ln10*self._resample(dsub_teff)
+        dmod[1] = mod*ln10*self._resample(dsub_logg)
+        dmod[2] = mod*scale*curve
+        dmod[3] = mod*(scale*av)*self._resample(dcurve_sub)
+        dmod[4] = -mod*dlnmod_dlw*dlw_dowave
+        dmod[5] = mod*dlnmod_dlw*dlw_dowave*dowave_drvel
+
+        # convolution is linear, so the derivatives are convolved as well
+        gsig = fwhm/model._fwhm_to_sigma * pixel_scale
+        out, dout_dgsig = model._convolver.convolve_grad(mod, gsig)
+        dmod = model._convolver.convolve(dmod, gsig)
+
+        dflux = np.empty((len(self._grad_names), len(out)))
+        dflux[0:4] = dmod[0:4]
+        dflux[4]   = dout_dgsig*(pixel_scale/model._fwhm_to_sigma)
+        dflux[5:7] = dmod[4:6]
+        return out, dflux
+
+
+    def _get_sed_grad(self, teff, logg, av, rv=3.1):
+        """
+        Returns the full reddened model SED on the model grid wavelengths and
+        its partial derivatives with respect to ``teff``, ``logg``, ``av`` and
+        ``rv``
+
+        Parameters
+        ----------
+        teff : float
+            Desired model white dwarf atmosphere temperature (in Kelvin)
+        logg : float
+            Desired model white dwarf atmosphere surface gravity (in dex)
+        av : float
+            Extinction in the V band, :math:`A_V`
+        rv : float, optional
+            The reddening law parameter, :math:`R_V`. Default is ``3.1``
+
+        Returns
+        -------
+        flux : array-like
+            The reddened model SED at :py:attr:`WDmodel.WDmodel.WDmodel._wave`
+        dflux : array-like
+            Array of shape ``(4, len(_wave))`` with the partial derivatives of
+            ``flux`` with respect to ``teff``, ``logg``, ``av`` and ``rv``, the
+            first four of :py:attr:`_grad_names`
+
+        Raises
+        ------
+        ValueError
+            If the model ``sptype`` is ``emission`` or ``transmission``
+        """
+        self._check_grad()
+        model = self.model
+        lflux, dteff, dlogg = model._get_grid_model_grad(teff, logg)
+        curve, dcurve = model._reddening.get_curve_grad(rv)
+        ln10  = np.log(10.)
+        scale = WDmodel_Reddening._lnscale
+        mod = 10.**lflux
+        mod *= np.exp(curve*(scale*av))
+        dmod = np.empty((4, len(mod)))
+        dmod[0] = mod*ln10*dteff
+        dmod[1] = mod*ln10*dlogg
+        dmod[2] = mod*scale*curve
+        dmod[3] = mod*(scale*av)*dcurve
+        return mod, dmod
@@ -0,0 +1,229 @@
+# -*- coding: UTF-8 -*-
+"""
+Bounded least-recently-used caches for intermediate results of the model,
+with hit rate statistics.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from collections import OrderedDict
+import numpy as np
+
+__all__=['LRUCache', 'WDmodel_StageCache']
+
+
+def _nbytes(value):
+    """
+    Returns the approximate memory used by ``value`` in bytes, counting only
+    :py:class:`numpy.ndarray` data
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(x) for x in value)
+    return 0
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache with a bounded number of entries
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of entries to hold. Default is ``128``
+
+    Attributes
+    ----------
+    maxsize : int
+        The input ``maxsize``
+    hits : int
+        Number of lookups that found an entry
+    misses : int
+        Number of lookups that did not find an entry
+    nbytes : int
+        Approximate memory used by the cached arrays in bytes
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data   = OrderedDict()
+        self.hits    = 0
+        self.misses  = 0
+        self.nbytes  = 0
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def get(self, key):
+        """
+        Returns the value cached for ``key`` or ``None`` if there is none
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # re-insert to mark as most recently used
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+
+    def put(self, key, value):
+        """
+        Caches ``value`` for ``key``, evicting the least recently used entry if
+        the cache is full
+        """
+        if self.maxsize <= 0:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.nbytes -= _nbytes(old)
+        self._data[key] = value
+        self.nbytes += _nbytes(value)
+        while len(self._data) > self.maxsize:
+            self.popitem()
+
+
+    def popitem(self):
+        """
+        Evicts the least recently used entry
+        """
+        _, value = self._data.popitem(last=False)
+        self.nbytes -= _nbytes(value)
+
+
+    def clear(self):
+        """
+        Removes all the entries and resets the statistics
+        """
+        self._data.clear()
+        self.hits   = 0
+        self.misses = 0
+        self.nbytes = 0
+
+
+    # cached values are not sent to other processes
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d['_data']  = OrderedDict()
+        d['nbytes'] = 0
+        return d
+
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+
+
+class WDmodel_StageCache(object):
+    """
+    Dependency-aware cache for the stages of the forward model and likelihood
+
+    Holds one :py:class:`LRUCache` per named stage. Each stage is keyed on
+    the parameters its output depends on, so that a stage is reused when
+    only parameters that enter later stages change. The total memory used by
+    the cached arrays is bounded.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of entries to hold per stage. Default is ``128``
+    maxmem : float, optional
+        Maximum memory in MB to use for cached arrays across all stages.
+        Default is ``256.``
+
+    Attributes
+    ----------
+    maxsize : int
+        The input ``maxsize``
+    maxmem : float
+        The input ``maxmem``
+    stages : :py:class:`collections.OrderedDict`
+        Mapping of stage name to :py:class:`LRUCache` instance
+
+    Notes
+    -----
+        The stages used by
+        :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` and
+        :py:meth:`WDmodel.likelihood.WDmodel_Likelihood.get_value` are listed
+        in the order in which they are evaluated by :py:meth:`report`.
+    """
+    def __init__(self, maxsize=128, maxmem=256.):
+        self.maxsize = maxsize
+        self.maxmem  = maxmem
+        self.stages  = OrderedDict()
+
+
+    def get(self, stage, key):
+        """
+        Returns the value cached for ``key`` in ``stage``, or ``None`` if
+        there is none
+        """
+        cache = self.stages.get(stage)
+        if cache is None:
+            cache = self.stages[stage] = LRUCache(self.maxsize)
+        return cache.get(key)
+
+
+    def put(self, stage, key, value):
+        """
+        Caches ``value`` for ``key`` in ``stage``, evicting least recently
+        used entries of ``stage`` if the memory bound is exceeded
+        """
+        cache = self.stages.get(stage)
+        if cache is None:
+            cache = self.stages[stage] = LRUCache(self.maxsize)
+        cache.put(key, value)
+        maxbytes = self.maxmem*1024.*1024.
+        while self.nbytes > maxbytes and len(cache) > 1:
+            cache.popitem()
+
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory used by the cached arrays in bytes
+        """
+        return sum(cache.nbytes for cache in self.stages.values())
+
+
+    def stats(self):
+        """
+        Returns the cache statistics for each stage
+
+        Returns
+        -------
+        out : :py:class:`collections.OrderedDict`
+            Mapping of stage name to a tuple of ``(hits, misses, hit rate)``
+        """
+        out = OrderedDict()
+        for stage, cache in self.stages.items():
+            nlookup = cache.hits + cache.misses
+            rate = cache.hits/float(nlookup) if nlookup > 0 else 0.
+            out[stage] = (cache.hits, cache.misses, rate)
+        return out
+
+
+    def report(self):
+        """
+        Prints the hit rate of each stage
+        """
+        stats = self.stats()
+        if len(stats) == 0:
+            return
+        message = "Stage cache ({:.1f} MB used)".format(self.nbytes/1024./1024.)
+        print(message)
+        for stage, (hits, misses, rate) in stats.items():
+            message = "{:>12s} : {:8d} hits {:8d} misses ({:.1%})".format(stage, hits, misses, rate)
+            print(message)
+
+
+    def clear(self):
+        """
+        Removes all the entries and resets the statistics
+        """
+        for cache in self.stages.values():
+            cache.clear()
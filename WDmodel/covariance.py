@@ -61,6 +61,15 @@ class WDmodel_CovModel(object):
         The white noise component of the kernel
     _logQ : float, conditional
         ``1/sqrt(2)`` - only set if ``covtype`` is ``'SHO'``
+    _gp : None or :py:class:`celerite.GP` instance
+        The persistent Gaussian process, created on the first call to
+        :py:meth:`getgp`
+    _gp_hyper : None or tuple
+        The hyperparameters ``(fsig, tau, fw)`` of ``_gp``
+    _gp_wave : None or array-like
+        The wavelengths ``_gp`` was last computed at
+    _gp_flux_err : None or array-like
+        The flux uncertainties ``_gp`` was last computed with
 
     Returns
     -------
@@ -100,6 +109,32 @@ class WDmodel_CovModel(object):
 
         message = "Parametrizing covariance with {} kernel and using Cholesky Solver".format(covtype)
         print(message)
+        self._reset_gp()
+
+
+    def _reset_gp(self):
+        """
+        Discards the persistent Gaussian process
+        """
+        self._gp = None
+        self._gp_hyper = None
+        self._gp_wave = None
+        self._gp_flux_err = None
+
+
+    # the factorized Gaussian process is not pickled - it is cheap to
+    # recreate on the first call, and celerite solvers need not be picklable
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d['_gp'] = None
+        d['_gp_hyper'] = None
+        d['_gp_wave'] = None
+        d['_gp_flux_err'] = None
+        return d
+
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
 
 
     def lnlikelihood(self, wave, res, flux_err, fsig, tau, fw):
@@ -146,7 +181,179 @@ class WDmodel_CovModel(object):
         return gp.log_likelihood(res)
 
 
-    def predict(self, wave, res, flux_err, fsig, tau, fw, mean_only=False):
+    def lnlikelihood_linear(self, wave, flux, mod, flux_err, fsig, tau, fw):
+        """
+        Return the log likelihood of the Gaussian process for a mean model
+        that is linear in its amplitude
+
+        The log likelihood of ``flux`` given the mean model ``s*mod`` is
+        ``lnlike0 + s*b - 0.5*s**2*a``, which is used to marginalize over the
+        amplitude ``s`` analytically.
+
+        Parameters
+        ----------
+        wave : array-like, optional
+            Wavelengths at which to condition the Gaussian process
+        flux : array-like
+            Flux array on which to condition the Gaussian process
+        mod : array-like
+            The mean model with unit amplitude
+        flux_err : array-like
+            Flux uncertaintyarray on which to condition the Gaussian process
+        fsig : float
+            The fractional amplitude of the non-trivial stationary kernel.
+        tau : float
+            The characteristic length scale of the non-trivial stationary
+            kernel.
+        fw : float
+            The fractional amplitude of the white noise component of the
+            kernel.
+
+        Returns
+        -------
+        lnlike0 : float
+            The log likelihood of the Gaussian process conditioned on ``flux``
+            with zero mean model
+        a : float
+            ``mod`` weighted by the inverse covariance, ``mod^T K^-1 mod``
+        b : float
+            ``mod^T K^-1 flux``
+
+        See Also
+        --------
+        :py:meth:`getgp`
+        """
+        gp   = self.getgp(wave, flux_err, fsig, tau, fw)
+        flux = np.ascontiguousarray(flux, dtype=np.float64)
+        mod  = np.ascontiguousarray(mod, dtype=np.float64)
+        lnlike0 = gp.log_likelihood(flux)
+        kmod = gp.apply_inverse(mod).ravel()
+        return lnlike0, np.dot(mod, kmod), np.dot(flux, kmod)
+
+
+    def lnlikelihood_grad(self, wave, res, flux_err, fsig, tau, fw):
+        """
+        Return the log likelihood of the Gaussian process and its gradient
+        with respect to the residuals and the hyperparameters
+
+        Same as :py:meth:`lnlikelihood`. The gradient with respect to the
+        hyperparameters is computed by the celerite solver in :math:`O(N)`,
+        with the Jacobian of the kernel coefficients from
+        :py:meth:`_get_kernel_jacobian`, so :py:mod:`autograd` is not needed.
+
+        Parameters
+        ----------
+        wave : array-like, optional
+            Wavelengths at which to condition the Gaussian process
+        res : array-like
+            Flux residual array on which to condition the Gaussian process.
+        flux_err : array-like
+            Flux uncertaintyarray on which to condition the Gaussian process
+        fsig : float
+            The fractional amplitude of the non-trivial stationary kernel.
+        tau : float
+            The characteristic length scale of the non-trivial stationary
+            kernel.
+        fw : float
+            The fractional amplitude of the white noise component of the
+            kernel.
+
+        Returns
+        -------
+        lnlike : float
+            The log likelihood of the Gaussian process conditioned on the data.
+        dres : array-like
+            The gradient of ``lnlike`` with respect to ``res``
+        dhyper : array-like
+            The gradient of ``lnlike`` with respect to ``fsig``, ``tau`` and
+            ``fw``. Zero for ``fsig`` and ``tau`` if ``covtype`` is ``'White'``.
+
+        See Also
+        --------
+        :py:meth:`getgp`
+        """
+        gp  = self.getgp(wave, flux_err, fsig, tau, fw)
+        res = np.ascontiguousarray(res, dtype=np.float64)
+        lnlike = gp.log_likelihood(res)
+        dres = -gp.apply_inverse(res).ravel()
+
+        # the solver loses the gradient for physical flux units, so it is
+        # evaluated in units of errscale. The amplitude coefficients and the
+        # jitter scale as variances and the gradient with respect to the
+        # hyperparameters is unchanged.
+        var = self._errscale**2.
+        ar, cr, ac, bc, cc, dc = gp.kernel.coefficients
+        coeffs = (ar/var, cr, ac/var, bc/var, cc, dc)
+        jitter = gp.kernel.jitter/var
+        args = (jitter,) + coeffs + (gp._A, gp._U, gp._V, gp._t, res/self._errscale, gp._yerr**2./var)
+        _, grad = gp.solver.grad_log_likelihood(*args)
+        djitter, dcoeffs = self._get_kernel_jacobian(fsig, tau, fw, jitter, np.concatenate(coeffs))
+        dhyper = djitter*grad[0] + np.dot(dcoeffs, grad[1:])
+        return lnlike, dres, dhyper
+
+
+    def _get_kernel_jacobian(self, fsig, tau, fw, jitter, coeffs):
+        """
+        Return the derivatives of the jitter and the kernel coefficients with
+        respect to the hyperparameters ``fsig``, ``tau`` and ``fw``
+
+        Parameters
+        ----------
+        fsig : float
+            The fractional amplitude of the non-trivial stationary kernel.
+        tau : float
+            The characteristic length scale of the non-trivial stationary
+            kernel.
+        fw : float
+            The fractional amplitude of the white noise component of the
+            kernel.
+        jitter : float
+            The jitter of the kernel
+        coeffs : array-like
+            The concatenated coefficients of the kernel constructed by
+            :py:meth:`_get_kernel` in the order of
+            :py:attr:`celerite.terms.Term.coefficients`
+
+        Returns
+        -------
+        djitter : array-like
+            The derivative of the jitter with respect to ``fsig``, ``tau`` and
+            ``fw``
+        dcoeffs : array-like
+            Array of shape ``(3, len(coeffs))`` with the derivative of each
+            coefficient with respect to ``fsig``, ``tau`` and ``fw``
+
+        Notes
+        -----
+            The coefficients are
+            ``(a, b, c, d) = (s**2, s**2 w/eps, w, eps)`` with ``s =
+            fsig*errscale``, ``w = sqrt(3)/tau`` for ``'Matern32'``, ``(a, b,
+            c, d)`` all proportional to ``w = 2 pi/tau`` and ``a, b``
+            proportional to ``fsig`` for ``'SHO'``, and ``(a, c) = (s,
+            exp(1/log(tau)))`` for ``'Exp'``. The jitter is ``(fw*errscale)**2``
+            for all kernels. The derivatives are computed from the values of
+            ``jitter`` and ``coeffs``, so they may be given in any units.
+        """
+        djitter = np.array([0., 0., 2.*jitter/fw])
+        dcoeffs = np.zeros((3, len(coeffs)))
+        if self._ndim == 1:
+            return djitter, dcoeffs
+        if self._covtype == 'Matern32':
+            a, b, c, d = coeffs
+            dcoeffs[0] = (2.*a/fsig, 2.*b/fsig, 0., 0.)
+            dcoeffs[1] = (0., -b/tau, -c/tau, 0.)
+        elif self._covtype == 'SHO':
+            a, b, c, d = coeffs
+            dcoeffs[0] = (a/fsig, b/fsig, 0., 0.)
+            dcoeffs[1] = (-a/tau, -b/tau, -c/tau, -d/tau)
+        else:
+            a, c = coeffs
+            dcoeffs[0] = (a/fsig, 0.)
+            dcoeffs[1] = (0., -c/(tau*np.log(tau)**2.))
+        return djitter, dcoeffs
+
+
+    def predict(self, wave, res, flux_err, fsig, tau, fw, mean_only=False, var_only=False):
         """
         Return the prediction for the Gaussian process
 
@@ -178,6 +385,11 @@ class WDmodel_CovModel(object):
             :py:attr:`WDmodel.covariance.WDmodel_CovModel._errscale`
         mean_only : bool, optional
             Return only the predicted mean, not the covariance matrix
+        var_only : bool, optional
+            Return only the diagonal of the covariance matrix, not the full
+            matrix. Computed in :math:`O(N)` without ever forming an ``N x
+            N`` array - see :py:meth:`_predict_var`. Ignored if ``mean_only``
+            is set.
 
         Returns
         -------
@@ -187,15 +399,192 @@ class WDmodel_CovModel(object):
         cov : array-like, optional
             The computed covariance matrix of the Gaussian process using the
             parametrized stationary kernel evaluated at the locations of the
-            data.
+            data. If ``var_only`` is set, only the diagonal of this matrix.
 
         See Also
         --------
         :py:meth:`getgp`
         """
         gp = self.getgp(wave, flux_err, fsig, tau, fw)
-        return_cov = not(mean_only)
-        return gp.predict(res, wave, return_cov)
+        if mean_only:
+            return gp.predict(res, wave, return_cov=False)
+        if var_only:
+            wres = gp.predict(res, return_cov=False)
+            var  = self._predict_var(gp)
+            return wres, var
+        return gp.predict(res, wave, return_cov=True)
+
+
+    def _predict_var(self, gp):
+        """
+        Return the diagonal of the predictive covariance of ``gp`` at the
+        locations of the data
+
+        :py:meth:`celerite.GP.predict` with ``return_var`` still forms the
+        dense ``N x N`` cross-covariance matrix. Instead, with ``D`` the white
+        noise + flux uncertainty variance on the diagonal and ``S = K + D``,
+        the predictive covariance at the data is ``K - K S^-1 K = D - D S^-1
+        D``, so only the diagonal of ``S^-1`` is needed. This is computed in
+        :math:`O(N)` time and memory by :py:meth:`_get_inverse_diag` from the
+        semiseparable factorization of ``S``.
+
+        Parameters
+        ----------
+        gp : :py:class:`celerite.GP` instance
+            A computed Gaussian process from :py:meth:`getgp`
+
+        Returns
+        -------
+        var : array-like
+            The variance of the prediction at the location of the data
+        """
+        d = gp._yerr**2. + gp.kernel.jitter
+        ar, cr, ac, bc, cc, dc = gp.kernel.coefficients
+
+        # with only white noise the data are predicted exactly
+        if len(cr) + len(cc) == 0:
+            return np.zeros_like(d)
+
+        # as for the gradient, work in units of errscale so the recursion
+        # does not under or overflow for physical flux units
+        scale = self._errscale**2.
+        sinv = self._get_inverse_diag(gp._t, d/scale, ar/scale, cr, ac/scale, bc/scale, cc, dc)/scale
+
+        # guard against roundoff when the kernel is dominated by white noise
+        var = np.clip(d - d**2.*sinv, 0., None)
+        return var
+
+
+    @staticmethod
+    def _get_inverse_diag(t, diag, ar, cr, ac, bc, cc, dc):
+        """
+        Return the diagonal of the inverse of the covariance matrix of a
+        celerite kernel plus a diagonal
+
+        The matrix ``S`` is factorized as ``S = L D L^T``, with ``L`` unit
+        lower triangular and semiseparable, with the recursion of the celerite
+        Cholesky solver (`Foreman-Mackey et al. 2017
+        <https://arxiv.org/abs/1703.09710>`_). The diagonal of ``S^-1 = L^-T
+        D^-1 L^-1`` is the sum of the squared columns of ``L^-1`` weighted by
+        ``1/D``. Each column of ``L^-1`` below the diagonal follows a linear
+        recursion in the ``J`` dimensional state of the semiseparable
+        representation, so the sums are accumulated in a single backward pass
+        as a ``J x J`` quadratic form. The cost is :math:`O(N J^2)`.
+
+        Parameters
+        ----------
+        t : array-like
+            The sorted locations of the data
+        diag : array-like
+            The diagonal added to the kernel
+        ar, cr, ac, bc, cc, dc : array-like
+            The coefficients of the real and complex terms of the kernel, as
+            in :py:attr:`celerite.terms.Term.coefficients`
+
+        Returns
+        -------
+        sinv : array-like
+            The diagonal of ``S^-1``
+        """
+        t = np.asarray(t, dtype=np.float64)
+        n = len(t)
+        ar, cr, ac, bc, cc, dc = [np.atleast_1d(x) for x in (ar, cr, ac, bc, cc, dc)]
+        a = diag + np.sum(ar) + np.sum(ac)
+        nterm = len(cr) + 2*len(cc)
+        if nterm == 0:
+            return 1./a
+
+        # the semiseparable representation of the kernel, with the decay
+        # between successive points in phi
+        cosdt = np.cos(np.outer(t, dc))
+        sindt = np.sin(np.outer(t, dc))
+        u = np.concatenate((np.repeat(ar[np.newaxis, :], n, axis=0),\
+                ac*cosdt + bc*sindt, ac*sindt - bc*cosdt), axis=1)
+        v = np.concatenate((np.ones((n, len(ar))), cosdt, sindt), axis=1)
+        c = np.concatenate((cr, cc, cc))
+        phi = np.exp(-np.outer(np.diff(t), c))
+
+        # forward pass - the factorization S = L D L^T. The loops are over
+        # the points, so every array they use is preallocated.
+        phi2  = phi[:, :, np.newaxis]*phi[:, np.newaxis, :]
+        d     = np.empty(n)
+        w     = np.empty((n, nterm))
+        state = np.zeros((nterm, nterm))
+        tmp   = np.empty((nterm, nterm))
+        su    = np.empty(nterm)
+        for i in range(n):
+            if i > 0:
+                np.outer(w[i-1], w[i-1], out=tmp)
+                tmp *= d[i-1]
+                state += tmp
+                state *= phi2[i-1]
+            np.dot(state, u[i], out=su)
+            d[i] = a[i] - np.dot(u[i], su)
+            np.subtract(v[i], su, out=w[i])
+            w[i] /= d[i]
+
+        # backward pass - the squared columns of L^-1 weighted by 1/D. With
+        # P = phi Q phi, p = P w and s = w^T p, the quadratic form Q of the
+        # points after i is updated to (1 - u w^T) P (1 - w u^T) + u u^T/d,
+        # i.e. P - u p^T - p u^T + (s + 1/d) u u^T, and s + 1/d is sinv
+        sinv = 1./d
+        quad = np.outer(u[-1], u[-1])/d[-1]
+        p    = np.empty(nterm)
+        for i in range(n-2, -1, -1):
+            quad *= phi2[i]
+            np.dot(quad, w[i], out=p)
+            s = np.dot(w[i], p)
+            sinv[i] += s
+            np.outer(u[i], p, out=tmp)
+            quad -= tmp
+            quad -= tmp.T
+            np.outer(u[i], u[i], out=tmp)
+            tmp *= sinv[i]
+            quad += tmp
+        return sinv
+
+
+    def _get_kernel_vector(self, fsig, tau, fw):
+        """
+        Return the parameter vector of the kernel for hyperparameters ``fsig``,
+        ``tau`` and ``fw``
+
+        The order of the vector is the order of the parameters of the kernel
+        constructed by :py:meth:`_get_kernel`.
+        """
+        log_sigma_fw = np.log(fw*self._errscale)
+        if self._ndim == 1:
+            return np.array([log_sigma_fw])
+        log_sigma_fsig = np.log(fsig*self._errscale)
+        if self._covtype == 'Matern32':
+            return np.array([log_sigma_fsig, np.log(tau), log_sigma_fw])
+        elif self._covtype == 'SHO':
+            return np.array([log_sigma_fsig, self._logQ, np.log((2.*np.pi)/tau), log_sigma_fw])
+        else:
+            return np.array([log_sigma_fsig, 1./np.log(tau), log_sigma_fw])
+
+
+    def _get_kernel(self, fsig, tau, fw):
+        """
+        Return the kernel for hyperparameters ``fsig``, ``tau`` and ``fw``
+        """
+        log_sigma_fw = np.log(fw*self._errscale)
+        kw = self._k2(log_sigma_fw)
+        if self._ndim != 1:
+            log_sigma_fsig = np.log(fsig*self._errscale)
+            if self._covtype == 'Matern32':
+                log_rho = np.log(tau)
+                ku = self._k1(log_sigma_fsig, log_rho, eps=self._coveps)
+            elif self._covtype == 'SHO':
+                log_omega0 = np.log((2.*np.pi)/tau)
+                ku = self._k1(log_sigma_fsig, self._logQ, log_omega0)
+            else:
+                log_c = 1./np.log(tau)
+                ku = self._k1(log_sigma_fsig, log_c)
+            kernel = ku + kw
+        else:
+            kernel = kw
+        return kernel
 
 
     def getgp(self, wave, flux_err, fsig, tau, fw):
@@ -206,6 +595,14 @@ class WDmodel_CovModel(object):
         the functional form of the stationary kernel and the current values of
         the hyperparameters. Wraps :py:class:`celerite.GP`.
 
+        A single Gaussian process is kept for the lifetime of the instance.
+        Its kernel parameter vector is updated in place when the
+        hyperparameters change, and the covariance matrix is only factorized
+        again if the hyperparameters, ``wave`` or ``flux_err`` differ from the
+        previous call. Evaluating the likelihood of a new residual vector with
+        the same hyperparameters is then just a solve with the existing
+        factorization.
+
         Parameters
         ----------
         wave : array-like, optional
@@ -228,7 +625,8 @@ class WDmodel_CovModel(object):
         -------
         gp : :py:class:`celerite.GP` instance
             The Gaussian process with covariance matrix precomputed at the
-            location of the data
+            location of the data. This instance is reused by later calls, and
+            should not be modified.
 
         Notes
         -----
@@ -239,23 +637,39 @@ class WDmodel_CovModel(object):
             instance using the :py:func:`WDmodel.likelihood.setup_likelihood`
             method.
         """
-        log_sigma_fw = np.log(fw*self._errscale)
-        kw = self._k2(log_sigma_fw)
-        if self._ndim != 1:
-            log_sigma_fsig = np.log(fsig*self._errscale)
-            if self._covtype == 'Matern32':
-                log_rho = np.log(tau)
-                ku = self._k1(log_sigma_fsig, log_rho, eps=self._coveps)
-            elif self._covtype == 'SHO':
-                log_omega0 = np.log((2.*np.pi)/tau)
-                ku = self._k1(log_sigma_fsig, self._logQ, log_omega0)
-            else:
-                log_c = 1./np.log(tau)
-                ku = self._k1(log_sigma_fsig, log_c)
-            kernel = ku + kw
+        hyper = (fsig, tau, fw)
+        gp = self._gp
+        if gp is None:
+            gp = celerite.GP(self._get_kernel(fsig, tau, fw), mean=0.)
+            recompute = True
         else:
-            kernel = kw
+            recompute = not gp.computed
+            if hyper != self._gp_hyper:
+                gp.set_parameter_vector(self._get_kernel_vector(fsig, tau, fw))
+                recompute = True
+            if not (self._same_array(wave, self._gp_wave) and self._same_array(flux_err, self._gp_flux_err)):
+                recompute = True
 
-        gp = celerite.GP(kernel, mean=0.)
-        gp.compute(wave, flux_err, check_sorted=False)
+        if recompute:
+            wave = np.array(wave, dtype=np.float64)
+            flux_err = np.array(flux_err, dtype=np.float64)
+            # don't keep a half-updated GP around if the factorization fails
+            self._reset_gp()
+            gp.compute(wave, flux_err, check_sorted=False)
+            self._gp = gp
+            self._gp_hyper = hyper
+            self._gp_wave = wave
+            self._gp_flux_err = flux_err
         return gp
+
+
+    @staticmethod
+    def _same_array(a, b):
+        """
+        Return ``True`` if arrays ``a`` and ``b`` have the same shape and values
+        """
+        if b is None:
+            return False
+        if a is b:
+            return True
+        return (np.shape(a) == b.shape) and np.array_equal(a, b)
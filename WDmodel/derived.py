@@ -0,0 +1,269 @@
+# -*- coding: UTF-8 -*-
+"""
+Registry of parameters derived from the sampled model parameters, evaluated in
+chunks directly from the Markov chain
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+from collections import OrderedDict
+import numpy as np
+from six.moves import range
+
+__all__=['WDmodel_DerivedParam', 'register_derived', 'get_derived_names',\
+        'get_derived_label', 'iter_derived', 'get_derived', 'write_derived']
+
+# number of chain samples to evaluate derived parameters for at once
+_CHUNKSIZE = 100000
+
+# registered derived parameters, in the order they are appended to the chain
+_DERIVED = OrderedDict()
+
+
+class WDmodel_DerivedParam(object):
+    """
+    A parameter that is a deterministic function of the model parameters
+
+    Parameters
+    ----------
+    name : str
+        The name of the derived parameter. Used as the key in the parameter
+        dict and the name of the chain dataset.
+    func : callable
+        Called as ``func(model, **kwargs)`` where ``kwargs`` maps each of
+        ``requires`` to an array of values, one per chain sample. Must return
+        an array with one value per chain sample.
+    requires : sequence of str
+        Names of model parameters (see :py:const:`WDmodel.io._PARAMETER_NAMES`)
+        that ``func`` depends on
+    sptypes : sequence of str or None, optional
+        The spectrum types for which this parameter is derived. ``None``
+        indicates only the DA white dwarf model, i.e. no ``sptype``.
+    label : str or None, optional
+        The plot label for the parameter. Defaults to ``name``.
+    """
+    def __init__(self, name, func, requires, sptypes=None, label=None):
+        self.name     = name
+        self.func     = func
+        self.requires = tuple(requires)
+        self.sptypes  = (None,) if sptypes is None else tuple(sptypes)
+        self.label    = name if label is None else label
+
+
+    def __call__(self, model, param_names, chunk, params):
+        """
+        Evaluate the derived parameter on a chunk of chain samples
+
+        Parameters
+        ----------
+        model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+            The model instance used in the fit
+        param_names : array-like
+            Names of the parameters corresponding to the columns of ``chunk``
+        chunk : array-like
+            Chain samples with shape ``(nsamples, nparam)``
+        params : dict
+            A parameter dict such as that produced by
+            :py:func:`WDmodel.io.read_params`. Values of parameters in
+            ``requires`` that were not fit for are taken from here.
+
+        Returns
+        -------
+        out : array-like
+            The derived parameter for each sample in ``chunk``
+
+        Raises
+        ------
+        KeyError
+            If a parameter in ``requires`` was neither fit for nor has a value
+            in ``params``
+        """
+        param_names = list(param_names)
+        nsamp = chunk.shape[0]
+        kwargs = {}
+        for param in self.requires:
+            if param in param_names:
+                kwargs[param] = chunk[:, param_names.index(param)]
+            else:
+                value = params.get(param, {}).get('value')
+                if value is None:
+                    message = 'Derived parameter {} requires {}, which was not fit for and has no value'.format(self.name, param)
+                    raise KeyError(message)
+                kwargs[param] = np.full(nsamp, value)
+        out = np.asarray(self.func(model, **kwargs), dtype='float64')
+        return np.broadcast_to(out, (nsamp,))
+
+
+def register_derived(name, func, requires, sptypes=None, label=None):
+    """
+    Register a derived parameter to be evaluated on the Markov chain
+
+    Registering a ``name`` that already exists replaces it. See
+    :py:class:`WDmodel_DerivedParam` for a description of the arguments.
+
+    Returns
+    -------
+    derived : :py:class:`WDmodel_DerivedParam` instance
+        The registered derived parameter
+    """
+    derived = WDmodel_DerivedParam(name, func, requires, sptypes=sptypes, label=label)
+    _DERIVED[name] = derived
+    return derived
+
+
+def get_derived_names(sptype=None):
+    """
+    Returns the names of the registered derived parameters for ``sptype``
+
+    Parameters
+    ----------
+    sptype : str or None, optional
+        The spectrum type. ``None`` for a DA white dwarf.
+
+    Returns
+    -------
+    names : list
+        Names of the derived parameters, in registration order
+    """
+    return [name for name, derived in _DERIVED.items() if sptype in derived.sptypes]
+
+
+def get_derived_label(name):
+    """
+    Returns the plot label for the derived parameter ``name``
+    """
+    return _DERIVED[name].label
+
+
+def iter_derived(model, param_names, samples, params, names=None, chunksize=_CHUNKSIZE):
+    """
+    Evaluate derived parameters on ``samples`` in chunks
+
+    Only ``chunksize`` rows of ``samples`` are read at once, so ``samples``
+    may be an :py:class:`h5py.Dataset` that is never fully read into memory.
+
+    Parameters
+    ----------
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The model instance used in the fit
+    param_names : array-like
+        Names of the parameters corresponding to the columns of ``samples``
+    samples : array-like or :py:class:`h5py.Dataset`
+        The flattened Markov Chain with shape ``(nsamples, nparam)``
+    params : dict
+        A parameter dict such as that produced by
+        :py:func:`WDmodel.io.read_params`, with the values of fixed
+        parameters
+    names : list or None, optional
+        The derived parameters to evaluate. Default is every derived parameter
+        for ``model._sptype``.
+    chunksize : int, optional
+        The number of samples to evaluate at once
+
+    Yields
+    ------
+    start : int
+        The index of the first sample in the chunk
+    stop : int
+        One past the index of the last sample in the chunk
+    values : :py:class:`collections.OrderedDict`
+        Maps each of ``names`` to the derived parameter values for the chunk
+    """
+    if names is None:
+        names = get_derived_names(model._sptype)
+    nsamp = samples.shape[0]
+    chunksize = max(int(chunksize), 1)
+    for start in range(0, nsamp, chunksize):
+        stop  = min(start + chunksize, nsamp)
+        chunk = np.asarray(samples[start:stop])
+        values = OrderedDict()
+        for name in names:
+            values[name] = _DERIVED[name](model, param_names, chunk, params)
+        yield start, stop, values
+
+
+def get_derived(model, param_names, samples, params, names=None, chunksize=_CHUNKSIZE):
+    """
+    Returns derived parameters evaluated on every sample in ``samples``
+
+    See :py:func:`iter_derived` for a description of the arguments.
+
+    Returns
+    -------
+    derived : :py:class:`collections.OrderedDict`
+        Maps each of ``names`` to an array of length ``nsamples``
+    """
+    if names is None:
+        names = get_derived_names(model._sptype)
+    nsamp = samples.shape[0]
+    out = OrderedDict((name, np.empty(nsamp)) for name in names)
+    for start, stop, values in iter_derived(model, param_names, samples, params, names=names, chunksize=chunksize):
+        for name, value in values.items():
+            out[name][start:stop] = value
+    return out
+
+
+def write_derived(chain, model, params, names=None, chunksize=_CHUNKSIZE):
+    """
+    Evaluate derived parameters on a saved Markov chain and write them to the
+    chain file
+
+    The chain positions are read from and the derived parameters written to
+    the HDF5 file in chunks. Each derived parameter is written as a dataset
+    ``derived/<name>`` under ``chain``, with one entry per chain sample.
+    Existing derived parameters are replaced.
+
+    Parameters
+    ----------
+    chain : :py:class:`h5py.Group`
+        The ``chain`` group of an open Markov chain file, with the
+        ``position`` and ``names`` datasets written by
+        :py:func:`WDmodel.fit.fit_model`
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The model instance used in the fit
+    params : dict
+        A parameter dict such as that produced by
+        :py:func:`WDmodel.io.read_params`, with the values of fixed
+        parameters
+    names : list or None, optional
+        The derived parameters to evaluate. Default is every derived parameter
+        for ``model._sptype``.
+    chunksize : int, optional
+        The number of samples to evaluate at once
+
+    Returns
+    -------
+    names : list
+        The names of the derived parameters written
+    """
+    if names is None:
+        names = get_derived_names(model._sptype)
+    if 'derived' in chain:
+        del chain['derived']
+    if len(names) == 0:
+        return names
+
+    samples = chain['position']
+    param_names = [x.decode('ascii') if isinstance(x, bytes) else str(x) for x in chain['names'][()]]
+    nsamp = samples.shape[0]
+
+    group = chain.create_group('derived')
+    group.attrs['names'] = np.array(names).astype(np.bytes_)
+    dsets = OrderedDict((name, group.create_dataset(name, (nsamp,), dtype='float64')) for name in names)
+    for start, stop, values in iter_derived(model, param_names, samples, params, names=names, chunksize=chunksize):
+        for name, value in values.items():
+            dsets[name][start:stop] = value
+    return names
+
+
+def _get_ne(model, logg, teff):
+    """
+    Electron density of the lab plasma from the EOS of the model grid. The
+    ``logg`` axis of the plasma grid is the mass density.
+    """
+    return model._get_ne(logg, teff)
+
+
+register_derived('ne', _get_ne, ('logg', 'teff'), sptypes=('emission', 'transmission'),\
+        label=r'$n_{\mathrm{e}}$')
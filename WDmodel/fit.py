@@ -15,6 +15,7 @@ from scipy.stats import norm
 from iminuit import Minuit
 from astropy.constants import c as _C
 import emcee
+from emcee.autocorr import function as autocorr_function
 import h5py
 import six.moves.cPickle as pickle
 from clint.textui import progress
@@ -26,6 +27,9 @@ from . import io
 from . import passband
 from . import likelihood
 from . import mossampler
+from . import nuts
+from . import derived
+from .pool import WDmodel_BatchPool
 
 
 def polyfit_continuum(continuumdata, wave):
@@ -411,6 +415,71 @@ def pre_process_spectrum(spec, bluelimit, redlimit, model, params,\
     return spec, cont_model, linedata, continuumdata, scale_factor, out_params
 
 
+def get_model_grid_bounds(params, spec, bluelimit=None, redlimit=None, lamshift=0., vel=0., pbwave=None):
+    """
+    Returns the bounds on temperature, surface gravity and wavelength of the
+    part of the model grid needed to fit the data
+
+    Parameters
+    ----------
+    params : dict
+        A parameter dict such as that produced by
+        :py:func:`WDmodel.io.read_params`
+    spec : :py:class:`numpy.recarray`
+        The spectrum with ``dtype=[('wave', '<f8'), ('flux', '<f8'), ('flux_err', '<f8')]``
+    bluelimit : None or float, optional
+        Wavelengths bluer than this limit will be trimmed from the spectrum.
+        See :py:func:`pre_process_spectrum`
+    redlimit : None or float, optional
+        Wavelengths redder than this limit will be trimmed from the spectrum.
+    lamshift : float, optional
+        Flat wavelength shift that will be applied to the spectrum. Default
+        is ``0``.
+    vel : float, optional
+        Velocity shift that will be applied to the spectrum. Default is
+        ``0``.
+    pbwave : None or 2-tuple, optional
+        Range of wavelengths of the passbands used for synthetic photometry,
+        from :py:func:`WDmodel.passband.get_pbwave_bounds`
+
+    Returns
+    -------
+    teffbounds : 2-tuple
+        The bounds on ``teff`` from ``params``
+    loggbounds : 2-tuple
+        The bounds on ``logg`` from ``params``
+    wavebounds : 2-tuple
+        The range of wavelengths of the spectrum and passbands, extended to
+        include the bounds on ``shift`` and ``rvel``
+
+    Notes
+    -----
+        The parameter bounds are used even if a parameter is fixed, so the
+        grid also covers any value the parameter can be set to. The output can
+        be passed to :py:class:`WDmodel.WDmodel.WDmodel`.
+    """
+    teffbounds = tuple(params['teff']['bounds'])
+    loggbounds = tuple(params['logg']['bounds'])
+
+    # same order as pre_process_spectrum - shift, then trim
+    wmin = (spec.wave.min() + lamshift)*(1. +(vel*1000./_C.value))
+    wmax = (spec.wave.max() + lamshift)*(1. +(vel*1000./_C.value))
+    if bluelimit is not None and bluelimit > 0:
+        wmin = max(wmin, float(bluelimit))
+    if redlimit is not None and redlimit > 0:
+        wmax = min(wmax, float(redlimit))
+    if pbwave is not None:
+        wmin = min(wmin, pbwave[0])
+        wmax = max(wmax, pbwave[1])
+
+    # the model is evaluated at wave*(1 - rvel/c) - shift
+    shiftlo, shifthi = params['shift']['bounds']
+    rvello,  rvelhi  = params['rvel']['bounds']
+    wmin = wmin*(1. - rvelhi*1000./_C.value) - shifthi
+    wmax = wmax*(1. - rvello*1000./_C.value) - shiftlo
+    return teffbounds, loggbounds, (wmin, wmax)
+
+
 def quick_fit_spec_model(spec, model, params):
     """
     Does a quick fit of the spectrum to get an initial guess of the fit parameters
@@ -419,6 +488,9 @@ def quick_fit_spec_model(spec, model, params):
     For simplicity, also fixed FWHM, radial velocity, and Rv (even when set to be fit).
     Therefore, only teff, logg, av, dl, and shift are fit for (at most).
     This isn't robust, but it's good enough for an initial guess.
+    For the DA white dwarf model, the analytic gradient of the chi-square from
+    :py:func:`WDmodel.WDmodel.WDmodel_BoundModel._get_obs_model_grad` is
+    passed to iminuit.
 
     Parameters
     ----------
@@ -495,15 +567,32 @@ def quick_fit_spec_model(spec, model, params):
     shift_bounds = params['shift']['bounds']
     length_bounds = params['length']['bounds']
 
+    # bind the model to the spectrum wavelengths since they don't change
+    bmodel = model.bind(spec.wave, pixel_scale=pixel_scale)
+
     # ignore the covariance and define a simple chi2 to minimize
     def chi2(teff, logg, av, dl, shift, length):
-        mod = model._get_obs_model(teff, logg, av, fwhm, spec.wave, shift, rvel, rv=rv, pixel_scale=pixel_scale, length=length)
+        mod = bmodel._get_obs_model(teff, logg, av, fwhm, spec.wave, shift, rvel, rv=rv, pixel_scale=pixel_scale, length=length)
         mod *= (1./(4.*np.pi*(dl)**2.))
         chi2 = np.sum(((spec.flux-mod)/spec.flux_err)**2.)
         return chi2
 
+    # analytic gradient of chi2 - not implemented for the lab plasma models
+    def chi2_grad(teff, logg, av, dl, shift, length):
+        mod, dmod = bmodel._get_obs_model_grad(teff, logg, av, fwhm, shift, rvel, rv=rv, pixel_scale=pixel_scale)
+        scale = 1./(4.*np.pi*(dl)**2.)
+        wres  = -2.*(spec.flux - mod*scale)/spec.flux_err**2.
+        dchi2 = scale*np.dot(dmod, wres)
+        names = bmodel._grad_names
+        return [dchi2[names.index('teff')], dchi2[names.index('logg')], dchi2[names.index('av')],\
+                -2.*scale*np.dot(mod, wres)/dl, dchi2[names.index('shift')], 0.]
+
+    grad = None
+    if model._sptype not in ('emission', 'transmission'):
+        grad = chi2_grad
+
     # use minuit to refine our starting guess
-    m = Minuit(chi2, teff=teff0, logg=logg0, av=av0, dl=dl0, shift=shift0, length=length0,\
+    m = Minuit(chi2, grad=grad, teff=teff0, logg=logg0, av=av0, dl=dl0, shift=shift0, length=length0,\
                 fix_teff=fix_teff, fix_logg=fix_logg, fix_av=fix_av, fix_dl=fix_dl, fix_shift=fix_shift, fix_length=fix_length,\
                 error_teff=teff_scale, error_logg=logg_scale, error_av=av_scale, error_dl=dl_scale, error_shift=shift_scale, error_length=length_scale,\
                 limit_teff=teff_bounds, limit_logg=logg_bounds, limit_av=av_bounds, limit_dl=dl_bounds, limit_shift=shift_bounds, limit_length=length_bounds,\
@@ -672,7 +761,8 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
             phot_dispersion=0.,\
             samptype='ensemble', ascale=2.0,\
             ntemps=1, nwalkers=300, nburnin=50, nprod=1000, everyn=1, thin=1, pool=None,\
-            resume=False, redo=False):
+            resume=False, redo=False, synmag_table=None, convgrid_fwhm=None, convgrid_nfwhm=11, convgrid_tol=1e-3,\
+            marginalize=(), autocorr_every=None, autocorr_factor=50., autocorr_tol=0.01, progress_bar=True):
     """
     Core routine that models the spectrum using the white dwarf model and a
     Gaussian process with a stationary kernel to account for any flux
@@ -702,21 +792,28 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         Excess photometric dispersion to add in quadrature with the
         photometric uncertainties ``phot.mag_err``. Use if the errors are
         grossly underestimated. Default is ``0.``
-    samptype : ``{'ensemble', 'pt', 'gibbs'}``
-        Which sampler to use. The default is ``ensemble``.
+    samptype : ``{'ensemble', 'pt', 'gibbs', 'nuts'}``
+        Which sampler to use. The default is ``ensemble``. ``nuts`` is the
+        gradient based No-U-Turn sampler
+        :py:class:`WDmodel.nuts.WDmodel_NUTSSampler`, and is only available
+        for the DA white dwarf model.
     ascale : float
-        The proposal scale for the sampler. Default is ``2.``
+        The proposal scale for the sampler. Not used by ``nuts``. Default is
+        ``2.``
     ntemps : int
         The number of temperatures to run walkers at. Only used if ``samptype``
-        is in ``{'pt','gibbs'}`` and set to ``1.`` for ``ensemble``. See a
-        short summary `review
+        is in ``{'pt','gibbs'}`` and set to ``1.`` for ``ensemble`` and
+        ``nuts``. See a short summary `review
         <https://en.wikipedia.org/wiki/Parallel_tempering>`_ for details.
         Default is ``1.``
     nwalkers : int
         The number of `Goodman and Weare walkers
-        <http://msp.org/camcos/2010/5-1/p04.xhtml>`_. Default is ``300``.
+        <http://msp.org/camcos/2010/5-1/p04.xhtml>`_. Default is ``300``. For
+        ``nuts``, the number of independent chains, of which a handful is
+        enough.
     nburnin : int
-        The number of steps to discard as burn-in for the Markov-Chain. Default is ``500``.
+        The number of steps to discard as burn-in for the Markov-Chain. The
+        step size and mass matrix of ``nuts`` are tuned during burn-in. Default is ``500``.
     nprod : int
         The number of production steps in the Markov-Chain. Default is ``1000``.
     everyn : int, optional
@@ -727,11 +824,50 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         brute force way of reducing correlation between samples.
     pool : None or :py:class`emcee.utils.MPIPool`
         If running with MPI, the pool object is used to distribute the
-        computations among the child process
+        computations among the child process. If ``None``, a
+        :py:class:`WDmodel.pool.WDmodel_BatchPool` is used to evaluate all
+        the walkers of each step in a single batched call.
     resume : bool
         If ``True``, restores state and resumes the chain for another ``nprod`` iterations.
     redo : bool
         If ``True``, and a chain file and state file exist, simply clobbers them.
+    synmag_table : None or :py:class:`WDmodel.passband.WDmodel_SynMagTable` instance, optional
+        If supplied, the synthetic magnitudes are interpolated from this table
+        wherever it covers the parameters, rather than computed from the full
+        SED.
+    convgrid_fwhm : None or 2-tuple, optional
+        If supplied, the model convolved with ``fwhm`` in this range is
+        tabulated on the spectrum wavelengths, and interpolated instead of
+        convolving the model wherever it covers the parameters. Requires
+        ``shift`` and ``rvel`` to be fixed. See
+        :py:meth:`WDmodel.WDmodel.WDmodel_BoundModel.set_convolved_grid`.
+    convgrid_nfwhm : int, optional
+        Number of ``fwhm`` nodes of the convolved grid. Default is ``11``
+    convgrid_tol : float, optional
+        Maximum relative error in flux of the convolved grid with respect to
+        the exact convolution to use it. Default is ``1e-3``
+    marginalize : sequence of str, optional
+        Free parameters to marginalize over analytically rather than sample -
+        any of ``('dl', 'mu')``. Their samples are reconstructed after the run
+        with :py:func:`write_marginalized` and saved with the derived
+        parameters. Not available with ``nuts``. Default is ``()``
+    autocorr_every : None or int, optional
+        If supplied, estimate the autocorrelation time from the saved chain
+        every ``autocorr_every`` production steps with
+        :py:func:`check_autocorr`, and stop production once the chain has
+        converged. The chain is then shorter than ``nprod`` steps. Default is
+        ``None``
+    autocorr_factor : float, optional
+        The chain must be longer than this many autocorrelation times to
+        stop. Default is ``50.``
+    autocorr_tol : float, optional
+        The maximum relative change of the autocorrelation time since the
+        previous estimate to stop. Default is ``0.01``
+    progress_bar : bool, optional
+        Show the progress bars of the burn-in and production. They are always
+        written to the STDOUT of the process that imported this module, so
+        they should be turned off if the output of the fit is redirected.
+        Default is ``True``
 
     Returns
     -------
@@ -763,6 +899,8 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
     RuntimeError
         If ``resume`` is set without the chain having been run in the first
         place.
+    ValueError
+        If ``autocorr_every`` is less than 1
 
     Notes
     -----
@@ -772,8 +910,17 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         Model parameters may be frozen/fixed. Parameters can have bounds
         limiting their range. Then runs a full production change. Chain state
         is saved after every 100 production steps, and may be continued after
-        the first 100 steps if interrupted or found to be too short. Progress
-        is indicated visually with a progress bar that is written to STDOUT.
+        the first 100 steps if interrupted or found to be too short. The
+        burn-in is saved with the chain, so that it is plotted along with a
+        resumed chain. Progress is indicated visually with a progress bar
+        that is written to STDOUT, unless ``progress_bar`` is ``False``.
+
+        With ``samptype='nuts'`` each walker is instead an independent
+        No-U-Turn Hamiltonian Monte Carlo chain using the analytic gradient of
+        the posterior. The chains move in a space where the bounded parameters
+        are unconstrained, and are mapped back to the parameters before they
+        are saved. The chain is saved in the same layout, and the tuned step
+        size and mass matrix are saved with it to resume the chain.
 
     See Also
     --------
@@ -781,6 +928,10 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
     :py:mod:`WDmodel.covariance`
     """
 
+    if autocorr_every is not None and autocorr_every < 1:
+        message = 'Autocorrelation time must be estimated every 1 or more steps ({})'.format(autocorr_every)
+        raise ValueError(message)
+
     outfile = io.get_outfile(outdir, specfile, '_mcmc.hdf5', check=True, redo=redo, resume=resume)
     if not resume:
         # create a HDF5 file to hold the chain data
@@ -800,12 +951,25 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         thin        = chain.attrs["thin"]
         samptype    = chain.attrs["samptype"]
         ascale      = chain.attrs["ascale"]
+        marginalize = [x.decode('ascii') if isinstance(x, bytes) else str(x)\
+                for x in chain.attrs.get("marginalize", [])]
 
     # create a state file to periodically save the state of the chain
     statefile = io.get_outfile(outdir, specfile, '_state.pkl', redo=redo)
 
     # setup the likelihood function
     lnlike = likelihood.setup_likelihood(params)
+
+    # parameters that are marginalized over are not sampled
+    for param in marginalize:
+        if params[param]['fixed']:
+            message = 'Parameter {} is fixed. Not marginalizing over it.'.format(param)
+            warnings.warn(message, RuntimeWarning)
+            continue
+        message = "Marginalizing over {}".format(param)
+        print(message)
+        lnlike.freeze_parameter(param)
+    marginalize = [x for x in marginalize if not params[x]['fixed']]
     nparam   = lnlike.vector_size
 
     # get the starting position and the scales for each parameter
@@ -817,7 +981,7 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
     # create a sample ball
     pos = emcee.utils.sample_ball(p0, std, size=ntemps*nwalkers)
     pos = fix_pos(pos, free_param_names, params)
-    if samptype != 'ensemble':
+    if samptype in ('pt', 'gibbs'):
         pos = pos.reshape(ntemps, nwalkers, nparam)
 
     if everyn != 1:
@@ -828,15 +992,59 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
     # even if we only take every nth sample, the pixel scale is the same
     pixel_scale = 1./np.median(np.gradient(spec.wave))
 
+    # the gibbs sampler only changes some parameters of the position of
+    # another walker in each proposal, so cache the stages of the model. Each
+    # step adds an entry per walker, and most are rejected proposals, so hold
+    # several steps of entries, or the rejected proposals evict the entries of
+    # the walkers that did not move before they are reused
+    cache_size = 0
+    if samptype == 'gibbs':
+        cache_size = 10*ntemps*nwalkers
+
+    # the gradient is only available for the exact model
+    if samptype == 'nuts' and (synmag_table is not None or convgrid_fwhm is not None):
+        message = 'The nuts sampler uses the exact model. Ignoring synthetic magnitude table and convolved grid.'
+        warnings.warn(message, RuntimeWarning)
+        synmag_table  = None
+        convgrid_fwhm = None
+
     # configure the posterior function
     lnpost = likelihood.WDmodel_Posterior(inspec, phot, model, covmodel, pbs, lnlike,\
-            pixel_scale=pixel_scale, phot_dispersion=phot_dispersion)
+            pixel_scale=pixel_scale, phot_dispersion=phot_dispersion, cache_size=cache_size,\
+            synmag_table=synmag_table, marginalize=marginalize)
+    stage_cache = lnpost.cache
+
+    # lnpost is reused for the log posterior of the chain below
+    posterior = lnpost
+
+    # tabulate the convolved model if fwhm is well constrained
+    if convgrid_fwhm is not None:
+        if params['shift']['fixed'] and params['rvel']['fixed']:
+            avbounds = [0. if x is None else x for x in params['av']['bounds']]
+            maxerr = lnpost.boundmodel.set_convolved_grid(convgrid_fwhm, shift=params['shift']['value'],\
+                    rvel=params['rvel']['value'], nfwhm=convgrid_nfwhm, teffbounds=params['teff']['bounds'],\
+                    loggbounds=params['logg']['bounds'], tol=convgrid_tol, seed=1, avbounds=avbounds,\
+                    rv=params['rv']['value'])
+            message = 'Convolved model grid max error {:.2e}'.format(maxerr)
+            print(message)
+        else:
+            message = 'Convolved model grid requires shift and rvel to be fixed. Convolving the model.'
+            warnings.warn(message, RuntimeWarning)
+
+    # without a parallel pool, evaluate all the walkers of a step at once
+    if pool is None:
+        pool = WDmodel_BatchPool()
 
     # setup the sampler
     if samptype == 'ensemble':
         sampler = emcee.EnsembleSampler(nwalkers, nparam, lnpost,\
                 a=ascale,  pool=pool)
         ntemps = 1
+    elif samptype == 'nuts':
+        # the chains move in an unconstrained space, away from the bounds
+        sampler = nuts.WDmodel_NUTSSampler(nwalkers, nparam, lnpost, pool=pool, scale=std,\
+                bounds=lnlike.get_parameter_bounds(), loc=p0)
+        ntemps = 1
     else:
         logpkwargs = {'prior':True}
         loglkwargs = {'likelihood':True}
@@ -848,7 +1056,7 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
     if samptype == 'gibbs':
         gibbs = True
     sampler_kwargs = {}
-    if samptype != 'ensemble':
+    if samptype in ('pt', 'gibbs'):
         inpos = pos.reshape(ntemps*nwalkers, nparam)
         if pool is None:
             lnprob0 = list(map(lnpost, inpos))
@@ -862,10 +1070,14 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
 
     # do a short burn-in
     if not resume:
-        with progress.Bar(label="Burn-in", expected_size=nburnin, hide=False) as bar:
+        # the nuts sampler tunes the step size and mass matrix during burn-in
+        burnin_kwargs = dict(sampler_kwargs)
+        if samptype == 'nuts':
+            burnin_kwargs['adapt'] = True
+        with progress.Bar(label="Burn-in", expected_size=nburnin, hide=not progress_bar) as bar:
             bar.show(0)
             j = 0
-            for i, result in enumerate(sampler.sample(pos, iterations=thin*nburnin, **sampler_kwargs)):
+            for i, result in enumerate(sampler.sample(pos, iterations=thin*nburnin, **burnin_kwargs)):
                 if (i+1)%thin == 0:
                     bar.show(j+1)
                     j+=1
@@ -899,6 +1111,9 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         # setup incremental chain saving
         chain = outf.create_group("chain")
 
+        # keep the burn-in chain for the plot of a resumed chain
+        chain.create_dataset("burnin", data=burnchain)
+
         # last saved position of the chain
         laststep = 0
 
@@ -912,6 +1127,10 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         chain.attrs["thin"]     = thin
         chain.attrs["nprod"]    = nprod
         chain.attrs["laststep"] = laststep
+        chain.attrs["marginalize"] = np.array(marginalize).astype(np.bytes_)
+        if samptype == 'nuts':
+            chain.attrs["stepsize"] = sampler.step_size
+            chain.attrs["invmass"]  = sampler.inv_mass
 
         # save the parameter names corresponding to the chain
         free_param_names = np.array([str(x) for x in free_param_names])
@@ -946,6 +1165,17 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         dset_lnprob.resize((ntemps*nwalkers*(laststep+nprod),))
         chain.attrs["nprod"] = laststep+nprod
 
+        # the burn-in chain for the plot, if the chain file has it
+        if "burnin" in chain:
+            burnchain = chain["burnin"][()]
+        else:
+            message = "Burn-in chain not saved in {}. Only plotting production.".format(outfile)
+            warnings.warn(message, RuntimeWarning)
+            if samptype in ('ensemble', 'nuts'):
+                burnchain = np.zeros((nwalkers, 0, nparam))
+            else:
+                burnchain = np.zeros((ntemps, nwalkers, 0, nparam))
+
         # and that we have the state of the chain when we ended
         try:
             with open(statefile, 'rb') as f:
@@ -965,6 +1195,9 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
             sampler.random_state = rstate
         else:
             sampler_kwargs['rstate0']=rstate
+        if samptype == 'nuts':
+            sampler.step_size = chain.attrs["stepsize"]
+            sampler.inv_mass  = chain.attrs["invmass"]
         sampler_kwargs['lnprob0']=lnpost
         pos = position
 
@@ -978,7 +1211,8 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
     # sampler_kwargs['storechain']=False
 
     # run the production chain
-    with progress.Bar(label="Production", expected_size=laststep+nprod, hide=False) as bar:
+    converged = False
+    with progress.Bar(label="Production", expected_size=laststep+nprod, hide=not progress_bar) as bar:
         bar.show(laststep)
         j = laststep
         for i, result in enumerate(sampler.sample(pos, iterations=thin*nprod, **sampler_kwargs)):
@@ -1004,9 +1238,20 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
             bar.show(j+1)
             j+=1
 
-        # save the final state of the chain and nprod, laststep
-        chain.attrs["nprod"]    = laststep+nprod
-        chain.attrs["laststep"] = laststep+nprod
+            # stop once the saved chain has converged
+            if autocorr_every is not None and (j-laststep)%autocorr_every == 0:
+                outf.flush()
+                converged = check_autocorr(chain, j, ntemps, nwalkers,\
+                        factor=autocorr_factor, tol=autocorr_tol)
+                if converged:
+                    message = "\nChain converged after {} steps. Stopping production.".format(j)
+                    print(message)
+                    break
+
+        # production may have stopped early, so keep only the steps that were
+        # run, and save the final state of the chain and nprod, laststep
+        nprod = j - laststep
+        trim_chain(chain, laststep+nprod, ntemps, nwalkers)
         with open(statefile, 'wb') as f:
             pickle.dump(result, f, 2)
 
@@ -1014,13 +1259,19 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
     if resume:
         if "afrac" in list(chain.keys()):
             del chain["afrac"]
-        if samptype != 'ensemble':
+        if samptype in ('pt', 'gibbs'):
             if "tswap_afrac" in list(chain.keys()):
                 del chain["tswap_afrac"]
     chain.create_dataset("afrac", data=sampler.acceptance_fraction)
-    if samptype != 'ensemble' and ntemps > 1:
+    if samptype in ('pt', 'gibbs') and ntemps > 1:
         chain.create_dataset("tswap_afrac", data=sampler.tswap_acceptance_fraction)
 
+    # evaluate the derived parameters chunk by chunk from the saved chain
+    derived.write_derived(chain, model, params)
+
+    # and draw the parameters that were marginalized over
+    write_marginalized(chain, posterior)
+
     samples         = np.array(dset_chain)
     samples_lnprob  = np.array(dset_lnprob)
 
@@ -1030,10 +1281,12 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
     if pool is not None:
         pool.close()
 
-    # save chains for plot
-    prodchain = sampler.chain
-    if samptype == 'ensemble':
-        fullchain = np.append(burnchain, prodchain, axis=1)  # nwalkers, niter, nparam
+    # save chains for plot - the production steps of this run are taken from
+    # the saved chain, which holds exactly the thinned steps that were run
+    prodchain = samples[ntemps*nwalkers*laststep:].reshape(nprod, ntemps, nwalkers, nparam)
+    prodchain = prodchain.transpose(1, 2, 0, 3)
+    if samptype in ('ensemble', 'nuts'):
+        fullchain = np.append(burnchain, prodchain[0], axis=1)  # nwalkers, niter, nparam
     else:
         fullchain = np.append(burnchain, prodchain, axis=2)  # ntemps, nwalkers, niter, nparam
 
@@ -1053,6 +1306,14 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         print(message)
     message = "Mean acceptance fraction: {0:.3f}".format(np.mean(sampler.acceptance_fraction))
     print(message)
+    if autocorr_every is not None and not converged:
+        message = "Chain did not converge in {} production steps. Consider resuming it.".format(laststep+nprod)
+        warnings.warn(message, RuntimeWarning)
+    if samptype == 'nuts' and sampler.ndivergent > 0:
+        message = "{} divergent trajectories in production. Posterior may be biased.".format(sampler.ndivergent)
+        warnings.warn(message, RuntimeWarning)
+    if stage_cache is not None:
+        stage_cache.report()
 
     # return the parameter names of the chain, the positions, posterior,
     # the chain for plotting, and the shape of the chain
@@ -1060,8 +1321,249 @@ def fit_model(spec, phot, model, covmodel, pbs, params,\
         (ntemps, nwalkers, laststep+nprod, nparam)
 
 
+def get_autocorr_time(chain, nstep, ntemps, nwalkers, c=5, chunksize=1000):
+    """
+    Estimate the integrated autocorrelation time of each parameter from the
+    first ``nstep`` steps of a saved Markov chain
+
+    The autocorrelation function of each parameter is computed separately
+    for each walker at the lowest temperature and averaged over the walkers,
+    which is much less noisy than averaging the autocorrelation times of the
+    walkers. The time is then summed over the smallest window that is at
+    least ``c`` autocorrelation times long, as in
+    :py:func:`emcee.autocorr.integrated_time`. The chain is read in chunks
+    of steps, so the file is read only once for each estimate, and only the
+    walkers of the lowest temperature are kept in memory.
+
+    Parameters
+    ----------
+    chain : :py:class:`h5py.Group`
+        The ``chain`` group of an open Markov chain file, with the
+        ``position`` dataset written by :py:func:`fit_model`
+    nstep : int
+        The number of saved steps to use
+    ntemps : int
+        The number of temperatures of the chain
+    nwalkers : int
+        The number of walkers of the chain
+    c : float, optional
+        The minimum length of the window in autocorrelation times. Default is
+        ``5``
+    chunksize : int, optional
+        The number of steps to read at once. Default is ``1000``
+
+    Returns
+    -------
+    tau : None or array-like
+        The autocorrelation time of each parameter in saved steps, or
+        ``None`` if the chain is too short to estimate it
+    """
+    dset = chain['position']
+    nparam = dset.shape[1]
+    nrow = ntemps*nwalkers
+
+    # the walkers of the lowest temperature are the first rows of each step
+    walkers = np.empty((nstep, nwalkers, nparam))
+    for j0 in range(0, nstep, chunksize):
+        j1 = min(j0 + chunksize, nstep)
+        walkers[j0:j1] = dset[nrow*j0:nrow*j1].reshape(j1-j0, nrow, nparam)[:, :nwalkers]
+    acf = autocorr_function(walkers, axis=0).mean(axis=1)
+
+    # the autocorrelation time summed over windows of increasing length, and
+    # the first window that is at least c autocorrelation times long. Noise
+    # in the sum can push it below the single step of independent samples.
+    taus = np.maximum(2.*np.cumsum(acf, axis=0) - 1., 1.)
+    window = np.arange(nstep)[:, np.newaxis] >= c*taus
+    if not np.all(np.any(window, axis=0)):
+        return None
+    ind = np.argmax(window, axis=0)
+    return taus[ind, np.arange(nparam)]
+
+
+def check_autocorr(chain, nstep, ntemps, nwalkers, factor=50., tol=0.01):
+    """
+    Check if a saved Markov chain has converged from the estimate of its
+    autocorrelation time, and record the estimate in the chain attributes
+
+    The chain has converged if it is longer than ``factor`` times the
+    autocorrelation time of every parameter, and the autocorrelation time of
+    every parameter has changed by less than ``tol`` relative to the previous
+    estimate.
+
+    Parameters
+    ----------
+    chain : :py:class:`h5py.Group`
+        The ``chain`` group of an open Markov chain file
+    nstep : int
+        The number of saved steps to use
+    ntemps : int
+        The number of temperatures of the chain
+    nwalkers : int
+        The number of walkers of the chain
+    factor : float, optional
+        The minimum length of the chain in autocorrelation times. Default is
+        ``50.``
+    tol : float, optional
+        The maximum relative change of the autocorrelation time. Default is
+        ``0.01``
+
+    Returns
+    -------
+    converged : bool
+        ``True`` if the chain has converged
+
+    Notes
+    -----
+        The estimates are appended to the ``autocorr_steps`` (the number of
+        steps used) and ``autocorr_tau`` (the autocorrelation time of each
+        parameter, or ``NaN`` if the chain was too short to estimate it)
+        attributes of ``chain``, so the estimates from a resumed chain are
+        kept. ``autocorr_converged`` records the result of the last check.
+
+    See Also
+    --------
+    :py:func:`get_autocorr_time`
+    """
+    tau = get_autocorr_time(chain, nstep, ntemps, nwalkers)
+    if tau is None:
+        # record the check anyway, so the history shows when the estimate
+        # first became possible
+        tau = np.repeat(np.nan, chain['position'].shape[1])
+
+    converged = False
+    if "autocorr_tau" in chain.attrs:
+        steps = list(chain.attrs["autocorr_steps"])
+        taus  = list(chain.attrs["autocorr_tau"])
+        if np.all(np.isfinite(tau)) and np.all(np.isfinite(taus[-1])):
+            change = np.abs(taus[-1] - tau)/tau
+            converged = bool(nstep > factor*np.max(tau) and np.all(change < tol))
+    else:
+        steps = []
+        taus  = []
+    steps.append(nstep)
+    taus.append(tau)
+
+    chain.attrs["autocorr_steps"] = np.array(steps, dtype='int')
+    chain.attrs["autocorr_tau"]   = np.array(taus)
+    chain.attrs["autocorr_factor"] = factor
+    chain.attrs["autocorr_tol"] = tol
+    chain.attrs["autocorr_converged"] = converged
+
+    if not np.all(np.isfinite(tau)):
+        message = "Step {}: chain too short to estimate the autocorrelation time".format(nstep)
+        print(message)
+        return False
+
+    message = "Step {}: max autocorrelation time {:.1f} steps".format(nstep, np.max(tau))
+    print(message)
+    return converged
+
+
+def trim_chain(chain, nstep, ntemps, nwalkers):
+    """
+    Trim a saved Markov chain to its first ``nstep`` steps
+
+    Parameters
+    ----------
+    chain : :py:class:`h5py.Group`
+        The ``chain`` group of an open Markov chain file, with the
+        ``position`` and ``lnprob`` datasets written by :py:func:`fit_model`
+    nstep : int
+        The number of saved steps to keep
+    ntemps : int
+        The number of temperatures of the chain
+    nwalkers : int
+        The number of walkers of the chain
+
+    Notes
+    -----
+        The ``nprod`` and ``laststep`` attributes of ``chain`` are set to
+        ``nstep``, and any autocorrelation time estimates recorded by
+        :py:func:`check_autocorr` that used steps beyond ``nstep`` are
+        dropped.
+    """
+    nrow = ntemps*nwalkers
+    nparam = chain['position'].shape[1]
+    chain['position'].resize((nrow*nstep, nparam))
+    chain['lnprob'].resize((nrow*nstep,))
+    chain.attrs["nprod"]    = nstep
+    chain.attrs["laststep"] = nstep
+
+    if "autocorr_steps" in chain.attrs:
+        keep = chain.attrs["autocorr_steps"] <= nstep
+        if np.any(keep):
+            chain.attrs["autocorr_steps"] = chain.attrs["autocorr_steps"][keep]
+            chain.attrs["autocorr_tau"]   = chain.attrs["autocorr_tau"][keep]
+        else:
+            del chain.attrs["autocorr_steps"]
+            del chain.attrs["autocorr_tau"]
+
+
+def write_marginalized(chain, lnpost, chunksize=1000, seed=1):
+    """
+    Draw the parameters that were marginalized over for every sample of a
+    saved Markov chain, and write them with the derived parameters
+
+    Each sample of the chain is paired with a draw of the marginalized
+    parameters from their posterior conditional on that sample, so that the
+    chain samples the joint posterior. The chain is read and the draws are
+    written in chunks.
+
+    Parameters
+    ----------
+    chain : :py:class:`h5py.Group`
+        The ``chain`` group of an open Markov chain file, with the
+        ``position`` dataset written by :py:func:`fit_model`
+    lnpost : :py:class:`WDmodel.likelihood.WDmodel_Posterior` instance
+        The posterior that was sampled
+    chunksize : int, optional
+        The number of samples to evaluate at once. Default is ``1000``
+    seed : int, optional
+        The seed of the random draws. Default is ``1``
+
+    Returns
+    -------
+    names : list
+        The names of the parameters written. Each is saved as
+        ``derived/<name>`` under ``chain`` and appended to the ``names``
+        attribute of the ``derived`` group.
+
+    See Also
+    --------
+    :py:meth:`WDmodel.likelihood.WDmodel_Posterior.sample_marginalized`
+    :py:func:`WDmodel.derived.write_derived`
+    """
+    if lnpost.marginal is None:
+        return []
+    names = list(lnpost.marginal.marginalize)
+    message = "Reconstructing samples of {} from the chain".format(', '.join(names))
+    print(message)
+
+    samples = chain['position']
+    nsamp = samples.shape[0]
+    group = chain.require_group('derived')
+    old_names = [x.decode('ascii') if isinstance(x, bytes) else str(x)\
+            for x in group.attrs.get('names', [])]
+    old_names = [x for x in old_names if x not in names]
+    dsets = {}
+    for name in names:
+        if name in group:
+            del group[name]
+        dsets[name] = group.create_dataset(name, (nsamp,), dtype='float64')
+
+    random_state = np.random.RandomState(seed)
+    chunksize = max(int(chunksize), 1)
+    for start in range(0, nsamp, chunksize):
+        stop  = min(start + chunksize, nsamp)
+        draws = lnpost.sample_marginalized(samples[start:stop], random_state=random_state)
+        for name, value in draws.items():
+            dsets[name][start:stop] = value
+    group.attrs['names'] = np.array(old_names + names).astype(np.bytes_)
+    return names
+
+
 def get_fit_params_from_samples(param_names, samples, samples_lnprob, params, model,\
-        ntemps=1, nwalkers=300, nprod=1000, discard=5, sptype=None):
+        ntemps=1, nwalkers=300, nprod=1000, discard=5, sptype=None, derived_samples=None):
     """
     Get the marginalized parameters from the sample chain
 
@@ -1094,6 +1596,13 @@ def get_fit_params_from_samples(param_names, samples, samples_lnprob, params, mo
         analyzing samples
     sptype : string specifying type of spectrum being fit. ``emission`` or
         ``transmission`` for lab plasma
+    derived_samples : :py:class:`collections.OrderedDict` or None, optional
+        Maps the names of derived parameters to their values for each of
+        ``samples``, such as that produced by
+        :py:func:`WDmodel.io.read_mcmc_derived`. If ``None``, every derived
+        parameter registered in :py:mod:`WDmodel.derived` for ``sptype`` is
+        evaluated on ``samples``. May include parameters that were
+        marginalized over, reconstructed by :py:func:`write_marginalized`.
 
     Returns
     -------
@@ -1103,45 +1612,33 @@ def get_fit_params_from_samples(param_names, samples, samples_lnprob, params, mo
         ``params``.
     out_samples : array-like
         The flattened Markov Chain with the parameter positions with the first
-        ``%discard`` tossed.
+        ``%discard`` tossed, followed by the derived parameters.
     out_ samples_lnprob : array-like
         The flattened log of the posterior corresponding to the positions in
         ``samples`` with the first ``%discard`` samples tossed.
     param_names : list
-        names of parameters that were fit for or those derived from fitted
-        parameters, e.g., ``ne``. Names correspond to keys in
+        names of parameters that were fit for, marginalized over or those
+        derived from fitted parameters, e.g., ``ne``. Names correspond to keys in
         ``params`` and the order of parameters in ``samples``.
 
     See Also
     --------
     :py:func:`fit_model`
+    :py:mod:`WDmodel.derived`
     """
 
-    # if fitting lab plasma, add electron density to params to be
-    # passed to plotting routines
-    # need to handle case where ne and Te are both fixed
-    if sptype in ('emission', 'transmission'):
-        indrho = np.squeeze(np.where(param_names == 'logg'))
-        indT = np.squeeze(np.where(param_names == 'teff'))
-        if indT.size == 0:
-            Tefixed = params['teff']['value']
-            Te_arr = np.full(samples.shape[0], Tefixed)
-        else:
-            Te_arr = samples[:, indT]
-        # print('samplesshape', samples.shape)
-        # print('indT', indT)
-        # print('indrho', indrho)
-        # print('samples[:, indT]', samples[:, indT])
-        nesamp = model._get_ne(samples[:, indrho], Te_arr)
-        samples = np.column_stack((samples, nesamp))
-        param_names = np.append(param_names, 'ne')
-        params['ne'] = {}
-        params['ne']['derived'] = True
-        params['ne']['fixed'] = False
-
-    ndim = len(param_names)
-
-    in_samp   = samples.reshape(ntemps, nwalkers, nprod, ndim)
+    # derived parameters, e.g. the electron density for lab plasma, are
+    # evaluated in chunks and appended only to the samples that are kept,
+    # rather than stacked onto a copy of the full chain
+    if derived_samples is None:
+        derived_names = derived.get_derived_names(sptype)
+        derived_samples = derived.get_derived(model, param_names, samples, params, names=derived_names)
+    derived_names = list(derived_samples.keys())
+
+    nparam = len(param_names)
+    ndim   = nparam + len(derived_names)
+
+    in_samp   = samples.reshape(ntemps, nwalkers, nprod, nparam)
     in_lnprob = samples_lnprob.reshape(ntemps, nwalkers, nprod)
 
     # discard the first %discard steps from all the walkers
@@ -1149,17 +1646,28 @@ def get_fit_params_from_samples(param_names, samples, samples_lnprob, params, mo
     in_samp   = in_samp[:,:,nstart:,:]
     in_lnprob = in_lnprob[:,:,nstart:]
 
-    # reflatten
-    in_samp = in_samp.reshape((-1, ndim))
-    in_lnprob = in_lnprob.reshape(in_samp.shape[0])
-
     # only select entries with finite log posterior
     # if this isn't all, something is wrong
     mask = np.isfinite(in_lnprob)
 
+    # fill the output one column at a time to avoid intermediate copies
+    out_samp = np.empty((np.count_nonzero(mask), ndim))
+    for i in range(nparam):
+        out_samp[:, i] = in_samp[..., i][mask]
+    for i, param in enumerate(derived_names):
+        x = np.asarray(derived_samples[param]).reshape(ntemps, nwalkers, nprod)
+        out_samp[:, nparam+i] = x[:,:,nstart:][mask]
+        # parameters that were marginalized over are model parameters
+        if param not in io._PARAMETER_NAMES:
+            params[param] = {}
+            params[param]['derived'] = True
+        params[param]['fixed'] = False
+    if len(derived_names) > 0:
+        param_names = np.append(param_names, derived_names)
+
     # update the parameter dict
     for i, param in enumerate(param_names):
-        x = in_samp[mask,i]
+        x = out_samp[:,i]
         q_16, q_50, q_84 = np.percentile(x, [16., 50., 84.])
         params[param]['value']  = q_50
         params[param]['bounds'] = (q_16, q_84)
@@ -1176,4 +1684,4 @@ def get_fit_params_from_samples(param_names, samples, samples_lnprob, params, mo
             # this should never happen, unless the state of the files was changed
             message = "Huh.... {} not marked as fixed but was not fit for...".format(param)
             print(message)
-    return params, in_samp[mask,:], in_lnprob[mask], param_names
+    return params, out_samp, in_lnprob[mask], param_names
@@ -10,6 +10,7 @@ from __future__ import unicode_literals
 import sys
 import os
 from emcee.utils import MPIPool
+from .pool import WDmodel_ProcessPool, WDmodel_MPIPool
 import argparse
 import warnings
 from copy import deepcopy
@@ -41,9 +42,10 @@ def get_options(args, comm):
     -------
     args : Namespace
         Parsed command line options
-    pool : None or :py:class`emcee.utils.MPIPool`
-        If running with MPI, the pool object is used to distribute the
-        computations among the child process
+    pool : None or :py:class`emcee.utils.MPIPool` or :py:class:`WDmodel.pool.WDmodel_MPIPool` or :py:class:`WDmodel.pool.WDmodel_ProcessPool`
+        If running with MPI, or with more than one local process, the pool
+        object is used to distribute the computations among the child
+        processes
 
     Raises
     ------
@@ -93,12 +95,19 @@ def get_options(args, comm):
                        action="store_true", help="Run with MPI.")
     mproc.add_argument("--mpil", dest="mpil", default=False,
                        action="store_true", help="Run with MPI and enable loadbalancing.")
+    mproc.add_argument("--mpichunk", dest="mpichunk", default=False,
+                       action="store_true", help="Run with MPI and send each process one block of walkers per step.")
+    mproc.add_argument("--nproc", dest="nproc", type=int, default=1,
+                       help="Run with this many local processes without MPI.")
 
     # spectrum options
     spectrum = parser.add_argument_group('spectrum', 'Spectrum options')
 
-    spectrum.add_argument('--specfile', required=True, \
+    specinput = spectrum.add_mutually_exclusive_group(required=True)
+    specinput.add_argument('--specfile', required=False, \
             help="Specify spectrum to fit")
+    specinput.add_argument('--speclist', required=False, \
+            help="Specify file listing spectra to fit in one batch, sharing the model grid and passbands")
     spectrum.add_argument('--spectable', required=False,  default="data/spectroscopy/spectable_resolution.dat",\
             help="Specify file containing a fwhm lookup table for specfile")
     spectrum.add_argument('--lamshift', required=False, type='NoneOrFloat', default=None,\
@@ -123,6 +132,24 @@ def get_options(args, comm):
             help='Specify name of the group name in the HDF5 file')
     specgrid.add_argument('--sptype', required=False, default=None,\
             help='Specify type of spectrum, e.g., "emission" or "transmission"')
+    specgrid.add_argument('--trimgrid', required=False, action="store_true", default=False,\
+            help="Read only the part of the model grid needed for the teff, logg, shift and rvel bounds, the trimmed spectrum and the passbands")
+    specgrid.add_argument('--gridprecision', required=False, choices=('float64', 'float32'), default='float64',\
+            help="Specify precision of the model grid and the interpolation in it. float32 halves the grid memory")
+    specgrid.add_argument('--gridprecisiontol', required=False, type=float, default=1e-4,\
+            help="Specify the maximum error in mag of a float32 grid vs float64 to use it")
+    specgrid.add_argument('--emulator', required=False, action="store_true", default=False,\
+            help="Replace the model grid with a principal component emulator of it")
+    specgrid.add_argument('--emulatortol', required=False, type=float, default=1e-3,\
+            help="Specify the maximum error in dex of the emulator at the grid nodes")
+    specgrid.add_argument('--emulatorfile', required=False, default=None,\
+            help="Specify file to read the emulator from and store it in. Default is the grid file, or <grid>_emulator.hdf5 next to it")
+    specgrid.add_argument('--sharedgrid', required=False, action="store_true", default=False,\
+            help="Share a single read-only memory-mapped copy of the model grid between the processes on a node")
+    specgrid.add_argument('--shareddir', required=False, default=None,\
+            help="Specify node-local directory for the shared model grid. Default is /dev/shm or the temporary directory")
+    specgrid.add_argument('--convolver', required=False, choices=('auto', 'direct', 'fft', 'iir'), default='auto',\
+            help="Specify backend for the Gaussian instrumental broadening. iir is fastest but approximate")
     
     # photometry options
     reddeninglaws = ('od94', 'ccm89', 'f99', 'custom')
@@ -139,6 +166,10 @@ def get_options(args, comm):
             help="Specify passbands to exclude" )
     phot.add_argument('--ignorephot',  required=False, action="store_true", default=False,\
             help="Ignores missing photometry and does the fit with just the spectrum")
+    phot.add_argument('--synmagtable', required=False, default=None,\
+            help="Specify HDF5 table of synthetic magnitudes from make_WDmodel_synmag_table to interpolate model photometry")
+    phot.add_argument('--synmagtol', required=False, type=float, default=0.001,\
+            help="Specify the maximum error in mag of the synthetic magnitude table vs the full SED to use the table")
 
     # fitting options
     model = parser.add_argument_group('model',\
@@ -174,14 +205,14 @@ def get_options(args, comm):
     mcmc = parser.add_argument_group('mcmc', 'MCMC options')
     mcmc.add_argument('--skipminuit',  required=False, action="store_true", default=False,\
             help="Skip Minuit fit - make sure to specify dl guess")
-    mcmc.add_argument('--samptype', required=False, default='ensemble', choices=('ensemble', 'gibbs', 'pt'),\
-            help='Specify what kind of sampler you want to use')
+    mcmc.add_argument('--samptype', required=False, default='ensemble', choices=('ensemble', 'gibbs', 'pt', 'nuts'),\
+            help='Specify what kind of sampler you want to use - nuts uses the gradient of the posterior and --nwalkers independent chains')
     mcmc.add_argument('--skipmcmc',  required=False, action="store_true", default=False,\
             help="Skip MCMC - if you skip both minuit and MCMC, simply prepares files")
     mcmc.add_argument('--ascale', required=False, type=float, default=2.0,\
             help="Specify proposal scale for MCMC")
-    mcmc.add_argument('--nwalkers',  required=False, type=int, default=300,\
-            help="Specify number of walkers to use (0 disables MCMC)")
+    mcmc.add_argument('--nwalkers',  required=False, type=int, default=None,\
+            help="Specify number of walkers to use (0 disables MCMC) - default is 300, or 4 chains for nuts")
     mcmc.add_argument('--ntemps', required=False, type=int, default=1,\
             help="Specify number of temperatures in ladder for parallel tempering - only available with PTSampler")
     mcmc.add_argument('--nburnin',  required=False, type=int, default=200,\
@@ -192,6 +223,20 @@ def get_options(args, comm):
             help="Use only every nth point in data for computing likelihood - useful for testing.")
     mcmc.add_argument('--thin', required=False, type=int, default=1,\
             help="Save only every nth point in the chain - only works with PTSampler and Gibbs")
+    mcmc.add_argument('--convgridfwhm', required=False, nargs=2, type=float, default=None,\
+            metavar=("FWHMLO", "FWHMHI"), help="Tabulate the model convolved with fwhm in this range on the spectrum wavelengths, and interpolate it instead of convolving")
+    mcmc.add_argument('--convgridnfwhm', required=False, type=int, default=11,\
+            help="Specify number of fwhm nodes of the convolved model grid")
+    mcmc.add_argument('--convgridtol', required=False, type=float, default=1e-3,\
+            help="Specify the maximum relative flux error of the convolved model grid vs convolving to use the grid")
+    mcmc.add_argument('--marginalize', required=False, nargs='+', choices=('dl', 'mu'), default=[],\
+            help="Analytically marginalize over these parameters instead of sampling them, and reconstruct their samples after the fit")
+    mcmc.add_argument('--autocorrevery', required=False, type=int, default=None,\
+            help="Estimate the autocorrelation time from the saved chain every n production steps, and stop production once the chain has converged")
+    mcmc.add_argument('--autocorrfactor', required=False, type=float, default=50.,\
+            help="Specify the minimum length of a converged chain in autocorrelation times")
+    mcmc.add_argument('--autocorrtol', required=False, type=float, default=0.01,\
+            help="Specify the maximum relative change of the autocorrelation time between estimates for a converged chain")
     mcmc.add_argument('--discard',  required=False, type=float, default=25,\
             help="Specify percentage of steps to be discarded")
     clobber = mcmc.add_mutually_exclusive_group()
@@ -246,10 +291,44 @@ def get_options(args, comm):
         message = 'Photometric dispersion must be GE 0. ({:g})'.format(args.phot_dispersion)
         raise ValueError(message)
 
+    if args.synmagtol <= 0.:
+        message = 'Synthetic magnitude table tolerance must be greater than 0. ({:g})'.format(args.synmagtol)
+        raise ValueError(message)
+
+    if args.gridprecisiontol <= 0.:
+        message = 'Grid precision tolerance must be greater than 0. ({:g})'.format(args.gridprecisiontol)
+        raise ValueError(message)
+
+    if args.emulatortol <= 0.:
+        message = 'Emulator tolerance must be greater than 0. ({:g})'.format(args.emulatortol)
+        raise ValueError(message)
+
+    if args.emulator and args.sharedgrid:
+        message = 'The emulator replaces the model grid, so it cannot be shared'
+        raise ValueError(message)
+
+    if args.convgridfwhm is not None:
+        if not (0. < args.convgridfwhm[0] < args.convgridfwhm[1]):
+            message = 'Convolved grid fwhm range must be positive and increasing ({}, {})'.format(*args.convgridfwhm)
+            raise ValueError(message)
+        if args.convgridnfwhm < 2:
+            message = 'Number of convolved grid fwhm nodes must be GE 2 ({})'.format(args.convgridnfwhm)
+            raise ValueError(message)
+        if args.convgridtol <= 0.:
+            message = 'Convolved grid tolerance must be greater than 0. ({:g})'.format(args.convgridtol)
+            raise ValueError(message)
+
     if args.coveps <= 0:
         message = 'Matern32 approximation eps must be greater than 0. ({:g})'.format(args.coveps)
         raise ValueError(message)
 
+    # a handful of independent chains is enough for nuts
+    if args.nwalkers is None:
+        if args.samptype == 'nuts':
+            args.nwalkers = 4
+        else:
+            args.nwalkers = 300
+
     if args.nwalkers <= 0:
         message = 'Number of walkers must be greater than zero for MCMC ({})'.format(args.nwalkers)
         raise ValueError(message)
@@ -262,10 +341,18 @@ def get_options(args, comm):
         message = 'Number of temperatures must be greater than zero ({})'.format(args.ntemps)
         raise ValueError(message)
 
-    if (args.ntemps > 1) and (args.samptype == 'ensemble'):
+    if (args.ntemps > 1) and (args.samptype in ('ensemble', 'nuts')):
         message = 'Multiple temperatures only available with PTSampler or Gibbs Sampler: ({})'.format(args.ntemps)
         raise ValueError(message)
 
+    if (args.samptype == 'nuts') and (len(args.marginalize) > 0):
+        message = 'NUTS sampler cannot be used while marginalizing over {}'.format(args.marginalize)
+        raise ValueError(message)
+
+    if (args.samptype == 'nuts') and (args.sptype is not None):
+        message = 'NUTS sampler requires the gradient of the DA model and is not available for sptype {}'.format(args.sptype)
+        raise ValueError(message)
+
     if args.nburnin <= 0:
         message = 'Number of burnin steps must be greater than zero ({})'.format(args.nburnin)
         raise ValueError(message)
@@ -274,6 +361,17 @@ def get_options(args, comm):
         message = 'Number of production steps must be greater than zero ({})'.format(args.nprod)
         raise ValueError(message)
 
+    if args.autocorrevery is not None:
+        if args.autocorrevery < 1:
+            message = 'Autocorrelation time must be estimated every 1 or more steps ({})'.format(args.autocorrevery)
+            raise ValueError(message)
+        if args.autocorrfactor <= 0.:
+            message = 'Autocorrelation factor must be greater than 0. ({:g})'.format(args.autocorrfactor)
+            raise ValueError(message)
+        if args.autocorrtol <= 0.:
+            message = 'Autocorrelation tolerance must be greater than 0. ({:g})'.format(args.autocorrtol)
+            raise ValueError(message)
+
     if not (0 <= args.discard < 100):
         message = 'Discard must be a percentage (0-100) ({})'.format(args.discard)
         raise ValueError(message)
@@ -291,13 +389,31 @@ def get_options(args, comm):
             message = 'Rv must be fixed to 3.1 for reddening model custom'
             raise ValueError(message)
 
-    # Wait for instructions from the master process if we are running MPI
+    if args.nproc < 1:
+        message = 'Number of processes must be greater than zero ({})'.format(args.nproc)
+        raise ValueError(message)
+
+    if args.speclist is not None:
+        if args.outdir is not None:
+            message = 'Cannot specify a single output directory for a list of spectra. Use outroot.'
+            raise ValueError(message)
+
+    # with a list of spectra, the processes are split between the objects instead
     pool = None
-    if args.mpi or args.mpil:
-        pool = MPIPool(loadbalance=args.mpil, debug=False)
+    if args.speclist is not None:
+        return args, pool
+
+    # Wait for instructions from the master process if we are running MPI
+    if args.mpi or args.mpil or args.mpichunk:
+        if args.mpichunk:
+            pool = WDmodel_MPIPool(comm)
+        else:
+            pool = MPIPool(loadbalance=args.mpil, debug=False)
         if not pool.is_master():
             pool.wait()
             sys.exit(0)
+    elif args.nproc > 1:
+        pool = WDmodel_ProcessPool(args.nproc)
 
     return args, pool
 
@@ -495,7 +611,93 @@ def get_params_from_argparse(args):
     return out
 
 
-def read_model_grid(grid_file=None, grid_name=None):
+def _get_grid_slice(grid, bounds):
+    """
+    Returns the slice of the sorted array ``grid`` that brackets ``bounds``
+
+    Parameters
+    ----------
+    grid : array-like
+        Sorted array of grid nodes
+    bounds : None or 2-tuple
+        The lower and upper bound. Either may be ``None`` for no bound.
+
+    Returns
+    -------
+    out : slice
+        Slice that includes the nodes within ``bounds`` and the nodes
+        immediately outside them, so the grid can be interpolated anywhere
+        within ``bounds``
+
+    Raises
+    ------
+    ValueError
+        If the slice has fewer than two grid nodes
+    """
+    if bounds is None:
+        return slice(None)
+    lo, hi = bounds
+    ngrid = len(grid)
+    start = 0
+    stop  = ngrid
+    if lo is not None:
+        start = max(np.searchsorted(grid, lo, side='right') - 1, 0)
+    if hi is not None:
+        stop  = min(np.searchsorted(grid, hi, side='left') + 1, ngrid)
+    if stop - start < 2:
+        message = 'Bounds ({},{}) do not overlap grid range ({},{})'.format(lo, hi, grid[0], grid[-1])
+        raise ValueError(message)
+    return slice(start, stop)
+
+
+def _is_plasma(sptype):
+    """
+    Returns ``True`` if the grid of ``sptype`` stores ln opacities rather than
+    fluxes
+    """
+    return sptype in ('emission', 'transmission')
+
+
+def _log_flux(flux, sptype=None):
+    """
+    Returns the ``log10`` grid fluxes (or opacities for plasma models) used
+    for interpolation with shape ``(ntemp, ngrav, nwave)`` from the grid file
+    array ``flux`` with shape ``(nwave, ngrav, ntemp)``
+    """
+    if _is_plasma(sptype):
+        return flux.T*np.log10(np.e)  # file opacities are ln opacity
+    return np.log10(flux.T)
+
+
+def _unlog_flux(lflux, sptype=None):
+    """
+    Inverse of :py:func:`_log_flux`
+    """
+    if _is_plasma(sptype):
+        return lflux.T/np.log10(np.e)
+    return 10.**lflux.T
+
+
+def _read_compiled_flux(grid_file, grid, tslice, gslice, wslice, dtype='float64'):
+    """
+    Returns the ``log10`` flux of a compiled grid written by
+    :py:func:`write_compiled_grid` within the slices as ``dtype``
+
+    Contiguous, uncompressed grids stored as ``dtype`` are memory mapped
+    read-only. Others are read from the chunks that overlap the slices.
+    """
+    dset = grid['lflux']
+    offset = None
+    if dset.chunks is None and dset.compression is None:
+        offset = dset.id.get_offset()
+    if offset is not None and dset.dtype == np.dtype(dtype):
+        lflux = np.memmap(grid_file, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+        return np.asarray(lflux)[tslice, gslice, wslice]
+    return dset[tslice, gslice, wslice].astype(dtype)
+
+
+def read_model_grid(grid_file=None, grid_name=None, teffbounds=None, loggbounds=None, wavebounds=None,\
+        log=False, sptype=None, dtype='float64'):
     """
     Read the Tlusty/Hubeny grid file
 
@@ -509,6 +711,23 @@ def read_model_grid(grid_file=None, grid_name=None):
     grid_name : None or str
         Name of the group name in the HDF5 file to read the grid from. If
         ``None`` uses ``default``
+    teffbounds : None or 2-tuple, optional
+        Lower and upper bound on temperature in Kelvin. If supplied, only the
+        part of the grid needed to interpolate within the bounds is read.
+    loggbounds : None or 2-tuple, optional
+        Lower and upper bound on surface gravity in dex
+    wavebounds : None or 2-tuple, optional
+        Lower and upper bound on wavelength in Angstrom
+    log : bool, optional
+        Return the ``log10`` flux used for interpolation, with shape
+        ``(ntemp, ngrav, nwave)`` instead of the flux. Default is ``False``
+    sptype : None or str, optional
+        The spectral type of the grid. ``'emission'`` and ``'transmission'``
+        grids store ln opacities, which are converted to ``log10`` opacities
+        if ``log`` is set. Default is ``None``
+    dtype : ``{'float64', 'float32'}``, optional
+        Type of the output ``log10`` flux if ``log`` is set. The conversion
+        is done in float64 before the output is cast. Default is ``float64``
 
     Returns
     -------
@@ -524,15 +743,32 @@ def read_model_grid(grid_file=None, grid_name=None):
         The temperature array of the grid with shape ``(ntemp,)``
     flux : array-like
         The DA white dwarf model atmosphere flux array of the grid.
-        Has shape ``(nwave, ngrav, ntemp)``
+        Has shape ``(nwave, ngrav, ntemp)``, or ``(ntemp, ngrav, nwave)`` if
+        ``log`` is set.
     negrid : array-like
         The electron density array
 
+    Raises
+    ------
+    ValueError
+        If ``grid_name`` is not in ``grid_file``, the bounds do not overlap
+        the grid, or ``sptype`` does not match a compiled grid
+
     Notes
     -----
         The grid can be changed with the '--gridfile' and '--gridname'
         command line options.
 
+        With bounds, only the matching hyperslab of the flux array is read
+        from the HDF5 file. The bounds of each dimension are extended to the
+        grid nodes that bracket them. Either end of each bound can be
+        ``None``.
+
+        Compiled grids written by :py:func:`WDmodel.io.write_compiled_grid`
+        store the ``log10`` flux already transposed. If they are contiguous
+        and uncompressed, stored as ``dtype``, and ``log`` is set, they are
+        memory mapped rather than read.
+
     See Also
     --------
     :py:class:`WDmodel.WDmodel`
@@ -570,18 +806,439 @@ def read_model_grid(grid_file=None, grid_name=None):
                     grid_file, ','.join(list(grids.keys())))
             raise ValueError(message)
 
+        compiled = 'lflux' in grid
+        if compiled:
+            grid_sptype = grid.attrs.get('sptype', '')
+            if isinstance(grid_sptype, bytes):
+                grid_sptype = grid_sptype.decode('utf-8')
+            if _is_plasma(grid_sptype) != _is_plasma(sptype):
+                message = 'Compiled grid {} in {} was made for sptype {}, not {}'.format(grid_name, grid_file,\
+                        grid_sptype, sptype)
+                raise ValueError(message)
+
         wave  = grid['wave'].value.astype('float64')
         ggrid = grid['ggrid'].value.astype('float64')
         tgrid = grid['tgrid'].value.astype('float64')
-        flux  = grid['flux'].value.astype('float64')
-        if grid_file_name == 'TlustyPlasmaGrids.hdf5':
-            negrid = grid['negrid'].value.astype('float64')
+
+        wslice = _get_grid_slice(wave,  wavebounds)
+        gslice = _get_grid_slice(ggrid, loggbounds)
+        tslice = _get_grid_slice(tgrid, teffbounds)
+        wave  = wave[wslice]
+        ggrid = ggrid[gslice]
+        tgrid = tgrid[tslice]
+
+        # h5py only reads the selected hyperslab from disk
+        if compiled:
+            if log:
+                flux = _read_compiled_flux(grid_file, grid, tslice, gslice, wslice, dtype=dtype)
+            else:
+                flux = _unlog_flux(_read_compiled_flux(grid_file, grid, tslice, gslice, wslice), sptype)
+        else:
+            flux = grid['flux'][wslice, gslice, tslice].astype('float64')
+            if log:
+                flux = _log_flux(flux, sptype).astype(dtype, copy=False)
+        if grid_file_name == 'TlustyPlasmaGrids.hdf5' or (compiled and 'negrid' in grid):
+            negrid = grid['negrid'][gslice, tslice].astype('float64')
         else:
             negrid = None
 
     return grid_file, grid_name, wave, ggrid, tgrid, flux, negrid
 
 
+def read_model_grid_cells(grid_file, grid_name, teff, logg, wavebounds=None, sptype=None):
+    """
+    Read the float64 ``log10`` flux at the corners of grid cells
+
+    Only the ``2x2`` nodes of each cell are read from the HDF5 file, so this
+    can be used to check a reduced precision grid without reading the
+    whole grid in float64.
+
+    Parameters
+    ----------
+    grid_file : str
+        Filename of the HDF5 grid file e.g. the ``grid_file`` returned by
+        :py:func:`WDmodel.io.read_model_grid`
+    grid_name : str
+        Name of the group in the HDF5 file with the grid arrays
+    teff : array-like
+        Grid temperatures of the lower corner of each cell
+    logg : array-like
+        Grid surface gravities of the lower corner of each cell
+    wavebounds : None or 2-tuple, optional
+        Lower and upper bound on wavelength in Angstrom, as in
+        :py:func:`WDmodel.io.read_model_grid`
+    sptype : None or str, optional
+        The spectral type of the grid
+
+    Returns
+    -------
+    lflux : array-like
+        The ``log10`` flux of the cells with shape ``(ncell, 2, 2, nwave)``
+
+    Raises
+    ------
+    ValueError
+        If any ``teff`` or ``logg`` is not a grid node with a node above it
+
+    Notes
+    -----
+        The nodes are returned as stored, so a compiled grid stored in
+        float32 is only converted to float64.
+    """
+    teff = np.atleast_1d(teff)
+    logg = np.atleast_1d(logg)
+    with h5py.File(grid_file, 'r') as grids:
+        grid  = grids[grid_name]
+        tgrid = grid['tgrid'].value.astype('float64')
+        ggrid = grid['ggrid'].value.astype('float64')
+        wslice = _get_grid_slice(grid['wave'].value.astype('float64'), wavebounds)
+        it = np.searchsorted(tgrid, teff)
+        ig = np.searchsorted(ggrid, logg)
+        if np.any(it >= len(tgrid) - 1) or np.any(ig >= len(ggrid) - 1) or\
+                np.any(tgrid[it] != teff) or np.any(ggrid[ig] != logg):
+            message = 'Cells must start at grid nodes of {} in {}'.format(grid_name, grid_file)
+            raise ValueError(message)
+
+        compiled = 'lflux' in grid
+        lflux = []
+        for i, j in zip(it, ig):
+            if compiled:
+                cell = grid['lflux'][i:i+2, j:j+2, wslice].astype('float64')
+            else:
+                cell = _log_flux(grid['flux'][wslice, j:j+2, i:i+2].astype('float64'), sptype)
+            lflux.append(cell)
+    return np.array(lflux)
+
+
+def write_compiled_grid(outfile, wave, ggrid, tgrid, lflux, negrid=None, grid_name='default', sptype=None,\
+        dtype='float64', chunked=False, compression=None, attrs=None):
+    """
+    Write a model grid in the compiled layout read by
+    :py:func:`WDmodel.io.read_model_grid`
+
+    Parameters
+    ----------
+    outfile : str
+        Output HDF5 grid filename. If it exists, the group ``grid_name`` is
+        replaced and any other groups are kept.
+    wave, ggrid, tgrid : array-like
+        The wavelength, surface gravity and temperature arrays of the grid
+    lflux : array-like
+        The ``log10`` flux (or opacity) with shape ``(ntemp, ngrav, nwave)``
+        i.e. :py:attr:`WDmodel.WDmodel.WDmodel._lflux`, or the output of
+        :py:func:`WDmodel.io.read_model_grid` with ``log`` set
+    negrid : None or array-like, optional
+        The electron density array of plasma grids
+    grid_name : str, optional
+        Name of the output group. Default is ``default``
+    sptype : None or str, optional
+        The spectral type the grid was converted with. Default is ``None``
+    dtype : ``{'float64', 'float32'}``, optional
+        Storage type of ``lflux``. Default is ``float64``
+    chunked : bool, optional
+        Store ``lflux`` in chunks of one spectrum - the unit the model
+        interpolates - instead of contiguously. Default is ``False``
+    compression : ``{None, 'gzip', 'lzf'}``, optional
+        Compress the chunks. Implies ``chunked``. Default is ``None``
+    attrs : dict, optional
+        Metadata describing how the grid was made. Saved as attributes of the
+        group.
+
+    Raises
+    ------
+    ValueError
+        If ``lflux`` does not match the grid arrays
+
+    Notes
+    -----
+        Only contiguous, uncompressed grids can be memory mapped when read,
+        so they load fastest, and are shared between processes through the
+        page cache. Chunked and compressed grids are smaller on disk, and are
+        the better choice if the grid is usually read with bounds. float32
+        grids are only memory mapped by float32 models, and are converted to
+        float64 otherwise.
+    """
+    lflux = np.asarray(lflux)
+    shape = (len(tgrid), len(ggrid), len(wave))
+    if lflux.shape != shape:
+        message = 'Grid shape {} does not match grid arrays {}'.format(lflux.shape, shape)
+        raise ValueError(message)
+
+    kwargs = {}
+    if chunked or compression is not None:
+        kwargs['chunks'] = (1, 1, len(wave))
+    if compression is not None:
+        kwargs['compression'] = compression
+
+    with h5py.File(outfile, 'a') as outf:
+        if grid_name in outf:
+            del outf[grid_name]
+        dset_grid = outf.create_group(grid_name)
+        dset_grid.create_dataset("wave", data=wave)
+        dset_grid.create_dataset("ggrid", data=ggrid)
+        dset_grid.create_dataset("tgrid", data=tgrid)
+        dset_grid.create_dataset("lflux", data=lflux.astype(dtype), **kwargs)
+        if negrid is not None:
+            dset_grid.create_dataset("negrid", data=negrid)
+        dset_grid.attrs['sptype'] = '' if sptype is None else str(sptype)
+        if attrs is not None:
+            for key, value in attrs.items():
+                dset_grid.attrs[key] = value
+    message = "Wrote compiled model grid {} to file {}".format(grid_name, outfile)
+    print(message)
+
+
+def write_grid_precision(outfile, grid_name, dtype, report):
+    """
+    Store the error of a reduced precision grid as attributes of the grid
+
+    Parameters
+    ----------
+    outfile : str
+        HDF5 grid filename
+    grid_name : str
+        Name of the group with the grid arrays
+    dtype : str
+        The precision the grid was checked in
+    report : dict
+        The output of :py:meth:`WDmodel.WDmodel.WDmodel.validate_precision`
+
+    Notes
+    -----
+        The report is saved in the attributes ``precision_dtype`` and
+        ``precision_<key>`` for each key of ``report``, replacing any
+        earlier report.
+
+    See Also
+    --------
+    :py:func:`WDmodel.io.read_grid_precision`
+    """
+    with h5py.File(outfile, 'a') as outf:
+        grid = outf[grid_name]
+        grid.attrs['precision_dtype'] = str(np.dtype(dtype))
+        for key, value in report.items():
+            grid.attrs['precision_{}'.format(key)] = value
+
+
+def read_grid_precision(grid_file, grid_name, dtype):
+    """
+    Read the error of a reduced precision grid written by
+    :py:func:`WDmodel.io.write_grid_precision`
+
+    Parameters
+    ----------
+    grid_file : str
+        HDF5 grid filename
+    grid_name : str
+        Name of the group with the grid arrays
+    dtype : str
+        The precision of the model
+
+    Returns
+    -------
+    report : dict or None
+        The stored report, or ``None`` if the grid has no report for
+        ``dtype``
+    """
+    with h5py.File(grid_file, 'r') as grids:
+        attrs = dict(grids[grid_name].attrs.items())
+    grid_dtype = attrs.pop('precision_dtype', b'')
+    if isinstance(grid_dtype, bytes):
+        grid_dtype = grid_dtype.decode('utf-8')
+    if grid_dtype != str(np.dtype(dtype)):
+        return None
+    report = {}
+    for key, value in attrs.items():
+        if key.startswith('precision_'):
+            report[key[len('precision_'):]] = float(value)
+    return report
+
+
+def write_synmag_table(outfile, tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp, attrs=None):
+    """
+    Write a synthetic magnitude table to an output file
+
+    Parameters
+    ----------
+    outfile : str
+        Output HDF5 synthetic magnitude table filename
+    tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp
+        The outputs of :py:func:`WDmodel.passband.make_synmag_table`
+    attrs : dict, optional
+        Metadata describing how the table was made e.g. the model grid file
+        and reddening law. Saved as attributes of the ``synmags`` group.
+
+    Notes
+    -----
+        The output is written into a group ``synmags`` with datasets
+         * ``tgrid`` : array-like - the temperature nodes
+         * ``ggrid`` : array-like - the surface gravity nodes
+         * ``avgrid`` : array-like - the :math:`A_V` nodes
+         * ``rvgrid`` : array-like - the :math:`R_V` nodes
+         * ``pbnames`` : array-like - the passband names
+         * ``lflux`` : array-like - the log10 band-integrated fluxes
+         * ``norm`` : array-like - the normalization of the passbands
+         * ``zp`` : array-like - the zeropoints of the passbands
+
+    See Also
+    --------
+    :py:func:`WDmodel.passband.make_synmag_table`
+    """
+    with h5py.File(outfile, 'w') as outf:
+        dset_table = outf.create_group("synmags")
+        dset_table.create_dataset("tgrid", data=tgrid)
+        dset_table.create_dataset("ggrid", data=ggrid)
+        dset_table.create_dataset("avgrid", data=avgrid)
+        dset_table.create_dataset("rvgrid", data=rvgrid)
+        dset_table.create_dataset("pbnames", data=np.array(pbnames, dtype='S'))
+        dset_table.create_dataset("lflux", data=lflux, compression='gzip', compression_opts=5)
+        dset_table.create_dataset("norm", data=norm)
+        dset_table.create_dataset("zp", data=zp)
+        if attrs is not None:
+            for key, value in attrs.items():
+                dset_table.attrs[key] = value
+    message = "Wrote synthetic magnitude table file {}".format(outfile)
+    print(message)
+
+
+def read_synmag_table(table_file):
+    """
+    Read a synthetic magnitude table written by
+    :py:func:`WDmodel.io.write_synmag_table`
+
+    Parameters
+    ----------
+    table_file : str
+        Input HDF5 synthetic magnitude table filename
+
+    Returns
+    -------
+    tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp
+        See :py:func:`WDmodel.passband.make_synmag_table`
+    attrs : dict
+        The metadata saved with the table
+
+    Raises
+    ------
+    KeyError
+        If the table is not found in the file
+    """
+    with h5py.File(table_file, 'r') as indata:
+        try:
+            table = indata['synmags']
+            tgrid  = table['tgrid'].value.astype('float64')
+            ggrid  = table['ggrid'].value.astype('float64')
+            avgrid = table['avgrid'].value.astype('float64')
+            rvgrid = table['rvgrid'].value.astype('float64')
+            pbnames = [x.decode('utf-8') if isinstance(x, bytes) else str(x) for x in table['pbnames'].value]
+            lflux  = table['lflux'].value.astype('float64')
+            norm   = table['norm'].value.astype('float64')
+            zp     = table['zp'].value.astype('float64')
+            attrs  = dict(table.attrs.items())
+        except KeyError as e:
+            message = '{}\nCould not load synthetic magnitude table from file {}'.format(e, table_file)
+            raise KeyError(message)
+    message = 'Using synthetic magnitude table file {} '.format(table_file)
+    print(message)
+    return tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp, attrs
+
+
+def write_grid_emulator(outfile, grid_name, tgrid, ggrid, wave, mean, comps, weights, attrs=None):
+    """
+    Write a principal component emulator of a model grid alongside the grid
+
+    Parameters
+    ----------
+    outfile : str
+        Output HDF5 filename - typically the grid file itself. If it exists,
+        any emulator of ``grid_name`` is replaced and everything else is
+        kept.
+    grid_name : str
+        Name of the model grid group the emulator belongs to
+    tgrid, ggrid, wave, mean, comps, weights : array-like
+        The arrays of the emulator. See
+        :py:class:`WDmodel.WDmodel.WDmodel_Emulator`
+    attrs : dict, optional
+        Metadata describing how the emulator was made e.g. the tolerance and
+        maximum error. Saved as attributes of the emulator group.
+
+    Notes
+    -----
+        The output is written into the group ``emulator`` of the group
+        ``grid_name``, with datasets ``tgrid``, ``ggrid``, ``wave``,
+        ``mean``, ``comps`` and ``weights``.
+
+    See Also
+    --------
+    :py:meth:`WDmodel.WDmodel.WDmodel.set_emulator`
+    """
+    with h5py.File(outfile, 'a') as outf:
+        grid = outf.require_group(grid_name)
+        if 'emulator' in grid:
+            del grid['emulator']
+        dset_emu = grid.create_group('emulator')
+        dset_emu.create_dataset("tgrid", data=tgrid)
+        dset_emu.create_dataset("ggrid", data=ggrid)
+        dset_emu.create_dataset("wave", data=wave)
+        dset_emu.create_dataset("mean", data=mean)
+        dset_emu.create_dataset("comps", data=comps)
+        dset_emu.create_dataset("weights", data=weights)
+        if attrs is not None:
+            for key, value in attrs.items():
+                dset_emu.attrs[key] = value
+    message = "Wrote emulator of grid {} to file {}".format(grid_name, outfile)
+    print(message)
+
+
+def read_grid_emulator(infile, grid_name=None):
+    """
+    Read a model grid emulator written by
+    :py:func:`WDmodel.io.write_grid_emulator`
+
+    Parameters
+    ----------
+    infile : str
+        Input HDF5 filename
+    grid_name : str, optional
+        Name of the model grid group the emulator belongs to. Default is
+        ``default``
+
+    Returns
+    -------
+    tgrid, ggrid, wave, mean, comps, weights : array-like
+        The arrays of the emulator. See
+        :py:class:`WDmodel.WDmodel.WDmodel_Emulator`
+    attrs : dict
+        The metadata saved with the emulator
+
+    Raises
+    ------
+    KeyError
+        If no emulator of ``grid_name`` is found in the file
+    """
+    if grid_name is None:
+        grid_name = "default"
+    with h5py.File(infile, 'r') as indata:
+        try:
+            emu = indata[grid_name]['emulator']
+            tgrid   = emu['tgrid'].value.astype('float64')
+            ggrid   = emu['ggrid'].value.astype('float64')
+            wave    = emu['wave'].value.astype('float64')
+            mean    = emu['mean'].value.astype('float64')
+            comps   = emu['comps'].value.astype('float64')
+            weights = emu['weights'].value.astype('float64')
+            attrs   = dict(emu.attrs.items())
+        except KeyError as e:
+            message = '{}\nCould not load emulator of grid {} from file {}'.format(e, grid_name, infile)
+            raise KeyError(message)
+    for key, value in attrs.items():
+        if isinstance(value, bytes):
+            attrs[key] = value.decode('utf-8')
+    message = 'Using emulator of grid {} from file {}'.format(grid_name, infile)
+    print(message)
+    return tgrid, ggrid, wave, mean, comps, weights, attrs
+
+
 def _read_ascii(filename, **kwargs):
     """
     Read ASCII files
@@ -777,6 +1434,39 @@ def read_spec(filename, **kwargs):
     return spec
 
 
+def read_speclist(filename):
+    """
+    Read a list of spectra to fit in one batch
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the ASCII file, with one spectrum filename per line.
+        Blank lines and lines starting with ``#`` are ignored.
+
+    Returns
+    -------
+    specfiles : list
+        The spectrum filenames, in the order listed
+
+    Raises
+    ------
+    ValueError
+        If the file does not list any spectra
+    """
+    specfiles = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            specfiles.append(line)
+    if len(specfiles) == 0:
+        message = 'No spectra listed in {}'.format(filename)
+        raise ValueError(message)
+    return specfiles
+
+
 def get_phot_for_obj(objname, filename):
     """
     Gets the measured photometry for an object from a photometry lookup table.
@@ -1278,7 +1968,7 @@ def read_mcmc(input_file):
     chain_params : dict
         The chain parameter dictionary
          * ``param_names`` : list - list of model parameter names
-         * ``samptype`` : ``{'ensemble','pt','gibbs'}`` - the sampler to use
+         * ``samptype`` : ``{'ensemble','pt','gibbs','nuts'}`` - the sampler to use
          * ``ntemps`` : int - the number of chain temperatures
          * ``nwalkers`` : int - the number of Goodman & Ware walkers
          * ``nprod`` : int - the number of production steps of the chain
@@ -1318,6 +2008,45 @@ def read_mcmc(input_file):
     return samples, samples_lnprob, chain_params
 
 
+def read_mcmc_derived(input_file):
+    """
+    Read the derived parameters saved with the HDF5 Markov chain file
+
+    Parameters
+    ----------
+    input_file : str
+        The HDF5 Markov chain filename
+
+    Returns
+    -------
+    derived : :py:class:`collections.OrderedDict`
+        Maps the name of each derived parameter to its value for each sample
+        in the chain. Empty if the chain has no derived parameters.
+
+    Raises
+    ------
+    IOError
+        If the chain cannot be read from ``input_file``
+
+    See Also
+    --------
+    :py:func:`WDmodel.derived.write_derived`
+    """
+    derived = OrderedDict()
+    try:
+        with h5py.File(input_file, mode='r') as d:
+            chain = d['chain']
+            if 'derived' in chain:
+                group = chain['derived']
+                names = [x.decode('ascii') if isinstance(x, bytes) else str(x) for x in group.attrs['names']]
+                for name in names:
+                    derived[name] = group[name].value
+    except (IOError, OSError, KeyError) as e:
+        message = '{}\nCould not load derived parameters from input file {}'.format(e, input_file)
+        raise IOError(message)
+    return derived
+
+
 def write_spectrum_model(spec, model_spec, outfile):
     """
     Write the spectrum and the model spectrum and residuals to an output file.
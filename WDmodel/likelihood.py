@@ -7,13 +7,21 @@ given the data
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
+from collections import OrderedDict
 import numpy as np
+from six.moves import range
 from celerite.modeling import Model
-from scipy.stats import norm, halfcauchy
+from scipy.stats import norm, halfcauchy, truncnorm
+from scipy.special import log_ndtr
 from . import io
-from .passband import get_model_synmags
+from .passband import get_model_synmags, get_model_synmags_proj, get_model_synmags_proj_grad, get_pbprojection
+from .cache import WDmodel_StageCache
 
-__all__=['WDmodel_Likelihood', 'WDmodel_Posterior', 'setup_likelihood']
+__all__=['WDmodel_Likelihood', 'WDmodel_Marginal', 'WDmodel_Posterior', 'setup_likelihood']
+
+# widths of the normal priors on dl and mu, centered on their initial values
+_DL_PRIOR_SIGMA = 1000.
+_MU_PRIOR_SIGMA = 10.
 
 def setup_likelihood(params):
     """
@@ -69,7 +77,8 @@ class WDmodel_Likelihood(Model):
     # defines the parameter names of the model
     parameter_names = io._PARAMETER_NAMES
 
-    def get_value(self, spec, phot, model, covmodel, pbs, pixel_scale=1., phot_dispersion=0.):
+    def get_value(self, spec, phot, model, covmodel, pbs, pixel_scale=1., phot_dispersion=0., cache=None,\
+            pbproj=None, synmags=None, marginal=None):
         """
         Returns the log likelihood of the model
 
@@ -79,7 +88,7 @@ class WDmodel_Likelihood(Model):
             The spectrum with ``dtype=[('wave', '<f8'), ('flux', '<f8'), ('flux_err', '<f8')]``
         phot : None or :py:class:`numpy.recarray`
             The photometry with ``dtype=[('pb', 'str'), ('mag', '<f8'), ('mag_err', '<f8')]``
-        model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        model : :py:class:`WDmodel.WDmodel.WDmodel` or :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` instance
             The DA White Dwarf SED model generator
         covmodel : :py:class:`WDmodel.covariance.WDmodel_CovModel` instance
             The parametrized model for the covariance of the spectrum ``spec``
@@ -96,6 +105,29 @@ class WDmodel_Likelihood(Model):
             Excess photometric dispersion to add in quadrature with the
             photometric uncertainties ``phot.mag_err``. Use if the errors are
             grossly underestimated. Default is ``0.``
+        cache : None or :py:class:`WDmodel.cache.WDmodel_StageCache` instance, optional
+            If supplied, the synthetic magnitudes (stage ``'synmags'``, which
+            does not depend on ``mu``) and the log likelihood of the spectrum
+            (stage ``'spec'``, which depends on all the parameters except
+            ``mu``) are cached. If ``model`` is a
+            :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` instance, it
+            should be bound with the same cache so that the stages of the
+            model are reused as well.
+        pbproj : None or tuple, optional
+            Passband projection aligned to ``phot.pb`` generated by
+            :py:func:`WDmodel.passband.get_pbprojection`. If supplied, the
+            synthetic magnitudes are computed with
+            :py:func:`WDmodel.passband.get_model_synmags_proj` instead of
+            :py:func:`WDmodel.passband.get_model_synmags`.
+        synmags : None or :py:class:`WDmodel.passband.WDmodel_SynMagTable` instance, optional
+            Synthetic magnitude table with passbands aligned to ``phot.pb``.
+            If supplied, the synthetic magnitudes are interpolated from the
+            table without computing the full SED, whenever the parameters are
+            within the bounds of the table. Otherwise the synthetic magnitudes
+            are computed from the full SED.
+        marginal : None or :py:class:`WDmodel_Marginal` instance, optional
+            If supplied, the likelihood is analytically marginalized over the
+            parameters in ``marginal.marginalize``, including their priors.
 
         Returns
         -------
@@ -103,20 +135,475 @@ class WDmodel_Likelihood(Model):
             The likelihood of the model parameters :py:attr:`parameter_names`
             given the data - the spectrum ``spec`` and photometry ``phot``.
         """
-        if phot is None:
-            phot_chi = 0.
-            mod = model._get_obs_model(self.teff, self.logg, self.av, self.fwhm,\
-                    spec.wave, self.shift, self.rvel, rv=self.rv, pixel_scale=pixel_scale, length=self.length)
+        spec_lnlike = None
+        mags = None
+        if cache is not None:
+            # everything but mu affects the spectrum
+            skey = (self.teff, self.logg, self.av, self.rv, self.dl, self.fwhm,\
+                    self.fsig, self.tau, self.fw, self.shift, self.rvel, self.length)
+            spec_lnlike = cache.get('spec', skey)
+            if phot is not None:
+                mkey = (self.teff, self.logg, self.av, self.rv, self.shift, self.rvel, self.length)
+                mags = cache.get('synmags', mkey)
+
+        # interpolate the synthetic magnitudes from the table if we can
+        if phot is not None and mags is None and synmags is not None:
+            if synmags.in_bounds(self.teff, self.logg, self.av, self.rv):
+                mags = synmags.get_synmags(self.teff, self.logg, self.av, self.rv, shift=self.shift, rvel=self.rvel)
+                if cache is not None:
+                    cache.put('synmags', mkey, mags)
+
+        if phot is None or mags is not None:
+            if spec_lnlike is None:
+                mod = model._get_obs_model(self.teff, self.logg, self.av, self.fwhm,\
+                        spec.wave, self.shift, self.rvel, rv=self.rv, pixel_scale=pixel_scale, length=self.length)
         else:
             mod, full = model._get_full_obs_model(self.teff, self.logg, self.av, self.fwhm,\
                     spec.wave, self.shift, self.rvel, rv=self.rv, pixel_scale=pixel_scale, length=self.length)
-            mod_mags = get_model_synmags(full, pbs, mu=self.mu)
-            phot_res = phot.mag - mod_mags.mag
+            if pbproj is None:
+                mags = get_model_synmags(full, pbs).mag
+            else:
+                mags = get_model_synmags_proj(full.flux, pbproj, shift=self.shift, rvel=self.rvel)
+            if cache is not None:
+                cache.put('synmags', mkey, mags)
+
+        if marginal is not None:
+            if phot is None:
+                phot_lnlike = marginal.get_phot_lnlike(np.zeros(0), np.ones(0), self.mu)
+            else:
+                phot_var = (phot.mag_err**2.)+(phot_dispersion**2.)
+                phot_lnlike = marginal.get_phot_lnlike(phot.mag - mags, phot_var, self.mu)
+        elif phot is None:
+            phot_lnlike = 0.
+        else:
+            mod_mags = mags + self.mu
+            phot_res = phot.mag - mod_mags
             phot_chi = np.sum(phot_res**2./((phot.mag_err**2.)+(phot_dispersion**2.)))
+            phot_lnlike = -(phot_chi/2.)
+
+        if spec_lnlike is None:
+            if marginal is None:
+                mod *= (1./(4.*np.pi*(self.dl)**2.))
+                res = spec.flux - mod
+                spec_lnlike = covmodel.lnlikelihood(spec.wave, res, spec.flux_err, self.fsig, self.tau, self.fw)
+            else:
+                mod *= marginal.ampref
+                lnlike0, a, b = covmodel.lnlikelihood_linear(spec.wave, spec.flux, mod, spec.flux_err,\
+                        self.fsig, self.tau, self.fw)
+                spec_lnlike = marginal.get_spec_lnlike(lnlike0, a, b, self.dl)
+            if cache is not None:
+                cache.put('spec', skey, spec_lnlike)
+        return spec_lnlike + phot_lnlike
+
+
+    def get_value_and_grad(self, spec, phot, model, covmodel, pbs, pixel_scale=1., phot_dispersion=0., pbproj=None):
+        """
+        Returns the log likelihood of the model and its gradient with respect
+        to all the model parameters
+
+        The gradient is propagated analytically through the model (see
+        :py:func:`WDmodel.WDmodel.WDmodel_BoundModel._get_obs_model_grad`),
+        the ``dl`` scaling, the Gaussian process likelihood of the spectrum
+        (see :py:meth:`WDmodel.covariance.WDmodel_CovModel.lnlikelihood_grad`)
+        and the synthetic photometry (see
+        :py:func:`WDmodel.passband.get_model_synmags_proj_grad`). The
+        synthetic photometry is always computed from the full SED, and the
+        model is always computed exactly, without the stage cache or the
+        convolved grid.
+
+        Parameters
+        ----------
+        spec : :py:class:`numpy.recarray`
+            The spectrum with ``dtype=[('wave', '<f8'), ('flux', '<f8'), ('flux_err', '<f8')]``
+        phot : None or :py:class:`numpy.recarray`
+            The photometry with ``dtype=[('pb', 'str'), ('mag', '<f8'), ('mag_err', '<f8')]``
+        model : :py:class:`WDmodel.WDmodel.WDmodel` or :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` instance
+            The DA White Dwarf SED model generator. If it is not bound to
+            ``spec.wave``, it is bound on every call.
+        covmodel : :py:class:`WDmodel.covariance.WDmodel_CovModel` instance
+            The parametrized model for the covariance of the spectrum ``spec``
+        pbs : dict
+            Passband dictionary containing the passbands corresponding to
+            ``phot.pb`` and generated by :py:func:`WDmodel.passband.get_pbmodel`.
+        pixel_scale : float, optional
+            Jacobian of the transformation between wavelength in Angstrom and
+            pixels. Default is ``1.``
+        phot_dispersion : float, optional
+            Excess photometric dispersion to add in quadrature with the
+            photometric uncertainties ``phot.mag_err``. Default is ``0.``
+        pbproj : None or tuple, optional
+            Passband projection aligned to ``phot.pb`` generated by
+            :py:func:`WDmodel.passband.get_pbprojection`. Computed on every
+            call if not supplied and ``phot`` is not ``None``.
+
+        Returns
+        -------
+        lnlike : float
+            The likelihood of the model parameters :py:attr:`parameter_names`
+            given the data - the spectrum ``spec`` and photometry ``phot``.
+        grad : array-like
+            The gradient of ``lnlike`` with respect to all the parameters in
+            :py:attr:`parameter_names`, including frozen parameters
 
-        mod *= (1./(4.*np.pi*(self.dl)**2.))
+        Raises
+        ------
+        ValueError
+            If the model ``sptype`` is ``emission`` or ``transmission``
+        """
+        if not (hasattr(model, '_grad_names') and model._is_bound(spec.wave)):
+            model = model.bind(spec.wave, pixel_scale=pixel_scale)
+        index = dict((name, i) for i, name in enumerate(self.parameter_names))
+        grad = np.zeros(len(self.parameter_names))
+
+        mod, dmod = model._get_obs_model_grad(self.teff, self.logg, self.av, self.fwhm,\
+                self.shift, self.rvel, rv=self.rv, pixel_scale=pixel_scale)
+        scale = 1./(4.*np.pi*(self.dl)**2.)
+        mod  *= scale
+        dmod *= scale
         res = spec.flux - mod
-        return covmodel.lnlikelihood(spec.wave, res, spec.flux_err, self.fsig, self.tau, self.fw) - (phot_chi/2.)
+        spec_lnlike, dres, dhyper = covmodel.lnlikelihood_grad(spec.wave, res, spec.flux_err,\
+                self.fsig, self.tau, self.fw)
+
+        # the residual decreases with the model
+        dmodel = -np.dot(dmod, dres)
+        for i, param in enumerate(model._grad_names):
+            grad[index[param]] += dmodel[i]
+        grad[index['dl']]   += 2.*np.dot(dres, mod)/self.dl
+        grad[index['fsig']] += dhyper[0]
+        grad[index['tau']]  += dhyper[1]
+        grad[index['fw']]   += dhyper[2]
+
+        if phot is None:
+            return spec_lnlike, grad
+
+        if pbproj is None:
+            pbproj = get_pbprojection(pbs, model, pbnames=phot.pb)
+        sed, dsed = model._get_sed_grad(self.teff, self.logg, self.av, rv=self.rv)
+        mod_mags, dmags = get_model_synmags_proj_grad(sed, dsed, pbproj, shift=self.shift,\
+                rvel=self.rvel, mu=self.mu)
+        phot_var = (phot.mag_err**2.)+(phot_dispersion**2.)
+        phot_res = phot.mag - mod_mags
+        phot_chi = np.sum(phot_res**2./phot_var)
+
+        # d(-phot_chi/2)/d(mod_mags)
+        wres = phot_res/phot_var
+        dphot = np.dot(dmags, wres)
+        for i, param in enumerate(('teff', 'logg', 'av', 'rv', 'shift', 'rvel')):
+            grad[index[param]] += dphot[i]
+        grad[index['mu']] += np.sum(wres)
+        return spec_lnlike - (phot_chi/2.), grad
+
+
+    def get_value_batch(self, pmatrix, spec, phot, model, covmodel, pbs, pixel_scale=1., phot_dispersion=0.,\
+            pbproj=None, synmags=None, marginal=None):
+        """
+        Returns the log likelihood of the model for a matrix of parameter vectors
+
+        Same as :py:meth:`get_value`, but the SED for all parameter vectors
+        is computed in a single call to
+        :py:func:`WDmodel.WDmodel.WDmodel._get_obs_model_batch` or
+        :py:func:`WDmodel.WDmodel.WDmodel._get_full_obs_model_batch`. The
+        parameters of the instance are not changed.
+
+        Parameters
+        ----------
+        pmatrix : array-like
+            Array of shape ``(N, len(parameter_names))`` of full parameter
+            vectors, including frozen parameters, in the order of
+            :py:attr:`parameter_names`.
+
+        See :py:meth:`get_value` for a description of the other parameters.
+
+        Returns
+        -------
+        lnlike : array-like
+            The likelihood of each of the ``N`` parameter vectors given the
+            data - the spectrum ``spec`` and photometry ``phot``.
+        """
+        pmatrix = np.atleast_2d(pmatrix)
+        p = dict(zip(self.parameter_names, pmatrix.T))
+        nrow = len(pmatrix)
+        mod, mags = self._get_model_batch(p, spec, phot, model, pbs, pixel_scale=pixel_scale,\
+                pbproj=pbproj, synmags=synmags)
+
+        if phot is None:
+            phot_res = np.zeros((nrow, 0))
+            phot_var = np.ones(0)
+        else:
+            phot_res = phot.mag - mags
+            phot_var = (phot.mag_err**2.)+(phot_dispersion**2.)
+
+        out = np.empty(nrow)
+        if marginal is None:
+            phot_chi = np.sum((phot_res - p['mu'][:, np.newaxis])**2./phot_var, axis=1)
+            mod *= (1./(4.*np.pi*(p['dl'])**2.))[:, np.newaxis]
+            res = spec.flux - mod
+            for i in range(nrow):
+                out[i] = covmodel.lnlikelihood(spec.wave, res[i], spec.flux_err, p['fsig'][i], p['tau'][i], p['fw'][i])
+            return out - (phot_chi/2.)
+
+        mod *= marginal.ampref
+        a = np.empty(nrow)
+        b = np.empty(nrow)
+        for i in range(nrow):
+            out[i], a[i], b[i] = covmodel.lnlikelihood_linear(spec.wave, spec.flux, mod[i], spec.flux_err,\
+                    p['fsig'][i], p['tau'][i], p['fw'][i])
+        out = marginal.get_spec_lnlike(out, a, b, p['dl'])
+        return out + marginal.get_phot_lnlike(phot_res, phot_var, p['mu'])
+
+
+    def _get_model_batch(self, p, spec, phot, model, pbs, pixel_scale=1., pbproj=None, synmags=None):
+        """
+        Returns the model spectrum and synthetic magnitudes for a set of
+        parameter vectors
+
+        Parameters
+        ----------
+        p : dict
+            Maps each of :py:attr:`parameter_names` to an array with the
+            value of the parameter for each of the ``N`` parameter vectors
+
+        See :py:meth:`get_value_batch` for a description of the other
+        parameters.
+
+        Returns
+        -------
+        mod : array-like
+            The model spectrum with unit amplitude with shape ``(N, len(spec))``
+        mags : None or array-like
+            The synthetic magnitudes without ``mu`` with shape ``(N,
+            len(phot))``, or ``None`` if there is no photometry
+        """
+        use_table = False
+        if phot is not None and synmags is not None:
+            use_table = np.all(synmags.in_bounds(p['teff'], p['logg'], p['av'], p['rv']))
+
+        if phot is None or use_table:
+            mod = model._get_obs_model_batch(p['teff'], p['logg'], p['av'], p['fwhm'],\
+                    spec.wave, p['shift'], p['rvel'], rv=p['rv'], pixel_scale=pixel_scale, length=p['length'])
+        else:
+            mod, full = model._get_full_obs_model_batch(p['teff'], p['logg'], p['av'], p['fwhm'],\
+                    spec.wave, p['shift'], p['rvel'], rv=p['rv'], pixel_scale=pixel_scale, length=p['length'])
+
+        mags = None
+        if phot is not None:
+            if use_table:
+                mags = synmags.get_synmags(p['teff'], p['logg'], p['av'], p['rv'],\
+                        shift=p['shift'], rvel=p['rvel'])
+            elif pbproj is None:
+                mags = np.array([get_model_synmags(x, pbs).mag for x in full])
+            else:
+                mags = get_model_synmags_proj(full.flux, pbproj, shift=p['shift'], rvel=p['rvel'])
+        return mod, mags
+
+
+def _log_norm_mass(mean, sigma, lo, hi):
+    """
+    Returns the log of the probability mass of a normal distribution with
+    ``mean`` and ``sigma`` between ``lo`` and ``hi``
+    """
+    u = (hi - mean)/sigma
+    l = (lo - mean)/sigma
+    # use the lower tail, where the CDF is accurate
+    flip = l > 0
+    u, l = np.where(flip, -l, u), np.where(flip, -u, l)
+    lu = log_ndtr(u)
+    ll = log_ndtr(l)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return lu + np.log1p(-np.exp(ll - lu))
+
+
+class WDmodel_Marginal(object):
+    """
+    Analytic marginalization of the likelihood over the amplitude of the
+    spectrum ``dl`` and the photometric offset ``mu``
+
+    The model spectrum is ``s*mod`` where ``s = (dlref/dl)**2`` and ``mod``
+    is the model at ``dlref``, so the likelihood of the spectrum is Gaussian
+    in ``s`` (see
+    :py:meth:`WDmodel.covariance.WDmodel_CovModel.lnlikelihood_linear`).
+    The synthetic magnitudes are offset by ``mu``, so the likelihood of the
+    photometry is Gaussian in ``mu``.
+
+    Parameters
+    ----------
+    marginalize : sequence of str
+        The parameters to marginalize over - any of ``('dl', 'mu')``. The
+        likelihood is evaluated at the value of the others.
+    dlref : float
+        The reference ``dl`` of the unit amplitude model
+    dl0 : float
+        The mean of the normal prior on ``dl``
+    dlsig : float
+        The standard deviation of the normal prior on ``dl``
+    dlbounds : 2-tuple
+        The bounds on ``dl``. Either may be ``None``.
+    mu0 : float
+        The mean of the normal prior on ``mu``
+    musig : float
+        The standard deviation of the normal prior on ``mu``
+    mubounds : 2-tuple
+        The bounds on ``mu``. Either may be ``None``.
+
+    Attributes
+    ----------
+    marginalize : tuple
+        The parameters that are marginalized over
+    ampref : float
+        The amplitude ``1/(4*pi*dlref**2)`` of the unit amplitude model
+
+    Notes
+    -----
+        The marginal over ``mu`` is exact, including the prior and the bounds.
+
+        The marginal over ``dl`` uses the Laplace approximation about the
+        maximum likelihood amplitude. The prior on ``dl``, with the Jacobian
+        ``|d dl/ds|``, is evaluated at the maximum, and the bounds on ``dl``
+        are applied exactly. The prior is broad compared to the constraint on
+        ``dl`` from any useful spectrum, so the approximation is very good.
+    """
+    def __init__(self, marginalize, dlref, dl0, dlsig, dlbounds, mu0, musig, mubounds):
+        for param in marginalize:
+            if param not in ('dl', 'mu'):
+                message = 'Can only marginalize over dl and mu analytically, not {}'.format(param)
+                raise ValueError(message)
+        self.marginalize = tuple(marginalize)
+        self.dlref  = float(dlref)
+        self.ampref = 1./(4.*np.pi*self.dlref**2.)
+        self.dl0    = dl0
+        self.dlsig  = dlsig
+        self.mu0    = mu0
+        self.musig  = musig
+
+        # bounds on the amplitude - dl is positive
+        dllo, dlhi = dlbounds
+        self._slo  = 0. if dlhi is None else (self.dlref/dlhi)**2.
+        self._shi  = np.inf if (dllo is None or dllo <= 0) else (self.dlref/dllo)**2.
+        mulo, muhi = mubounds
+        self._mulo = -np.inf if mulo is None else mulo
+        self._muhi = np.inf if muhi is None else muhi
+
+
+    def get_spec_lnlike(self, lnlike0, a, b, dl):
+        """
+        Returns the log likelihood of the spectrum, marginalized over ``dl``
+        with its prior if ``dl`` is in :py:attr:`marginalize`
+
+        Parameters
+        ----------
+        lnlike0 : float or array-like
+            The log likelihood of the spectrum with zero model
+        a : float or array-like
+            The inverse variance of the amplitude ``s``
+        b : float or array-like
+            ``a`` times the maximum likelihood amplitude
+        dl : float or array-like
+            The value of ``dl`` if it is not marginalized over
+
+        Returns
+        -------
+        lnlike : float or array-like
+            The log likelihood of the spectrum
+        """
+        if 'dl' not in self.marginalize:
+            s = (self.dlref/dl)**2.
+            return lnlike0 + s*b - 0.5*s**2.*a
+
+        shat = b/a
+        s = np.clip(shat, self._slo, self._shi)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dl = self.dlref/np.sqrt(s)
+            lnprior = norm.logpdf(dl, self.dl0, self.dlsig) + np.log(0.5*self.dlref) - 1.5*np.log(s)
+            out = lnlike0 + 0.5*b*shat + 0.5*np.log(2.*np.pi/a) + lnprior +\
+                    _log_norm_mass(shat, 1./np.sqrt(a), self._slo, self._shi)
+        return np.where(np.isfinite(out), out, -np.inf)
+
+
+    def get_phot_lnlike(self, res, var, mu):
+        """
+        Returns the log likelihood of the photometry, marginalized over ``mu``
+        with its prior if ``mu`` is in :py:attr:`marginalize`
+
+        Parameters
+        ----------
+        res : array-like
+            The photometry minus the synthetic magnitudes without ``mu``, with
+            the passbands along the last axis
+        var : array-like
+            The variance of the photometry
+        mu : float or array-like
+            The value of ``mu`` if it is not marginalized over
+
+        Returns
+        -------
+        lnlike : float or array-like
+            The log likelihood of the photometry
+        """
+        if 'mu' not in self.marginalize:
+            mu = np.asarray(mu)[..., np.newaxis]
+            return -0.5*np.sum((res - mu)**2./var, axis=-1)
+
+        w = 1./var
+        prec = np.sum(w) + 1./self.musig**2.
+        mean = (np.sum(w*res, axis=-1) + self.mu0/self.musig**2.)/prec
+        out = -0.5*(np.sum(w*res**2., axis=-1) + (self.mu0/self.musig)**2. - prec*mean**2.)
+        out -= 0.5*np.log(prec*self.musig**2.)
+        out += _log_norm_mass(mean, 1./np.sqrt(prec), self._mulo, self._muhi)
+        return out
+
+
+    def sample_dl(self, a, b, random_state=None):
+        """
+        Draw ``dl`` from its posterior conditional on the other parameters
+
+        Parameters
+        ----------
+        a : array-like
+            The inverse variance of the amplitude ``s``
+        b : array-like
+            ``a`` times the maximum likelihood amplitude
+        random_state : None or :py:class:`numpy.random.RandomState`, optional
+            The random number generator
+
+        Returns
+        -------
+        dl : array-like
+            One draw of ``dl`` for each element of ``a``
+        """
+        shat  = b/a
+        ssig  = 1./np.sqrt(a)
+        lo = (self._slo - shat)/ssig
+        hi = (self._shi - shat)/ssig
+        s = truncnorm.rvs(lo, hi, loc=shat, scale=ssig, size=np.shape(a), random_state=random_state)
+        return self.dlref/np.sqrt(s)
+
+
+    def sample_mu(self, res, var, random_state=None):
+        """
+        Draw ``mu`` from its posterior conditional on the other parameters
+
+        Parameters
+        ----------
+        res : array-like
+            The photometry minus the synthetic magnitudes without ``mu``, with
+            shape ``(N, npb)``
+        var : array-like
+            The variance of the photometry
+        random_state : None or :py:class:`numpy.random.RandomState`, optional
+            The random number generator
+
+        Returns
+        -------
+        mu : array-like
+            One draw of ``mu`` for each row of ``res``
+        """
+        w = 1./var
+        prec = np.sum(w) + 1./self.musig**2.
+        mean = (np.sum(w*res, axis=-1) + self.mu0/self.musig**2.)/prec
+        sig  = 1./np.sqrt(prec)
+        lo = (self._mulo - mean)/sig
+        hi = (self._muhi - mean)/sig
+        return truncnorm.rvs(lo, hi, loc=mean, scale=sig, size=np.shape(mean), random_state=random_state)
 
 
 class WDmodel_Posterior(object):
@@ -152,6 +639,24 @@ class WDmodel_Posterior(object):
         Excess photometric dispersion to add in quadrature with the
         photometric uncertainties ``phot.mag_err``. Use if the errors are
         grossly underestimated. Default is ``0.``
+    cache_size : int, optional
+        If ``> 0``, cache up to this many results for each stage of the model
+        and likelihood with a :py:class:`WDmodel.cache.WDmodel_StageCache`.
+        Useful when the sampler changes only some of the parameters in each
+        proposal, as with the ``gibbs`` sampler. Default is ``0`` i.e. no
+        caching.
+    cache_mem : float, optional
+        Maximum memory in MB used by the cache. Default is ``256.``
+    synmag_table : None or :py:class:`WDmodel.passband.WDmodel_SynMagTable` instance, optional
+        If supplied, interpolate the synthetic magnitudes from this table
+        rather than computing them from the full SED wherever the table
+        covers the parameters. Should be validated against the full SED
+        with :py:meth:`WDmodel.passband.WDmodel_SynMagTable.validate` first.
+    marginalize : sequence of str, optional
+        Parameters to analytically marginalize over with their priors - any
+        of ``('dl', 'mu')``. They must be frozen in ``lnlike``, and their
+        posterior samples can be reconstructed from the chain with
+        :py:meth:`WDmodel_Posterior.sample_marginalized`. Default is ``()``
 
     Attributes
     ----------
@@ -163,11 +668,21 @@ class WDmodel_Posterior(object):
         The photometry with ``dtype=[('pb', 'str'), ('mag', '<f8'), ('mag_err', '<f8')]``
     model : :py:class:`WDmodel.WDmodel.WDmodel` instance
         The DA White Dwarf SED model generator
+    boundmodel : :py:class:`WDmodel.WDmodel.WDmodel_BoundModel` instance
+        The DA White Dwarf SED model generator bound to ``spec.wave`` that is
+        used to evaluate the likelihood
     covmodel : :py:class:`WDmodel.covariance.WDmodel_CovModel` instance
         The parametrized model for the covariance of the spectrum ``spec``
     pbs : dict
         Passband dictionary containing the passbands corresponding to
         ``phot.pb`` and generated by :py:func:`WDmodel.passband.get_pbmodel`.
+    pbproj : None or tuple
+        Passband projection aligned to ``phot.pb`` generated by
+        :py:func:`WDmodel.passband.get_pbprojection`, or ``None`` if there is
+        no photometry
+    synmags : None or :py:class:`WDmodel.passband.WDmodel_SynMagTable` instance
+        ``synmag_table`` with passbands aligned to ``phot.pb``, or ``None`` if
+        there is no photometry or no table
     _lnlike : :py:class:`WDmodel_Likelihood` instance
         Instance of the likelihood function class, such as that produced by
         :py:meth:`WDmodel.likelihood.setup_likelihood`
@@ -183,6 +698,11 @@ class WDmodel_Posterior(object):
         grossly underestimated. Default is ``0.``
     p0 : dict
         initial values of all the model parameters, including fixed parameters
+    cache : None or :py:class:`WDmodel.cache.WDmodel_StageCache` instance
+        Cache for the stages of the model and likelihood, if ``cache_size > 0``
+    marginal : None or :py:class:`WDmodel_Marginal` instance
+        The analytic marginalization over ``marginalize``, or ``None`` if
+        nothing is marginalized over
 
     Returns
     -------
@@ -197,19 +717,45 @@ class WDmodel_Posterior(object):
         boundscheck and returns ``-inf``. This is not an issue as
         the samplers used in the methods in :py:mod:`WDmodel.fit`.
     """
-    def __init__(self, spec, phot, model, covmodel, pbs, lnlike, pixel_scale=1., phot_dispersion=0.):
+    def __init__(self, spec, phot, model, covmodel, pbs, lnlike, pixel_scale=1., phot_dispersion=0.,\
+            cache_size=0, cache_mem=256., synmag_table=None, marginalize=()):
         self.spec      = spec
         self.wavescale = spec.wave.ptp()
         self.phot      = phot
         self.model     = model
+        if cache_size > 0:
+            self.cache = WDmodel_StageCache(maxsize=cache_size, maxmem=cache_mem)
+        else:
+            self.cache = None
+        self.boundmodel = model.bind(spec.wave, pixel_scale=pixel_scale, cache=self.cache)
         self.covmodel  = covmodel
         self.pbs       = pbs
+        if phot is not None:
+            self.pbproj = get_pbprojection(pbs, model, pbnames=phot.pb)
+        else:
+            self.pbproj = None
+        self.synmags = None
+        if phot is not None and synmag_table is not None:
+            self.synmags = synmag_table.select(phot.pb)
         self._lnlike   = lnlike
         self.pixscale  = pixel_scale
         self.phot_dispersion = phot_dispersion
         init_p0 = lnlike.get_parameter_dict(include_frozen=True)
         self.p0 = init_p0
 
+        # the priors on dl and mu are the same as in _lnprior
+        self.marginal = None
+        if len(marginalize) > 0:
+            names  = lnlike.get_parameter_names(include_frozen=True)
+            bounds = dict(zip(names, lnlike.get_parameter_bounds(include_frozen=True)))
+            free   = lnlike.get_parameter_names()
+            for param in marginalize:
+                if param in free:
+                    message = 'Parameter {} must be frozen to marginalize over it'.format(param)
+                    raise ValueError(message)
+            self.marginal = WDmodel_Marginal(marginalize, self.p0['dl'], self.p0['dl'], _DL_PRIOR_SIGMA,\
+                    bounds['dl'], self.p0['mu'], _MU_PRIOR_SIGMA, bounds['mu'])
+
 
     def __call__(self, theta, prior=False, likelihood=False):
         """
@@ -239,8 +785,9 @@ class WDmodel_Posterior(object):
         if prior:
             return out
 
-        loglike = self._lnlike.get_value(self.spec, self.phot, self.model, self.covmodel, self.pbs,\
-                pixel_scale=self.pixscale, phot_dispersion=self.phot_dispersion)
+        loglike = self._lnlike.get_value(self.spec, self.phot, self.boundmodel, self.covmodel, self.pbs,\
+                pixel_scale=self.pixscale, phot_dispersion=self.phot_dispersion, cache=self.cache,\
+                pbproj=self.pbproj, synmags=self.synmags, marginal=self.marginal)
         if likelihood:
             return loglike
 
@@ -248,6 +795,176 @@ class WDmodel_Posterior(object):
         return out
 
 
+    def batch(self, thetas, prior=False, likelihood=False):
+        """
+        Evalulates the log posterior of a matrix of model parameters given the data
+
+        Vectorized version of :py:meth:`WDmodel_Posterior.__call__` that
+        computes the model for all the parameter vectors with a finite prior
+        in a single call to
+        :py:meth:`WDmodel.likelihood.WDmodel_Likelihood.get_value_batch`.
+        Used to evaluate all the walkers of an ensemble step at once, for
+        instance by :py:class:`WDmodel.pool.WDmodel_BatchPool`.
+
+        If the stage cache is enabled, the rows are instead evaluated one at
+        a time with :py:meth:`WDmodel_Posterior.__call__` so that each row can
+        reuse the cached stages.
+
+        Parameters
+        ----------
+        thetas : array-like
+            Array of shape ``(N, ndim)`` of vectors of the non-frozen model
+            parameters. The order of the parameters is defined by
+            :py:attr:`WDmodel_Likelihood.parameter_names`.
+        prior : bool, optional
+            Only return the value of the log prior given the model parameters
+        likelihood : bool, optional
+            Only return the value of the log likelihood given the model
+            parameters if the prior is finite
+
+        Returns
+        -------
+        lnpost : array-like
+            the log posterior of each of the ``N`` parameter vectors given the
+            data
+        """
+        thetas = np.atleast_2d(thetas)
+        if self.cache is not None:
+            return np.array([self(theta, prior=prior, likelihood=likelihood) for theta in thetas])
+
+        nrow   = len(thetas)
+        out    = np.full(nrow, -np.inf)
+        pmatrix = []
+        good    = []
+        for i, theta in enumerate(thetas):
+            self._lnlike.set_parameter_vector(theta)
+            lp = self._lnprior()
+            if not np.isfinite(lp):
+                continue
+            out[i] = lp
+            good.append(i)
+            pmatrix.append(self._lnlike.get_parameter_vector(include_frozen=True))
+        if prior or len(good) == 0:
+            return out
+
+        loglike = self._lnlike.get_value_batch(np.array(pmatrix), self.spec, self.phot, self.boundmodel,\
+                self.covmodel, self.pbs, pixel_scale=self.pixscale, phot_dispersion=self.phot_dispersion,\
+                pbproj=self.pbproj, synmags=self.synmags, marginal=self.marginal)
+        if likelihood:
+            out[good] = loglike
+        else:
+            out[good] += loglike
+        return out
+
+
+    def value_and_grad(self, theta):
+        """
+        Evalulates the log posterior of the model parameters given the data
+        and its gradient with respect to the non-frozen model parameters
+
+        The gradient of the likelihood is computed by
+        :py:meth:`WDmodel.likelihood.WDmodel_Likelihood.get_value_and_grad`
+        and that of the prior by :py:meth:`WDmodel_Posterior._lnprior_grad`.
+        The value is that of the exact model, and may differ slightly from
+        :py:meth:`WDmodel_Posterior.__call__` if the synthetic magnitude table
+        or a convolved grid are used.
+
+        Parameters
+        ----------
+        theta : array-like
+            Vector of the non-frozen model parameters. The order of the
+            parameters is defined by
+            :py:attr:`WDmodel_Likelihood.parameter_names`.
+
+        Returns
+        -------
+        lnpost : float
+            the log posterior of the model parameters given the data
+        grad : array-like
+            the gradient of ``lnpost`` with respect to ``theta``. Zero if
+            ``lnpost`` is ``-inf``.
+
+        Raises
+        ------
+        ValueError
+            If any parameters are marginalized over
+        """
+        if self.marginal is not None:
+            message = 'Gradient of the posterior is not available when marginalizing over {}'.format(self.marginal.marginalize)
+            raise ValueError(message)
+        self._lnlike.set_parameter_vector(theta)
+        mask = self._lnlike.unfrozen_mask
+        out = self._lnprior()
+        if not np.isfinite(out):
+            return -np.inf, np.zeros(np.count_nonzero(mask))
+        loglike, grad = self._lnlike.get_value_and_grad(self.spec, self.phot, self.boundmodel, self.covmodel,\
+                self.pbs, pixel_scale=self.pixscale, phot_dispersion=self.phot_dispersion, pbproj=self.pbproj)
+        grad += self._lnprior_grad()
+        return out + loglike, grad[mask]
+
+
+    def sample_marginalized(self, thetas, random_state=None):
+        """
+        Draw the marginalized parameters from their posterior conditional on
+        each of a set of model parameter vectors
+
+        Given samples of the non-frozen parameters from the marginalized
+        posterior, e.g. a Markov chain, this reconstructs samples of the
+        parameters that were marginalized over. The model for all the
+        parameter vectors is computed at once as in
+        :py:meth:`WDmodel_Posterior.batch`.
+
+        Parameters
+        ----------
+        thetas : array-like
+            Array of shape ``(N, ndim)`` of vectors of the non-frozen model
+            parameters. The order of the parameters is defined by
+            :py:attr:`WDmodel_Likelihood.parameter_names`.
+        random_state : None or :py:class:`numpy.random.RandomState`, optional
+            The random number generator
+
+        Returns
+        -------
+        samples : :py:class:`collections.OrderedDict`
+            Maps each of the marginalized parameters to an array with one
+            draw for each of the ``N`` parameter vectors. Empty if nothing is
+            marginalized over.
+        """
+        out = OrderedDict()
+        if self.marginal is None:
+            return out
+
+        lnlike = self._lnlike
+        thetas = np.atleast_2d(thetas)
+        pmatrix = []
+        for theta in thetas:
+            lnlike.set_parameter_vector(theta)
+            pmatrix.append(lnlike.get_parameter_vector(include_frozen=True))
+        pmatrix = np.array(pmatrix)
+        p = dict(zip(lnlike.parameter_names, pmatrix.T))
+
+        mod, mags = lnlike._get_model_batch(p, self.spec, self.phot, self.boundmodel, self.pbs,\
+                pixel_scale=self.pixscale, pbproj=self.pbproj, synmags=self.synmags)
+        for param in self.marginal.marginalize:
+            if param == 'dl':
+                mod *= self.marginal.ampref
+                a = np.empty(len(thetas))
+                b = np.empty(len(thetas))
+                for i in range(len(thetas)):
+                    _, a[i], b[i] = self.covmodel.lnlikelihood_linear(self.spec.wave, self.spec.flux, mod[i],\
+                            self.spec.flux_err, p['fsig'][i], p['tau'][i], p['fw'][i])
+                out[param] = self.marginal.sample_dl(a, b, random_state=random_state)
+            else:
+                if self.phot is None:
+                    res = np.zeros((len(thetas), 0))
+                    var = np.ones(0)
+                else:
+                    res = self.phot.mag - mags
+                    var = (self.phot.mag_err**2.)+(self.phot_dispersion**2.)
+                out[param] = self.marginal.sample_mu(res, var, random_state=random_state)
+        return out
+
+
     def lnlike(self, theta):
         """
         Evalulates the log likelihood of the model parameters given the data.
@@ -266,11 +983,13 @@ class WDmodel_Posterior(object):
         Returns
         -------
         lnlike : float
-            the log likelihood of the model parameters given the data
+            the log likelihood of the model parameters given the data,
+            marginalized over any parameters in ``marginalize``
         """
         self._lnlike.set_parameter_vector(theta)
-        out = self._lnlike.get_value(self.spec, self.phot, self.model, self.covmodel, self.pbs,\
-                pixel_scale=self.pixscale, phot_dispersion=self.phot_dispersion)
+        out = self._lnlike.get_value(self.spec, self.phot, self.boundmodel, self.covmodel, self.pbs,\
+                pixel_scale=self.pixscale, phot_dispersion=self.phot_dispersion, cache=self.cache,\
+                pbproj=self.pbproj, synmags=self.synmags, marginal=self.marginal)
         return out
 
 
@@ -359,10 +1078,15 @@ class WDmodel_Posterior(object):
             rv  = self._lnlike.get_parameter('rv')
             out += norm.logpdf(rv, 3.1, 0.18)
 
+            # the priors on dl and mu are included in the marginal likelihood
+            # if they are marginalized over
+            marginalize = () if self.marginal is None else self.marginal.marginalize
+
             # normal on dl
-            dl  = self._lnlike.get_parameter('dl')
-            dl0 = self.p0['dl']
-            out += norm.logpdf(dl, dl0, 1000.)
+            if 'dl' not in marginalize:
+                dl  = self._lnlike.get_parameter('dl')
+                dl0 = self.p0['dl']
+                out += norm.logpdf(dl, dl0, _DL_PRIOR_SIGMA)
 
             fwhm  = self._lnlike.get_parameter('fwhm')
             # The FWHM is converted into a gaussian sigma for convolution.
@@ -384,12 +1108,55 @@ class WDmodel_Posterior(object):
             out += halfcauchy.logpdf(fw, loc=0, scale=3)
 
             # normal on mu
-            mu  = self._lnlike.get_parameter('mu')
-            mu0 = self.p0['mu']
-            out += norm.logpdf(mu, mu0, 10.)
+            if 'mu' not in marginalize:
+                mu  = self._lnlike.get_parameter('mu')
+                mu0 = self.p0['mu']
+                out += norm.logpdf(mu, mu0, _MU_PRIOR_SIGMA)
             return out
 
 
+    def _lnprior_grad(self):
+        """
+        Evalulates the gradient of the log prior with respect to all the model
+        parameters, including frozen parameters, in the order of
+        :py:attr:`WDmodel_Likelihood.parameter_names`
+
+        Only valid where :py:meth:`WDmodel_Posterior._lnprior` is finite. See
+        :py:meth:`WDmodel_Posterior._lnprior` for the form of the prior.
+
+        Returns
+        -------
+        grad : array-like
+            the gradient of the log prior
+        """
+        names = self._lnlike.parameter_names
+        grad  = np.zeros(len(names))
+        index = dict((name, i) for i, name in enumerate(names))
+        get   = self._lnlike.get_parameter
+
+        # the glos prior on Av
+        av = get('av')
+        avtau   = 0.4
+        avsdelt = 0.1
+        wtexp   = 1.
+        wtdelt  = 0.5
+        sqrt2pi = np.sqrt(2.*np.pi)
+        pdelt = (wtdelt/sqrt2pi)*np.exp((-av**2.)/(2.*avsdelt**2.))/(2.*avsdelt)
+        pexp  = wtexp*np.exp(-av/avtau)/avtau
+        grad[index['av']] = (-pdelt*av/avsdelt**2. - pexp/avtau)/(pdelt + pexp)
+
+        grad[index['rv']]   = -(get('rv') - 3.1)/0.18**2.
+        grad[index['dl']]   = -(get('dl') - self.p0['dl'])/_DL_PRIOR_SIGMA**2.
+        grad[index['fwhm']] = -(get('fwhm') - self.p0['fwhm'])/8.**2.
+        grad[index['mu']]   = -(get('mu') - self.p0['mu'])/_MU_PRIOR_SIGMA**2.
+
+        # half-Cauchy with scale 3
+        for param in ('fsig', 'fw'):
+            x = get(param)
+            grad[index[param]] = -2.*x/(3.**2. + x**2.)
+        return grad
+
+
     def lnprior(self, theta):
         """
         Evalulates the log prior of the model parameters.
@@ -9,6 +9,10 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 import sys
+import warnings
+import traceback
+from functools import partial
+from collections import OrderedDict
 import mpi4py
 import numpy as np
 from . import io
@@ -17,6 +21,9 @@ from . import passband
 from . import covariance
 from . import fit
 from . import viz
+from . import scheduler
+import six.moves.cPickle as pickle
+from six.moves import zip
 
 
 sys_excepthook = sys.excepthook
@@ -29,120 +36,60 @@ def mpi_excepthook(excepttype, exceptvalue, traceback):
     mpi4py.MPI.COMM_WORLD.Abort(1)
 
 
-def main(inargs=None):
+def get_fit_inputs(args, specfile):
     """
-    Entry point for the :py:mod:`WDmodel` fitter package.
+    Creates the output directory for ``specfile`` and reads the inputs to its
+    fit
 
     Parameters
     ----------
-    inargs : dict, optional
-        Input arguments to configure the fit. If not specified
-        :py:data:`sys.argv` is used. inargs must be parseable by
-        :py:func:`WDmodel.io.get_options`.
+    args : Namespace
+        Parsed command line options from :py:func:`WDmodel.io.get_options`
+    specfile : str
+        The spectrum filename
+
+    Returns
+    -------
+    objname : str
+        The human readable object name based on the spectrum
+    outdir : str
+        The output directory
+    inputs : dict
+        The inputs to the fit, with keys ``spec``, ``phot``, ``pbnames``,
+        ``params``, ``lamshift``, ``rvmodel``, ``covtype``, ``coveps``,
+        ``phot_dispersion``, ``cont_model``, ``linedata``, ``continuumdata``
+        and ``scale_factor``. If resuming, ``params`` and ``lamshift`` are
+        ``None`` and the rest are read from the saved inputs. Otherwise
+        ``cont_model``, ``linedata``, ``continuumdata`` and ``scale_factor``
+        are ``None`` until the spectrum is pre-processed.
 
     Raises
     ------
     RuntimeError
         If user attempts to resume the fit without having run it first
 
-    Notes
-    -----
-    The package is structured into several modules and classes
-
-    ================================================= ===================
-                         Module                         Model Component
-    ================================================= ===================
-    :py:mod:`WDmodel.io`                              I/O methods
-    :py:class:`WDmodel.WDmodel.WDmodel`               SED generator
-    :py:mod:`WDmodel.passband`                        Throughput model
-    :py:class:`WDmodel.covariance.WDmodel_CovModel`   Noise model
-    :py:class:`WDmodel.likelihood.WDmodel_Likelihood` Likelihood function
-    :py:class:`WDmodel.likelihood.WDmodel_Posterior`  Posterior function
-    :py:mod:`WDmodel.fit`                             "Fitting" methods
-    :py:mod:`WDmodel.viz`                             Viz methods
-    ================================================= ===================
-
-    This method implements our algorithm to infer the DA White Dwarf properties
-    and construct the SED model given the data using the methods and classes
-    listed above. Once the data is read, the model is configured, and the
-    liklihood and posterior functions constructed, the fitter methods evaluate
-    the model parameters given the data, using the samplers in :py:mod:`emcee`.
-    :py:mod:`WDmodel.mossampler` provides an overloaded
-    :py:class:`emcee.PTSampler` with a more reliable auto-correlation estimate.
-    Finally, the result is output along with various plots.
+    See Also
+    --------
+    :py:func:`WDmodel.io.set_objname_outdir_for_specfile`
     """
-    comm = mpi4py.MPI.COMM_WORLD
-    size = comm.Get_size()
-    if size > 1:
-        # force all MPI processes to terminate if we are running with --mpi and an exception is raised
-        sys.excepthook = mpi_excepthook
-
-    if inargs is None:
-        inargs = sys.argv[1:]
-
-    # parse the arguments
-    args, pool= io.get_options(inargs, comm)
-
-    specfile  = args.specfile
     spectable = args.spectable
     lamshift  = args.lamshift
-    vel       = args.vel
-    bluelim, redlim   = args.trimspec
-    rebin     = args.rebin
-    rescale   = args.rescale
-    blotch    = args.blotch
-
-    specgrid  = args.gridfile
-    gridgroup = args.gridname
-    sptype = args.sptype
-
     outdir    = args.outdir
     outroot   = args.outroot
-
     photfile  = args.photfile
-    rvmodel   = args.reddeningmodel
-    phot_dispersion = args.phot_dispersion
-    pbfile    = args.pbfile
     excludepb = args.excludepb
     ignorephot= args.ignorephot
-
-    covtype   = args.covtype
-    coveps    = args.coveps
-
-    samptype  = args.samptype
-    ascale    = args.ascale
-    ntemps    = args.ntemps
-    nwalkers  = args.nwalkers
-    nburnin   = args.nburnin
-    nprod     = args.nprod
-    everyn    = args.everyn
-    thin      = args.thin
     redo      = args.redo
     resume    = args.resume
 
-    discard   = args.discard
-
-    balmer    = args.balmerlines
-    ndraws    = args.ndraws
-    savefig   = args.savefig
-    savechains = args.savechains
-
-
-    ##### SETUP #####
-
-
     # set the object name and create output directories
     objname, outdir = io.set_objname_outdir_for_specfile(specfile, outdir=outdir, outroot=outroot,\
                         redo=redo, resume=resume)
     message = "Writing to outdir {}".format(outdir)
     print(message)
 
-    # init the model
-    model = WDmodel.WDmodel(grid_file=specgrid, grid_name=gridgroup, sptype=sptype, rvmodel=rvmodel)
-
-    # get labels dict for plots
-    labels = viz.get_plot_labels(sptype=sptype)
-
+    inputs = {'params':None, 'lamshift':None, 'cont_model':None, 'linedata':None,\
+            'continuumdata':None, 'scale_factor':None}
     if not resume:
         # parse the parameter keywords in the argparse Namespace into a dictionary
         params = io.get_params_from_argparse(args)
@@ -157,12 +104,6 @@ def main(inargs=None):
         # read spectrum
         spec = io.read_spec(specfile)
 
-
-        # pre-process spectrum
-        out = fit.pre_process_spectrum(spec, bluelim, redlim, model, params,\
-                rebin=rebin, lamshift=lamshift, vel=vel, blotch=blotch, rescale=rescale)
-        spec, cont_model, linedata, continuumdata, scale_factor, params  = out
-
         # get photometry
         if not ignorephot:
             phot = io.get_phot_for_obj(objname, photfile)
@@ -192,10 +133,12 @@ def main(inargs=None):
             params['mu']['fixed'] = True
             phot = None
 
-        # save the inputs to the fitter
-        outfile = io.get_outfile(outdir, specfile, '_inputs.hdf5', check=True, redo=redo, resume=resume)
-        io.write_fit_inputs(spec, phot, cont_model, linedata, continuumdata,\
-               rvmodel, covtype, coveps, phot_dispersion, scale_factor, outfile)
+        inputs['params']   = params
+        inputs['lamshift'] = lamshift
+        inputs['rvmodel']  = args.reddeningmodel
+        inputs['covtype']  = args.covtype
+        inputs['coveps']   = args.coveps
+        inputs['phot_dispersion'] = args.phot_dispersion
     else:
         outfile = io.get_outfile(outdir, specfile, '_inputs.hdf5', check=False, redo=redo, resume=resume)
         try:
@@ -203,18 +146,237 @@ def main(inargs=None):
         except IOError as e:
             message = '{}\nMust run fit to generate inputs before attempting to resume'.format(e)
             raise RuntimeError(message)
-        rvmodel  = fit_config['rvmodel']
-        covtype  = fit_config['covtype']
-        coveps   = fit_config['coveps']
-        scale_factor    = fit_config['scale_factor']
-        phot_dispersion = fit_config['phot_dispersion']
+        inputs['cont_model']    = cont_model
+        inputs['linedata']      = linedata
+        inputs['continuumdata'] = continuumdata
+        inputs['rvmodel']  = fit_config['rvmodel']
+        inputs['covtype']  = fit_config['covtype']
+        inputs['coveps']   = fit_config['coveps']
+        inputs['scale_factor']    = fit_config['scale_factor']
+        inputs['phot_dispersion'] = fit_config['phot_dispersion']
         if phot is not None:
             pbnames = list(phot.pb)
         else:
             pbnames = []
 
+    inputs['spec']    = spec
+    inputs['phot']    = phot
+    inputs['pbnames'] = pbnames
+    return objname, outdir, inputs
+
+
+def get_grid_bounds(args, inputs):
+    """
+    Returns the bounds of the part of the model grid needed to fit an object
+
+    Parameters
+    ----------
+    args : Namespace
+        Parsed command line options from :py:func:`WDmodel.io.get_options`
+    inputs : dict
+        The inputs to the fit from :py:func:`get_fit_inputs`
+
+    Returns
+    -------
+    teffbounds : None or 2-tuple
+        The bounds on ``teff``
+    loggbounds : None or 2-tuple
+        The bounds on ``logg``
+    wavebounds : None or 2-tuple
+        The range of wavelengths
+
+    Notes
+    -----
+        All the bounds are ``None`` unless ``--trimgrid`` is set. See
+        :py:func:`WDmodel.fit.get_model_grid_bounds`
+    """
+    if not args.trimgrid:
+        return None, None, None
+
+    bluelim, redlim = args.trimspec
+    spec = inputs['spec']
+    pbwave = passband.get_pbwave_bounds(inputs['pbnames'], pbfile=args.pbfile)
+    if not args.resume:
+        # the spectrum has not been shifted and trimmed yet
+        return fit.get_model_grid_bounds(inputs['params'], spec, bluelimit=bluelim, redlimit=redlim,\
+                lamshift=inputs['lamshift'], vel=args.vel, pbwave=pbwave)
+    gridparams = io.get_params_from_argparse(args)
+    return fit.get_model_grid_bounds(gridparams, spec, pbwave=pbwave)
+
+
+def get_model(args, rvmodel, teffbounds=None, loggbounds=None, wavebounds=None):
+    """
+    Initializes the SED model as configured by the command line options
+
+    Parameters
+    ----------
+    args : Namespace
+        Parsed command line options from :py:func:`WDmodel.io.get_options`
+    rvmodel : ``{'ccm89','od94','f99','custom'}``
+        The reddening law parametrization
+    teffbounds : None or 2-tuple, optional
+        The bounds on ``teff`` of the grid to read
+    loggbounds : None or 2-tuple, optional
+        The bounds on ``logg`` of the grid to read
+    wavebounds : None or 2-tuple, optional
+        The range of wavelengths of the grid to read
+
+    Returns
+    -------
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The DA White Dwarf SED model generator
+    """
+    specgrid  = args.gridfile
+    gridgroup = args.gridname
+    sptype    = args.sptype
+    convolver = args.convolver
+    gridprecision = args.gridprecision
+    gridprecisiontol = args.gridprecisiontol
+
+    # init the model
+    model = WDmodel.WDmodel(grid_file=specgrid, grid_name=gridgroup, sptype=sptype, rvmodel=rvmodel,\
+            convolver=convolver, teffbounds=teffbounds, loggbounds=loggbounds, wavebounds=wavebounds,\
+            dtype=gridprecision)
+
+    # make sure the reduced precision grid reproduces the float64 grid, else fall back to float64
+    if gridprecision != 'float64':
+        report = model.validate_precision(seed=1)
+        message = 'Grid precision {}: max error {:.2e} in flux, {:.2e} mag'.format(gridprecision,\
+                report['flux'], report['mag'])
+        print(message)
+        if report['mag'] > gridprecisiontol:
+            message = 'Grid precision error exceeds {:g} mag. Using float64 grid.'.format(gridprecisiontol)
+            warnings.warn(message, RuntimeWarning)
+            model = WDmodel.WDmodel(grid_file=specgrid, grid_name=gridgroup, sptype=sptype, rvmodel=rvmodel,\
+                    convolver=convolver, teffbounds=teffbounds, loggbounds=loggbounds, wavebounds=wavebounds)
+    if args.emulator:
+        model.set_emulator(tol=args.emulatortol, emulator_file=args.emulatorfile, keep_grid=False)
+    if args.sharedgrid:
+        model.share_grid(shared_dir=args.shareddir)
+    return model
+
+
+def fit_spectrum(args, specfile, objname, outdir, inputs, model, pbs=None, pool=None, progress_bar=True):
+    """
+    Fits a single spectrum and its photometry, and writes the results
+
+    Parameters
+    ----------
+    args : Namespace
+        Parsed command line options from :py:func:`WDmodel.io.get_options`
+    specfile : str
+        The spectrum filename
+    objname : str
+        The human readable object name based on the spectrum
+    outdir : str
+        The output directory
+    inputs : dict
+        The inputs to the fit from :py:func:`get_fit_inputs`
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The DA White Dwarf SED model generator
+    pbs : None or dict, optional
+        Passband models from :py:func:`WDmodel.passband.get_pbmodel`
+        including at least the passbands of this object. If ``None``, they
+        are loaded.
+    pool : None or pool, optional
+        Used to distribute the evaluations of the posterior. See
+        :py:func:`WDmodel.fit.fit_model`
+    progress_bar : bool, optional
+        Show the progress bars of the MCMC. See
+        :py:func:`WDmodel.fit.fit_model`. Default is ``True``
+
+    Raises
+    ------
+    RuntimeError
+        If user attempts to resume the fit without having run it first
+    """
+    bluelim, redlim   = args.trimspec
+    rebin     = args.rebin
+    rescale   = args.rescale
+    blotch    = args.blotch
+    vel       = args.vel
+    sptype    = args.sptype
+    pbfile    = args.pbfile
+    synmagtable = args.synmagtable
+    synmagtol = args.synmagtol
+
+    samptype  = args.samptype
+    ascale    = args.ascale
+    ntemps    = args.ntemps
+    nwalkers  = args.nwalkers
+    nburnin   = args.nburnin
+    nprod     = args.nprod
+    convgridfwhm  = args.convgridfwhm
+    convgridnfwhm = args.convgridnfwhm
+    convgridtol   = args.convgridtol
+    marginalize   = args.marginalize
+    autocorrevery  = args.autocorrevery
+    autocorrfactor = args.autocorrfactor
+    autocorrtol    = args.autocorrtol
+    everyn    = args.everyn
+    thin      = args.thin
+    redo      = args.redo
+    resume    = args.resume
+
+    discard   = args.discard
+
+    balmer    = args.balmerlines
+    ndraws    = args.ndraws
+    savefig   = args.savefig
+    savechains = args.savechains
+
+    spec      = inputs['spec']
+    phot      = inputs['phot']
+    pbnames   = inputs['pbnames']
+    rvmodel   = inputs['rvmodel']
+    covtype   = inputs['covtype']
+    coveps    = inputs['coveps']
+    phot_dispersion = inputs['phot_dispersion']
+
+    # get labels dict for plots
+    labels = viz.get_plot_labels(sptype=sptype)
+
+    if not resume:
+        # pre-process spectrum
+        out = fit.pre_process_spectrum(spec, bluelim, redlim, model, inputs['params'],\
+                rebin=rebin, lamshift=inputs['lamshift'], vel=vel, blotch=blotch, rescale=rescale)
+        spec, cont_model, linedata, continuumdata, scale_factor, params  = out
+
+        # save the inputs to the fitter
+        outfile = io.get_outfile(outdir, specfile, '_inputs.hdf5', check=True, redo=redo, resume=resume)
+        io.write_fit_inputs(spec, phot, cont_model, linedata, continuumdata,\
+               rvmodel, covtype, coveps, phot_dispersion, scale_factor, outfile)
+    else:
+        cont_model    = inputs['cont_model']
+        linedata      = inputs['linedata']
+        continuumdata = inputs['continuumdata']
+        scale_factor  = inputs['scale_factor']
+
     # get the throughput model
-    pbs = passband.get_pbmodel(pbnames, model, pbfile=pbfile)
+    if pbs is None:
+        pbs = passband.get_pbmodel(pbnames, model, pbfile=pbfile)
+    else:
+        pbs = OrderedDict((pb, pbs[pb]) for pb in pbnames)
+
+    # load the synthetic magnitude table, and make sure it reproduces the
+    # photometry of the full SED, else fall back to the full SED
+    synmag_table = None
+    if synmagtable is not None and phot is not None:
+        try:
+            synmag_table = passband.get_synmag_table(synmagtable)
+            maxdiff = synmag_table.validate(model, pbs, seed=1)
+        except (IOError, OSError, KeyError, ValueError) as e:
+            message = '{}\nCould not use synthetic magnitude table {}. Using full SED.'.format(e, synmagtable)
+            warnings.warn(message, RuntimeWarning)
+            synmag_table = None
+        else:
+            for pb, diff in zip(pbs.keys(), maxdiff):
+                message = 'Synthetic magnitude table max error in {}: {:.2e} mag'.format(pb, diff)
+                print(message)
+            if np.max(maxdiff) > synmagtol:
+                message = 'Synthetic magnitude table error exceeds {:g} mag. Using full SED.'.format(synmagtol)
+                warnings.warn(message, RuntimeWarning)
+                synmag_table = None
 
 
     ##### MINUIT #####
@@ -271,15 +433,23 @@ def main(inargs=None):
                     ntemps=ntemps, nwalkers=nwalkers, nburnin=nburnin, nprod=nprod,\
                     thin=thin, everyn=everyn,\
                     redo=redo, resume=resume,\
-                    pool=pool)
+                    pool=pool, synmag_table=synmag_table,\
+                    convgrid_fwhm=convgridfwhm, convgrid_nfwhm=convgridnfwhm, convgrid_tol=convgridtol,\
+                    marginalize=marginalize, autocorr_every=autocorrevery,\
+                    autocorr_factor=autocorrfactor, autocorr_tol=autocorrtol, progress_bar=progress_bar)
 
         param_names, samples, samples_lnprob, everyn, fullchain, shape = result
         ntemps, nwalkers, nprod, nparam = shape
         mcmc_params = io.copy_params(migrad_params)
 
+        # the derived and marginalized parameters were evaluated and saved with the chain
+        chainfile = io.get_outfile(outdir, specfile, '_mcmc.hdf5')
+        derived_samples = io.read_mcmc_derived(chainfile)
+
         # parse the samples in the chain and get the result
         result = fit.get_fit_params_from_samples(param_names, samples, samples_lnprob, mcmc_params, model,\
-                        ntemps=ntemps, nwalkers=nwalkers, nprod=nprod, discard=discard, sptype=sptype)
+                        ntemps=ntemps, nwalkers=nwalkers, nprod=nprod, discard=discard, sptype=sptype,\
+                        derived_samples=derived_samples)
         mcmc_params, in_samp, in_lnprob, p_names = result
 
         # write the result to a file
@@ -295,7 +465,7 @@ def main(inargs=None):
                     scale_factor, phot_dispersion,\
                     objname, outdir, specfile,\
                     model, covmodel, cont_model, pbs,\
-                    mcmc_params, param_names, in_samp, in_lnprob, labels,\
+                    mcmc_params, p_names, in_samp, in_lnprob, labels,\
                     covtype=covtype, balmer=balmer,\
                     ndraws=ndraws, everyn=everyn, savefig=savefig)
         model_spec, full_mod, model_mags = plot_out
@@ -311,3 +481,308 @@ def main(inargs=None):
             io.write_phot_model(phot, model_mags, phot_model_file)
 
     return
+
+
+def _union_bounds(bounds):
+    """
+    Returns the smallest 2-tuple range containing all the ranges in
+    ``bounds``, or ``None`` if any of them is ``None``
+    """
+    if any(x is None for x in bounds):
+        return None
+    return (min(x[0] for x in bounds), max(x[1] for x in bounds))
+
+
+def _fit_batch_object(task, pool, model=None, pbs=None):
+    """
+    Fits one object of a batch with the shared model and passbands
+
+    The output and errors of the fit are written to the ``.stdout`` and
+    ``.stderr`` files in the object's output directory. The progress bars of
+    the MCMC are turned off, since they cannot be redirected, and would
+    interleave with those of the other objects. Any exception is caught, so
+    that the remaining objects are still fit.
+
+    Parameters
+    ----------
+    task : tuple
+        ``(args, specfile, objname, outdir, inputs)`` - see
+        :py:func:`fit_spectrum`
+    pool : None or pool
+        Used to distribute the evaluations of the posterior. See
+        :py:func:`WDmodel.fit.fit_model`
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The DA White Dwarf SED model generator
+    pbs : dict
+        Passband models including at least the passbands of this object
+
+    Returns
+    -------
+    specfile : str
+        The spectrum filename
+    error : None or str
+        ``None`` if the fit succeeded, else the error message
+    """
+    args, specfile, objname, outdir, inputs = task
+    stdout_file = io.get_outfile(outdir, specfile, '.stdout')
+    stderr_file = io.get_outfile(outdir, specfile, '.stderr')
+    error = None
+    with open(stdout_file, 'w') as out, open(stderr_file, 'w') as err:
+        sys.stdout, sys.stderr = out, err
+        try:
+            fit_spectrum(args, specfile, objname, outdir, inputs, model, pbs=pbs, pool=pool, progress_bar=False)
+        except Exception as e:
+            traceback.print_exc()
+            error = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    return specfile, error
+
+
+def _bcast_model(comm, model=None, pbs=None):
+    """
+    Broadcasts the model and passbands of a batch from rank 0 of ``comm`` to
+    all its ranks
+
+    If the model grid is shared (see
+    :py:meth:`WDmodel.WDmodel.WDmodel.share_grid`), the pickled model only
+    carries the name of the shared grid, and each rank attaches to it when it
+    unpickles the model. The first rank on each node unpickles the model
+    before the others, so that it is the only one to read the grid file and
+    create the shared grid on the node, and the others map it. Otherwise,
+    every rank unpickles its own copy of the grid.
+
+    Parameters
+    ----------
+    comm : :py:class:`mpi4py.MPI.Comm` instance
+        The communicator. Must be called by all its ranks.
+    model : None or :py:class:`WDmodel.WDmodel.WDmodel` instance, optional
+        The DA White Dwarf SED model generator. Only used on rank 0.
+    pbs : None or dict, optional
+        Passband models. Only used on rank 0.
+
+    Returns
+    -------
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The DA White Dwarf SED model generator
+    pbs : dict
+        Passband models
+    """
+    rank = comm.Get_rank()
+    message = None
+    if rank == 0:
+        message = (model._shared_grid is not None, pickle.dumps((model, pbs), 2))
+    shared, payload = comm.bcast(message, root=0)
+    if not shared:
+        if rank != 0:
+            model, pbs = pickle.loads(payload)
+        return model, pbs
+
+    # rank 0 has already created the shared grid on its node, and is the
+    # first rank there
+    node = comm.Split_type(mpi4py.MPI.COMM_TYPE_SHARED, key=rank)
+    first = (node.Get_rank() == 0)
+    if first and rank != 0:
+        model, pbs = pickle.loads(payload)
+    node.Barrier()
+    if not first:
+        model, pbs = pickle.loads(payload)
+    node.Free()
+    return model, pbs
+
+
+def _failed_batch_object(task, error):
+    """
+    Returns the result of :py:func:`_fit_batch_object` for an object whose
+    fit died without returning one
+    """
+    return task[1], error
+
+
+def fit_speclist(args, comm=None):
+    """
+    Fits all the spectra listed in ``--speclist`` in one batch
+
+    The model grid and the passbands are loaded only once, covering all the
+    objects, and shared by their fits. The processes - ``--nproc`` local
+    processes, or the ranks of ``comm`` - are split into groups that each fit
+    one object at a time, sized from the length of its spectrum and the
+    number of walkers by :py:mod:`WDmodel.scheduler`. The output directories
+    are the same as when each spectrum is fit separately. An object that
+    cannot be fit is reported, and does not stop the fits of the others.
+
+    Parameters
+    ----------
+    args : Namespace
+        Parsed command line options from :py:func:`WDmodel.io.get_options`
+    comm : None or :py:class:`mpi4py.MPI.Comm` instance, optional
+        If supplied, the objects are scheduled over its ranks, and this
+        function must be called by all of them. Rank 0 only reads the inputs
+        and schedules the objects.
+
+    Returns
+    -------
+    failed : list
+        The spectrum filenames that could not be fit. Empty on all but rank
+        0 of ``comm``.
+
+    Raises
+    ------
+    RuntimeError
+        If none of the listed spectra can be read
+
+    See Also
+    --------
+    :py:func:`fit_spectrum`
+    """
+    if comm is not None and comm.Get_rank() != 0:
+        model, pbs = _bcast_model(comm)
+        function = partial(_fit_batch_object, model=model, pbs=pbs)
+        scheduler.run_mpi_groups(function, None, None, None, comm)
+        return []
+
+    specfiles = io.read_speclist(args.speclist)
+    rvmodel = args.reddeningmodel
+
+    # read the inputs of all the objects first, so the model grid covers all of them
+    tasks  = []
+    bounds = []
+    failed = []
+    for specfile in specfiles:
+        try:
+            objname, outdir, inputs = get_fit_inputs(args, specfile)
+            if inputs['rvmodel'] != rvmodel:
+                message = 'Reddening model {} of the saved inputs does not match {}'.format(inputs['rvmodel'], rvmodel)
+                raise ValueError(message)
+            bounds.append(get_grid_bounds(args, inputs))
+        except Exception as e:
+            message = '{}\nCould not read inputs for {}. Skipping.'.format(e, specfile)
+            warnings.warn(message, RuntimeWarning)
+            failed.append(specfile)
+            continue
+        tasks.append((args, specfile, objname, outdir, inputs))
+
+    if len(tasks) == 0:
+        message = 'Could not read inputs for any spectrum in {}'.format(args.speclist)
+        raise RuntimeError(message)
+
+    # load the model and passbands needed by all the objects once
+    teffbounds, loggbounds, wavebounds = [_union_bounds(x) for x in zip(*bounds)]
+    model = get_model(args, rvmodel, teffbounds=teffbounds, loggbounds=loggbounds, wavebounds=wavebounds)
+    pbnames = []
+    for task in tasks:
+        pbnames += [pb for pb in task[4]['pbnames'] if pb not in pbnames]
+    pbs = passband.get_pbmodel(pbnames, model, pbfile=args.pbfile)
+    function = partial(_fit_batch_object, model=model, pbs=pbs)
+
+    # size the groups from the spectrum length - the spectrum is rebinned
+    # before the fit unless it was saved already
+    costs    = []
+    maxsizes = []
+    rebin = 1 if args.resume else args.rebin
+    for task in tasks:
+        npix = len(task[4]['spec'])//rebin
+        cost, maxsize = scheduler.get_object_cost(npix, args.nwalkers, ntemps=args.ntemps)
+        costs.append(cost)
+        maxsizes.append(maxsize)
+
+    if comm is not None:
+        message = 'Fitting {} spectra with {} MPI processes'.format(len(tasks), comm.Get_size()-1)
+        print(message)
+        _bcast_model(comm, model=model, pbs=pbs)
+        results = scheduler.run_mpi_groups(function, tasks, costs, maxsizes, comm)
+    elif args.nproc > 1:
+        message = 'Fitting {} spectra with {} processes'.format(len(tasks), args.nproc)
+        print(message)
+        results = scheduler.run_process_groups(function, tasks, costs, maxsizes, args.nproc,\
+                failed=_failed_batch_object)
+    else:
+        results = [function(task, None) for task in tasks]
+
+    for specfile, error in results:
+        if error is None:
+            message = 'Finished {}'.format(specfile)
+            print(message)
+        else:
+            message = 'Fit failed for {}\n{}'.format(specfile, error)
+            warnings.warn(message, RuntimeWarning)
+            failed.append(specfile)
+
+    message = 'Fit {} of {} spectra'.format(len(specfiles) - len(failed), len(specfiles))
+    print(message)
+    return failed
+
+
+def main(inargs=None):
+    """
+    Entry point for the :py:mod:`WDmodel` fitter package.
+
+    Parameters
+    ----------
+    inargs : dict, optional
+        Input arguments to configure the fit. If not specified
+        :py:data:`sys.argv` is used. inargs must be parseable by
+        :py:func:`WDmodel.io.get_options`.
+
+    Raises
+    ------
+    RuntimeError
+        If user attempts to resume the fit without having run it first
+
+    Notes
+    -----
+    The package is structured into several modules and classes
+
+    ================================================= ===================
+                         Module                         Model Component
+    ================================================= ===================
+    :py:mod:`WDmodel.io`                              I/O methods
+    :py:class:`WDmodel.WDmodel.WDmodel`               SED generator
+    :py:mod:`WDmodel.passband`                        Throughput model
+    :py:class:`WDmodel.covariance.WDmodel_CovModel`   Noise model
+    :py:class:`WDmodel.likelihood.WDmodel_Likelihood` Likelihood function
+    :py:class:`WDmodel.likelihood.WDmodel_Posterior`  Posterior function
+    :py:mod:`WDmodel.fit`                             "Fitting" methods
+    :py:mod:`WDmodel.viz`                             Viz methods
+    ================================================= ===================
+
+    This method implements our algorithm to infer the DA White Dwarf properties
+    and construct the SED model given the data using the methods and classes
+    listed above. Once the data is read, the model is configured, and the
+    liklihood and posterior functions constructed, the fitter methods evaluate
+    the model parameters given the data, using the samplers in :py:mod:`emcee`.
+    :py:mod:`WDmodel.mossampler` provides an overloaded
+    :py:class:`emcee.PTSampler` with a more reliable auto-correlation estimate.
+    Finally, the result is output along with various plots.
+
+    If ``--speclist`` is specified instead of ``--specfile``, all the listed
+    spectra are fit in one batch with :py:func:`fit_speclist`.
+    """
+    comm = mpi4py.MPI.COMM_WORLD
+    size = comm.Get_size()
+    if size > 1:
+        # force all MPI processes to terminate if we are running with --mpi and an exception is raised
+        sys.excepthook = mpi_excepthook
+
+    if inargs is None:
+        inargs = sys.argv[1:]
+
+    # parse the arguments
+    args, pool= io.get_options(inargs, comm)
+
+    if args.speclist is not None:
+        if args.mpi or args.mpil or args.mpichunk:
+            fit_speclist(args, comm=comm)
+        else:
+            fit_speclist(args)
+        return
+
+    specfile = args.specfile
+    objname, outdir, inputs = get_fit_inputs(args, specfile)
+
+    # restrict the model grid to what is needed to fit the spectrum and photometry
+    teffbounds, loggbounds, wavebounds = get_grid_bounds(args, inputs)
+    model = get_model(args, inputs['rvmodel'], teffbounds=teffbounds, loggbounds=loggbounds, wavebounds=wavebounds)
+
+    fit_spectrum(args, specfile, objname, outdir, inputs, model, pool=pool)
+    return
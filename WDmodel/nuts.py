@@ -0,0 +1,605 @@
+# -*- coding: UTF-8 -*-
+"""
+No-U-Turn Hamiltonian Monte Carlo sampler using the analytic gradient of the
+posterior :py:meth:`WDmodel.likelihood.WDmodel_Posterior.value_and_grad`.
+
+The sampler follows the efficient No-U-Turn Sampler (Algorithm 6) of `Hoffman
+& Gelman (2014) <http://jmlr.org/papers/v15/hoffman14a.html>`_, with a
+diagonal mass matrix. The step size is tuned with dual averaging and the mass
+matrix is estimated from the samples in a series of windows during burn-in,
+in the same way as Stan. Several independent chains are run, and presented
+with the same interface as :py:class:`emcee.EnsembleSampler` (with the chains
+in place of walkers) so that :py:func:`WDmodel.fit.fit_model` can save and
+resume them in the same way.
+
+The chains move in an unconstrained space, so that the trajectories never
+run into the walls of the bounds on the parameters, where the posterior is
+``-inf``. Parameters bounded on one side are mapped with a log transform, and
+parameters bounded on both sides with a logit transform. The log of the
+Jacobian of the transform is added to the posterior and its gradient, and
+the chains are mapped back to the parameters before they are stored.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import numpy as np
+from scipy.special import expit
+from six.moves import map
+from six.moves import range
+
+__all__=['WDmodel_NUTSSampler']
+
+# a trajectory is considered divergent if the energy error exceeds this
+_MAX_ENERGY_ERROR = 1000.
+
+
+class _BoundsTransform(object):
+    """
+    Maps bounded parameters to and from an unconstrained space
+
+    A parameter ``x`` with only a lower bound ``lo`` is mapped to ``u =
+    log(x - lo)``, one with only an upper bound ``hi`` to ``u = log(hi - x)``
+    and one with both to ``u = logit((x - lo)/(hi - lo))``. Parameters without
+    bounds are unchanged.
+
+    Parameters
+    ----------
+    bounds : None or sequence of 2-tuples
+        The ``(lower, upper)`` bounds of each parameter. Either may be
+        ``None``. If ``None``, no parameters are bounded.
+    dim : int
+        The number of parameters
+    """
+    def __init__(self, bounds, dim):
+        if bounds is None:
+            bounds = [(None, None)]*dim
+        if len(bounds) != dim:
+            message = 'Number of bounds ({}) does not match number of parameters ({})'.format(len(bounds), dim)
+            raise ValueError(message)
+        lo = np.array([-np.inf if b[0] is None else b[0] for b in bounds], dtype='float64')
+        hi = np.array([ np.inf if b[1] is None else b[1] for b in bounds], dtype='float64')
+        if np.any(lo >= hi):
+            message = 'Lower bounds must be less than upper bounds'
+            raise ValueError(message)
+        self.lo = lo
+        self.hi = hi
+        self._both  = np.isfinite(lo) & np.isfinite(hi)
+        self._lower = np.isfinite(lo) & ~np.isfinite(hi)
+        self._upper = ~np.isfinite(lo) & np.isfinite(hi)
+        self._width = np.where(self._both, hi - lo, 1.)
+
+
+    def to_unconstrained(self, x):
+        """
+        Returns the unconstrained position ``u`` of the parameters ``x``.
+        Parameters on or outside their bounds map to ``+/-inf`` or ``nan``.
+        """
+        x = np.asarray(x, dtype='float64')
+        u = x.copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y = (x - self.lo)/self._width
+            u = np.where(self._both, np.log(y) - np.log1p(-y), u)
+            u = np.where(self._lower, np.log(x - self.lo), u)
+            u = np.where(self._upper, np.log(self.hi - x), u)
+        return u
+
+
+    def from_unconstrained(self, u):
+        """
+        Returns the parameters ``x`` at the unconstrained position ``u``
+        """
+        u = np.asarray(u, dtype='float64')
+        x = u.copy()
+        with np.errstate(over='ignore'):
+            x = np.where(self._both, self.lo + self._width*expit(u), x)
+            x = np.where(self._lower, self.lo + np.exp(u), x)
+            x = np.where(self._upper, self.hi - np.exp(u), x)
+        return x
+
+
+    def jacobian(self, u):
+        """
+        Returns the derivative ``dx/du`` of each parameter, the log of the
+        determinant of the Jacobian of the map from ``u`` to ``x`` and its
+        gradient with respect to ``u``
+        """
+        u = np.asarray(u, dtype='float64')
+        dxdu   = np.ones_like(u)
+        logjac = np.zeros_like(u)
+        dlogjac = np.zeros_like(u)
+
+        sig = expit(u)
+        with np.errstate(over='ignore'):
+            # log(sig) + log(1 - sig), written to avoid underflow
+            logsig = -np.logaddexp(0., -u) - np.logaddexp(0., u)
+            expu   = np.exp(u)
+        dxdu    = np.where(self._both, self._width*sig*(1. - sig), dxdu)
+        logjac  = np.where(self._both, np.log(self._width) + logsig, logjac)
+        dlogjac = np.where(self._both, 1. - 2.*sig, dlogjac)
+
+        onesided = self._lower | self._upper
+        sign = np.where(self._upper, -1., 1.)
+        dxdu    = np.where(onesided, sign*expu, dxdu)
+        logjac  = np.where(onesided, u, logjac)
+        dlogjac = np.where(onesided, 1., dlogjac)
+        return dxdu, logjac.sum(axis=-1), dlogjac
+
+
+    def scale_to_unconstrained(self, x, scale):
+        """
+        Returns the scale ``scale`` of the parameters at ``x`` propagated to
+        the unconstrained space
+
+        The scale of bounded parameters is at most ``1.``, which already spans
+        most of their range, as it does if ``x`` is at a bound.
+        """
+        dxdu, _, _ = self.jacobian(self.to_unconstrained(x))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.asarray(scale, dtype='float64')/np.abs(dxdu)
+        bounded = self._both | self._lower | self._upper
+        scale = np.where(bounded & ~(scale < 1.), 1., scale)
+        return scale
+
+
+class _NUTSStep(object):
+    """
+    Advance a single chain by one No-U-Turn trajectory
+
+    The step size, inverse mass matrix and random seed are passed with each
+    task rather than stored, so that the same instance can be mapped over a
+    pool for every iteration without being resent to the workers.
+
+    The positions are in the unconstrained space of ``transform``, and the
+    target density is the posterior there, including the Jacobian of the
+    transform.
+
+    Parameters
+    ----------
+    lnpostfn : callable
+        Object with a method ``value_and_grad`` that returns the log posterior
+        and its gradient at a position
+    max_depth : int
+        Maximum depth of the trajectory tree. At most ``2**max_depth - 1``
+        leapfrog steps are taken per iteration.
+    transform : :py:class:`_BoundsTransform` instance
+        The map between the parameters and the unconstrained space
+    """
+    def __init__(self, lnpostfn, max_depth, transform):
+        self.lnpostfn  = lnpostfn
+        self.max_depth = max_depth
+        self.transform = transform
+        self._divergent = False
+
+
+    def _value_and_grad(self, q):
+        """
+        Returns the log target density and its gradient at the unconstrained
+        position ``q``, with ``-inf`` for any non-finite posterior
+        """
+        x = self.transform.from_unconstrained(q)
+        logp, grad = self.lnpostfn.value_and_grad(x)
+        dxdu, logjac, dlogjac = self.transform.jacobian(q)
+        logp = logp + logjac
+        grad = np.asarray(grad, dtype='float64')*dxdu + dlogjac
+        if not (np.isfinite(logp) and np.all(np.isfinite(grad))):
+            return -np.inf, np.zeros_like(q)
+        return logp, grad
+
+
+    def _leapfrog(self, q, p, grad, eps, invmass):
+        """
+        Take a single leapfrog step of size ``eps``
+        """
+        p = p + 0.5*eps*grad
+        q = q + eps*invmass*p
+        logp, grad = self._value_and_grad(q)
+        p = p + 0.5*eps*grad
+        return q, p, grad, logp
+
+
+    def _build_tree(self, q, p, grad, logu, v, j, eps, invmass, joint0, rng):
+        """
+        Recursively build a trajectory subtree of depth ``j`` in direction
+        ``v`` starting from ``(q, p)``
+
+        Returns the leftmost and rightmost states of the subtree, the proposed
+        state, the number of valid states, whether the subtree can be
+        extended, the summed acceptance statistic and the number of leapfrog
+        steps.
+        """
+        if j == 0:
+            q1, p1, grad1, logp1 = self._leapfrog(q, p, grad, v*eps, invmass)
+            joint = logp1 - 0.5*np.dot(p1, invmass*p1)
+            if not np.isfinite(joint):
+                joint = -np.inf
+            n1 = int(logu <= joint)
+            s1 = int(logu < joint + _MAX_ENERGY_ERROR)
+            if s1 == 0:
+                self._divergent = True
+            alpha = np.exp(min(0., joint - joint0)) if np.isfinite(joint) else 0.
+            return q1, p1, grad1, q1, p1, grad1, q1, grad1, logp1, n1, s1, alpha, 1
+
+        out = self._build_tree(q, p, grad, logu, v, j-1, eps, invmass, joint0, rng)
+        qm, pm, gradm, qp, pp, gradp, q1, grad1, logp1, n1, s1, alpha1, nalpha1 = out
+        if s1 == 1:
+            if v == -1:
+                out = self._build_tree(qm, pm, gradm, logu, v, j-1, eps, invmass, joint0, rng)
+                qm, pm, gradm, _, _, _, q2, grad2, logp2, n2, s2, alpha2, nalpha2 = out
+            else:
+                out = self._build_tree(qp, pp, gradp, logu, v, j-1, eps, invmass, joint0, rng)
+                _, _, _, qp, pp, gradp, q2, grad2, logp2, n2, s2, alpha2, nalpha2 = out
+            if n1 + n2 > 0 and rng.uniform() < float(n2)/(n1 + n2):
+                q1, grad1, logp1 = q2, grad2, logp2
+            alpha1 += alpha2
+            nalpha1 += nalpha2
+            dq = qp - qm
+            s1 = int(s2 == 1 and np.dot(dq, invmass*pm) >= 0 and np.dot(dq, invmass*pp) >= 0)
+            n1 += n2
+        return qm, pm, gradm, qp, pp, gradp, q1, grad1, logp1, n1, s1, alpha1, nalpha1
+
+
+    def __call__(self, task):
+        """
+        Run one No-U-Turn iteration
+
+        Parameters
+        ----------
+        task : tuple
+            ``(q, logp, grad, eps, invmass, seed)`` - the current unconstrained
+            position, the log target density and its gradient there, the step
+            size, the diagonal inverse mass matrix and the seed for the random
+            numbers of this iteration
+
+        Returns
+        -------
+        q : array-like
+            The new unconstrained position
+        logp : float
+            The log target density at ``q``
+        grad : array-like
+            The gradient of the log target density at ``q``
+        accept : float
+            The mean Metropolis acceptance statistic over the trajectory
+        divergent : bool
+            ``True`` if the trajectory was terminated by a divergence
+        nleapfrog : int
+            The number of leapfrog steps taken
+        """
+        q, logp, grad, eps, invmass, seed = task
+        rng = np.random.RandomState(seed)
+        self._divergent = False
+
+        p0 = rng.normal(size=len(q))/np.sqrt(invmass)
+        joint0 = logp - 0.5*np.dot(p0, invmass*p0)
+        logu = joint0 + np.log(rng.uniform())
+
+        qm, qp = q, q
+        pm, pp = p0, p0
+        gradm, gradp = grad, grad
+        j, n, s = 0, 1, 1
+        alpha, nalpha = 0., 0
+        while s == 1 and j < self.max_depth:
+            v = 1 if rng.uniform() < 0.5 else -1
+            if v == -1:
+                out = self._build_tree(qm, pm, gradm, logu, v, j, eps, invmass, joint0, rng)
+                qm, pm, gradm, _, _, _, q1, grad1, logp1, n1, s1, alpha1, nalpha1 = out
+            else:
+                out = self._build_tree(qp, pp, gradp, logu, v, j, eps, invmass, joint0, rng)
+                _, _, _, qp, pp, gradp, q1, grad1, logp1, n1, s1, alpha1, nalpha1 = out
+            if s1 == 1 and rng.uniform() < min(1., float(n1)/n):
+                q, logp, grad = q1, logp1, grad1
+            n += n1
+            alpha += alpha1
+            nalpha += nalpha1
+            dq = qp - qm
+            s = int(s1 == 1 and np.dot(dq, invmass*pm) >= 0 and np.dot(dq, invmass*pp) >= 0)
+            j += 1
+        return q, logp, grad, alpha/max(nalpha, 1), self._divergent, nalpha
+
+
+class WDmodel_NUTSSampler(object):
+    """
+    Runs independent No-U-Turn Hamiltonian Monte Carlo chains
+
+    Presents the interface of :py:class:`emcee.EnsembleSampler` used by
+    :py:func:`WDmodel.fit.fit_model`, with each walker an independent chain.
+    All the chains share the step size and mass matrix. The chains move in the
+    unconstrained space of the parameters, but the positions and log
+    posterior that are yielded and stored are those of the parameters.
+
+    Parameters
+    ----------
+    nwalkers : int
+        The number of independent chains
+    dim : int
+        The number of parameters
+    lnpostfn : :py:class:`WDmodel.likelihood.WDmodel_Posterior` instance
+        The posterior function. Must have a ``value_and_grad`` method.
+    pool : None or pool, optional
+        If supplied, its ``map`` method is used to advance the chains in
+        parallel
+    scale : None or array-like, optional
+        The initial guess for the scale of each parameter. Propagated to the
+        unconstrained space at ``loc``, it is used as the square root of the
+        initial diagonal inverse mass matrix. Default is ``1.`` for each
+        parameter in the unconstrained space.
+    bounds : None or sequence of 2-tuples, optional
+        The ``(lower, upper)`` bounds of each parameter, either of which may
+        be ``None``, such as from
+        :py:meth:`celerite.modeling.Model.get_parameter_bounds`. Default is
+        no bounds.
+    loc : None or array-like, optional
+        The parameters at which ``scale`` is propagated to the unconstrained
+        space. Required if ``scale`` and ``bounds`` are both supplied.
+    target_accept : float, optional
+        The mean acceptance statistic the step size is tuned to during
+        adaptation. Default is ``0.8``
+    max_depth : int, optional
+        The maximum depth of the trajectory tree. Default is ``10``
+
+    Attributes
+    ----------
+    step_size : float
+        The leapfrog step size. Tuned if ``adapt`` is set in
+        :py:meth:`WDmodel_NUTSSampler.sample`
+    inv_mass : array-like
+        The diagonal inverse mass matrix in the unconstrained space. Estimated from the samples if
+        ``adapt`` is set in :py:meth:`WDmodel_NUTSSampler.sample`
+    ndivergent : int
+        The number of divergent trajectories since the last reset
+    """
+    def __init__(self, nwalkers, dim, lnpostfn, pool=None, scale=None, bounds=None, loc=None,\
+            target_accept=0.8, max_depth=10):
+        if not hasattr(lnpostfn, 'value_and_grad'):
+            message = 'NUTS sampler requires a posterior function with a value_and_grad method'
+            raise ValueError(message)
+        if not (0. < target_accept < 1.):
+            message = 'Target acceptance must be between 0 and 1 ({:g})'.format(target_accept)
+            raise ValueError(message)
+
+        self.k             = nwalkers
+        self.dim           = dim
+        self.lnpostfn      = lnpostfn
+        self.pool          = pool
+        self.target_accept = target_accept
+        self.transform     = _BoundsTransform(bounds, dim)
+        self._step         = _NUTSStep(lnpostfn, max_depth, self.transform)
+        self._random       = np.random.mtrand.RandomState()
+
+        if scale is None:
+            scale = np.ones(dim)
+        elif bounds is not None:
+            if loc is None:
+                message = 'NUTS sampler requires loc to propagate the scale of bounded parameters'
+                raise ValueError(message)
+            scale = self.transform.scale_to_unconstrained(loc, scale)
+        self.inv_mass  = np.asarray(scale, dtype='float64')**2.
+        self.step_size = None
+        self.reset()
+
+
+    def reset(self):
+        """
+        Clear the chain, posterior values and acceptance statistics
+        """
+        self._chain      = np.empty((self.k, 0, self.dim))
+        self._lnprob     = np.empty((self.k, 0))
+        self._accept     = np.zeros(self.k)
+        self.iterations  = 0
+        self.ndivergent  = 0
+
+
+    @property
+    def random_state(self):
+        """
+        The state of the random number generator
+        """
+        return self._random.get_state()
+
+
+    @random_state.setter
+    def random_state(self, state):
+        try:
+            self._random.set_state(state)
+        except:
+            pass
+
+
+    @property
+    def chain(self):
+        """
+        The chain positions with shape ``(nwalkers, niter, dim)``
+        """
+        return self._chain
+
+
+    @property
+    def flatchain(self):
+        """
+        The chain positions with shape ``(nwalkers*niter, dim)``
+        """
+        return self._chain.reshape((-1, self.dim))
+
+
+    @property
+    def lnprobability(self):
+        """
+        The log posterior of the chain positions with shape ``(nwalkers, niter)``
+        """
+        return self._lnprob
+
+
+    @property
+    def acceptance_fraction(self):
+        """
+        The mean acceptance statistic of each chain since the last reset
+        """
+        return self._accept/max(self.iterations, 1)
+
+
+    def _map(self, function, tasks):
+        """
+        Map ``function`` over ``tasks`` with the pool if there is one
+        """
+        if self.pool is None:
+            return list(map(function, tasks))
+        return list(self.pool.map(function, tasks))
+
+
+    def _find_step_size(self, q, logp, grad):
+        """
+        Heuristic for a reasonable initial step size - doubles or halves it
+        until the acceptance probability of a single leapfrog step crosses
+        0.5. Algorithm 4 of Hoffman & Gelman (2014).
+        """
+        eps = 1.
+        p = self._random.normal(size=self.dim)/np.sqrt(self.inv_mass)
+        joint0 = logp - 0.5*np.dot(p, self.inv_mass*p)
+
+        def logratio(eps):
+            _, p1, _, logp1 = self._step._leapfrog(q, p, grad, eps, self.inv_mass)
+            joint = logp1 - 0.5*np.dot(p1, self.inv_mass*p1)
+            if not np.isfinite(joint):
+                return -np.inf
+            return joint - joint0
+
+        direction = 1. if logratio(eps) > np.log(0.5) else -1.
+        for _ in range(100):
+            if direction*logratio(eps) <= direction*np.log(0.5):
+                break
+            eps *= 2.**direction
+        return eps
+
+
+    def _get_windows(self, iterations):
+        """
+        Returns the iterations at the end of each mass matrix adaptation
+        window for a burn-in of ``iterations`` steps
+
+        Like Stan, the first 15% and last 10% of the iterations only tune the
+        step size, and the rest is split into windows that double in length.
+        """
+        start = int(0.15*iterations)
+        stop  = iterations - int(0.1*iterations)
+        width = (stop - start)//7
+        if width < 5:
+            if stop - start < 10:
+                return []
+            return [stop]
+        return [start + width, start + 3*width, stop]
+
+
+    def sample(self, p0, lnprob0=None, rstate0=None, iterations=1, thin=1, adapt=False, storechain=True):
+        """
+        Advance the chains ``iterations`` steps as a generator
+
+        Parameters
+        ----------
+        p0 : array-like
+            The initial positions of the chains with shape ``(nwalkers, dim)``.
+            Must be strictly within the bounds.
+        lnprob0 : None or array-like, optional
+            The log posterior at ``p0``. Ignored, as the gradient must be
+            evaluated at ``p0`` anyway.
+        rstate0 : None or tuple, optional
+            The state of the random number generator. See
+            :py:attr:`WDmodel_NUTSSampler.random_state`
+        iterations : int, optional
+            The number of steps to run. Default is ``1``
+        thin : int, optional
+            Only store every ``thin`` steps. Default is ``1``
+        adapt : bool, optional
+            If ``True``, tune the step size and mass matrix during these
+            iterations. The step size is initialized with a heuristic if not
+            already set. Default is ``False``
+        storechain : bool, optional
+            If ``True``, store the positions and posterior values. Default is
+            ``True``
+
+        Yields
+        ------
+        pos : array-like
+            The positions of the chains with shape ``(nwalkers, dim)``
+        lnprob : array-like
+            The log posterior of each chain
+        rstate : tuple
+            The state of the random number generator
+        """
+        self.random_state = rstate0
+
+        p = np.array(p0, dtype='float64').reshape((self.k, self.dim))
+        p = self.transform.to_unconstrained(p)
+        results = list(map(self._step._value_and_grad, p))
+        lnprob = np.array([x[0] for x in results])
+        grad   = [x[1] for x in results]
+        if not np.all(np.isfinite(lnprob)):
+            message = 'Initial positions of NUTS sampler must have finite posterior'
+            raise ValueError(message)
+
+        if self.step_size is None:
+            self.step_size = self._find_step_size(p[0], lnprob[0], grad[0])
+
+        if adapt:
+            windows = self._get_windows(iterations)
+            window_start = int(0.15*iterations)
+            window = []
+            mu = np.log(10.*self.step_size)
+            hbar, log_eps_bar, m = 0., 0., 0
+
+        if storechain:
+            nstore = iterations//thin
+            chain  = np.empty((self.k, nstore, self.dim))
+            lnpost = np.empty((self.k, nstore))
+            self._chain  = np.concatenate((self._chain, chain), axis=1)
+            self._lnprob = np.concatenate((self._lnprob, lnpost), axis=1)
+        i0 = self._chain.shape[1] - iterations//thin
+
+        for i in range(iterations):
+            seeds = self._random.randint(0, 2**31-1, size=self.k)
+            tasks = [(p[k], lnprob[k], grad[k], self.step_size, self.inv_mass, seeds[k]) for k in range(self.k)]
+            results = self._map(self._step, tasks)
+            p      = np.array([x[0] for x in results])
+            lnprob = np.array([x[1] for x in results])
+            grad   = [x[2] for x in results]
+            accept = np.array([x[3] for x in results])
+            self.ndivergent += sum(x[4] for x in results)
+            self._accept += accept
+            self.iterations += 1
+
+            # the positions and log posterior of the parameters
+            x = self.transform.from_unconstrained(p)
+            lnpost = lnprob - self.transform.jacobian(p)[1]
+
+            if adapt:
+                # dual averaging of the step size
+                m += 1
+                eta = 1./(m + 10.)
+                hbar = (1. - eta)*hbar + eta*(self.target_accept - np.mean(accept))
+                log_eps = mu - np.sqrt(m)/0.05*hbar
+                eta = m**-0.75
+                log_eps_bar = eta*log_eps + (1. - eta)*log_eps_bar
+                self.step_size = np.exp(log_eps)
+
+                # estimate the mass matrix from the samples in each window
+                if i >= window_start:
+                    window.append(p.copy())
+                if windows and i + 1 == windows[0]:
+                    windows.pop(0)
+                    samples = np.concatenate(window, axis=0)
+                    n = len(samples)
+                    var = np.var(samples, axis=0)
+                    self.inv_mass = (n/(n + 5.))*var + 1e-3*(5./(n + 5.))
+                    window = []
+                    self.step_size = self._find_step_size(p[0], lnprob[0], grad[0])
+                    mu = np.log(10.*self.step_size)
+                    hbar, log_eps_bar, m = 0., 0., 0
+
+            if storechain and (i + 1) % thin == 0:
+                ind = i0 + i//thin
+                self._chain[:, ind, :] = x
+                self._lnprob[:, ind] = lnpost
+
+            yield x, lnpost, self.random_state
+
+        if adapt and m > 0:
+            self.step_size = np.exp(log_eps_bar)
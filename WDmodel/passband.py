@@ -9,6 +9,9 @@ from __future__ import unicode_literals
 import warnings
 import numpy as np
 from scipy.interpolate import interp1d
+import scipy.interpolate as spinterp
+import scipy.sparse as spsparse
+from astropy.constants import c
 import pysynphot as S
 from . import io
 from collections import OrderedDict
@@ -128,6 +131,218 @@ def get_model_synmags(model_spec, pbs, mu=0.):
     return out
 
 
+def get_pbprojection(pbs, model, pbnames=None):
+    """
+    Precomputes the trapezoid-rule weights of the passbands ``pbs`` on the
+    wavelengths of the SED model as sparse projection matrices, so that the
+    synthetic photometry of a model spectrum is a matrix product.
+
+    Parameters
+    ----------
+    pbs : dict
+        Passband dictionary generated by
+        :py:func:`WDmodel.passband.get_pbmodel`.
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The DA White Dwarf SED model generator used to generate ``pbs``
+    pbnames : None or array-like, optional
+        Passband names setting the order of the rows of the projection e.g.
+        ``phot.pb``. Names may be repeated. If ``None``, the order of ``pbs``
+        is used.
+
+    Returns
+    -------
+    pbproj : tuple
+        A tuple ``(W, norm, zp)``. ``W`` is a
+        :py:class:`scipy.sparse.csr_matrix` with shape ``(2*len(pbnames),
+        len(model._wave))`` stacking the weights ``W1`` above ``W0`` (see
+        Notes), ``norm`` are the row sums of ``W`` and ``zp`` is the array of
+        zeropoints of the passbands. Can be passed to
+        :py:func:`WDmodel.passband.get_model_synmags_proj`.
+
+    Raises
+    ------
+    KeyError
+        If a passband in ``pbnames`` is not in ``pbs``
+
+    Notes
+    -----
+        The model spectrum is computed at wavelengths ``a*_wave + b`` with
+        ``a = 1 + rvel/c`` and ``b = shift`` (see
+        :py:meth:`WDmodel.WDmodel.WDmodel._get_full_obs_model`), while the
+        transmission is fixed on the unshifted model wavelengths. The
+        numerator and denominator of :py:func:`WDmodel.passband.synflux` are
+        therefore ``a*(a*W1 + b*W0)`` applied to ``flux`` and to ones
+        respectively, where ``W1`` holds the trapezoid weights times the
+        unshifted wavelength times the transmission and ``W0`` holds the
+        trapezoid weights times the transmission. The projection is exact for
+        any ``shift`` and ``rvel``.
+
+    See Also
+    --------
+    :py:func:`WDmodel.passband.synflux`
+    :py:func:`WDmodel.passband.get_model_synmags_proj`
+    """
+    if pbnames is None:
+        pbnames = list(pbs.keys())
+    wave  = model._wave
+    nwave = len(wave)
+    windex = np.arange(nwave)
+
+    rows = []
+    cols = []
+    w1 = []
+    w0 = []
+    zp = []
+    for i, pbname in enumerate(pbnames):
+        _, transmission, ind, pbzp, _ = pbs[pbname]
+        col = windex[ind]
+        pwave = wave[col]
+        dw = np.diff(pwave)/2.
+        weight = np.zeros(len(pwave))
+        weight[:-1] += dw
+        weight[1:]  += dw
+        rows.append(np.repeat(i, len(col)))
+        cols.append(col)
+        w1.append(weight*pwave*transmission)
+        w0.append(weight*transmission)
+        zp.append(pbzp)
+
+    npb = len(zp)
+    if npb > 0:
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        w1 = np.concatenate(w1)
+        w0 = np.concatenate(w0)
+    else:
+        rows = cols = np.zeros(0, dtype='int')
+        w1 = w0 = np.zeros(0)
+
+    # stack both sets of weights so a single sparse product does all the work
+    W = spsparse.csr_matrix((np.concatenate((w1, w0)),\
+            (np.concatenate((rows, rows+npb)), np.concatenate((cols, cols)))),\
+            shape=(2*npb, nwave))
+    norm = np.asarray(W.sum(axis=1)).ravel()
+    zp = np.array(zp, dtype='float64')
+    return W, norm, zp
+
+
+def get_model_synmags_proj(flux, pbproj, shift=0., rvel=0., mu=0.):
+    """
+    Computes the synthetic magnitudes of one or more model spectra using the
+    passband projection ``pbproj``, and optionally applies a common offset,
+    ``mu``
+
+    Equivalent to :py:func:`WDmodel.passband.get_model_synmags` applied to the
+    full model spectrum returned by
+    :py:meth:`WDmodel.WDmodel.WDmodel._get_full_obs_model`, but evaluated as a
+    sparse matrix product.
+
+    Parameters
+    ----------
+    flux : array-like
+        The model flux on the model wavelengths. Either 1-D with shape
+        ``(len(model._wave),)`` or 2-D with shape ``(N, len(model._wave))``
+    pbproj : tuple
+        Passband projection ``(W, norm, zp)`` generated by
+        :py:func:`WDmodel.passband.get_pbprojection`
+    shift : float or array-like, optional
+        Linear wavelength shift in Angstroms of the model spectrum. Array of
+        length ``N`` if ``flux`` is 2-D.
+    rvel : float or array-like, optional
+        Radial velocity in km/s of the model spectrum. Array of length ``N``
+        if ``flux`` is 2-D.
+    mu : float or array-like, optional
+        Common achromatic photometric offset to apply to the synthetic
+        magnitudes in all the passbands. Array of length ``N`` if ``flux`` is
+        2-D.
+
+    Returns
+    -------
+    model_mags : array-like
+        The model magnitudes in the order of the rows of the projection. Has
+        shape ``(npb,)`` if ``flux`` is 1-D, and ``(N, npb)`` if ``flux`` is
+        2-D.
+
+    See Also
+    --------
+    :py:func:`WDmodel.passband.get_pbprojection`
+    """
+    W, norm, zp = pbproj
+    npb = len(zp)
+    a = 1. + np.asarray(rvel)*1000./c.value
+    b = np.asarray(shift)
+
+    # sparse matrix product on the transpose keeps the passbands on the rows
+    flux = np.asarray(flux)
+    f = W.dot(flux.T)
+    if flux.ndim == 2:
+        norm = norm[:, np.newaxis]
+        zp = zp[:, np.newaxis]
+    synflux = (a*f[:npb] + b*f[npb:])/(a*norm[:npb] + b*norm[npb:])
+    out = -2.5*np.log10(synflux) + zp + mu
+    return out.T
+
+
+def get_model_synmags_proj_grad(flux, dflux, pbproj, shift=0., rvel=0., mu=0.):
+    """
+    Computes the synthetic magnitudes of a model spectrum using the passband
+    projection ``pbproj`` as :py:func:`get_model_synmags_proj`, and their
+    derivatives
+
+    Parameters
+    ----------
+    flux : array-like
+        The model flux on the model wavelengths, with shape
+        ``(len(model._wave),)``
+    dflux : array-like
+        Partial derivatives of ``flux`` with respect to ``K`` parameters, with
+        shape ``(K, len(model._wave))``
+    pbproj : tuple
+        Passband projection ``(W, norm, zp)`` generated by
+        :py:func:`WDmodel.passband.get_pbprojection`
+    shift : float, optional
+        Linear wavelength shift in Angstroms of the model spectrum
+    rvel : float, optional
+        Radial velocity in km/s of the model spectrum
+    mu : float, optional
+        Common achromatic photometric offset to apply to the synthetic
+        magnitudes in all the passbands
+
+    Returns
+    -------
+    model_mags : array-like
+        The model magnitudes in the order of the rows of the projection, with
+        shape ``(npb,)``
+    dmags : array-like
+        Array of shape ``(K+2, npb)`` with the derivatives of ``model_mags``
+        with respect to the ``K`` parameters of ``dflux``, followed by
+        ``shift`` and ``rvel``. The derivative with respect to ``mu`` is
+        ``1``.
+
+    See Also
+    --------
+    :py:func:`WDmodel.passband.get_model_synmags_proj`
+    """
+    W, norm, zp = pbproj
+    npb = len(zp)
+    a = 1. + rvel*1000./c.value
+    b = shift
+
+    f  = W.dot(np.asarray(flux))
+    df = W.dot(np.asarray(dflux).T)
+    den = a*norm[:npb] + b*norm[npb:]
+    synflux = (a*f[:npb] + b*f[npb:])/den
+    out = -2.5*np.log10(synflux) + zp + mu
+
+    # d(mag)/d(synflux) = -2.5/(ln(10)*synflux)
+    dmag = -2.5/(np.log(10.)*synflux)
+    dmags = np.empty((df.shape[1]+2, npb))
+    dmags[:-2] = ((a*df[:npb] + b*df[npb:])/den[:, np.newaxis]).T*dmag
+    dmags[-2]  = (f[npb:] - synflux*norm[npb:])/den*dmag
+    dmags[-1]  = (f[:npb] - synflux*norm[:npb])/den*dmag*(1000./c.value)
+    return out, dmags
+
+
 def interp_passband(wave, pb, model):
     """
     Find the indices of the wavelength array ``wave``, that overlap with the
@@ -228,6 +443,89 @@ def chop_syn_spec_pb(spec, model_mag, pb, model):
     return outpb, outzp
 
 
+def _load_bandpass(pb, obsmode):
+    """
+    Loads the passband ``pb`` with :py:mod:`pysynphot`, treating ``obsmode``
+    as an ``obsmode`` string, or failing that, as a file
+
+    Raises
+    ------
+    RuntimeError
+        If the bandpass cannot be loaded
+    """
+    loadedpb = False
+    # treat the passband as a obsmode string
+    try:
+        bp = S.ObsBandpass(obsmode)
+        loadedpb = True
+    except ValueError:
+        message = 'Could not load pb {} as an obsmode string {}'.format(pb, obsmode)
+        warnings.warn(message, RuntimeWarning)
+        loadedpb = False
+
+    # if that fails, try to load the passband interpreting obsmode as a file
+    if not loadedpb:
+        try:
+            bandpassfile = io.get_filepath(obsmode)
+            bp = S.FileBandpass(bandpassfile)
+            loadedpb = True
+        except Exception as e:
+            message = 'Could not load passband {} from obsmode or file {}'.format(pb, obsmode)
+            warnings.warn(message, RuntimeWarning)
+            loadedpb = False
+
+    if not loadedpb:
+        message = 'Could not load passband {}. Giving up.'.format(pb)
+        raise RuntimeError(message)
+    return bp
+
+
+def get_pbwave_bounds(pbnames, pbfile=None):
+    """
+    Returns the range of wavelengths with non-zero throughput of the
+    passbands ``pbnames``
+
+    Used to restrict the model grid to the wavelengths needed for synthetic
+    photometry before the model is loaded. See
+    :py:func:`WDmodel.io.read_model_grid`.
+
+    Parameters
+    ----------
+    pbnames : array-like
+        List of passband names. See :py:func:`WDmodel.passband.get_pbmodel`
+    pbfile : str, optional
+        Filename containing mapping between ``pbnames`` and ``pysynphot``
+        ``obsmode`` string. See :py:func:`WDmodel.passband.get_pbmodel`
+
+    Returns
+    -------
+    bounds : None or 2-tuple
+        The minimum and maximum wavelength in Angstrom, or ``None`` if
+        ``pbnames`` is empty
+
+    Raises
+    ------
+    RuntimeError
+        If a bandpass cannot be loaded
+    """
+    if len(pbnames) == 0:
+        return None
+    if pbfile is None:
+        pbfile = 'WDmodel_pb_obsmode_map.txt'
+        pbfile = io.get_pkgfile(pbfile)
+    pbdata  = io.read_pbmap(pbfile)
+    pbmap   = dict(list(zip(pbdata.pb, pbdata.obsmode)))
+
+    wmin = np.inf
+    wmax = -np.inf
+    for pb in pbnames:
+        bp = _load_bandpass(pb, pbmap.get(pb, pb))
+        wave = np.asarray(bp.wave)[np.nonzero(bp.throughput)]
+        wmin = min(wmin, wave.min())
+        wmax = max(wmax, wave.max())
+    return wmin, wmax
+
+
 def get_pbmodel(pbnames, model, pbfile=None, mag_type=None, mag_zero=0.):
     """
     Converts passband names ``pbnames`` into passband models based on the
@@ -357,30 +655,7 @@ def get_pbmodel(pbnames, model, pbfile=None, mag_type=None, mag_zero=0.):
             message = 'Unknown standard system {} for passband {}'.format(magsys, pb)
             raise RuntimeError(message)
 
-        loadedpb = False
-        # treat the passband as a obsmode string
-        try:
-            bp = S.ObsBandpass(obsmode)
-            loadedpb = True
-        except ValueError:
-            message = 'Could not load pb {} as an obsmode string {}'.format(pb, obsmode)
-            warnings.warn(message, RuntimeWarning)
-            loadedpb = False
-
-        # if that fails, try to load the passband interpreting obsmode as a file
-        if not loadedpb:
-            try:
-                bandpassfile = io.get_filepath(obsmode)
-                bp = S.FileBandpass(bandpassfile)
-                loadedpb = True
-            except Exception as e:
-                message = 'Could not load passband {} from obsmode or file {}'.format(pb, obsmode)
-                warnings.warn(message, RuntimeWarning)
-                loadedpb = False
-
-        if not loadedpb:
-            message = 'Could not load passband {}. Giving up.'.format(pb)
-            raise RuntimeError(message)
+        bp = _load_bandpass(pb, obsmode)
 
         avgwave = bp.avgwave()
         if standard.wave.min() > model._wave.min():
@@ -399,9 +674,361 @@ def get_pbmodel(pbnames, model, pbfile=None, mag_type=None, mag_zero=0.):
         # cut the passband to non-zero values and interpolate onto overlapping standard wavelengths
         outpb, outzp = chop_syn_spec_pb(standard, synphot_mag, bp, model)
 
+        if outpb.wave.min() < model._wave.min() or outpb.wave.max() > model._wave.max():
+            message = 'Passband {} extends past the model wavelengths. Synthetic photometry will be truncated.'.format(pb)
+            warnings.warn(message, RuntimeWarning)
+
         # interpolate the passband onto the standard's  wavelengths
         transmission, ind = interp_passband(model._wave, outpb, model)
 
         # save everything we need for this passband
         out[pb] = (outpb, transmission, ind, outzp, avgwave)
     return out
+
+
+def _oversample_grid(grid, oversample=1):
+    """
+    Subdivides each interval of the 1-D array ``grid`` into ``oversample``
+    equal intervals
+    """
+    grid = np.atleast_1d(grid)
+    if oversample <= 1 or len(grid) < 2:
+        return grid.copy()
+    frac = np.arange(oversample)/float(oversample)
+    out = (grid[:-1, np.newaxis] + np.diff(grid)[:, np.newaxis]*frac).ravel()
+    return np.append(out, grid[-1])
+
+
+def make_synmag_table(model, pbs, avgrid, rvgrid, oversample=1):
+    """
+    Tabulates the band-integrated fluxes of the model SED through the
+    passbands ``pbs`` on the model grid nodes and a lattice of ``av`` and
+    ``rv``
+
+    Parameters
+    ----------
+    model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+        The DA White Dwarf SED model generator used to generate ``pbs``
+    pbs : dict
+        Passband dictionary generated by
+        :py:func:`WDmodel.passband.get_pbmodel`.
+    avgrid : array-like
+        Sorted lattice of extinction in the V band, :math:`A_V`
+    rvgrid : array-like
+        Sorted lattice of the reddening law parameter, :math:`R_V`
+    oversample : int, optional
+        Subdivide each interval of the temperature and surface gravity grid
+        of ``model`` into this many intervals. The model is evaluated with
+        :py:meth:`WDmodel.WDmodel.WDmodel._get_model` at the intermediate
+        nodes. Default is ``1``, i.e. only the grid nodes.
+
+    Returns
+    -------
+    tgrid : array-like
+        The temperature nodes of the table, shape ``(nt,)``
+    ggrid : array-like
+        The surface gravity nodes of the table, shape ``(ng,)``
+    avgrid : array-like
+        The :math:`A_V` nodes of the table, shape ``(nav,)``
+    rvgrid : array-like
+        The :math:`R_V` nodes of the table, shape ``(nrv,)``
+    pbnames : list
+        The names of the passbands in the table
+    lflux : array-like
+        The log10 of the band-integrated fluxes, shape ``(nt, ng, nav, nrv,
+        2*npb)``. The last axis has the numerator weights ``W1`` followed by
+        the denominator weights ``W0`` of
+        :py:func:`WDmodel.passband.get_pbprojection`
+    norm : array-like
+        The row sums of the projection, shape ``(2*npb,)``
+    zp : array-like
+        The zeropoints of the passbands, shape ``(npb,)``
+
+    Raises
+    ------
+    ValueError
+        If the ``av`` or ``rv`` lattice is not sorted or if ``model`` has a
+        spectral type with a plasma model, since the SED then also depends on
+        ``length``
+
+    Notes
+    -----
+        The band-integrated fluxes do not depend on ``shift`` or ``rvel``, so
+        those are applied exactly when the table is evaluated by
+        :py:class:`WDmodel.passband.WDmodel_SynMagTable`.
+
+    See Also
+    --------
+    :py:class:`WDmodel.passband.WDmodel_SynMagTable`
+    :py:func:`WDmodel.io.write_synmag_table`
+    """
+    if model._sptype in ('emission', 'transmission'):
+        message = 'Cannot tabulate synthetic magnitudes for spectral type {}'.format(model._sptype)
+        raise ValueError(message)
+
+    avgrid = np.atleast_1d(avgrid).astype('float64')
+    rvgrid = np.atleast_1d(rvgrid).astype('float64')
+    for name, grid in (('av', avgrid), ('rv', rvgrid)):
+        if np.any(np.diff(grid) <= 0):
+            message = 'Lattice for {} must be sorted and unique'.format(name)
+            raise ValueError(message)
+
+    tgrid = _oversample_grid(model._tgrid, oversample)
+    ggrid = _oversample_grid(model._ggrid, oversample)
+    pbnames = list(pbs.keys())
+    W, norm, zp = get_pbprojection(pbs, model)
+    npb = len(pbnames)
+
+    # the extinction laws are linear in av, so evaluate each rv once
+    ext = model._get_extinction_batch(model._wave, np.ones(len(rvgrid)), rvgrid)
+    redfac = 10.**(-0.4*avgrid[np.newaxis, :, np.newaxis]*ext[:, np.newaxis, :])
+
+    lflux = np.zeros((len(tgrid), len(ggrid), len(avgrid), len(rvgrid), 2*npb))
+    for i, teff in enumerate(tgrid):
+        for j, logg in enumerate(ggrid):
+            sed = model._get_model(teff, logg)
+            for k in range(len(rvgrid)):
+                flux = W.dot((sed*redfac[k]).T)
+                lflux[i, j, :, k, :] = np.log10(flux.T)
+    return tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp
+
+
+def get_synmag_table(table_file):
+    """
+    Reads a synthetic magnitude table written by
+    :py:func:`WDmodel.io.write_synmag_table`
+
+    Parameters
+    ----------
+    table_file : str
+        Filename of the HDF5 synthetic magnitude table
+
+    Returns
+    -------
+    table : :py:class:`WDmodel.passband.WDmodel_SynMagTable` instance
+        The synthetic magnitude table
+
+    See Also
+    --------
+    :py:func:`WDmodel.io.read_synmag_table`
+    """
+    intable = io.read_synmag_table(table_file)
+    tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp, attrs = intable
+    return WDmodel_SynMagTable(tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp, attrs=attrs)
+
+
+class WDmodel_SynMagTable(object):
+    """
+    Interpolates synthetic magnitudes from a table of band-integrated model
+    fluxes
+
+    The table is tabulated over the model grid nodes and a lattice of ``av``
+    and ``rv`` by :py:func:`WDmodel.passband.make_synmag_table`. The log of
+    the band-integrated fluxes is linearly interpolated, just as the model
+    grid itself, so the synthetic photometry needs no work on the full SED.
+    :py:meth:`validate` compares the interpolated magnitudes against
+    :py:func:`WDmodel.passband.get_model_synmags` on the full SED.
+
+    Parameters
+    ----------
+    tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp
+        The outputs of :py:func:`WDmodel.passband.make_synmag_table`
+    attrs : dict, optional
+        Metadata describing how the table was made
+
+    Attributes
+    ----------
+    pbnames : list
+        The names of the passbands in the table, in order
+    attrs : dict
+        The input ``attrs``
+    _grids : tuple
+        The nodes ``(tgrid, ggrid, avgrid, rvgrid)`` of the table
+    _free : array-like
+        Boolean mask of the dimensions with more than one node. Dimensions
+        with a single node are not interpolated and must match exactly
+    _norm : array-like
+        The input ``norm``
+    _zp : array-like
+        The input ``zp``
+    _interp : :py:class:`scipy.interpolate.RegularGridInterpolator` instance
+        The interpolator of ``lflux`` over the free dimensions
+
+    Notes
+    -----
+        Only the dimensions with more than one node are interpolated, so a
+        table made with a single ``rv`` can only be evaluated at that ``rv``.
+        Use :py:meth:`in_bounds` before :py:meth:`get_synmags`.
+    """
+    def __init__(self, tgrid, ggrid, avgrid, rvgrid, pbnames, lflux, norm, zp, attrs=None):
+        self._grids = tuple(np.atleast_1d(x).astype('float64') for x in (tgrid, ggrid, avgrid, rvgrid))
+        self.pbnames = [str(x) for x in pbnames]
+        self._lflux = np.asarray(lflux)
+        self._norm = np.asarray(norm, dtype='float64')
+        self._zp = np.asarray(zp, dtype='float64')
+        if attrs is None:
+            attrs = {}
+        self.attrs = dict(attrs)
+
+        npb = len(self.pbnames)
+        shape = tuple(len(x) for x in self._grids) + (2*npb,)
+        if self._lflux.shape != shape or self._norm.shape != (2*npb,) or self._zp.shape != (npb,):
+            message = 'Synthetic magnitude table shape {} does not match grids {}'.format(self._lflux.shape, shape)
+            raise ValueError(message)
+
+        self._free = np.array([len(x) > 1 for x in self._grids])
+        points = tuple(x for x, free in zip(self._grids, self._free) if free)
+        fixed  = tuple(slice(None) if free else 0 for free in self._free)
+        self._interp = spinterp.RegularGridInterpolator(points, self._lflux[fixed])
+
+
+    def select(self, pbnames):
+        """
+        Returns a table with the passbands ``pbnames``, in order
+
+        Parameters
+        ----------
+        pbnames : array-like
+            Passband names, e.g. ``phot.pb``. Names may be repeated.
+
+        Returns
+        -------
+        table : :py:class:`WDmodel.passband.WDmodel_SynMagTable` instance
+            Table with the passbands ``pbnames``
+
+        Raises
+        ------
+        KeyError
+            If a passband in ``pbnames`` is not in the table
+        """
+        npb = len(self.pbnames)
+        lookup = dict((name, i) for i, name in enumerate(self.pbnames))
+        ind = []
+        for pbname in pbnames:
+            if pbname not in lookup:
+                message = 'Passband {} is not in the synthetic magnitude table'.format(pbname)
+                raise KeyError(message)
+            ind.append(lookup[pbname])
+        ind = np.array(ind, dtype='int')
+        rows = np.concatenate((ind, ind+npb))
+        tgrid, ggrid, avgrid, rvgrid = self._grids
+        return WDmodel_SynMagTable(tgrid, ggrid, avgrid, rvgrid, [self.pbnames[i] for i in ind],\
+                self._lflux[..., rows], self._norm[rows], self._zp[ind], attrs=self.attrs)
+
+
+    def in_bounds(self, teff, logg, av, rv):
+        """
+        Checks if ``teff``, ``logg``, ``av``, ``rv`` are covered by the table
+
+        Parameters
+        ----------
+        teff, logg, av, rv : float or array-like
+            The model parameters
+
+        Returns
+        -------
+        inside : bool or array-like
+            ``True`` where the table can be evaluated
+        """
+        inside = True
+        for x, grid in zip((teff, logg, av, rv), self._grids):
+            x = np.asarray(x)
+            inside = inside & (x >= grid[0]) & (x <= grid[-1])
+        return inside
+
+
+    def get_synmags(self, teff, logg, av, rv, shift=0., rvel=0., mu=0.):
+        """
+        Returns the synthetic magnitudes interpolated from the table
+
+        Parameters
+        ----------
+        teff, logg, av, rv : float or array-like
+            The model parameters. Must satisfy :py:meth:`in_bounds`
+        shift : float or array-like, optional
+            Linear wavelength shift in Angstroms of the model spectrum
+        rvel : float or array-like, optional
+            Radial velocity in km/s of the model spectrum
+        mu : float or array-like, optional
+            Common achromatic photometric offset to apply to the synthetic
+            magnitudes in all the passbands
+
+        Returns
+        -------
+        model_mags : array-like
+            The model magnitudes in the order of :py:attr:`pbnames`. Has
+            shape ``(npb,)`` if the parameters are scalars and ``(N, npb)``
+            if they are arrays of length ``N``.
+
+        Notes
+        -----
+            ``shift`` and ``rvel`` are applied exactly as in
+            :py:func:`WDmodel.passband.get_model_synmags_proj`.
+        """
+        params = np.broadcast_arrays(*[np.asarray(x, dtype='float64') for x in (teff, logg, av, rv)])
+        scalar = (params[0].ndim == 0)
+        xi = np.column_stack([np.atleast_1d(x) for x, free in zip(params, self._free) if free])
+        flux = 10.**self._interp(xi)
+        npb = len(self._zp)
+        a = np.atleast_1d(1. + np.asarray(rvel)*1000./c.value)[:, np.newaxis]
+        b = np.atleast_1d(np.asarray(shift))[:, np.newaxis]
+        synflux = (a*flux[:, :npb] + b*flux[:, npb:])/(a*self._norm[:npb] + b*self._norm[npb:])
+        out = -2.5*np.log10(synflux) + self._zp + np.atleast_1d(np.asarray(mu))[:, np.newaxis]
+        if scalar:
+            return out[0]
+        return out
+
+
+    def validate(self, model, pbs, ntest=100, seed=None):
+        """
+        Compares the table against the synthetic magnitudes of the full SED
+
+        Draws ``ntest`` random parameter vectors within the bounds of the
+        table and the model grid, and computes the synthetic magnitudes with
+        :py:func:`WDmodel.passband.get_model_synmags` on the full SED from
+        :py:meth:`WDmodel.WDmodel.WDmodel._get_full_obs_model`, and with
+        :py:meth:`get_synmags`.
+
+        Parameters
+        ----------
+        model : :py:class:`WDmodel.WDmodel.WDmodel` instance
+            The DA White Dwarf SED model generator
+        pbs : dict
+            Passband dictionary generated by
+            :py:func:`WDmodel.passband.get_pbmodel`. All the passbands must
+            be in the table.
+        ntest : int, optional
+            Number of random parameter vectors to test. Default is ``100``
+        seed : None or int, optional
+            Seed for the random parameter vectors
+
+        Returns
+        -------
+        maxdiff : array-like
+            The maximum absolute difference in magnitudes over the test
+            vectors in each passband of ``pbs``, in order
+
+        Raises
+        ------
+        KeyError
+            If a passband in ``pbs`` is not in the table
+        """
+        table = self.select(list(pbs.keys()))
+        rng = np.random.RandomState(seed)
+        lo = [grid[0] for grid in self._grids]
+        hi = [grid[-1] for grid in self._grids]
+        # the model grid may have been read with bounds
+        lo[0] = max(lo[0], model._tgrid[0])
+        hi[0] = min(hi[0], model._tgrid[-1])
+        lo[1] = max(lo[1], model._ggrid[0])
+        hi[1] = min(hi[1], model._ggrid[-1])
+        maxdiff = np.zeros(len(pbs))
+        for _ in range(ntest):
+            teff, logg, av, rv = rng.uniform(lo, hi)
+            shift = rng.uniform(-5., 5.)
+            rvel  = rng.uniform(-100., 100.)
+            _, full = model._get_full_obs_model(teff, logg, av, 1., model._wave[:2], shift, rvel, rv=rv)
+            fullmags = get_model_synmags(full, pbs).mag
+            tabmags  = table.get_synmags(teff, logg, av, rv, shift=shift, rvel=rvel)
+            maxdiff = np.maximum(maxdiff, np.abs(fullmags - tabmags))
+        return maxdiff
@@ -0,0 +1,429 @@
+# -*- coding: UTF-8 -*-
+"""
+Pools that evaluate the posterior for all the walkers of a sampler step at
+once, using the batched posterior
+:py:meth:`WDmodel.likelihood.WDmodel_Posterior.batch`.
+
+The samplers in :py:mod:`emcee` and :py:class:`WDmodel.mossampler.MOSSampler`
+only require that a pool provides a ``map`` method. They wrap the posterior
+function in :py:class:`emcee.ensemble._function_wrapper` or
+:py:class:`emcee.ptsampler.PTLikePrior` before calling ``map``. The pools here
+recognize those wrappers and evaluate all the positions with a single call to
+the batched posterior.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import multiprocessing
+import numpy as np
+from emcee.ensemble import _function_wrapper
+from emcee.ptsampler import PTLikePrior
+from six import BytesIO
+import six.moves.cPickle as pickle
+from six.moves import map
+from six.moves import zip
+
+__all__=['WDmodel_BatchPool', 'WDmodel_ProcessPool', 'WDmodel_MPIPool', 'get_batch_function']
+
+# objects shared with a worker process of WDmodel_ProcessPool, keyed by id
+_SHARED = {}
+
+
+def get_batch_function(function):
+    """
+    Returns a function that evaluates ``function`` on an array of positions
+    at once, if ``function`` supports it
+
+    Parameters
+    ----------
+    function : callable
+        The function passed to the ``map`` method of a pool by a sampler.
+        Either an object with a ``batch`` method such as
+        :py:class:`WDmodel.likelihood.WDmodel_Posterior`, or such an object
+        wrapped in :py:class:`emcee.ensemble._function_wrapper` or
+        :py:class:`emcee.ptsampler.PTLikePrior`
+
+    Returns
+    -------
+    batch : None or callable
+        ``None`` if ``function`` cannot be evaluated in batches. Otherwise a
+        function that takes an array of positions with shape ``(N, ndim)`` and
+        returns a list of the ``N`` results of ``function``.
+    """
+    if isinstance(function, _function_wrapper):
+        f = function.f
+        if not hasattr(f, 'batch'):
+            return None
+        args, kwargs = function.args, function.kwargs
+        def batch(thetas):
+            return list(f.batch(thetas, *args, **kwargs))
+        return batch
+
+    if isinstance(function, PTLikePrior):
+        logl, logp = function.logl, function.logp
+        if not (hasattr(logl, 'batch') and hasattr(logp, 'batch')):
+            return None
+        def batch(thetas):
+            # same logic as PTLikePrior.__call__
+            lp = logp.batch(thetas, *function.logpargs, **function.logpkwargs)
+            ll = np.full(len(thetas), -np.inf)
+            good = (lp != -np.inf)
+            if np.any(good):
+                ll[good] = logl.batch(thetas[good], *function.loglargs, **function.loglkwargs)
+            return list(zip(ll, lp))
+        return batch
+
+    if hasattr(function, 'batch'):
+        def batch(thetas):
+            return list(function.batch(thetas))
+        return batch
+    return None
+
+
+class WDmodel_BatchPool(object):
+    """
+    Serial pool that evaluates all the tasks of a ``map`` in one batched call
+
+    Provides the interface the samplers used in :py:func:`WDmodel.fit.fit_model`
+    expect from a pool, without any parallelism. Functions that do not support
+    batched evaluation are simply mapped over the tasks.
+
+    Notes
+    -----
+        Used by :py:func:`WDmodel.fit.fit_model` when no pool is supplied.
+    """
+    def map(self, function, tasks):
+        """
+        Like the built-in :py:func:`map`, apply ``function`` to all the
+        ``tasks`` and return the list of results
+
+        Parameters
+        ----------
+        function : callable
+            The function to apply. See :py:func:`get_batch_function`
+        tasks : iterable
+            The positions at which to evaluate ``function``
+
+        Returns
+        -------
+        results : list
+            The result of ``function`` for each element of ``tasks``
+        """
+        batch = get_batch_function(function)
+        if batch is None:
+            return list(map(function, tasks))
+        tasks = np.array([task for task in tasks])
+        if len(tasks) == 0:
+            return []
+        return batch(tasks)
+
+
+    def is_master(self):
+        """
+        Returns ``True`` - there are no workers
+        """
+        return True
+
+
+    def close(self):
+        """
+        Does nothing - there are no workers
+        """
+        pass
+
+
+def _init_worker(shared):
+    """
+    Stores the objects shared with a worker process of
+    :py:class:`WDmodel_ProcessPool` when it is started
+    """
+    global _SHARED
+    _SHARED = shared
+
+
+def _dumps(function):
+    """
+    Pickle ``function``, replacing any posterior in it with a reference
+
+    Any object with a ``batch`` method, i.e. the posterior, is pickled by
+    reference, so that the wrappers the samplers put around the posterior can
+    be sent to the workers of :py:class:`WDmodel_ProcessPool` without the
+    data and the model.
+
+    Returns
+    -------
+    payload : bytes
+        The pickled ``function``
+    found : dict
+        The objects pickled by reference, keyed by the reference
+    """
+    found = {}
+    def persistent_id(obj):
+        if hasattr(obj, 'batch') and not isinstance(obj, type):
+            key = id(obj)
+            found[key] = obj
+            return key
+        return None
+    f = BytesIO()
+    pickler = pickle.Pickler(f, 2)
+    pickler.persistent_id = persistent_id
+    pickler.dump(function)
+    return f.getvalue(), found
+
+
+def _loads(payload, shared):
+    """
+    Unpickle a function pickled by :py:func:`_dumps` in a worker process,
+    restoring references to the objects in ``shared``
+    """
+    unpickler = pickle.Unpickler(BytesIO(payload))
+    unpickler.persistent_load = shared.__getitem__
+    return unpickler.load()
+
+
+def _evaluate(function, tasks):
+    """
+    Evaluate ``function`` on a chunk of tasks, in a single batched call if
+    possible
+    """
+    if len(tasks) == 0:
+        return []
+    batch = get_batch_function(function)
+    if batch is None:
+        return list(map(function, tasks))
+    return batch(np.array(tasks))
+
+
+def _process_worker(args):
+    """
+    Evaluate a chunk of tasks in a worker process of
+    :py:class:`WDmodel_ProcessPool`
+    """
+    payload, tasks = args
+    function = _loads(payload, _SHARED)
+    return _evaluate(function, tasks)
+
+
+class WDmodel_ProcessPool(object):
+    """
+    Pool of local worker processes that evaluates the tasks of a ``map`` in
+    parallel
+
+    Provides the interface the samplers used in :py:func:`WDmodel.fit.fit_model`
+    expect from a pool, like :py:class:`emcee.utils.MPIPool`, but without
+    MPI, and without an idle master process.
+
+    The posterior, which holds the spectrum, photometry, passbands and model,
+    is sent to the workers only once, when they are started. Each ``map``
+    only sends the positions, and the sampler's wrapper around the posterior
+    with the posterior replaced by a reference. The tasks are split into one
+    chunk per worker, and each chunk is evaluated with the batched posterior
+    if possible (see :py:func:`get_batch_function`).
+
+    Parameters
+    ----------
+    nproc : int
+        The number of worker processes
+
+    Raises
+    ------
+    ValueError
+        If ``nproc`` is less than 1
+
+    Notes
+    -----
+        The workers are started on the first call to ``map``, and restarted
+        if a new posterior is passed. Only the posterior of the current
+        ``map`` is sent to the restarted workers, and it is released when the
+        pool is closed. Changes to the posterior in this process after the
+        workers are started are not seen by the workers.
+    """
+    def __init__(self, nproc):
+        if nproc < 1:
+            message = 'Number of processes must be greater than zero ({})'.format(nproc)
+            raise ValueError(message)
+        self.nproc   = int(nproc)
+        self._pool   = None
+        self._shared = {}
+
+
+    def _start(self, shared):
+        """
+        Start the worker processes with the ``shared`` objects
+        """
+        self.close()
+        self._shared = shared
+        self._pool = multiprocessing.Pool(self.nproc, initializer=_init_worker, initargs=(shared,))
+
+
+    def map(self, function, tasks):
+        """
+        Like the built-in :py:func:`map`, apply ``function`` to all the
+        ``tasks`` and return the list of results
+
+        Parameters
+        ----------
+        function : callable
+            The function to apply. Must be picklable, except for any
+            posterior in it. See :py:func:`get_batch_function`
+        tasks : iterable
+            The positions at which to evaluate ``function``
+
+        Returns
+        -------
+        results : list
+            The result of ``function`` for each element of ``tasks``
+        """
+        tasks = list(tasks)
+        if len(tasks) == 0:
+            return []
+
+        payload, found = _dumps(function)
+        if self._pool is None or not set(found).issubset(self._shared):
+            self._start(found)
+
+        nchunk = min(self.nproc, len(tasks))
+        edges  = np.linspace(0, len(tasks), nchunk+1).astype('int')
+        chunks = [(payload, tasks[lo:hi]) for lo, hi in zip(edges[:-1], edges[1:])]
+        results = self._pool.map(_process_worker, chunks)
+        return [result for chunk in results for result in chunk]
+
+
+    def is_master(self):
+        """
+        Returns ``True`` - this process is never a worker
+        """
+        return True
+
+
+    def close(self):
+        """
+        Stop the worker processes and release the shared objects
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._shared = {}
+
+
+class WDmodel_MPIPool(object):
+    """
+    Pool that evaluates the tasks of a ``map`` in contiguous blocks on all the
+    processes of an MPI communicator
+
+    Provides the same interface as :py:class:`emcee.utils.MPIPool`. Where
+    that pool sends each walker to a worker as a separate message, and resends
+    the posterior whenever the sampler passes a new wrapper around it, this
+    pool splits the tasks of each ``map`` into one contiguous block per
+    process, including the master, scatters the blocks in a single collective
+    and gathers the results in another. Each block is evaluated with the
+    batched posterior if possible (see :py:func:`get_batch_function`).
+
+    As with :py:class:`WDmodel_ProcessPool`, the posterior is broadcast to the
+    workers only the first time it is seen, and each ``map`` only broadcasts
+    the sampler's wrapper with the posterior replaced by a reference. A new
+    posterior replaces the previous one on all the processes, and it is
+    released when the pool is closed.
+
+    Parameters
+    ----------
+    comm : :py:class:`mpi4py.MPI.Comm` instance
+        The communicator. Rank 0 is the master process.
+
+    Notes
+    -----
+        The results are the same as with :py:class:`emcee.utils.MPIPool`.
+        Changes to the posterior on the master after it has been broadcast are not
+        seen by the workers.
+    """
+    def __init__(self, comm):
+        self.comm    = comm
+        self.rank    = comm.Get_rank()
+        self.size    = comm.Get_size()
+        self._shared = {}
+        self._closed = False
+
+
+    def is_master(self):
+        """
+        Returns ``True`` on the master process (rank 0)
+        """
+        return self.rank == 0
+
+
+    def wait(self):
+        """
+        Evaluate the blocks of tasks sent by the master until the pool is
+        closed. Only called by the worker processes.
+
+        Raises
+        ------
+        RuntimeError
+            If called by the master process
+        """
+        if self.is_master():
+            message = 'Master process told to wait for tasks'
+            raise RuntimeError(message)
+
+        while True:
+            message = self.comm.bcast(None, root=0)
+            if message is None:
+                break
+            payload, found = message
+            if found:
+                self._shared = found
+            function = _loads(payload, self._shared)
+            tasks = self.comm.scatter(None, root=0)
+            self.comm.gather(_evaluate(function, tasks), root=0)
+        self._shared = {}
+
+
+    def map(self, function, tasks):
+        """
+        Like the built-in :py:func:`map`, apply ``function`` to all the
+        ``tasks`` and return the list of results
+
+        Parameters
+        ----------
+        function : callable
+            The function to apply. Must be picklable. See
+            :py:func:`get_batch_function`
+        tasks : iterable
+            The positions at which to evaluate ``function``
+
+        Returns
+        -------
+        results : list
+            The result of ``function`` for each element of ``tasks`` on the
+            master process. The worker processes wait for tasks instead, and
+            return ``None`` once the pool is closed.
+        """
+        if not self.is_master():
+            self.wait()
+            return
+
+        tasks = list(tasks)
+        payload, found = _dumps(function)
+        if set(found).issubset(self._shared):
+            found = {}
+        else:
+            self._shared = found
+        self.comm.bcast((payload, found), root=0)
+
+        edges  = np.linspace(0, len(tasks), self.size+1).astype('int')
+        chunks = [tasks[lo:hi] for lo, hi in zip(edges[:-1], edges[1:])]
+        chunk = self.comm.scatter(chunks, root=0)
+        results = self.comm.gather(_evaluate(function, chunk), root=0)
+        return [result for chunk in results for result in chunk]
+
+
+    def close(self):
+        """
+        Tell the worker processes to stop waiting for tasks, and release the
+        shared objects. Does nothing if the pool is already closed.
+        """
+        if self.is_master() and not self._closed:
+            self.comm.bcast(None, root=0)
+            self._closed = True
+            self._shared = {}
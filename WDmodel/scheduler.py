@@ -0,0 +1,382 @@
+# -*- coding: UTF-8 -*-
+"""
+Two-level scheduler to fit many objects at once on a fixed set of processes.
+
+The processes - either local processes, or the ranks of an MPI communicator -
+are split into groups, and each group fits one object, distributing the
+walkers of each step among its processes with a
+:py:class:`WDmodel.pool.WDmodel_ProcessPool` or
+:py:class:`WDmodel.pool.WDmodel_MPIPool`. Each group is sized from the cost of
+its object - the length of the spectrum and the number of walkers - so that
+small spectra do not occupy more processes than they can use. The sizes are
+recomputed from the remaining work whenever a group finishes, so the last
+objects are fit by larger groups as processes free up.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import multiprocessing
+import numpy as np
+from .pool import WDmodel_ProcessPool, WDmodel_MPIPool
+from six.moves import range
+from six.moves.queue import Empty
+
+__all__=['WDmodel_Scheduler', 'get_object_cost', 'run_process_groups', 'run_mpi_groups']
+
+# each process of a group should evaluate at least this many model pixels per
+# step, so the computation outweighs the cost of distributing it
+_MIN_PIXELS_PER_PROCESS = 20000
+
+
+def get_object_cost(npix, nwalkers, ntemps=1, min_pixels=_MIN_PIXELS_PER_PROCESS):
+    """
+    Returns the relative cost of fitting an object, and the largest number of
+    processes it can use efficiently
+
+    Parameters
+    ----------
+    npix : int
+        The number of pixels in the spectrum
+    nwalkers : int
+        The number of walkers
+    ntemps : int, optional
+        The number of temperatures. Default is ``1``
+    min_pixels : int, optional
+        The minimum number of model pixels each process should evaluate per
+        step
+
+    Returns
+    -------
+    cost : float
+        The number of model pixels evaluated per step
+    maxsize : int
+        The largest useful group size. The samplers evaluate half the walkers
+        of each temperature at once, so no more processes than that can be
+        used, and fewer if the spectrum is short.
+    """
+    ntasks = max(1, (ntemps*nwalkers)//2)
+    cost = float(npix)*ntemps*nwalkers
+    maxsize = max(1, min(ntasks, int(ntasks*npix//min_pixels)))
+    return cost, maxsize
+
+
+class WDmodel_Scheduler(object):
+    """
+    Decides the order in which objects are fit and the size of the group of
+    processes for each
+
+    Objects are started in order of decreasing cost. Each object is given a
+    share of the processes proportional to its share of the work that
+    remains, including the objects that are still being fit, limited by the
+    largest group size it can use.
+
+    Parameters
+    ----------
+    nproc : int
+        The total number of processes available to fit objects
+    costs : array-like
+        The relative cost of each object. See :py:func:`get_object_cost`
+    maxsizes : array-like
+        The largest useful group size for each object
+
+    Raises
+    ------
+    ValueError
+        If ``nproc`` is less than 1, or ``costs`` and ``maxsizes`` have
+        different lengths
+    """
+    def __init__(self, nproc, costs, maxsizes):
+        if nproc < 1:
+            message = 'Number of processes must be greater than zero ({})'.format(nproc)
+            raise ValueError(message)
+        if len(costs) != len(maxsizes):
+            message = 'Costs and maximum group sizes must have the same length ({}, {})'.format(len(costs), len(maxsizes))
+            raise ValueError(message)
+        self.nproc    = nproc
+        self.costs    = np.array(costs, dtype='float64')
+        self.maxsizes = np.array(maxsizes, dtype='int')
+        self.pending  = [int(x) for x in np.argsort(-self.costs, kind='mergesort')]
+        self.running  = set()
+
+
+    def get_group_size(self, index):
+        """
+        Returns the target group size for object ``index``
+        """
+        remaining = self.costs[self.pending].sum() + self.costs[list(self.running)].sum()
+        if remaining <= 0.:
+            share = self.nproc
+        else:
+            share = int(round(self.nproc*self.costs[index]/remaining))
+        return int(max(1, min(share, self.maxsizes[index])))
+
+
+    def next_group(self, nfree):
+        """
+        Returns the next object to fit and its group size, given the number
+        of free processes
+
+        Parameters
+        ----------
+        nfree : int
+            The number of free processes
+
+        Returns
+        -------
+        index : None or int
+            The index of the next object, or ``None`` if no object is pending,
+            or no process is free
+        size : int
+            The number of processes to fit it with, at most ``nfree``
+        """
+        if len(self.pending) == 0 or nfree < 1:
+            return None, 0
+        index = self.pending[0]
+        size = min(self.get_group_size(index), nfree)
+        self.pending.pop(0)
+        self.running.add(index)
+        return index, size
+
+
+    def finish(self, index):
+        """
+        Marks object ``index`` as done, so it no longer counts towards the
+        remaining work
+        """
+        self.running.discard(index)
+
+
+def _run_process_group(function, task, index, size, queue):
+    """
+    Fit one object in a child process with a pool of ``size`` processes, and
+    put the result on ``queue``
+
+    If the pool cannot be started, the exception ends the child process
+    without a result, which :py:func:`_wait_process_group` detects.
+    """
+    pool = None
+    try:
+        if size > 1:
+            pool = WDmodel_ProcessPool(size)
+        result = function(task, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+    queue.put((index, result))
+
+
+def _wait_process_group(queue, running, timeout):
+    """
+    Wait for the next child process in ``running`` to put its result on
+    ``queue``
+
+    The queue is polled every ``timeout`` seconds, and the running processes
+    are checked in between, so that a process that dies without a result -
+    e.g. killed for running out of memory, or crashing in a C extension -
+    does not block the parent forever. A process that exited with a non-zero
+    code has failed. One that exited cleanly is given one more poll for its
+    result to arrive before it is considered failed.
+
+    Parameters
+    ----------
+    queue : :py:class:`multiprocessing.Queue` instance
+        The queue the child processes put their ``(index, result)`` on
+    running : dict
+        The running ``(process, size)`` keyed by the index of their task
+    timeout : float
+        The interval in seconds at which the processes are checked
+
+    Returns
+    -------
+    index : int
+        The index of the task that finished
+    result : object
+        The result of the task, or ``None`` if it failed
+    error : None or str
+        ``None`` if the task returned a result, else a description of the
+        failure
+    """
+    exited = set()
+    while True:
+        try:
+            index, result = queue.get(timeout=timeout)
+            return index, result, None
+        except Empty:
+            pass
+        for index, (process, _) in running.items():
+            exitcode = process.exitcode
+            if exitcode is None:
+                continue
+            if exitcode != 0 or index in exited:
+                error = 'Process fitting task {} exited with code {} without a result'.format(index, exitcode)
+                return index, None, error
+            exited.add(index)
+
+
+def run_process_groups(function, tasks, costs, maxsizes, nproc, failed=None, timeout=1.):
+    """
+    Run ``function`` on each task with groups of local processes
+
+    Each task is run in its own child process with a
+    :py:class:`WDmodel.pool.WDmodel_ProcessPool` of the size chosen by
+    :py:class:`WDmodel_Scheduler`, or without a pool if the size is ``1``. A
+    child process that dies without a result is recorded as a failed task,
+    and the remaining tasks are still run.
+
+    Parameters
+    ----------
+    function : callable
+        Called as ``function(task, pool)`` in the child process. Must catch
+        its own exceptions, and return a picklable result.
+    tasks : list
+        The tasks
+    costs : array-like
+        The relative cost of each task. See :py:func:`get_object_cost`
+    maxsizes : array-like
+        The largest useful group size for each task
+    nproc : int
+        The total number of worker processes
+    failed : None or callable, optional
+        Called as ``failed(task, error)`` in the parent process to make the
+        result of a task whose process died without a result, with ``error``
+        a description of the failure. If ``None``, the result is ``error``.
+    timeout : float, optional
+        The interval in seconds at which the child processes are checked
+        while waiting for a result. Default is ``1.``
+
+    Returns
+    -------
+    results : list
+        The result of ``function`` for each task, in the order of ``tasks``
+    """
+    scheduler = WDmodel_Scheduler(nproc, costs, maxsizes)
+    queue = multiprocessing.Queue()
+    results = [None]*len(tasks)
+    running = {}
+    nfree = nproc
+    while scheduler.pending or running:
+        while True:
+            index, size = scheduler.next_group(nfree)
+            if index is None:
+                break
+            process = multiprocessing.Process(target=_run_process_group,\
+                    args=(function, tasks[index], index, size, queue))
+            process.start()
+            running[index] = (process, size)
+            nfree -= size
+
+        index, result, error = _wait_process_group(queue, running, timeout)
+        process, size = running.pop(index)
+        process.join()
+        if error is not None:
+            result = error if failed is None else failed(tasks[index], error)
+        results[index] = result
+        scheduler.finish(index)
+        nfree += size
+    return results
+
+
+def run_mpi_groups(function, tasks, costs, maxsizes, comm):
+    """
+    Run ``function`` on each task with groups of MPI processes
+
+    Must be called by every rank of ``comm``. Rank 0 only schedules the
+    tasks. For each task, it picks a group of free ranks of the size chosen
+    by :py:class:`WDmodel_Scheduler`. The group creates its own communicator,
+    the first rank of the group runs the task with a
+    :py:class:`WDmodel.pool.WDmodel_MPIPool` on it, and the other ranks of the
+    group evaluate the posterior for it until the pool is closed.
+
+    Parameters
+    ----------
+    function : callable
+        Called as ``function(task, pool)`` by the first rank of each group.
+        Must catch its own exceptions, close ``pool``, and return a picklable
+        result.
+    tasks : list
+        The tasks. Only used on rank 0
+    costs : array-like
+        The relative cost of each task. Only used on rank 0
+    maxsizes : array-like
+        The largest useful group size for each task. Only used on rank 0
+    comm : :py:class:`mpi4py.MPI.Comm` instance
+        The communicator. Must have at least two ranks
+
+    Returns
+    -------
+    results : None or list
+        On rank 0, the result of ``function`` for each task, in the order of
+        ``tasks``. ``None`` on the other ranks.
+
+    Raises
+    ------
+    ValueError
+        If ``comm`` has fewer than two ranks
+    """
+    size = comm.Get_size()
+    if size < 2:
+        message = 'Scheduling objects with MPI requires at least two processes ({})'.format(size)
+        raise ValueError(message)
+
+    if comm.Get_rank() != 0:
+        _wait_mpi_group(function, comm)
+        return None
+
+    scheduler = WDmodel_Scheduler(size-1, costs, maxsizes)
+    results = [None]*len(tasks)
+    running = {}
+    free = list(range(1, size))
+    while scheduler.pending or running:
+        while True:
+            index, nrank = scheduler.next_group(len(free))
+            if index is None:
+                break
+            ranks, free = free[:nrank], free[nrank:]
+            comm.send((index, tasks[index], ranks), dest=ranks[0])
+            for rank in ranks[1:]:
+                comm.send((index, None, ranks), dest=rank)
+            running[index] = ranks
+
+        index, result = comm.recv()
+        free += running.pop(index)
+        results[index] = result
+        scheduler.finish(index)
+
+    for rank in range(1, size):
+        comm.send(None, dest=rank)
+    return results
+
+
+def _wait_mpi_group(function, comm):
+    """
+    Join the groups that rank 0 of ``comm`` assigns this rank to, until it
+    sends ``None``
+    """
+    rank = comm.Get_rank()
+    while True:
+        message = comm.recv(source=0)
+        if message is None:
+            break
+        index, task, ranks = message
+
+        group = None
+        subcomm = None
+        pool = None
+        if len(ranks) > 1:
+            group = comm.Get_group().Incl(ranks)
+            subcomm = comm.Create_group(group)
+            pool = WDmodel_MPIPool(subcomm)
+
+        if rank == ranks[0]:
+            try:
+                result = function(task, pool)
+            finally:
+                if pool is not None:
+                    pool.close()
+            comm.send((index, result), dest=0)
+        else:
+            pool.wait()
+
+        if subcomm is not None:
+            subcomm.Free()
+            group.Free()
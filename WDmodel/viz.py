@@ -18,6 +18,7 @@ from matplotlib.font_manager import FontProperties as FM
 from astropy.visualization import hist
 from . import io
 from . import passband
+from . import derived
 import corner
 from six.moves import range
 from collections import OrderedDict
@@ -37,8 +38,9 @@ def get_plot_labels(sptype=None):
     labels : dict
         dictionary of plot labels with :py:const:`WDmodel.io._PARAMETER_NAMES`
         as keys.  If ``sptype`` is ``emission`` or ``transmission``, ``logg``
-        and ``teff`` labels are set to ``rho`` and ``T``, and ``ne`` is added
-        to dictionary.
+        and ``teff`` labels are set to ``rho`` and ``T``. Labels of the
+        derived parameters registered in :py:mod:`WDmodel.derived` for
+        ``sptype``, e.g. ``ne``, are added to dictionary.
     """
     labelnames = (r'$T_{\mathrm{eff}}$', r'$\log\,g$', r'$A_{V}$', r'$R_{V}$',
                 'dl', 'fwhm', r'$f_{\sigma}$', r'$\tau$', r'$f_{\omega}$',
@@ -49,7 +51,8 @@ def get_plot_labels(sptype=None):
     if sptype in ('emission', 'transmission'):
         labels['teff'] = 'T'
         labels['logg'] = r'$\rho$'
-        labels['ne'] = r'$n_{\mathrm{e}}$'
+    for name in derived.get_derived_names(sptype):
+        labels[name] = derived.get_derived_label(name)
     return labels
 
 
@@ -287,19 +290,19 @@ def plot_mcmc_spectrum_fit(spec, objname, specfile, scale_factor, model,
         smoothedmod = mod* (1./(4.*np.pi*(dl)**2.))
 
         res = spec.flux - smoothedmod
-        wres, cov = covmodel.predict(spec.wave, res, spec.flux_err, fsig, tau, fw)
+        wres, wres_var = covmodel.predict(spec.wave, res, spec.flux_err, fsig, tau, fw, var_only=True)
         ax_spec.plot(spec.wave, smoothedmod+wres,\
                 color=color, linestyle='-',marker='None', alpha=alpha, label=label)
         out_draw = io.copy_params(this_draw)
-        return smoothedmod, wres, cov, full_mod, out_draw
+        return smoothedmod, wres, wres_var, full_mod, out_draw
 
     # for each draw, update the dict, and plot it
     out = []
     for i in range(ndraws):
         for j, param in enumerate(param_names):
             this_draw[param]['value'] = draws[i,j]
-        smoothedmod, wres, cov, full_mod, out_draw = plot_one(this_draw, color='orange', alpha=0.3, i=i)
-        wres_err = np.diag(cov)**0.5
+        smoothedmod, wres, wres_var, full_mod, out_draw = plot_one(this_draw, color='orange', alpha=0.3, i=i)
+        wres_err = wres_var**0.5
         out.append((smoothedmod, wres, wres_err, full_mod, out_draw))
 
     outlabel = 'Model\n'
@@ -319,8 +322,8 @@ def plot_mcmc_spectrum_fit(spec, objname, specfile, scale_factor, model,
         outlabel += thislabel
 
     # finally, overplot the best result draw as solid
-    smoothedmod, wres, cov, full_mod, out_draw = plot_one(result, color='red', alpha=1., label=outlabel)
-    wres_err = np.diag(cov)**0.5
+    smoothedmod, wres, wres_var, full_mod, out_draw = plot_one(result, color='red', alpha=1., label=outlabel)
+    wres_err = wres_var**0.5
     out.append((smoothedmod, wres, wres_err, full_mod, out_draw))
 
     # plot the residuals
@@ -841,7 +844,7 @@ def plot_mcmc_model(spec, phot, linedata, scale_factor, phot_dispersion,\
         ``bounds`` for each. Same format as returned from
         :py:func:`WDmodel.io.read_params`
     param_names : array-like
-        Ordered list of free parameter names
+        Ordered list of free and derived parameter names
     samples : array-like
         Samples from the flattened Markov Chain with shape ``(N, len(param_names))``
     samples_lnprob : array-like
@@ -924,7 +927,6 @@ def plot_mcmc_model(spec, phot, linedata, scale_factor, phot_dispersion,\
 
         # plot corner plot
         labelfree = [labels.get(k) for k in param_names]
-        labelfree.append(labels['ne'])
         fig = corner.corner(samples, bins=51, labels=labelfree,
                             show_titles=True, quantiles=(0.16,0.84), smooth=1.,
                             title_fmt='.5g')
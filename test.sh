@@ -17,6 +17,21 @@ if [ "$1" = -c ]; then
 fi
 $ARUNNER -m WDmodel --specfile WDmodel/tests/test.flm --ignorephot --nburnin 10 --nprod 50 --redo --outdir out_temp --covtype Exp --nwalkers 50 --av_fix True --av 0.03 --savefig --mu None --samptype gibbs --reddeningmodel ccm89
 $ARUNNER -m WDmodel --specfile WDmodel/tests/test.flm --ignorephot --nprod 50 --nburnin 10 --redo --nwalkers 30 --covtype White --reddeningmodel custom
+$ARUNNER -m WDmodel --specfile WDmodel/tests/test.flm --photfile WDmodel/tests/test.phot --rebin 2 --everyn 3 --nprod 20 --nburnin 10 --redo --outdir out_nuts --samptype nuts --nwalkers 4 --covtype White
+$ARUNNER -m WDmodel --specfile WDmodel/tests/test.flm --resume --nprod 5 --outdir out_nuts --samptype nuts --nwalkers 4
+SPECOPTS="--photfile WDmodel/tests/test.phot --rebin 2 --everyn 3 --nburnin 10 --nprod 50 --nwalkers 30 --covtype White --reddeningmodel od94 --skipminuit --redo"
+$ARUNNER -m WDmodel --specfile WDmodel/tests/test.flm $SPECOPTS --outroot out_single
+mkdir -p out_speclist
+cp WDmodel/tests/test.flm out_speclist/test-a.flm
+cp WDmodel/tests/test.flm out_speclist/test-b.flm
+printf "out_speclist/test-a.flm\nout_speclist/missing.flm\nout_speclist/test-b.flm\n" > out_speclist/speclist.txt
+$ARUNNER -m WDmodel --speclist out_speclist/speclist.txt --nproc 2 $SPECOPTS --outroot out_speclist/out
+ls out_single/test/test | sort > out_speclist/single.txt
+for spec in test-a test-b; do
+    ls out_speclist/out/test/$spec | grep -v -e '\.stdout$' -e '\.stderr$' | sed "s/^$spec/test/" | sort | diff out_speclist/single.txt -
+    test -s out_speclist/out/test/$spec/$spec.stdout
+done
+test -z "$(ls out_speclist/out/missing/missing 2>/dev/null)"
 $ARUNNER test_WDmodel.py
 
 if [ "$1" = -c ]; then
@@ -5,9 +5,1070 @@ Runs some tests for coveralls on the WDmodel package. Just checks that the
 functions execute, not that the output is sane.
 """
 import sys
+import os
+import warnings
+import tempfile
+import shutil
 import numpy as np
+import h5py
+from astropy.constants import c as _C
+from scipy.special import logsumexp
+from scipy.ndimage.filters import gaussian_filter1d
+from scipy.stats import norm
+from emcee.ensemble import _function_wrapper
+from emcee.ptsampler import PTLikePrior
 import WDmodel.WDmodel
 import WDmodel.io
+import WDmodel.covariance
+import WDmodel.likelihood
+import WDmodel.passband
+import WDmodel.nuts
+import WDmodel.fit
+import WDmodel.derived
+import WDmodel.mossampler
+import WDmodel.pool
+import WDmodel.scheduler
+
+
+def gaussian_passbands(model, centers, sigma):
+    """
+    Returns synthetic Gaussian passbands on the model wavelengths in the
+    layout of :py:func:`WDmodel.passband.get_pbmodel`, so photometry can be
+    tested without the CDBS throughput files
+    """
+    pbs = {}
+    for center in centers:
+        pbwave = np.arange(center - 4.*sigma, center + 4.*sigma + 1., 10.)
+        throughput = np.exp(-0.5*((pbwave - center)/sigma)**2.)
+        pb = np.rec.fromarrays((pbwave, throughput), names=str('wave,throughput'))
+        transmission, ind = WDmodel.passband.interp_passband(model._wave, pb, model)
+        pbs['G{:.0f}'.format(center)] = (pb, transmission, ind, 0., center)
+    return pbs
+
+
+def check_gradient(model, wave, teff, logg, av, fwhm, tol=1e-4):
+    """
+    Checks the analytic gradients of the observed model and of the log
+    posterior against central finite differences
+    """
+    pixel_scale = 1./np.median(np.gradient(wave))
+    bmodel = model.bind(wave, pixel_scale=pixel_scale)
+
+    # keep away from the grid and reddening lattice nodes, where the
+    # piecewise linear interpolation is not differentiable
+    theta = {'teff':teff+123., 'logg':logg+0.011, 'av':av+0.02, 'rv':3.137,\
+            'fwhm':fwhm, 'shift':0.1, 'rvel':5.}
+    steps = {'teff':1., 'logg':1e-4, 'av':1e-5, 'rv':1e-4, 'fwhm':1e-4, 'shift':1e-4, 'rvel':1e-2}
+
+    def obs(p):
+        return bmodel._get_obs_model(p['teff'], p['logg'], p['av'], p['fwhm'], wave, p['shift'], p['rvel'], rv=p['rv'])
+
+    mod, dmod = bmodel._get_obs_model_grad(theta['teff'], theta['logg'], theta['av'], theta['fwhm'],\
+            theta['shift'], theta['rvel'], rv=theta['rv'])
+    for i, param in enumerate(bmodel._grad_names):
+        up   = dict(theta)
+        down = dict(theta)
+        up[param]   += steps[param]
+        down[param] -= steps[param]
+        fd  = (obs(up) - obs(down))/(2.*steps[param])
+        err = np.max(np.abs(fd - dmod[i]))/np.max(np.abs(fd))
+        if err > tol:
+            message = 'Gradient of the model with respect to {} disagrees with finite differences ({:.2e})'.format(param, err)
+            raise RuntimeError(message)
+
+    # simulate a spectrum and photometry and check the gradient of the log posterior
+    dl = 500.
+    rng = np.random.RandomState(1)
+    flux = mod/(4.*np.pi*dl**2.)
+    flux_err = np.full(len(wave), 0.01*flux.mean())
+    flux = flux + rng.normal(0., 1., len(wave))*flux_err
+    spec = np.rec.fromarrays((wave, flux, flux_err), names=str('wave,flux,flux_err'))
+
+    pbs = gaussian_passbands(model, (3600., 4500., 6200., 8000.), 300.)
+    _, full = model._get_full_obs_model(theta['teff'], theta['logg'], theta['av'], theta['fwhm'], wave,\
+            theta['shift'], theta['rvel'], rv=theta['rv'], pixel_scale=pixel_scale)
+    mags = WDmodel.passband.get_model_synmags(full, pbs)
+    mag_err = np.full(len(mags), 0.02)
+    phot = np.rec.fromarrays((mags.pb, mags.mag + rng.normal(0., 1., len(mags))*mag_err, mag_err),\
+            names=str('pb,mag,mag_err'))
+
+    values = dict(theta, dl=dl, fsig=0.5, tau=500., fw=0.5, mu=0., length=12.)
+    params = {}
+    for param in WDmodel.io._PARAMETER_NAMES:
+        value = values[param]
+        params[param] = {'value':value, 'fixed':param == 'length', 'scale':1., 'bounds':(value - abs(value) - 1., value + abs(value) + 1.)}
+    lnlike   = WDmodel.likelihood.setup_likelihood(params)
+    covmodel = WDmodel.covariance.WDmodel_CovModel(np.median(flux_err), 'Matern32')
+
+    for obsphot in (None, phot):
+        lnpost = WDmodel.likelihood.WDmodel_Posterior(spec, obsphot, model, covmodel, pbs, lnlike, pixel_scale=pixel_scale)
+        p0 = lnlike.get_parameter_vector()
+        value, grad = lnpost.value_and_grad(p0)
+        if abs(value - lnpost(p0)) > 1e-8*max(abs(value), 1.):
+            message = 'Log posterior with its gradient disagrees with the log posterior'
+            raise RuntimeError(message)
+        for i, param in enumerate(lnlike.get_parameter_names()):
+            step = 1e-6*max(abs(p0[i]), 1.)
+            up   = p0.copy()
+            down = p0.copy()
+            up[i]   += step
+            down[i] -= step
+            fd  = (lnpost.value_and_grad(up)[0] - lnpost.value_and_grad(down)[0])/(2.*step)
+            err = abs(fd - grad[i])/max(abs(fd), 1.)
+            if err > tol:
+                message = 'Gradient of the log posterior with respect to {} disagrees with finite differences ({:.2e})'.format(param, err)
+                if obsphot is not None:
+                    message += ' with photometry'
+                raise RuntimeError(message)
+    return
+
+
+def check_grid_bounds(model, wave, teff, logg, av, fwhm, ntest=10):
+    """
+    Checks that a model reading only the part of the grid within bounds keeps
+    the bracketing nodes and agrees with the full grid inside the bounds, and
+    that bounds of ``None`` read the full axis
+    """
+    wave = wave[(wave >= 4000.) & (wave <= 5500.)]
+    pixel_scale = 1./np.median(np.gradient(wave))
+    bounds = {'teff':(teff - 1500., teff + 1500.), 'logg':(logg - 0.1, logg + 0.1), 'wave':(3900., 5600.)}
+    sub = WDmodel.WDmodel.WDmodel(grid_file=model._grid_file, grid_name=model._grid_name,\
+            teffbounds=bounds['teff'], loggbounds=bounds['logg'], wavebounds=bounds['wave'])
+    for name, grid, subgrid in (('teff', model._tgrid, sub._tgrid), ('logg', model._ggrid, sub._ggrid),\
+            ('wave', model._wave, sub._wave)):
+        lo, hi = bounds[name]
+        start = np.searchsorted(grid, subgrid[0])
+        if not (np.array_equal(grid[start:start+len(subgrid)], subgrid) and subgrid[0] <= lo < subgrid[1]\
+                and subgrid[-2] < hi <= subgrid[-1]):
+            message = 'Grid read with {} bounds {} does not bracket them ({}, {})'.format(name, bounds[name],\
+                    subgrid[0], subgrid[-1])
+            raise RuntimeError(message)
+
+    rng = np.random.RandomState(1)
+    for _ in range(ntest):
+        thisteff = rng.uniform(*bounds['teff'])
+        thislogg = rng.uniform(*bounds['logg'])
+        shift = rng.uniform(-2., 2.)
+        rvel  = rng.uniform(-50., 50.)
+        ref = model._get_obs_model(thisteff, thislogg, av, fwhm, wave, shift, rvel, pixel_scale=pixel_scale)
+        out = sub._get_obs_model(thisteff, thislogg, av, fwhm, wave, shift, rvel, pixel_scale=pixel_scale)
+        if np.max(np.abs(out/ref - 1.)) > 1e-12:
+            message = 'Model read with bounds disagrees with the full grid at teff {}, logg {}'.format(thisteff, thislogg)
+            raise RuntimeError(message)
+
+    partial = WDmodel.WDmodel.WDmodel(grid_file=model._grid_file, grid_name=model._grid_name,\
+            teffbounds=(None, bounds['teff'][1]), loggbounds=None, wavebounds=(bounds['wave'][0], None))
+    if not (np.array_equal(partial._ggrid, model._ggrid) and partial._tgrid[0] == model._tgrid[0]\
+            and partial._wave[-1] == model._wave[-1]):
+        message = 'Bounds of None did not read the full grid axis'
+        raise RuntimeError(message)
+    return
+
+
+def check_convolver(model, wave, teff, logg, av, sigmas=(0.3, 1.2, 4.7, 15.3, 40.1)):
+    """
+    Checks the convolution backends against
+    :py:func:`scipy.ndimage.filters.gaussian_filter1d`, and the derivative of
+    each backend against finite differences of its own convolution
+    """
+    flux = model._get_red_model(teff, logg, av, wave)
+    depth = flux.max() - flux.min()
+    for backend in ('direct', 'fft', 'iir'):
+        conv = WDmodel.WDmodel.WDmodel_Convolver(backend=backend)
+        for gsig in sigmas:
+            ref = gaussian_filter1d(flux, gsig, mode='nearest', truncate=conv.truncate)
+            out = conv.convolve(flux, gsig)
+            if backend == 'iir':
+                # the recursive filter only approximates the Gaussian
+                err = np.max(np.abs(out - ref))/depth
+                tol = 0.01
+            else:
+                err = np.max(np.abs(out/ref - 1.))
+                tol = 1e-10
+            if err > tol:
+                message = 'Convolution backend {} with sigma {} disagrees with gaussian_filter1d ({:.2e})'.format(backend, gsig, err)
+                raise RuntimeError(message)
+
+            value, grad = conv.convolve_grad(flux, gsig)
+            step = 1e-5*gsig
+            fd = (conv.convolve(flux, gsig + step) - conv.convolve(flux, gsig - step))/(2.*step)
+            err = np.max(np.abs(fd - grad))/np.max(np.abs(fd))
+            if not np.array_equal(value, out) or err > 1e-4:
+                message = 'Gradient of convolution backend {} with sigma {} disagrees with finite differences ({:.2e})'.format(backend, gsig, err)
+                raise RuntimeError(message)
+    return
+
+
+def check_batch(model, wave, teff, logg, av, fwhm, nrow=6):
+    """
+    Checks the bound model and the batch model against the unbound model,
+    and the batch posterior against the posterior of each parameter vector,
+    including parameter vectors out of bounds or with zero prior
+    """
+    pixel_scale = 1./np.median(np.gradient(wave))
+    bmodel = model.bind(wave, pixel_scale=pixel_scale)
+    rng = np.random.RandomState(1)
+    p = {'teff':teff + rng.uniform(-2000., 2000., nrow), 'logg':logg + rng.uniform(-0.2, 0.2, nrow),\
+            'av':rng.uniform(0., 0.1, nrow), 'rv':rng.uniform(2.5, 3.8, nrow),\
+            'fwhm':rng.choice([fwhm, 2.*fwhm], nrow), 'shift':rng.uniform(-2., 2., nrow),\
+            'rvel':rng.uniform(-100., 100., nrow)}
+    # on the rv lattice, including the default
+    p['rv'][:2] = (3.1, 2.87)
+
+    def compare(value, expected, rtol, what):
+        err = np.max(np.abs(value/expected - 1.))
+        if err > rtol:
+            message = '{} disagrees with the unbound model ({:.2e})'.format(what, err)
+            raise RuntimeError(message)
+
+    args = [p[x] for x in ('teff', 'logg', 'av', 'fwhm')] + [wave, p['shift'], p['rvel']]
+    batch = model._get_obs_model_batch(*args, rv=p['rv'], pixel_scale=pixel_scale)
+    bbatch = bmodel._get_obs_model_batch(*args, rv=p['rv'])
+    fbatch, sbatch = model._get_full_obs_model_batch(*args, rv=p['rv'], pixel_scale=pixel_scale)
+    for i in range(nrow):
+        args = [p[x][i] for x in ('teff', 'logg', 'av', 'fwhm')] + [wave, p['shift'][i], p['rvel'][i]]
+        ref = model._get_obs_model(*args, rv=p['rv'][i], pixel_scale=pixel_scale)
+        fref, sref = model._get_full_obs_model(*args, rv=p['rv'][i], pixel_scale=pixel_scale)
+        compare(bmodel._get_obs_model(*args, rv=p['rv'][i]), ref, 1e-5, 'Bound model')
+        compare(batch[i], ref, 1e-5, 'Batch model')
+        compare(bbatch[i], ref, 1e-5, 'Bound batch model')
+        full, sed = bmodel._get_full_obs_model(*args, rv=p['rv'][i])
+        compare(full, fref, 1e-5, 'Bound model with the full SED')
+        compare(sed.flux, sref.flux, 2e-4, 'Bound full SED')
+        compare(fbatch[i], fref, 1e-5, 'Batch model with the full SED')
+        compare(sbatch.flux[i], sref.flux, 2e-4, 'Batch full SED')
+        if not (np.allclose(sed.wave, sref.wave, rtol=1e-12) and np.allclose(sbatch.wave[i], sref.wave, rtol=1e-12)):
+            message = 'Wavelengths of the full SED disagree with the unbound model'
+            raise RuntimeError(message)
+
+    # the extinction of rows of shifted wavelengths, and of the grid
+    # wavelengths from the rv lattice
+    owave = wave[np.newaxis, :]*(1. - p['rvel'][:, np.newaxis]*1000./_C.value) - p['shift'][:, np.newaxis]
+    for w, ext in ((owave, model._get_extinction_batch(owave, p['av'], p['rv'])),\
+            (wave, model._get_extinction_batch(wave, p['av'], p['rv'])),\
+            (np.tile(model._wave, (nrow, 1)), model._get_extinction_batch(model._wave, p['av'], p['rv']))):
+        w = np.broadcast_to(w, (nrow, w.shape[-1]))
+        ref = np.array([model.extinction(np.ascontiguousarray(x), y, z) for x, y, z in zip(w, p['av'], p['rv'])])
+        if np.max(np.abs(ext - ref)) > 1e-4*np.max(np.abs(ref)):
+            message = 'Batch extinction disagrees with the reddening law'
+            raise RuntimeError(message)
+
+    # rows with the same kernel width are convolved together
+    gsig = p['fwhm']/model._fwhm_to_sigma*pixel_scale
+    conv = model._convolve_batch(batch, gsig)
+    ref = np.array([model._convolver.convolve(x, y) for x, y in zip(batch, gsig)])
+    if np.max(np.abs(conv - ref)/ref) > 1e-12:
+        message = 'Batch convolution disagrees with the convolution of each row'
+        raise RuntimeError(message)
+
+    # simulate a spectrum and photometry, and evaluate the posterior of
+    # parameter vectors in bounds, out of bounds and with zero prior
+    mod, full = model._get_full_obs_model(teff, logg, av, fwhm, wave, 0., 0., pixel_scale=pixel_scale)
+    dl = 500.
+    flux = mod/(4.*np.pi*dl**2.)
+    flux_err = np.full(len(wave), 0.01*flux.mean())
+    flux = flux + rng.normal(0., 1., len(wave))*flux_err
+    spec = np.rec.fromarrays((wave, flux, flux_err), names=str('wave,flux,flux_err'))
+    pbs = gaussian_passbands(model, (3600., 4500., 6200., 8000.), 300.)
+    mags = WDmodel.passband.get_model_synmags(full, pbs)
+    mag_err = np.full(len(mags), 0.02)
+    phot = np.rec.fromarrays((mags.pb, mags.mag + rng.normal(0., 1., len(mags))*mag_err, mag_err),\
+            names=str('pb,mag,mag_err'))
+
+    values = {'teff':teff, 'logg':logg, 'av':av, 'rv':3.1, 'fwhm':fwhm, 'shift':0., 'rvel':0.,\
+            'dl':dl, 'fsig':0.5, 'tau':500., 'fw':0.5, 'mu':0., 'length':12.}
+    scales = {'teff':500., 'logg':0.05, 'av':0.02, 'rv':0.2, 'fwhm':0.5, 'shift':0.5, 'rvel':20.,\
+            'dl':5., 'fsig':0.1, 'tau':50., 'fw':0.1, 'mu':0.01, 'length':0.}
+    params = {}
+    for param in WDmodel.io._PARAMETER_NAMES:
+        value = values[param]
+        params[param] = {'value':value, 'fixed':param == 'length', 'scale':scales[param],\
+                'bounds':(value - abs(value) - 1., value + abs(value) + 1.)}
+    lnlike   = WDmodel.likelihood.setup_likelihood(params)
+    covmodel = WDmodel.covariance.WDmodel_CovModel(np.median(flux_err), 'Matern32')
+    names = list(lnlike.get_parameter_names())
+    p0  = lnlike.get_parameter_vector()
+    std = np.array([scales[param] for param in names])
+    thetas = p0 + std*rng.normal(0., 1., (nrow, len(p0)))
+    thetas[:, names.index('av')] = np.abs(thetas[:, names.index('av')])
+    thetas[1, names.index('logg')] = 2.*logg + 2.
+    thetas[3, names.index('fwhm')] = 0.05*fwhm
+
+    for obsphot in (None, phot):
+        lnpost = WDmodel.likelihood.WDmodel_Posterior(spec, obsphot, model, covmodel, pbs, lnlike, pixel_scale=pixel_scale)
+        for kwargs in ({}, {'prior':True}, {'likelihood':True}):
+            value = lnpost.batch(thetas, **kwargs)
+            ref = np.array([lnpost(theta, **kwargs) for theta in thetas])
+            if not (np.all(np.isneginf(value[[1, 3]])) and np.all(np.isneginf(ref[[1, 3]]))):
+                message = 'Batch posterior of parameters out of bounds or with zero prior is not -inf'
+                raise RuntimeError(message)
+            good = np.isfinite(ref)
+            if not np.array_equal(np.isfinite(value), good) or\
+                    np.max(np.abs(value[good] - ref[good])/np.maximum(np.abs(ref[good]), 1.)) > 1e-8:
+                message = 'Batch posterior {} disagrees with the posterior {}'.format(value, ref)
+                if obsphot is not None:
+                    message += ' with photometry'
+                raise RuntimeError(message)
+    return
+
+
+def check_pbprojection(model, wave, teff, logg, av, tol=1e-10):
+    """
+    Checks the synthetic magnitudes from the sparse passband projection, and
+    their derivatives, against the synthetic photometry of the full model,
+    including wavelength shifts and radial velocities
+    """
+    pbs = gaussian_passbands(model, (3600., 4500., 6200., 8000.), 300.)
+    pbproj = WDmodel.passband.get_pbprojection(pbs, model)
+    bmodel = model.bind(wave)
+    sed, dsed = bmodel._get_sed_grad(teff, logg, av, rv=3.1)
+
+    def get_synmags(flux, shift, rvel):
+        wout = model._wave*(1. + rvel*1000./_C.value) + shift
+        spec = np.rec.fromarrays((wout, flux), names=str('wave,flux'))
+        return WDmodel.passband.get_model_synmags(spec, pbs).mag
+
+    cases = ((0., 0.), (2.5, 0.), (0., -150.), (-1.5, 80.))
+    for shift, rvel in cases:
+        _, full = model._get_full_obs_model(teff, logg, av, 3., wave, shift, rvel)
+        ref = WDmodel.passband.get_model_synmags(full, pbs).mag
+        mags = WDmodel.passband.get_model_synmags_proj(full.flux, pbproj, shift=shift, rvel=rvel, mu=0.3)
+        if np.max(np.abs(mags - 0.3 - ref)) > tol:
+            message = 'Projected synthetic magnitudes disagree with the full model at shift {} rvel {}'.format(shift, rvel)
+            raise RuntimeError(message)
+
+        # the synthetic magnitudes are linear in the flux through the
+        # projection, so the derivatives are checked with the full model
+        mags, dmags = WDmodel.passband.get_model_synmags_proj_grad(sed, dsed, pbproj, shift=shift, rvel=rvel)
+        if np.max(np.abs(mags - get_synmags(sed, shift, rvel))) > tol:
+            message = 'Projected synthetic magnitudes with their gradient disagree with the full model'
+            raise RuntimeError(message)
+        fd = []
+        for d in dsed:
+            step = 1e-4*np.max(np.abs(sed))/np.max(np.abs(d))
+            fd.append((get_synmags(sed + step*d, shift, rvel) - get_synmags(sed - step*d, shift, rvel))/(2.*step))
+        fd.append((get_synmags(sed, shift + 1e-3, rvel) - get_synmags(sed, shift - 1e-3, rvel))/2e-3)
+        fd.append((get_synmags(sed, shift, rvel + 1e-1) - get_synmags(sed, shift, rvel - 1e-1))/2e-1)
+        fd = np.array(fd)
+        err = np.max(np.abs(fd - dmags)/np.maximum(np.max(np.abs(fd), axis=1), 1e-12)[:, np.newaxis])
+        if err > 1e-6:
+            message = 'Gradient of the projected synthetic magnitudes disagrees with the full model ({:.2e})'.format(err)
+            raise RuntimeError(message)
+
+    # all the rows of a batch at once
+    fluxes = np.array([model._get_full_obs_model(teff, logg, av, 3., wave, shift, rvel)[1].flux for shift, rvel in cases])
+    shift, rvel = np.array(cases).T
+    mags = WDmodel.passband.get_model_synmags_proj(fluxes, pbproj, shift=shift, rvel=rvel)
+    ref  = np.array([get_synmags(f, x, v) for f, x, v in zip(fluxes, shift, rvel)])
+    if mags.shape != ref.shape or np.max(np.abs(mags - ref)) > tol:
+        message = 'Projected synthetic magnitudes of a batch disagree with the full model'
+        raise RuntimeError(message)
+    return
+
+
+def check_synmag_table(model, wave, teff, logg, av, fwhm, tol=0.01):
+    """
+    Checks the synthetic magnitudes interpolated from a coarse table against
+    the synthetic photometry of the full SED, and that the posterior falls
+    back to the full SED outside the table
+    """
+    pbs = gaussian_passbands(model, (4500., 6200.), 300.)
+    table = WDmodel.passband.WDmodel_SynMagTable(*WDmodel.passband.make_synmag_table(model, pbs,\
+            (0., 0.05, 0.1), (3.1,)))
+    maxdiff = table.validate(model, pbs, ntest=20, seed=1)
+    if np.any(maxdiff > tol):
+        message = 'Synthetic magnitude table differs from the full SED by {} mag'.format(maxdiff)
+        raise RuntimeError(message)
+    _, full = model._get_full_obs_model(teff, logg, av, fwhm, wave, 1.5, 30.)
+    fullmags = WDmodel.passband.get_model_synmags(full, pbs)
+    tabmags = table.select(fullmags.pb).get_synmags(teff, logg, av, 3.1, shift=1.5, rvel=30.)
+    if np.any(np.abs(tabmags - fullmags.mag) > tol):
+        message = 'Synthetic magnitude table {} differs from the full SED {}'.format(tabmags, fullmags.mag)
+        raise RuntimeError(message)
+
+    pixel_scale = 1./np.median(np.gradient(wave))
+    rng = np.random.RandomState(1)
+    mod = model._get_obs_model(teff, logg, av, fwhm, wave, 0., 0., pixel_scale=pixel_scale)
+    dl = 500.
+    flux = mod/(4.*np.pi*dl**2.)
+    flux_err = np.full(len(wave), 0.01*flux.mean())
+    flux = flux + rng.normal(0., 1., len(wave))*flux_err
+    spec = np.rec.fromarrays((wave, flux, flux_err), names=str('wave,flux,flux_err'))
+    mag_err = np.full(len(fullmags), 0.02)
+    phot = np.rec.fromarrays((fullmags.pb, fullmags.mag + rng.normal(0., 1., len(fullmags))*mag_err, mag_err),\
+            names=str('pb,mag,mag_err'))
+
+    values = {'teff':teff, 'logg':logg, 'av':av, 'rv':3.1, 'fwhm':fwhm, 'shift':0., 'rvel':0.,\
+            'dl':dl, 'fsig':0.5, 'tau':500., 'fw':0.5, 'mu':0., 'length':12.}
+    params = {}
+    for param in WDmodel.io._PARAMETER_NAMES:
+        value = values[param]
+        params[param] = {'value':value, 'fixed':param == 'length', 'scale':1.,\
+                'bounds':(value - abs(value) - 1., value + abs(value) + 1.)}
+    lnlike   = WDmodel.likelihood.setup_likelihood(params)
+    covmodel = WDmodel.covariance.WDmodel_CovModel(np.median(flux_err), 'Matern32')
+    lnpost   = WDmodel.likelihood.WDmodel_Posterior(spec, phot, model, covmodel, pbs, lnlike,\
+            pixel_scale=pixel_scale)
+    tabpost  = WDmodel.likelihood.WDmodel_Posterior(spec, phot, model, covmodel, pbs, lnlike,\
+            pixel_scale=pixel_scale, synmag_table=table)
+    names = list(lnlike.get_parameter_names())
+    p0 = lnlike.get_parameter_vector()
+    if tabpost(p0) == lnpost(p0):
+        message = 'Synthetic magnitude table not used inside its coverage'
+        raise RuntimeError(message)
+    for param, value in (('av', 0.3), ('rv', 3.3)):
+        theta = p0.copy()
+        theta[names.index(param)] = value
+        if tabpost(theta) != lnpost(theta):
+            message = 'Posterior with {} = {} outside the table does not use the full SED'.format(param, value)
+            raise RuntimeError(message)
+    return
+
+
+def check_stage_cache(model, wave, teff, logg, av, fwhm, nwalkers=20, niter=30):
+    """
+    Checks that a short gibbs fit reuses the cached model stages of the
+    walkers that did not move
+    """
+    pixel_scale = 1./np.median(np.gradient(wave))
+    mod = model._get_obs_model(teff, logg, av, fwhm, wave, 0., 0., pixel_scale=pixel_scale)
+    dl = 500.
+    flux = mod/(4.*np.pi*dl**2.)
+    flux_err = np.full(len(wave), 0.01*flux.mean())
+    flux = flux + np.random.RandomState(1).normal(0., 1., len(wave))*flux_err
+    spec = np.rec.fromarrays((wave, flux, flux_err), names=str('wave,flux,flux_err'))
+
+    values = {'teff':teff, 'logg':logg, 'av':av, 'rv':3.1, 'fwhm':fwhm, 'shift':0., 'rvel':0.,\
+            'dl':dl, 'fsig':0.5, 'tau':500., 'fw':0.5, 'mu':0., 'length':12.}
+    scales = {'teff':10., 'logg':0.01, 'av':0.001, 'rv':0.01, 'fwhm':0.01, 'shift':0.01, 'rvel':0.1,\
+            'dl':1., 'fsig':0.01, 'tau':1., 'fw':0.01, 'mu':0.01, 'length':0.}
+    params = {}
+    for param in WDmodel.io._PARAMETER_NAMES:
+        value = values[param]
+        params[param] = {'value':value, 'fixed':param == 'length', 'scale':scales[param],\
+                'bounds':(value - 100.*scales[param], value + 100.*scales[param])}
+    lnlike   = WDmodel.likelihood.setup_likelihood(params)
+    covmodel = WDmodel.covariance.WDmodel_CovModel(np.median(flux_err), 'Matern32')
+    lnpost   = WDmodel.likelihood.WDmodel_Posterior(spec, None, model, covmodel, None, lnlike,\
+            pixel_scale=pixel_scale, cache_size=10*nwalkers)
+
+    p0  = lnlike.get_parameter_vector()
+    std = np.array([scales[param] for param in lnlike.get_parameter_names()])
+    np.random.seed(1)
+    pos = (p0 + std*np.random.normal(0., 1., (nwalkers, len(p0))))[np.newaxis]
+    lnprob0 = np.array([lnpost(x) for x in pos[0]])[np.newaxis]
+    sampler = WDmodel.mossampler.MOSSampler(1, nwalkers, len(p0), lnpost, lnpost,\
+            logpkwargs={'prior':True}, loglkwargs={'likelihood':True})
+    for _ in sampler.sample(pos, lnprob0=lnprob0, lnlike0=lnprob0, iterations=niter, gibbs=True):
+        pass
+
+    # on average, a third of the proposals keep the temperature and surface
+    # gravity, but all the proposals of a step thaw the same parameters
+    _, _, rate = lnpost.cache.stats()['interp']
+    if rate < 0.1:
+        message = 'Stage cache hit rate of the grid interpolation in a gibbs fit is only {:.1%}'.format(rate)
+        raise RuntimeError(message)
+    return
+
+
+def check_convolved_grid(model, wave, teff, logg, av, fwhm, tol=1e-3):
+    """
+    Checks the convolved grid against the exact convolution over a narrow
+    ``fwhm`` bracket, and that parameters it does not cover get the exact
+    model
+    """
+    pixel_scale = 1./np.median(np.gradient(wave))
+    bmodel = model.bind(wave, pixel_scale=pixel_scale)
+    maxerr = bmodel.set_convolved_grid((fwhm - 0.25, fwhm + 0.25), teffbounds=(teff - 2000., teff + 2000.),\
+            loggbounds=(logg - 0.2, logg + 0.2), tol=tol, seed=1)
+    if bmodel.convgrid is None or not maxerr <= tol:
+        message = 'Convolved grid max error {:g} exceeds tolerance {:g}'.format(maxerr, tol)
+        raise RuntimeError(message)
+
+    convgrid = bmodel.convgrid
+    grid  = bmodel._get_obs_model(teff, logg, av, fwhm, wave, 0., 0.)
+    exact = model._get_obs_model(teff, logg, av, fwhm, wave, 0., 0., pixel_scale=pixel_scale)
+    err = np.abs(grid/exact - 1.).max()
+    if err > tol:
+        message = 'Convolved grid differs from the exact convolution by {:g}'.format(err)
+        raise RuntimeError(message)
+
+    # a shift or velocity equal to the tabulated one up to rounding uses the grid
+    for shift, rvel in ((1e-12, 0.), (0., 1e-10)):
+        if not np.array_equal(bmodel._get_obs_model(teff, logg, av, fwhm, wave, shift, rvel), grid):
+            message = 'Convolved grid not used for shift {:g}, rvel {:g}'.format(shift, rvel)
+            raise RuntimeError(message)
+
+    cases = ((fwhm + 0.5, 0., 0.), (fwhm - 0.5, 0., 0.), (fwhm, 0.5, 0.), (fwhm, 0., 20.))
+    for thisfwhm, shift, rvel in cases:
+        bmodel.convgrid = convgrid
+        out = bmodel._get_obs_model(teff, logg, av, thisfwhm, wave, shift, rvel)
+        bmodel.convgrid = None
+        ref = bmodel._get_obs_model(teff, logg, av, thisfwhm, wave, shift, rvel)
+        if not np.array_equal(out, ref):
+            message = 'Convolved grid used outside its bounds for fwhm {:g}, shift {:g}, rvel {:g}'.format(\
+                    thisfwhm, shift, rvel)
+            raise RuntimeError(message)
+    return
+
+
+def check_planck(model, wave):
+    """
+    Checks the cached Planck function against the :py:mod:`astropy.units`
+    reference, including wavelength arrays that share their first, middle and
+    last elements
+    """
+    other = wave.copy()
+    other[1:len(wave)//2] += 0.5
+    for T in (3000., 15000., 55000.):
+        ref = model._plancklam_units(wave, T)
+        for B_lam in (model.plancklam(wave, T), model.plancklam(wave, T, cache=True), model.plancklam(wave, T, cache=True)):
+            if not np.allclose(B_lam, ref, rtol=1e-12, atol=0.):
+                message = 'Planck function at {} K disagrees with the astropy version'.format(T)
+                raise RuntimeError(message)
+        B_lam = model.plancklam(other, T, cache=True)
+        if not np.allclose(B_lam, model._plancklam_units(other, T), rtol=1e-12, atol=0.):
+            message = 'Cached Planck function at {} K returned for the wrong wavelengths'.format(T)
+            raise RuntimeError(message)
+    return
+
+
+def check_precision():
+    """
+    Checks that the float32 grid check on sampled cells agrees with the check
+    against the full float64 grid, and that a stored check is used instead
+    """
+    model = WDmodel.WDmodel.WDmodel(dtype='float32')
+    lflux = model._read_grid(model._grid_file, model._grid_name, dtype='float64')[5]
+    full   = model.validate_precision(ntest=100, seed=1, lflux=lflux)
+    sample = model.validate_precision(ntest=100, seed=1)
+    if sample['interp_dex'] != full['interp_dex'] or not (0. < sample['node_dex'] <= full['node_dex']):
+        message = 'Sampled grid precision check disagrees with the full check'
+        raise RuntimeError(message)
+
+    fd, fn = tempfile.mkstemp(suffix='.hdf5')
+    os.close(fd)
+    try:
+        WDmodel.io.write_compiled_grid(fn, model._wave, model._ggrid, model._tgrid, lflux,\
+                grid_name=model._grid_name, dtype='float32')
+        WDmodel.io.write_grid_precision(fn, model._grid_name, 'float32', full)
+        if WDmodel.io.read_grid_precision(fn, model._grid_name, 'float64') is not None:
+            message = 'Grid precision check stored for float32 returned for float64'
+            raise RuntimeError(message)
+        stored = WDmodel.WDmodel.WDmodel(grid_file=fn, grid_name=model._grid_name, dtype='float32')
+        if stored.validate_precision(seed=1) != full:
+            message = 'Stored grid precision check not used'
+            raise RuntimeError(message)
+    finally:
+        os.remove(fn)
+    return
+
+
+def check_emulator(model, tol=1e-3, ntest=20):
+    """
+    Checks the grid emulator against interpolating the grid at random points
+    off the grid nodes, and that an emulator written to file is read back
+    instead of being rebuilt
+    """
+    rng = np.random.RandomState(1)
+    teff = rng.uniform(model._tgrid[0], model._tgrid[-1], ntest)
+    logg = rng.uniform(model._ggrid[0], model._ggrid[-1], ntest)
+    ref = np.array([model._get_model(t, g, log=True) for t, g in zip(teff, logg)])
+
+    emu_dir = tempfile.mkdtemp()
+    fn = os.path.join(emu_dir, 'emulator.hdf5')
+    try:
+        emulated = WDmodel.WDmodel.WDmodel(grid_file=model._grid_file, grid_name=model._grid_name)
+        emulator = emulated.set_emulator(tol=tol, emulator_file=fn)
+        if not emulator.maxerr <= tol:
+            message = 'Emulator max error {:g} exceeds tolerance {:g}'.format(emulator.maxerr, tol)
+            raise RuntimeError(message)
+        single = np.array([emulated._get_model(t, g, log=True) for t, g in zip(teff, logg)])
+        batch  = emulator._get_grid_model_batch(teff, logg)
+        for name, out in (('_get_model', single), ('_get_grid_model_batch', batch)):
+            err = np.abs(out - ref).max()
+            if err > tol + 1e-10:
+                message = 'Emulator {} differs from the grid by {:g} dex'.format(name, err)
+                raise RuntimeError(message)
+
+        ingrid = WDmodel.io.read_grid_emulator(fn, model._grid_name)
+        saved  = (emulator._tgrid, emulator._ggrid, emulator._wave, emulator._mean, emulator._comps, emulator._weights)
+        if not all(np.array_equal(x, y) for x, y in zip(ingrid[:6], saved)):
+            message = 'Emulator read from file differs from the one written'
+            raise RuntimeError(message)
+
+        # without the grid, the emulator can only come from the file
+        reloaded = WDmodel.WDmodel.WDmodel(grid_file=model._grid_file, grid_name=model._grid_name)
+        reloaded._lflux = None
+        reloaded.set_emulator(tol=tol, emulator_file=fn)
+        if not np.array_equal(reloaded._get_model(teff[0], logg[0], log=True), single[0]):
+            message = 'Emulator reloaded from file differs from the one built'
+            raise RuntimeError(message)
+
+        # a stored emulator that does not meet the tolerance is rebuilt
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            try:
+                reloaded.set_emulator(tol=emulator.maxerr/2., emulator_file=fn)
+            except ValueError:
+                pass
+            else:
+                message = 'Emulator that does not meet the tolerance was not rebuilt'
+                raise RuntimeError(message)
+        if not any(issubclass(w.category, RuntimeWarning) for w in caught):
+            message = 'No warning when rebuilding an emulator that does not meet the tolerance'
+            raise RuntimeError(message)
+    finally:
+        shutil.rmtree(emu_dir)
+    return
+
+
+def check_shared_grid():
+    """
+    Checks that a shared grid without the completion marker, e.g. left by a
+    process that crashed while writing it, is recreated rather than attached
+    """
+    model = WDmodel.WDmodel.WDmodel()
+    lflux = np.array(model._lflux)
+    shared_dir = tempfile.mkdtemp()
+    try:
+        shared_grid = model._get_shared_grid_name(shared_dir)
+        np.save(shared_grid, np.zeros_like(lflux))
+        if model.share_grid(shared_dir) != shared_grid:
+            message = 'Shared grid written to the wrong file'
+            raise RuntimeError(message)
+        if not np.array_equal(model._lflux, lflux):
+            message = 'Incomplete shared grid attached'
+            raise RuntimeError(message)
+        if WDmodel.WDmodel._load_shared_grid(shared_grid, lflux.shape) is None:
+            message = 'Shared grid written without the completion marker'
+            raise RuntimeError(message)
+    finally:
+        shutil.rmtree(shared_dir)
+    return
+
+
+def check_predict_var():
+    """
+    Checks the variance-only prediction of the Gaussian process against the
+    diagonal of the full predictive covariance
+    """
+    rng = np.random.RandomState(1)
+    wave = np.sort(rng.uniform(3000., 9000., 400))
+    flux_err = rng.uniform(0.5, 1.5, len(wave))
+    res = rng.normal(0., 1., len(wave))*flux_err
+    for covtype in ('White', 'Matern32', 'SHO', 'Exp'):
+        covmodel = WDmodel.covariance.WDmodel_CovModel(np.median(flux_err), covtype)
+        _, cov = covmodel.predict(wave, res, flux_err, 2., 300., 0.5)
+        _, var = covmodel.predict(wave, res, flux_err, 2., 300., 0.5, var_only=True)
+        # the predictive variance is at most the white noise + flux uncertainty variance
+        d = flux_err**2. + covmodel.getgp(wave, flux_err, 2., 300., 0.5).kernel.jitter
+        err = np.max(np.abs(var - np.diag(cov))/d)
+        if err > 1e-8:
+            message = 'Variance of the {} prediction disagrees with the full covariance ({:.2e})'.format(covtype, err)
+            raise RuntimeError(message)
+    return
+
+
+class BoundedPosterior(object):
+    """
+    Simple posterior with bounds - an exponential distribution with unit scale
+    on ``[0, inf)`` and a uniform distribution on ``[0, 1]`` - that is
+    ``-inf`` outside the bounds like :py:class:`WDmodel.likelihood.WDmodel_Posterior`
+    """
+    bounds = [(0., None), (0., 1.)]
+
+    def value_and_grad(self, theta):
+        x, y = theta
+        if x < 0. or not (0. <= y <= 1.):
+            return -np.inf, np.zeros(2)
+        return -x, np.array([-1., 0.])
+
+
+def check_nuts(nchains=4, nburnin=300, nprod=1000):
+    """
+    Checks that the NUTS sampler recovers the moments of a posterior with
+    bounds, with hardly any divergent trajectories
+    """
+    lnpost = BoundedPosterior()
+    sampler = WDmodel.nuts.WDmodel_NUTSSampler(nchains, 2, lnpost, scale=[1., 0.1],\
+            bounds=lnpost.bounds, loc=[1., 0.5])
+    rstate = np.random.RandomState(1).get_state()
+    pos = np.column_stack((np.full(nchains, 1.), np.full(nchains, 0.5)))
+    for result in sampler.sample(pos, rstate0=rstate, iterations=nburnin, adapt=True):
+        pass
+    sampler.reset()
+    for result in sampler.sample(result[0], rstate0=result[2], iterations=nprod):
+        pass
+
+    samples = sampler.flatchain
+    if sampler.ndivergent > 0.01*nchains*nprod:
+        message = 'NUTS sampler had {} divergent trajectories'.format(sampler.ndivergent)
+        raise RuntimeError(message)
+    if samples.min(axis=0)[0] < 0. or samples.min(axis=0)[1] < 0. or samples.max(axis=0)[1] > 1.:
+        message = 'NUTS sampler stepped out of bounds'
+        raise RuntimeError(message)
+    if not np.allclose(sampler.lnprobability.ravel(), -samples[:,0]):
+        message = 'NUTS sampler did not store the log posterior of the parameters'
+        raise RuntimeError(message)
+
+    mean = samples.mean(axis=0)
+    var  = samples.var(axis=0)
+    for name, value, expected in zip(('mean', 'mean', 'variance', 'variance'),\
+            (mean[0], mean[1], var[0], var[1]), (1., 0.5, 1., 1./12.)):
+        if abs(value - expected) > 0.1*expected:
+            message = 'NUTS sampler {} {:.3f} disagrees with {:.3f}'.format(name, value, expected)
+            raise RuntimeError(message)
+    return
+
+
+def check_marginal(model, wave, teff, logg, av, fwhm, ndraw=2000, ngrid=801):
+    """
+    Checks the likelihood marginalized analytically over dl and mu against
+    numerical integrals over dl and mu, and the draws of dl and mu against
+    their conditional Gaussian posterior
+    """
+    wave = wave[(wave >= 4000.) & (wave <= 5000.)]
+    pixel_scale = 1./np.median(np.gradient(wave))
+    dl = 500.
+    rng = np.random.RandomState(1)
+    mod, full = model._get_full_obs_model(teff, logg, av, fwhm, wave, 0., 0., pixel_scale=pixel_scale)
+    flux = mod/(4.*np.pi*dl**2.)
+    flux_err = np.full(len(wave), 0.01*flux.mean())
+    flux = flux + rng.normal(0., 1., len(wave))*flux_err
+    spec = np.rec.fromarrays((wave, flux, flux_err), names=str('wave,flux,flux_err'))
+
+    pbs = gaussian_passbands(model, (3600., 4500., 6200., 8000.), 300.)
+    mags = WDmodel.passband.get_model_synmags(full, pbs)
+    mag_err = np.full(len(mags), 0.02)
+    phot = np.rec.fromarrays((mags.pb, mags.mag + 0.005 + rng.normal(0., 1., len(mags))*mag_err, mag_err),\
+            names=str('pb,mag,mag_err'))
+    covmodel = WDmodel.covariance.WDmodel_CovModel(np.median(flux_err), 'Matern32')
+
+    values = {'teff':teff, 'logg':logg, 'av':av, 'rv':3.1, 'fwhm':fwhm, 'shift':0., 'rvel':0.,\
+            'dl':dl, 'fsig':0.5, 'tau':500., 'fw':0.5, 'mu':0., 'length':12.}
+    lnposts = {}
+    for marginalize in ((), ('dl',), ('mu',), ('dl', 'mu')):
+        params = {}
+        for param in WDmodel.io._PARAMETER_NAMES:
+            value = values[param]
+            params[param] = {'value':value, 'fixed':param == 'length' or param in marginalize, 'scale':1.,\
+                    'bounds':(value - abs(value) - 1., value + abs(value) + 1.)}
+        lnlike = WDmodel.likelihood.setup_likelihood(params)
+        lnposts[marginalize] = WDmodel.likelihood.WDmodel_Posterior(spec, phot, model, covmodel, pbs, lnlike,\
+                pixel_scale=pixel_scale, cache_size=10, marginalize=marginalize)
+
+    # the conditional posterior of the amplitude s = (dl0/dl)**2 is Gaussian
+    # with mean b/a and variance 1/a, and that of mu is Gaussian because the
+    # prior on mu is much broader than the bounds
+    _, a, b = covmodel.lnlikelihood_linear(wave, flux, mod/(4.*np.pi*dl**2.), flux_err,\
+            values['fsig'], values['tau'], values['fw'])
+    smean, svar = b/a, 1./a
+    w = 1./mag_err**2.
+    muvar  = 1./(np.sum(w) + 1./10.**2.)
+    mumean = muvar*np.sum(w*(phot.mag - mags.mag))
+
+    # integrate the likelihood times the prior over grids of dl and mu,
+    # keeping the other parameters at their values
+    lnpost = lnposts[()]
+    names  = list(lnpost._lnlike.get_parameter_names())
+    p0     = lnpost._lnlike.get_parameter_vector()
+    slo = smean - 10.*np.sqrt(svar)
+    shi = smean + 10.*np.sqrt(svar)
+    grids = {'dl':np.linspace(dl/np.sqrt(shi), dl/np.sqrt(slo), ngrid),\
+            'mu':np.linspace(mumean - 10.*np.sqrt(muvar), mumean + 10.*np.sqrt(muvar), ngrid)}
+    priors = {'dl':WDmodel.likelihood._DL_PRIOR_SIGMA, 'mu':WDmodel.likelihood._MU_PRIOR_SIGMA}
+    lnmarg = {}
+    for param, grid in grids.items():
+        lnprob = np.empty(ngrid)
+        for i, value in enumerate(grid):
+            p = p0.copy()
+            p[names.index(param)] = value
+            lnprob[i] = lnpost.lnlike(p) + norm.logpdf(value, values[param], priors[param])
+        weights = np.full(ngrid, grid[1] - grid[0])
+        weights[[0, -1]] *= 0.5
+        lnmarg[param] = logsumexp(lnprob, b=weights)
+    lnmarg[('dl', 'mu')] = lnmarg['dl'] + lnmarg['mu'] - lnpost.lnlike(p0)
+
+    for marginalize, expected, tol in ((('dl',), lnmarg['dl'], 1e-3), (('mu',), lnmarg['mu'], 1e-6),\
+            (('dl', 'mu'), lnmarg[('dl', 'mu')], 1e-3)):
+        lnpost = lnposts[marginalize]
+        value = lnpost.lnlike(lnpost._lnlike.get_parameter_vector())
+        if abs(value - expected) > tol:
+            message = 'Likelihood marginalized over {} {:.6f} disagrees with the numerical integral {:.6f}'.format(\
+                    ', '.join(marginalize), value, expected)
+            raise RuntimeError(message)
+
+    lnpost = lnposts[('dl', 'mu')]
+    thetas = np.tile(lnpost._lnlike.get_parameter_vector(), (ndraw//10, 1))
+    random_state = np.random.RandomState(2)
+    draws = {'dl':[], 'mu':[]}
+    for _ in range(10):
+        for param, value in lnpost.sample_marginalized(thetas, random_state=random_state).items():
+            draws[param].append(value)
+    s  = (dl/np.concatenate(draws['dl']))**2.
+    mu = np.concatenate(draws['mu'])
+    for param, x, mean, var in (('dl', s, smean, svar), ('mu', mu, mumean, muvar)):
+        if abs(x.mean() - mean) > 5.*np.sqrt(var/len(x)) or abs(x.var()/var - 1.) > 5.*np.sqrt(2./len(x)):
+            message = 'Draws of {} disagree with the conditional posterior'.format(param)
+            raise RuntimeError(message)
+    return
+
+
+class GaussianPosterior(object):
+    """
+    Simple posterior with a batched version like
+    :py:class:`WDmodel.likelihood.WDmodel_Posterior` - a unit normal
+    distribution about ``loc``, that is ``-inf`` if the first parameter is
+    negative
+    """
+    def __init__(self, loc):
+        self.loc = np.asarray(loc)
+
+    def __call__(self, theta, prior=False, likelihood=False):
+        return self.batch([theta], prior=prior, likelihood=likelihood)[0]
+
+    def batch(self, thetas, prior=False, likelihood=False):
+        thetas = np.atleast_2d(thetas)
+        out = np.zeros(len(thetas))
+        if not prior:
+            out -= 0.5*np.sum((thetas - self.loc)**2., axis=1)
+        out[thetas[:,0] < 0.] = -np.inf
+        return out
+
+
+def check_pools(ntask=25, ndim=3):
+    """
+    Checks that the process pool and the MPI pool return the same results as
+    a serial map for the wrappers the samplers put around the posterior, and
+    that the process pool restarts its workers for a new posterior
+    """
+    tasks = np.random.RandomState(1).normal(0., 1., (ntask, ndim))
+    def get_functions(lnpost):
+        return (_function_wrapper(lnpost, [], {}),\
+                PTLikePrior(lnpost, lnpost, logpkwargs={'prior':True}, loglkwargs={'likelihood':True}))
+
+    def check_map(pool, lnpost, name):
+        for function in get_functions(lnpost):
+            results = np.array(pool.map(function, tasks), dtype='float64')
+            expected = np.array(list(map(function, tasks)), dtype='float64')
+            if results.shape != expected.shape or not np.allclose(results, expected, rtol=1e-12, atol=0.):
+                message = '{} map of {} disagrees with a serial map'.format(name, type(function).__name__)
+                raise RuntimeError(message)
+
+    pool = WDmodel.pool.WDmodel_ProcessPool(2)
+    try:
+        lnpost = GaussianPosterior(np.zeros(ndim))
+        check_map(pool, lnpost, 'Process pool')
+        workers = pool._pool
+        check_map(pool, lnpost, 'Process pool')
+        if pool._pool is not workers:
+            message = 'Process pool restarted its workers for the same posterior'
+            raise RuntimeError(message)
+
+        lnpost = GaussianPosterior(np.ones(ndim))
+        check_map(pool, lnpost, 'Process pool')
+        if pool._pool is workers or list(pool._shared.values()) != [lnpost]:
+            message = 'Process pool did not restart its workers for a new posterior'
+            raise RuntimeError(message)
+    finally:
+        pool.close()
+    if pool._pool is not None or pool._shared:
+        message = 'Process pool did not release its workers and the posterior'
+        raise RuntimeError(message)
+
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return
+    pool = WDmodel.pool.WDmodel_MPIPool(MPI.COMM_SELF)
+    check_map(pool, GaussianPosterior(np.zeros(ndim)), 'MPI pool')
+    check_map(pool, GaussianPosterior(np.ones(ndim)), 'MPI pool')
+    pool.close()
+    return
+
+
+def write_ar1_chain(chain, phis, nstep, ntemps=1, nwalkers=20, seed=1):
+    """
+    Writes AR(1) processes with coefficients ``phis`` - one per parameter,
+    with autocorrelation time ``(1+phi)/(1-phi)`` - as the position dataset of
+    a chain in the layout of :py:func:`WDmodel.fit.fit_model`
+    """
+    rng = np.random.RandomState(seed)
+    phis = np.asarray(phis)
+    nrow = ntemps*nwalkers
+    x = np.zeros((nstep, nrow, len(phis)))
+    x[0] = rng.normal(size=(nrow, len(phis)))
+    for j in range(1, nstep):
+        x[j] = phis*x[j-1] + np.sqrt(1. - phis**2.)*rng.normal(size=(nrow, len(phis)))
+    chain.create_dataset("position", data=x.reshape(-1, len(phis)), maxshape=(None, len(phis)))
+    chain.create_dataset("lnprob", data=np.zeros(nstep*nrow), maxshape=(None,))
+    return (1. + phis)/(1. - phis)
+
+
+def check_chain_autocorr():
+    """
+    Checks the autocorrelation time estimate of a saved chain against AR(1)
+    processes with known autocorrelation times, and the history of estimates
+    through resuming and trimming the chain
+    """
+    nwalkers = 20
+    fd, fn = tempfile.mkstemp(suffix='.hdf5')
+    os.close(fd)
+    try:
+        with h5py.File(fn, 'w') as outf:
+            chain = outf.create_group("chain")
+            expected = write_ar1_chain(chain, [0.9, 0.5], 20000, nwalkers=nwalkers)
+
+            tau = WDmodel.fit.get_autocorr_time(chain, 20000, 1, nwalkers, chunksize=3000)
+            if not np.allclose(tau, expected, rtol=0.1):
+                message = 'Autocorrelation time {} disagrees with AR(1) {}'.format(tau, expected)
+                raise RuntimeError(message)
+
+            # too short for a window of c autocorrelation times of at least a step
+            if WDmodel.fit.get_autocorr_time(chain, 5, 1, nwalkers) is not None:
+                message = 'Autocorrelation time estimated from a chain that is too short'
+                raise RuntimeError(message)
+            if WDmodel.fit.check_autocorr(chain, 5, 1, nwalkers):
+                message = 'Chain that is too short reported as converged'
+                raise RuntimeError(message)
+            if WDmodel.fit.check_autocorr(chain, 10000, 1, nwalkers, factor=50., tol=0.5):
+                message = 'Chain reported as converged without a previous estimate'
+                raise RuntimeError(message)
+
+        # the history of estimates is kept when the chain is resumed
+        with h5py.File(fn, 'a') as outf:
+            chain = outf["chain"]
+            if WDmodel.fit.check_autocorr(chain, 20000, 1, nwalkers, factor=5000., tol=0.5):
+                message = 'Chain shorter than factor autocorrelation times reported as converged'
+                raise RuntimeError(message)
+            if not WDmodel.fit.check_autocorr(chain, 20000, 1, nwalkers, factor=50., tol=0.01):
+                message = 'Chain with unchanged autocorrelation time not reported as converged'
+                raise RuntimeError(message)
+            steps = list(chain.attrs["autocorr_steps"])
+            taus  = chain.attrs["autocorr_tau"]
+            if steps != [5, 10000, 20000, 20000] or not np.all(np.isnan(taus[0])) or not chain.attrs["autocorr_converged"]:
+                message = 'Autocorrelation time history not kept ({})'.format(steps)
+                raise RuntimeError(message)
+
+            # trimming the chain drops the estimates that used the steps removed
+            WDmodel.fit.trim_chain(chain, 15000, 1, nwalkers)
+            if chain["position"].shape != (15000*nwalkers, 2) or chain["lnprob"].shape != (15000*nwalkers,)\
+                    or chain.attrs["laststep"] != 15000 or chain.attrs["nprod"] != 15000:
+                message = 'Chain not trimmed to 15000 steps'
+                raise RuntimeError(message)
+            if list(chain.attrs["autocorr_steps"]) != [5, 10000] or len(chain.attrs["autocorr_tau"]) != 2:
+                message = 'Autocorrelation time estimates beyond the trimmed chain kept'
+                raise RuntimeError(message)
+            WDmodel.fit.trim_chain(chain, 4, 1, nwalkers)
+            if "autocorr_steps" in chain.attrs or "autocorr_tau" in chain.attrs:
+                message = 'Autocorrelation time estimates beyond the trimmed chain kept'
+                raise RuntimeError(message)
+    finally:
+        os.remove(fn)
+    return
+
+
+def _derived_radius(model, dl, mu):
+    """
+    Relative radius from ``dl`` and ``mu``, registered by
+    :py:func:`check_derived`
+    """
+    return dl*10.**(-0.2*mu)
+
+
+def check_derived(model, nstep=50, nwalkers=4, chunksize=7):
+    """
+    Checks that derived parameters written to a chain file in chunks smaller
+    than the chain match evaluating them on the whole chain at once
+    """
+    WDmodel.derived.register_derived('radius', _derived_radius, ('dl', 'mu'), sptypes=())
+    fd, fn = tempfile.mkstemp(suffix='.hdf5')
+    os.close(fd)
+    try:
+        with h5py.File(fn, 'w') as outf:
+            chain = outf.create_group("chain")
+            write_ar1_chain(chain, [0.5, 0.9], nstep, nwalkers=nwalkers)
+            chain.create_dataset("names", data=np.array(['dl', 'teff']).astype(np.bytes_))
+            params = {'mu':{'value':0.3}}
+            names = WDmodel.derived.write_derived(chain, model, params, names=['radius'], chunksize=chunksize)
+            out = chain['derived']['radius'][()]
+            position = chain['position'][()]
+        ref = _derived_radius(model, position[:, 0], np.full(nstep*nwalkers, 0.3))
+        if names != ['radius'] or not np.array_equal(out, ref):
+            message = 'Derived parameter written in chunks disagrees with the whole chain'
+            raise RuntimeError(message)
+    finally:
+        del WDmodel.derived._DERIVED['radius']
+        os.remove(fn)
+    return
+
+
+def scheduled_task(task, pool):
+    """
+    Task for :py:func:`check_scheduler` - returns the task, or kills its
+    process without a result if the task is negative
+    """
+    if task < 0:
+        os._exit(1)
+    return task
+
+
+def scheduled_task_failed(task, error):
+    """
+    Result of a task of :py:func:`check_scheduler` whose process died
+    """
+    return 'failed {}'.format(task)
+
+
+def check_scheduler():
+    """
+    Checks the group sizes chosen by the scheduler, and that a task whose
+    process dies is recorded as failed rather than hanging the batch
+    """
+    # shares proportional to the remaining cost, capped by maxsizes and the
+    # free processes
+    sched = WDmodel.scheduler.WDmodel_Scheduler(8, [1., 4., 1., 2.], [8, 8, 1, 8])
+    groups = []
+    nfree = 8
+    while True:
+        index, size = sched.next_group(nfree)
+        if index is None:
+            break
+        groups.append((index, size))
+        nfree -= size
+    if groups != [(1, 4), (3, 2), (0, 1), (2, 1)]:
+        message = 'Scheduler chose groups {}'.format(groups)
+        raise RuntimeError(message)
+
+    sched = WDmodel.scheduler.WDmodel_Scheduler(8, [1.], [3])
+    if sched.next_group(8) != (0, 3):
+        message = 'Scheduler group size not capped by maxsize'
+        raise RuntimeError(message)
+
+    # groups grow as the objects that compete for processes finish
+    sched = WDmodel.scheduler.WDmodel_Scheduler(4, [1.]*6, [4]*6)
+    sizes = [sched.next_group(nfree)[1] for nfree in (4, 3, 2, 1)]
+    if sizes != [1, 1, 1, 1] or sched.next_group(0) != (None, 0):
+        message = 'Scheduler chose group sizes {} for the first objects'.format(sizes)
+        raise RuntimeError(message)
+    sched.finish(0)
+    if sched.next_group(1) != (4, 1):
+        message = 'Scheduler did not start the next object on the free process'
+        raise RuntimeError(message)
+    for index in (1, 2, 3):
+        sched.finish(index)
+    if sched.next_group(3) != (5, 2):
+        message = 'Scheduler group did not grow as objects finished'
+        raise RuntimeError(message)
+
+    results = WDmodel.scheduler.run_process_groups(scheduled_task, [3, -1, 2, 1], [1.]*4, [1]*4, 2,\
+            failed=scheduled_task_failed, timeout=0.1)
+    if results != [3, 'failed -1', 2, 1]:
+        message = 'Process groups returned {}'.format(results)
+        raise RuntimeError(message)
+    return
+
 
 def main():
     model = WDmodel.WDmodel.WDmodel()
@@ -45,6 +1106,44 @@ def main():
 
     model.extract_spectral_line(testspec.wave, testspec.flux, line=2)
 
+    check_gradient(model, WAVE, TEFF, LOGG, AV, FWHM)
+
+    check_grid_bounds(model, WAVE, TEFF, LOGG, AV, FWHM)
+
+    check_convolver(model, WAVE, TEFF, LOGG, AV)
+
+    check_batch(model, WAVE, TEFF, LOGG, AV, FWHM)
+
+    check_pbprojection(model, WAVE, TEFF, LOGG, AV)
+
+    check_synmag_table(model, WAVE, TEFF, LOGG, AV, FWHM)
+
+    check_stage_cache(model, WAVE, TEFF, LOGG, AV, FWHM)
+
+    check_convolved_grid(model, WAVE, TEFF, LOGG, AV, FWHM)
+
+    check_planck(model, WAVE)
+
+    check_precision()
+
+    check_emulator(model)
+
+    check_shared_grid()
+
+    check_predict_var()
+
+    check_nuts()
+
+    check_marginal(model, WAVE, TEFF, LOGG, AV, FWHM)
+
+    check_chain_autocorr()
+
+    check_derived(model)
+
+    check_pools()
+
+    check_scheduler()
+
     fn = 'out/test/test/test_mcmc.hdf5'
     WDmodel.io.read_mcmc(fn)
 